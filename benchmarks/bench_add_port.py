@@ -0,0 +1,110 @@
+# -*- coding: UTF-8 -*-
+"""
+Compare the cost of allocating a ``conn_port`` via ``Database.add_port`` against
+the old random-retry allocator, at 10%, 90% and 99% utilisation of the port range.
+
+Usage::
+
+    PGHOST=/var/run/postgresql python3 benchmarks/bench_add_port.py
+
+The ``ipam`` table of the scratch database (``VLAB_BENCH_DBNAME``, default
+``vlab_ipam_bench``) is dropped and recreated, so never point this at a real
+IPAM database.
+"""
+import os
+import time
+import random
+
+os.environ.setdefault('VLAB_PORT_MIN', '50000')
+os.environ.setdefault('VLAB_PORT_MAX', '51999')
+
+from vlab_ipam_api.lib import const, Database
+from vlab_ipam_api.lib.exceptions import DatabaseError
+
+DBNAME = os.environ.get('VLAB_BENCH_DBNAME', 'vlab_ipam_bench')
+ALLOCATIONS = int(os.environ.get('VLAB_BENCH_ALLOCATIONS', 200))
+UTILISATION = (0.10, 0.90, 0.99)
+SCHEMA = """DROP TABLE IF EXISTS ipam;
+            CREATE TABLE ipam(
+              conn_port INT PRIMARY KEY NOT NULL,
+              target_addr TEXT,
+              target_port INT,
+              target_name TEXT,
+              target_component TEXT,
+              routable  Boolean
+            );"""
+
+
+def legacy_add_port(db):
+    """The random-retry allocator that ``add_port`` used to implement.
+
+    :Returns: Tuple (conn_port or None, round trips)
+    """
+    sql = "INSERT INTO ipam (conn_port, target_addr, target_port, target_name, target_component) VALUES (%s, %s, %s, %s, %s);"
+    for attempt in range(1, const.VLAB_INSERT_MAX_TRIES + 1):
+        conn_port = random.randint(const.VLAB_PORT_MIN, const.VLAB_PORT_MAX)
+        try:
+            db.execute(sql, params=(conn_port, '1.2.3.4', 22, 'bench', 'bench'))
+        except DatabaseError as doh:
+            if doh.pgcode == '23505':
+                continue
+            raise
+        return conn_port, attempt
+    return None, const.VLAB_INSERT_MAX_TRIES
+
+
+def current_add_port(db):
+    """The gap-finding allocator in ``Database.add_port``
+
+    :Returns: Tuple (conn_port or None, round trips)
+    """
+    return db.add_port('1.2.3.4', 22, 'bench', 'bench'), 1
+
+
+def fill(db, utilisation):
+    """Claim a random ``utilisation`` fraction of the port range"""
+    db.execute('TRUNCATE ipam;')
+    ports = list(range(const.VLAB_PORT_MIN, const.VLAB_PORT_MAX + 1))
+    taken = random.sample(ports, int(len(ports) * utilisation))
+    db.execute("INSERT INTO ipam (conn_port, target_addr, target_port, target_name, target_component) \
+                SELECT unnest(%s), '1.2.3.4', 22, 'bench', 'bench';", params=(taken,))
+
+
+def run(db, allocator):
+    """Allocate (then release, to hold utilisation steady) ``ALLOCATIONS`` ports
+
+    :Returns: Tuple (seconds per allocation, mean round trips, failures)
+    """
+    trips = 0
+    failures = 0
+    start = time.perf_counter()
+    for _ in range(ALLOCATIONS):
+        conn_port, attempts = allocator(db)
+        trips += attempts
+        if conn_port is None:
+            failures += 1
+        else:
+            db.delete_port(conn_port)
+    elapsed = time.perf_counter() - start
+    return elapsed / ALLOCATIONS, trips / ALLOCATIONS, failures
+
+
+def main():
+    """Entry point"""
+    size = const.VLAB_PORT_MAX - const.VLAB_PORT_MIN + 1
+    print('Port range: {} ports, {} allocations per run\n'.format(size, ALLOCATIONS))
+    print('{:>6}  {:>10}  {:>12}  {:>11}  {:>8}'.format('util', 'allocator', 'usec/alloc', 'round trips', 'failures'))
+    with Database(dbname=DBNAME) as db:
+        db.execute(SCHEMA)
+        for utilisation in UTILISATION:
+            for label, allocator in (('random', legacy_add_port), ('gap-find', current_add_port)):
+                random.seed(utilisation)
+                fill(db, utilisation)
+                per_alloc, trips, failures = run(db, allocator)
+                print('{:>5.0f}%  {:>10}  {:>12.1f}  {:>11.2f}  {:>8}'.format(utilisation * 100, label,
+                                                                           per_alloc * 1e6, trips, failures))
+        db.execute('DROP TABLE ipam;')
+
+
+if __name__ == '__main__':
+    main()
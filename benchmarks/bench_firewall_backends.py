@@ -0,0 +1,174 @@
+# -*- coding: UTF-8 -*-
+"""
+Compare the iptables ``FireWall`` and the nftables ``NftFireWall`` backends, as
+the number of port mappings grows:
+
+* control plane - the time for ``map_port`` and ``find_rule`` + ``delete_rule``
+* data plane - new TCP connections per second through the DNAT of the last
+  mapping created (NAT rules only see the first packet of a connection)
+
+Three network namespaces are chained with veth pairs; the middle one runs the
+backend under test. Its interface toward the client is named ``ens160``, like
+the production server, so the rules apply unchanged::
+
+    vlab-src (10.200.1.2) <-> (10.200.1.1, ens160) vlab-fw (10.200.2.1) <-> (10.200.2.2) vlab-dst
+
+Usage (needs root, iproute2, iptables and nft)::
+
+    sudo python3 benchmarks/bench_firewall_backends.py
+
+The script re-runs itself within the namespaces for each part. The rules are
+never saved to disk, and the namespaces are removed afterwards.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import subprocess
+
+MAPPINGS = [int(x) for x in os.environ.get('VLAB_BENCH_MAPPINGS', '100,1000,5000').split(',')]
+SECONDS = float(os.environ.get('VLAB_BENCH_SECONDS', 5))
+SRC, FW, DST = 'vlab-src', 'vlab-fw', 'vlab-dst'
+FW_ADDR, DST_ADDR, DST_PORT = '10.200.1.1', '10.200.2.2', 8022
+FIRST_CONN_PORT = 20000
+
+
+def sh(cmd, netns=None):
+    """Run a command, optionally within a network namespace
+
+    :Returns: String - The stdout
+    """
+    if netns:
+        cmd = 'ip netns exec {} {}'.format(netns, cmd)
+    return subprocess.run(cmd.split(), stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+
+
+def setup():
+    """Create the namespaces, link them, and make ``vlab-fw`` a router"""
+    for ns in (SRC, FW, DST):
+        sh('ip netns add {}'.format(ns))
+    sh('ip link add veth-src type veth peer name ens160')
+    sh('ip link add veth-dst type veth peer name veth-fw')
+    sh('ip link set veth-src netns {}'.format(SRC))
+    sh('ip link set ens160 netns {}'.format(FW))
+    sh('ip link set veth-fw netns {}'.format(FW))
+    sh('ip link set veth-dst netns {}'.format(DST))
+    for ns, dev, addr in ((SRC, 'veth-src', '10.200.1.2/24'), (FW, 'ens160', '10.200.1.1/24'),
+                          (FW, 'veth-fw', '10.200.2.1/24'), (DST, 'veth-dst', '10.200.2.2/24')):
+        sh('ip addr add {} dev {}'.format(addr, dev), netns=ns)
+        sh('ip link set {} up'.format(dev), netns=ns)
+        sh('ip link set lo up', netns=ns)
+    sh('ip route add default via 10.200.1.1', netns=SRC)
+    sh('ip route add default via 10.200.2.1', netns=DST)
+    sh('sysctl -qw net.ipv4.ip_forward=1', netns=FW)
+
+
+def teardown():
+    """Remove the namespaces; the veths go with them"""
+    for ns in (SRC, FW, DST):
+        subprocess.call(['ip', 'netns', 'del', ns], stderr=subprocess.DEVNULL)
+
+
+def in_netns(netns, *args):
+    """Run this script, with the given args, within a network namespace
+
+    :Returns: subprocess.Popen
+    """
+    cmd = ['ip', 'netns', 'exec', netns, sys.executable, os.path.abspath(__file__)] + [str(x) for x in args]
+    return subprocess.Popen(cmd, stdout=subprocess.PIPE, universal_newlines=True)
+
+
+def reset_fw():
+    """Remove whatever the previous backend left behind in ``vlab-fw``"""
+    sh('iptables -t nat -F PREROUTING', netns=FW)
+    sh('iptables -F FORWARD', netns=FW)
+    subprocess.call(['ip', 'netns', 'exec', FW, 'nft', 'delete', 'table', 'ip', 'vlab_ipam'],
+                    stderr=subprocess.DEVNULL)
+
+
+def control_plane(backend, mappings):
+    """Runs within ``vlab-fw``. Maps ports to decoy targets, then one to the
+    real target, and times it all. Leaves every mapping in place.
+
+    :Returns: Dictionary
+    """
+    from vlab_ipam_api.lib.firewall import get_firewall
+
+    fw = get_firewall(backend, save_mode='sync')
+    fw.request_save = lambda: None # never touch the real rules files
+    fw.load_index()
+    start = time.perf_counter()
+    for n in range(mappings):
+        fw.map_port(FIRST_CONN_PORT + n, 22, '10.201.{}.{}'.format(n // 256, n % 256))
+    fw.map_port(FIRST_CONN_PORT + mappings, DST_PORT, DST_ADDR)
+    map_port = (time.perf_counter() - start) / (mappings + 1)
+    # Delete + re-create a mapping in the middle, like the DELETE view's lookups
+    victim = FIRST_CONN_PORT + mappings // 2
+    target = '10.201.{}.{}'.format((mappings // 2) // 256, (mappings // 2) % 256)
+    start = time.perf_counter()
+    with fw:
+        fw.delete_rule(fw.find_rule(22, target, table='nat', conn_port=victim), table='nat')
+        fw.delete_rule(fw.find_rule(22, target, table='filter', conn_port=victim), table='filter')
+    delete = time.perf_counter() - start
+    fw.map_port(victim, 22, target)
+    return {'map_port_ms': map_port * 1000, 'delete_ms': delete * 1000}
+
+
+def serve():
+    """Runs within ``vlab-dst``. Accept (and immediately close) connections until killed"""
+    server = socket.socket()
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((DST_ADDR, DST_PORT))
+    server.listen(1024)
+    print('ready', flush=True)
+    while True:
+        conn, _ = server.accept()
+        conn.close()
+
+
+def connect(conn_port):
+    """Runs within ``vlab-src``. Open connections through the DNAT for SECONDS
+
+    :Returns: Dictionary
+    """
+    count = 0
+    deadline = time.perf_counter() + SECONDS
+    while time.perf_counter() < deadline:
+        sock = socket.create_connection((FW_ADDR, conn_port), timeout=2)
+        # RST instead of FIN, so the client doesn't run out of ports to TIME_WAIT
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, b'\x01\x00\x00\x00\x00\x00\x00\x00')
+        sock.close()
+        count += 1
+    return {'conn_per_sec': count / SECONDS}
+
+
+def main():
+    teardown()
+    setup()
+    server = in_netns(DST, 'serve')
+    try:
+        server.stdout.readline()
+        print('{:>9} {:>9} {:>14} {:>12} {:>14}'.format('mappings', 'backend', 'map_port (ms)',
+                                                         'delete (ms)', 'new conn/sec'))
+        for mappings in MAPPINGS:
+            for backend in ('iptables', 'nftables'):
+                reset_fw()
+                result = json.loads(in_netns(FW, 'control', backend, mappings).communicate()[0])
+                result.update(json.loads(in_netns(SRC, 'connect', FIRST_CONN_PORT + mappings).communicate()[0]))
+                print('{:>9} {:>9} {:>14.2f} {:>12.2f} {:>14,.0f}'.format(mappings, backend, result['map_port_ms'],
+                                                                         result['delete_ms'], result['conn_per_sec']))
+    finally:
+        server.kill()
+        teardown()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 1:
+        main()
+    elif sys.argv[1] == 'serve':
+        serve()
+    elif sys.argv[1] == 'control':
+        print(json.dumps(control_plane(sys.argv[2], int(sys.argv[3]))))
+    elif sys.argv[1] == 'connect':
+        print(json.dumps(connect(int(sys.argv[2]))))
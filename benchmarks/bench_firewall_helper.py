@@ -0,0 +1,85 @@
+# -*- coding: UTF-8 -*-
+"""
+Compare the latency of running a firewall command via ``shell.run_cmd`` (a
+fork/exec of ``sudo`` from the API process) against sending it to the firewall
+helper daemon, which runs it as root already.
+
+Three paths are timed:
+
+* run_cmd - ``shell.run_cmd(VLAB_BENCH_CMD)``, like the API without the helper
+* helper - the helper runs the same command (without ``sudo``)
+* round trip - a stand-in helper that runs nothing, so only the socket is timed
+
+``VLAB_BENCH_CMD`` defaults to ``sudo iptables-save`` where both exist, else
+to ``true`` (so the sudo cost isn't part of the comparison). The helper runs
+in a thread of this process, on a socket in a temporary directory.
+
+Usage::
+
+    sudo python3 benchmarks/bench_firewall_helper.py
+"""
+import os
+import re
+import time
+import shutil
+import tempfile
+import threading
+from unittest.mock import MagicMock
+
+from vlab_ipam_api import firewall_helper
+from vlab_ipam_api.lib import shell
+from vlab_ipam_api.lib.helper_client import HelperClient, strip_sudo
+
+ROUNDS = int(os.environ.get('VLAB_BENCH_ROUNDS', 500))
+if shutil.which('sudo') and shutil.which('iptables-save'):
+    DEFAULT_CMD = 'sudo iptables-save'
+else:
+    DEFAULT_CMD = 'true'
+CMD = os.environ.get('VLAB_BENCH_CMD', DEFAULT_CMD)
+
+
+def stand_in(cmd, stdin=None):
+    """A runner that runs nothing"""
+    return {'stdout' : '', 'stderr' : '', 'exit_code' : 0}
+
+
+def measure(func):
+    """Call ``func`` ROUNDS times
+
+    :Returns: Tuple (median, 99th percentile) in milliseconds
+    """
+    func() # warm up, i.e. connect
+    times = []
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return times[len(times) // 2] * 1000, times[int(len(times) * 0.99)] * 1000
+
+
+def main():
+    # The benchmark command might not be one the helper normally allows
+    firewall_helper.ALLOWED.append(re.compile(re.escape(strip_sudo(CMD))))
+    with tempfile.TemporaryDirectory() as tmp:
+        servers = {}
+        for name, runner in (('helper', firewall_helper.execute), ('stand-in', stand_in)):
+            path = os.path.join(tmp, '{}.sock'.format(name))
+            servers[name] = (firewall_helper.FirewallHelper(path, MagicMock(), runner=runner), path)
+            threading.Thread(target=servers[name][0].serve_forever, daemon=True).start()
+        helper = HelperClient(servers['helper'][1])
+        stand_in_helper = HelperClient(servers['stand-in'][1])
+        print('{!r}, {} rounds'.format(CMD, ROUNDS))
+        print('{:<12} {:>12} {:>12}'.format('path', 'median ms', 'p99 ms'))
+        for label, func in (('run_cmd', lambda: shell.run_cmd(CMD)),
+                            ('helper', lambda: helper.run_cmd(CMD)),
+                            ('round trip', lambda: stand_in_helper.run_cmd(CMD))):
+            median, p99 = measure(func)
+            print('{:<12} {:>12.3f} {:>12.3f}'.format(label, median, p99))
+        for server, _ in servers.values():
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == '__main__':
+    main()
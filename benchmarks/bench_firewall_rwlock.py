@@ -0,0 +1,99 @@
+# -*- coding: UTF-8 -*-
+"""
+Compare the throughput of ``FireWall`` under a mixed read/write load, when
+``show`` holds the lock for reading (RWLock) versus exclusively (like the
+RLock it replaced).
+
+The iptables commands are replaced by sleeps of a typical duration, so this
+runs anywhere, and measures only the locking.
+
+Usage::
+
+    python3 benchmarks/bench_firewall_rwlock.py
+"""
+import os
+import time
+import threading
+from unittest.mock import patch
+
+from vlab_ipam_api.lib import firewall
+from vlab_ipam_api.lib.locks import RWLock
+from vlab_ipam_api.lib.shell import CliResult
+
+SECONDS = float(os.environ.get('VLAB_BENCH_SECONDS', 3))
+READ_MS = float(os.environ.get('VLAB_BENCH_READ_MS', 20)) # iptables-save
+WRITE_MS = float(os.environ.get('VLAB_BENCH_WRITE_MS', 30)) # iptables-restore
+MIXES = ((8, 0), (8, 1), (8, 2), (16, 2)) # (reader threads, writer threads)
+
+
+class ExclusiveLock(RWLock):
+    """Every read is a write; how the old RLock behaved"""
+    def acquire_read(self):
+        self.acquire_write()
+
+    def release_read(self):
+        self.release_write()
+
+
+def fake_run_cmd(cli_syntax, stdin=None):
+    """Stand-in for ``shell.run_cmd`` that takes about as long as iptables"""
+    if cli_syntax.startswith('sudo iptables-save'):
+        time.sleep(READ_MS / 1000.0)
+    else:
+        time.sleep(WRITE_MS / 1000.0)
+    return CliResult(cli_syntax, '', '', 0)
+
+
+def run(lock_class, readers, writers):
+    """Hammer one FireWall with reader and writer threads for SECONDS
+
+    :Returns: Tuple (reads/sec, writes/sec, worst read latency in ms)
+    """
+    fw = firewall.FireWall(save_mode='sync')
+    fw._lock = lock_class()
+    fw._index = {table: firewall.RuleIndex([]) for table in firewall.CHAINS}
+    fw.request_save = lambda: None
+    counts = {'reads': 0, 'writes': 0, 'worst': 0.0}
+    counts_lock = threading.Lock()
+    deadline = time.perf_counter() + SECONDS
+
+    def reader():
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            fw.show(table='nat')
+            took = time.perf_counter() - start
+            with counts_lock:
+                counts['reads'] += 1
+                counts['worst'] = max(counts['worst'], took)
+
+    def writer(offset):
+        port = 50000 + offset * 100000
+        while time.perf_counter() < deadline:
+            fw.map_port(port, 22, '10.0.0.1')
+            port += 1
+            with counts_lock:
+                counts['writes'] += 1
+
+    threads = [threading.Thread(target=reader) for _ in range(readers)]
+    threads += [threading.Thread(target=writer, args=(n,)) for n in range(writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return counts['reads'] / SECONDS, counts['writes'] / SECONDS, counts['worst'] * 1000
+
+
+def main():
+    print('iptables-save {} ms, iptables-restore {} ms, {} s per run'.format(READ_MS, WRITE_MS, SECONDS))
+    print('{:>8} {:>8} {:>10} {:>10} {:>10} {:>14}'.format('readers', 'writers', 'lock', 'reads/s',
+                                                           'writes/s', 'worst read ms'))
+    with patch.object(firewall, 'run_cmd', fake_run_cmd):
+        for readers, writers in MIXES:
+            for name, lock_class in (('exclusive', ExclusiveLock), ('rwlock', RWLock)):
+                reads, writes, worst = run(lock_class, readers, writers)
+                print('{:>8} {:>8} {:>10} {:>10.0f} {:>10.1f} {:>14.1f}'.format(readers, writers, name,
+                                                                               reads, writes, worst))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+# -*- coding: UTF-8 -*-
+"""
+Compare the forwarding throughput of the 'rules' and 'ipset' FORWARD modes, as
+the number of port mappings grows.
+
+Three network namespaces are chained with veth pairs, and the middle one routes
+between the other two::
+
+    vlab-src (10.200.1.2) <-> (10.200.1.1) vlab-fw (10.200.2.1) <-> (10.200.2.2) vlab-dst
+
+For every mapping count, the FORWARD chain of ``vlab-fw`` (policy DROP) gets
+either that many non-matching ACCEPT rules ahead of the one that matches the
+traffic ('rules' mode), or that many non-matching set members plus one
+``--match-set`` rule ('ipset' mode). ``iperf3`` then blasts small UDP datagrams
+through it, and the packets per second that reach ``vlab-dst`` are reported.
+
+Usage (needs root, iproute2, iptables, ipset and iperf3)::
+
+    sudo python3 benchmarks/bench_forward_ipset.py
+
+Only the namespaces above are touched; they're removed afterwards.
+"""
+import os
+import json
+import subprocess
+
+MAPPINGS = [int(x) for x in os.environ.get('VLAB_BENCH_MAPPINGS', '0,100,1000,5000').split(',')]
+SECONDS = int(os.environ.get('VLAB_BENCH_SECONDS', 5))
+SET_NAME = 'vlab-bench-forward'
+SRC, FW, DST = 'vlab-src', 'vlab-fw', 'vlab-dst'
+DST_ADDR = '10.200.2.2'
+IPERF_PORT = 5201
+
+
+def sh(cmd, stdin=None, netns=None):
+    """Run a command, optionally within a network namespace
+
+    :Returns: String - The stdout
+    """
+    if netns:
+        cmd = 'ip netns exec {} {}'.format(netns, cmd)
+    result = subprocess.run(cmd.split(), input=stdin, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    return result.stdout
+
+
+def setup():
+    """Create the namespaces, link them, and make ``vlab-fw`` a router"""
+    for ns in (SRC, FW, DST):
+        sh('ip netns add {}'.format(ns))
+    sh('ip link add veth-src type veth peer name veth-fw-a')
+    sh('ip link add veth-dst type veth peer name veth-fw-b')
+    sh('ip link set veth-src netns {}'.format(SRC))
+    sh('ip link set veth-fw-a netns {}'.format(FW))
+    sh('ip link set veth-fw-b netns {}'.format(FW))
+    sh('ip link set veth-dst netns {}'.format(DST))
+    for ns, dev, addr in ((SRC, 'veth-src', '10.200.1.2/24'), (FW, 'veth-fw-a', '10.200.1.1/24'),
+                          (FW, 'veth-fw-b', '10.200.2.1/24'), (DST, 'veth-dst', '10.200.2.2/24')):
+        sh('ip addr add {} dev {}'.format(addr, dev), netns=ns)
+        sh('ip link set {} up'.format(dev), netns=ns)
+        sh('ip link set lo up', netns=ns)
+    sh('ip route add default via 10.200.1.1', netns=SRC)
+    sh('ip route add default via 10.200.2.1', netns=DST)
+    sh('sysctl -qw net.ipv4.ip_forward=1', netns=FW)
+
+
+def teardown():
+    """Remove the namespaces; the veths go with them"""
+    for ns in (SRC, FW, DST):
+        subprocess.call(['ip', 'netns', 'del', ns], stderr=subprocess.DEVNULL)
+
+
+def decoy(n):
+    """A non-matching target, like the other port mappings on a busy server
+
+    :Returns: Tuple (address, port)
+    """
+    return '10.{}.{}.{}'.format(100 + n // 65536, (n // 256) % 256, n % 256), 22
+
+
+def load_rules(mode, mappings):
+    """Replace the FORWARD chain of ``vlab-fw`` for the given mode"""
+    sh('iptables -F FORWARD', netns=FW)
+    sh('iptables -P FORWARD DROP', netns=FW)
+    subprocess.call(['ip', 'netns', 'exec', FW, 'ipset', 'destroy', SET_NAME], stderr=subprocess.DEVNULL)
+    # Replies (only iperf3's control connection needs them) always take the slow path
+    accept = ['-p udp -d {} --dport {} -j ACCEPT'.format(DST_ADDR, IPERF_PORT),
+              '-p tcp -d {} --dport {} -j ACCEPT'.format(DST_ADDR, IPERF_PORT)]
+    if mode == 'rules':
+        rules = ['-p tcp -d {} --dport {} -j ACCEPT'.format(*decoy(n)) for n in range(mappings)] + accept
+    else:
+        members = ['add {} {},tcp:{}'.format(SET_NAME, *decoy(n)) for n in range(mappings)]
+        members += ['add {} {},udp:{}'.format(SET_NAME, DST_ADDR, IPERF_PORT),
+                    'add {} {},tcp:{}'.format(SET_NAME, DST_ADDR, IPERF_PORT)]
+        sh('ipset create {} hash:ip,port maxelem {}'.format(SET_NAME, max(65536, mappings * 2)), netns=FW)
+        sh('ipset restore -exist', stdin='\n'.join(members) + '\n', netns=FW)
+        rules = ['-m set --match-set {} dst,dst -j ACCEPT'.format(SET_NAME)]
+    rules.append('-s {} -j ACCEPT'.format(DST_ADDR))
+    batch = '*filter\n' + ''.join('-A FORWARD {}\n'.format(r) for r in rules) + 'COMMIT\n'
+    sh('iptables-restore --noflush', stdin=batch, netns=FW)
+
+
+def measure():
+    """Send 64 byte UDP datagrams as fast as possible from ``vlab-src`` to ``vlab-dst``
+
+    :Returns: Float - Packets per second received
+    """
+    server = subprocess.Popen(['ip', 'netns', 'exec', DST, 'iperf3', '-s', '-1', '-p', str(IPERF_PORT)],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        out = None
+        for _ in range(20):
+            try:
+                out = sh('iperf3 -c {} -p {} -u -b 0 -l 64 -t {} -J'.format(DST_ADDR, IPERF_PORT, SECONDS), netns=SRC)
+                break
+            except subprocess.CalledProcessError:
+                # the server isn't listening yet
+                continue
+        if out is None:
+            raise RuntimeError('Unable to run iperf3')
+        stats = json.loads(out)['end']['sum']
+        return (stats['packets'] - stats['lost_packets']) / stats['seconds']
+    finally:
+        server.kill()
+        server.wait()
+
+
+def main():
+    teardown()
+    setup()
+    try:
+        print('{:>9} {:>14} {:>14}'.format('mappings', 'rules (pps)', 'ipset (pps)'))
+        for mappings in MAPPINGS:
+            row = []
+            for mode in ('rules', 'ipset'):
+                load_rules(mode, mappings)
+                row.append(measure())
+            print('{:>9} {:>14,.0f} {:>14,.0f}'.format(mappings, *row))
+    finally:
+        teardown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+# -*- coding: UTF-8 -*-
+"""
+Compare how long a sweep of vlab-worker takes with the 'ping' prober (THREAD_COUNT
+threads that each run ``/bin/ping``) and the 'icmp' prober (one thread that
+shares an ICMP socket between up to VLAB_WORKER_MAX_IN_FLIGHT probes).
+
+The targets are ``VLAB_BENCH_ALIVE`` addresses that reply, and ``VLAB_BENCH_DEAD``
+that never do, so every probe of them waits the full timeout. By default they're
+in a network namespace, behind a veth pair: the replying addresses are routed
+via the far end, and the others are on the link, but fail ARP, like a powered
+off VM. (Thousands of targets on the link would overflow the kernel's neighbour
+table, see ``net.ipv4.neigh.default.gc_thresh3``, and some probes would be
+dropped; a gateway with that many VMs on ens192 needs the same tuning.) With
+``VLAB_BENCH_TARGETS=loopback`` the replying addresses are 127.x (no namespace
+needed), and the others are routed nowhere (a blackhole route).
+
+Without ``/bin/ping`` (or with ``VLAB_BENCH_PING=0``), the 'ping' prober is
+approximated by the ICMP engine limited to THREAD_COUNT probes in flight; the
+same concurrency, without the cost of a process per probe.
+
+Usage::
+
+    sudo python3 benchmarks/bench_icmp_prober.py
+
+Needs root (or CAP_NET_RAW and CAP_NET_ADMIN) for the namespace and raw socket.
+The namespace, veth pair and routes are removed afterwards.
+"""
+import os
+import time
+import shutil
+import asyncio
+import ipaddress
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from vlab_ipam_api import worker
+from vlab_ipam_api.lib.icmp import IcmpProber
+
+ALIVE = int(os.environ.get('VLAB_BENCH_ALIVE', 2000))
+DEAD = int(os.environ.get('VLAB_BENCH_DEAD', 100))
+TARGETS = os.environ.get('VLAB_BENCH_TARGETS', 'netns')
+MAX_IN_FLIGHT = int(os.environ.get('VLAB_BENCH_MAX_IN_FLIGHT', 1000))
+USE_PING = os.environ.get('VLAB_BENCH_PING', '1') == '1' and os.path.exists('/bin/ping')
+NETNS = 'vlab-bench-icmp'
+VETH = 'vbench0'
+NETWORK = ipaddress.ip_network('10.254.0.0/16')
+ROUTED = ipaddress.ip_network('10.252.0.0/16')
+BLACKHOLE = ipaddress.ip_network('10.253.0.0/16')
+# Like worker.PING_SYNTAX, but via whatever interface routes to the target
+PING_SYNTAX = '/bin/ping -W 2 -c 3 -4 {}'
+
+
+def ip(*args, netns=False, stdin=None):
+    """Run an ``ip`` command, i.e. ``ip -n NETNS link ...``"""
+    cmd = ['ip'] + (['-n', NETNS] if netns else []) + list(args)
+    subprocess.run(cmd, input=stdin, check=True, universal_newlines=True, stdout=subprocess.DEVNULL)
+
+
+def setup(kind):
+    """Create the targets
+
+    :Returns: Tuple (alive, dead) - Lists of addresses
+    """
+    if kind == 'netns':
+        ip('netns', 'add', NETNS)
+        ip('link', 'add', VETH, 'type', 'veth', 'peer', 'name', 'eth0', 'netns', NETNS)
+        ip('addr', 'add', '10.254.0.1/16', 'dev', VETH)
+        ip('link', 'set', VETH, 'up')
+        alive = [str(x) for x, _ in zip(ROUTED.hosts(), range(ALIVE))]
+        lines = ['link set lo up', 'link set eth0 up', 'addr add 10.254.0.2/16 dev eth0']
+        lines += ['addr add {}/32 dev lo'.format(x) for x in alive]
+        ip('-batch', '-', netns=True, stdin='\n'.join(lines) + '\n')
+        ip('route', 'add', str(ROUTED), 'via', '10.254.0.2')
+        dead = [str(NETWORK.network_address + 3 + n) for n in range(DEAD)]
+    else:
+        alive = [str(ipaddress.ip_address('127.1.0.0') + n) for n in range(1, ALIVE + 1)]
+        ip('route', 'add', 'blackhole', str(BLACKHOLE))
+        dead = [str(BLACKHOLE.network_address + n) for n in range(1, DEAD + 1)]
+    return alive, dead
+
+
+def teardown(kind):
+    """Remove the targets"""
+    if kind == 'netns':
+        subprocess.run(['ip', 'route', 'del', str(ROUTED)], stderr=subprocess.DEVNULL)
+        subprocess.run(['ip', 'link', 'del', VETH], stderr=subprocess.DEVNULL)
+        subprocess.run(['ip', 'netns', 'del', NETNS], stderr=subprocess.DEVNULL)
+    else:
+        subprocess.run(['ip', 'route', 'del', 'blackhole', str(BLACKHOLE)], stderr=subprocess.DEVNULL)
+
+
+def sweep_icmp(addrs, max_in_flight):
+    """Probe every address with the ICMP engine
+
+    :Returns: Tuple (results, prober stats)
+    """
+    loop = asyncio.new_event_loop()
+    prober = IcmpProber()
+    prober.open(loop)
+    try:
+        results = loop.run_until_complete(prober.probe_many(addrs, max_in_flight=max_in_flight))
+    finally:
+        prober.close()
+        loop.close()
+    return results, prober.stats
+
+
+def sweep_ping(addrs):
+    """Probe every address like the 'ping' prober; THREAD_COUNT at a time
+
+    :Returns: Tuple (results, stats)
+    """
+    def pingable(addr):
+        return subprocess.run(PING_SYNTAX.format(addr).split(), stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL).returncode == 0
+    with ThreadPoolExecutor(worker.THREAD_COUNT) as pool:
+        results = dict(zip(addrs, pool.map(pingable, addrs)))
+    return results, {'processes' : len(addrs)}
+
+
+def measure(label, func, alive, dead):
+    """Time one sweep, and check what it found"""
+    cpu, start = time.process_time(), time.perf_counter()
+    results, stats = func(alive + dead)
+    elapsed, cpu = time.perf_counter() - start, time.process_time() - cpu
+    wrong = sum(1 for x in alive if not results[x]) + sum(1 for x in dead if results[x])
+    print('{:<24} {:>10.2f} {:>12.0f} {:>10.2f} {:>8}  {}'.format(label, elapsed, len(results) / elapsed, cpu, wrong,
+                                                          ', '.join('{}: {}'.format(k, v) for k, v in stats.items())))
+
+
+def main():
+    kind = TARGETS if shutil.which('ip') else 'loopback'
+    teardown(kind) # from an interrupted run
+    alive, dead = setup(kind)
+    try:
+        defaults = IcmpProber()
+        wait = (defaults.count - 1) * defaults.interval + defaults.timeout
+        print('{} targets: {} alive, {} dead (a dead probe waits {}s)\n'.format(kind, len(alive), len(dead), wait))
+        print('{:<24} {:>10} {:>12} {:>10} {:>8}'.format('prober', 'sweep s', 'probes/s', 'cpu s', 'wrong'))
+        if USE_PING:
+            measure('ping ({} threads)'.format(worker.THREAD_COUNT), sweep_ping, alive, dead)
+        else:
+            measure('icmp, {} in flight'.format(worker.THREAD_COUNT),
+                    lambda addrs: sweep_icmp(addrs, worker.THREAD_COUNT), alive, dead)
+        measure('icmp, {} in flight'.format(MAX_IN_FLIGHT),
+                lambda addrs: sweep_icmp(addrs, MAX_IN_FLIGHT), alive, dead)
+    finally:
+        teardown(kind)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+# -*- coding: UTF-8 -*-
+"""
+Measure lookup latency on a 100k row ``ipam`` table before and after the
+schema migrations that add the lookup indexes.
+
+Usage::
+
+    PGHOST=/var/run/postgresql python3 benchmarks/bench_lookup_indexes.py
+
+The ``ipam`` and ``schema_version`` tables of the scratch database
+(``VLAB_BENCH_DBNAME``, default ``vlab_ipam_bench``) are dropped and recreated,
+so never point this at a real IPAM database.
+"""
+import os
+import time
+
+from vlab_ipam_api.lib import Database
+from vlab_ipam_api.lib.migrations import migrate, MIGRATIONS
+
+DBNAME = os.environ.get('VLAB_BENCH_DBNAME', 'vlab_ipam_bench')
+ROWS = int(os.environ.get('VLAB_BENCH_ROWS', 100000))
+REPEAT = int(os.environ.get('VLAB_BENCH_REPEAT', 50))
+WORKER_UPDATE = "UPDATE ipam SET routable=true WHERE target_name = (%s) AND target_addr = (%s);"
+
+
+def populate(db):
+    """Create the ``ipam`` table with ``ROWS`` records and no indexes"""
+    db.execute('DROP TABLE IF EXISTS ipam, schema_version;')
+    create_table = [m for m in MIGRATIONS if m[0] == 1][0][2]
+    db.execute(create_table)
+    db.execute("""INSERT INTO ipam (conn_port, target_addr, target_port, target_name, target_component, routable)
+                  SELECT n, '10.' || (n / 65536) || '.' || (n / 256 %% 256) || '.' || (n %% 256), 22,
+                         'vm-' || n, 'component-' || (n %% 500), true
+                  FROM generate_series(1, %s) AS n;""", params=(ROWS,))
+    db.execute('ANALYZE ipam;')
+
+
+def timed(func):
+    """Run ``func`` ``REPEAT`` times
+
+    :Returns: Float - mean milliseconds per call
+    """
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        func()
+    return (time.perf_counter() - start) * 1000 / REPEAT
+
+
+def run(db):
+    """Time each lookup shape the API and worker issue
+
+    :Returns: List of (label, milliseconds)
+    """
+    middle = ROWS // 2
+    addr = '10.{}.{}.{}'.format(middle // 65536, middle // 256 % 256, middle % 256)
+    name = 'vm-{}'.format(middle)
+    return [
+        ('lookup_addr(addr=...)', timed(lambda: db.lookup_addr(name=None, addr=addr, component=None))),
+        ('lookup_addr(name=...)', timed(lambda: db.lookup_addr(name=name, addr=None, component=None))),
+        ('lookup_addr(component=...)', timed(lambda: db.lookup_addr(name=None, addr=None, component='component-7'))),
+        ('lookup_addr(page)', timed(lambda: db.lookup_addr(name=None, addr=None, component=None,
+                                                           limit=100, after=name))),
+        ('lookup_port(name=...)', timed(lambda: db.lookup_port(name=name))),
+        ('lookup_port(addr=...)', timed(lambda: db.lookup_port(addr=addr))),
+        ('worker UPDATE', timed(lambda: db.execute(WORKER_UPDATE, params=(name, addr)))),
+    ]
+
+
+def main():
+    """Entry point"""
+    with Database(dbname=DBNAME) as db:
+        populate(db)
+        before = run(db)
+        migrate(db)
+        after = run(db)
+        db.execute('DROP TABLE ipam, schema_version;')
+    print('{} rows, mean of {} calls\n'.format(ROWS, REPEAT))
+    print('{:<28}  {:>12}  {:>12}'.format('query', 'before (ms)', 'after (ms)'))
+    for (label, slow), (_, fast) in zip(before, after):
+        print('{:<28}  {:>12.3f}  {:>12.3f}'.format(label, slow, fast))
+
+
+if __name__ == '__main__':
+    main()
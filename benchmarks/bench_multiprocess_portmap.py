@@ -0,0 +1,243 @@
+# -*- coding: UTF-8 -*-
+"""
+Stress the port map API from several processes at once, like uWSGI workers,
+then check the database and the firewall still agree.
+
+Every process has its own Flask app and ``FireWall`` object, and makes random
+POST and DELETE requests (half of the DELETEs pick a port any process might
+have mapped). The iptables commands are simulated by one rules file that all
+the processes share, with a typical latency, so this runs without root. The
+database is real.
+
+The run is repeated with the ``FireWall`` lock file disabled (i.e. only the
+in-process lock), to show the drift the cross-process lock prevents: a process
+with a stale copy of the rules can't find (so refuses to delete) a port
+mapping another process made. A failed DELETE is counted as "port still
+mapped" if the port is in the database afterwards; a few are expected even with
+the lock, when two processes delete the same port and a POST claims it again
+before the check.
+
+Usage::
+
+    PGHOST=/var/run/postgresql python3 benchmarks/bench_multiprocess_portmap.py
+
+The ``ipam`` table of the scratch database (``VLAB_BENCH_DBNAME``, default
+``vlab_ipam_bench``) is dropped and recreated, so never point this at a real
+IPAM database.
+"""
+import os
+import time
+import fcntl
+import logging
+import re
+import random
+import tempfile
+import functools
+import multiprocessing
+from unittest.mock import patch
+
+os.environ.setdefault('VLAB_PORT_MIN', '50000')
+os.environ.setdefault('VLAB_PORT_MAX', '51999')
+
+import ujson
+from flask import Flask
+from vlab_api_common.http_auth import generate_v2_test_token
+
+from vlab_ipam_api.lib import const, firewall, Database
+from vlab_ipam_api.lib.shell import CliResult
+from vlab_ipam_api.lib.exceptions import CliError
+from vlab_ipam_api.lib.migrations import migrate
+from vlab_ipam_api.lib.views import portmap
+
+DBNAME = os.environ.get('VLAB_BENCH_DBNAME', 'vlab_ipam_bench')
+PROCESSES = int(os.environ.get('VLAB_BENCH_PROCESSES', 4))
+REQUESTS = int(os.environ.get('VLAB_BENCH_REQUESTS', 200)) # per process
+LATENCY_MS = float(os.environ.get('VLAB_BENCH_LATENCY_MS', 2)) # per iptables command
+TARGETS = ['10.9.0.{}'.format(n) for n in range(1, 9)] # few, so port mappings share targets
+
+
+class FakeIptables(object):
+    """Stand-in for ``shell.run_cmd``. The PREROUTING and FORWARD rules live in
+    a file, and every command locks it, so each ``iptables-restore`` is atomic
+    across processes, like the kernel.
+
+    :param path: The file that holds the rules
+    :type path: String
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def _load(self, fd):
+        text = os.pread(fd, 1 << 24, 0).decode()
+        return ujson.loads(text) if text else {'nat': [], 'filter': []}
+
+    def __call__(self, cli_syntax, stdin=None):
+        time.sleep(LATENCY_MS / 1000.0)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            rules = self._load(fd)
+            if cli_syntax == 'sudo iptables-save':
+                return CliResult(cli_syntax, render(rules), '', 0)
+            elif cli_syntax.startswith('sudo iptables-restore'):
+                self._restore(rules, stdin)
+                data = ujson.dumps(rules).encode()
+                os.pwrite(fd, data, 0)
+                os.ftruncate(fd, len(data))
+            return CliResult(cli_syntax, '', '', 0)
+        finally:
+            os.close(fd)
+
+    def _restore(self, rules, stdin):
+        """Apply the ``-A``/``-D`` lines of each table; all or nothing, like a COMMIT"""
+        table = None
+        changed = {name: list(specs) for name, specs in rules.items()}
+        for line in stdin.splitlines():
+            if line.startswith('*'):
+                table = line[1:]
+            elif line.startswith(('-A ', '-D ')):
+                spec = canonical(line.split(' ', 2)[2])
+                if line.startswith('-A '):
+                    changed[table].append(spec)
+                elif spec in changed[table]:
+                    changed[table].remove(spec)
+                else:
+                    raise CliError('iptables-restore', '', 'Bad rule (does a matching rule exist in that chain?)', 1)
+        rules.update(changed)
+
+
+def canonical(spec):
+    """A rule specification as ``iptables-save`` outputs it
+
+    :Returns: String
+    """
+    spec = spec.replace('-p tcp --dport', '-p tcp -m tcp --dport').replace(' --to ', ' --to-destination ')
+    return re.sub(r'-d ([0-9.]+) ', r'-d \1/32 ', spec)
+
+
+def render(rules):
+    """The ``iptables-save`` output of the simulated rules
+
+    :Returns: String
+    """
+    lines = ['*nat', ':PREROUTING ACCEPT [0:0]']
+    lines += ['-A PREROUTING {}'.format(spec) for spec in rules['nat']]
+    lines += ['COMMIT', '*filter', ':FORWARD ACCEPT [0:0]']
+    lines += ['-A FORWARD {}'.format(spec) for spec in rules['filter']]
+    lines += ['COMMIT']
+    return '\n'.join(lines) + '\n'
+
+
+def worker(seed, lock_file, results):
+    """Runs in each process. Make random POST and DELETE requests.
+
+    :Returns: None
+    """
+    random.seed(seed)
+    logging.disable(logging.CRITICAL) # the 404s and 500s are counted instead
+    app = Flask(__name__)
+    portmap.PortMapView.register(app)
+    app.firewall = firewall.FireWall(save_mode='debounce', save_delay=50, lock_file=lock_file)
+    app.firewall.load_index()
+    client = app.test_client()
+    headers = {'X-Auth': generate_v2_test_token(username=const.VLAB_IPAM_OWNER)}
+    mine = []
+    statuses = {}
+    start = time.perf_counter()
+    for _ in range(REQUESTS):
+        if mine and random.random() < 0.45:
+            # Any process's port, half the time; some are already gone (404)
+            if random.random() < 0.5:
+                conn_port = mine.pop(random.randrange(len(mine)))
+            else:
+                conn_port = random.randint(const.VLAB_PORT_MIN, const.VLAB_PORT_MIN + REQUESTS)
+            resp = client.delete('/api/1/ipam/portmap', headers=headers, json={'conn_port': conn_port})
+            kind = 'DELETE'
+        else:
+            body = {'target_addr': random.choice(TARGETS), 'target_port': 22,
+                    'target_name': 'bench', 'target_component': 'bench'}
+            resp = client.post('/api/1/ipam/portmap', headers=headers, json=body)
+            if resp.status_code == 200:
+                mine.append(resp.json['content']['conn_port'])
+            kind = 'POST'
+        key = '{} {}'.format(kind, resp.status_code)
+        if kind == 'DELETE' and resp.status_code != 200:
+            with Database(dbname=DBNAME) as db:
+                exists = db.port_info(conn_port)[0] is not None
+            # Deleting a port that doesn't exist fails too; failing to delete one that does is drift
+            key += ' (port still mapped)' if exists else ' (no such port)'
+        statuses[key] = statuses.get(key, 0) + 1
+    elapsed = time.perf_counter() - start
+    app.firewall.flush()
+    results.put({'statuses': statuses, 'elapsed': elapsed})
+
+
+def check(state_file):
+    """Compare the database with the simulated firewall
+
+    :Returns: Dictionary
+    """
+    with Database(dbname=DBNAME) as db:
+        rows = set(tuple(x) for x in db.execute('SELECT conn_port, target_addr, target_port FROM ipam;'))
+    with open(state_file) as the_file:
+        snapshot = firewall.RuleSnapshot(render(ujson.loads(the_file.read() or '{"nat": [], "filter": []}')))
+    nat = [(key[2], key[0], key[1]) for key, _ in snapshot.entries('nat') if key]
+    forward = [(key[2], key[0], key[1]) for key, _ in snapshot.entries('filter') if key]
+    return {'rows': len(rows),
+            'db only': len(rows - set(nat)),
+            'nat only': len(set(nat) - rows),
+            'forward missing': len(rows - set(forward)),
+            'duplicates': (len(nat) - len(set(nat))) + (len(forward) - len(set(forward)))}
+
+
+def run(lock_file, tmp):
+    """Reset the database and firewall, then run PROCESSES workers
+
+    :Returns: Tuple (requests/sec, status counts, consistency check)
+    """
+    state_file = os.path.join(tmp, 'iptables.json')
+    if os.path.exists(state_file):
+        os.remove(state_file)
+    with Database(dbname=DBNAME) as db:
+        db.execute('DROP TABLE IF EXISTS ipam; DROP TABLE IF EXISTS schema_version;')
+        migrate(db)
+    results = multiprocessing.Queue()
+    with patch.object(firewall, 'run_cmd', FakeIptables(state_file)), \
+         patch.object(firewall, 'RULES_FILE', os.path.join(tmp, 'rules.v4')), \
+         patch.object(portmap, 'Database', functools.partial(Database, dbname=DBNAME)):
+        procs = [multiprocessing.Process(target=worker, args=(n, lock_file, results)) for n in range(PROCESSES)]
+        for proc in procs:
+            proc.start()
+        outcomes = [results.get() for _ in procs]
+        for proc in procs:
+            proc.join()
+    statuses = {}
+    for outcome in outcomes:
+        for key, count in outcome['statuses'].items():
+            statuses[key] = statuses.get(key, 0) + count
+    rate = PROCESSES * REQUESTS / max(x['elapsed'] for x in outcomes)
+    return rate, statuses, check(state_file)
+
+
+def main():
+    multiprocessing.set_start_method('fork')
+    print('{} processes x {} requests, {} ms per iptables command\n'.format(PROCESSES, REQUESTS, LATENCY_MS))
+    with tempfile.TemporaryDirectory() as tmp:
+        for label, lock_file in (('flock', os.path.join(tmp, 'fw.lock')), ('none', '')):
+            rate, statuses, result = run(lock_file, tmp)
+            print('cross-process lock: {}'.format(label))
+            print('  requests/sec: {:.0f}'.format(rate))
+            print('  responses:    {}'.format(', '.join('{}: {}'.format(k, v) for k, v in sorted(statuses.items()))))
+            print('  consistency:  {}'.format(', '.join('{}: {}'.format(k, v) for k, v in result.items())))
+            if label == 'flock':
+                with open(os.path.join(tmp, 'rules.v4')) as the_file:
+                    saved = the_file.read()
+                with open(os.path.join(tmp, 'iptables.json')) as the_file:
+                    print('  rules file:   {}'.format('latest' if saved == render(ujson.loads(the_file.read()))
+                                                      else 'STALE'))
+        with Database(dbname=DBNAME) as db:
+            db.execute('DROP TABLE IF EXISTS ipam; DROP TABLE IF EXISTS schema_version;')
+
+
+if __name__ == '__main__':
+    main()
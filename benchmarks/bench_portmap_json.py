@@ -0,0 +1,88 @@
+# -*- coding: UTF-8 -*-
+"""
+Compare the two ways of building the GET /api/1/ipam/portmap response body for
+10k port mappings:
+
+* ``lookup_port`` + ``ujson.dumps`` (rows decoded into Python, then re-encoded)
+* ``lookup_port_json`` + ``splice_json`` (Postgres builds the JSON document)
+
+Usage::
+
+    PGHOST=/var/run/postgresql python3 benchmarks/bench_portmap_json.py
+
+The ``ipam`` table of the scratch database (``VLAB_BENCH_DBNAME``, default
+``vlab_ipam_bench``) is dropped and recreated, so never point this at a real
+IPAM database.
+"""
+import os
+import time
+
+import ujson
+
+from vlab_ipam_api.lib import Database
+from vlab_ipam_api.lib.migrations import MIGRATIONS
+from vlab_ipam_api.lib.views.streaming import splice_json
+
+DBNAME = os.environ.get('VLAB_BENCH_DBNAME', 'vlab_ipam_bench')
+MAPPINGS = int(os.environ.get('VLAB_BENCH_MAPPINGS', 10000))
+REPEAT = int(os.environ.get('VLAB_BENCH_REPEAT', 50))
+
+
+def populate(db):
+    """Create the ``ipam`` table with ``MAPPINGS`` records"""
+    db.execute('DROP TABLE IF EXISTS ipam;')
+    create_table = [m for m in MIGRATIONS if m[0] == 1][0][2]
+    db.execute(create_table)
+    db.execute("""INSERT INTO ipam (conn_port, target_addr, target_port, target_name, target_component, routable)
+                  SELECT 50000 + n, '192.168.' || (n / 256) || '.' || (n %% 256), 22,
+                         'vm-' || n, 'OneFS', true
+                  FROM generate_series(1, %s) AS n;""", params=(MAPPINGS,))
+
+
+def python_path(db):
+    """How the view used to build the body"""
+    resp_data = {'user' : 'bob', 'content' : {}}
+    resp_data['content']['ports'] = db.lookup_port()
+    resp_data['content']['gateway_ip'] = '10.1.1.1'
+    return ujson.dumps(resp_data)
+
+
+def database_path(db):
+    """How the view builds the body now"""
+    resp_data = {'user' : 'bob', 'content' : {}}
+    ports, _ = db.lookup_port_json()
+    resp_data['content']['gateway_ip'] = '10.1.1.1'
+    content = splice_json(resp_data.pop('content'), 'ports', ports)
+    return splice_json(resp_data, 'content', content)
+
+
+def timed(func, db):
+    """Run ``func`` ``REPEAT`` times, and measure wall clock and process CPU time
+
+    :Returns: Tuple (wall ms per call, CPU ms per call, body size)
+    """
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    for _ in range(REPEAT):
+        body = func(db)
+    wall = (time.perf_counter() - wall) * 1000 / REPEAT
+    cpu = (time.process_time() - cpu) * 1000 / REPEAT
+    return wall, cpu, len(body)
+
+
+def main():
+    """Entry point"""
+    with Database(dbname=DBNAME) as db:
+        populate(db)
+        assert ujson.loads(python_path(db)) == ujson.loads(database_path(db))
+        results = [('lookup_port + ujson', timed(python_path, db)),
+                   ('lookup_port_json + splice', timed(database_path, db))]
+        db.execute('DROP TABLE ipam;')
+    print('{} mappings, mean of {} calls\n'.format(MAPPINGS, REPEAT))
+    print('{:<26}  {:>9}  {:>12}  {:>10}'.format('path', 'wall (ms)', 'API CPU (ms)', 'body bytes'))
+    for label, (wall, cpu, size) in results:
+        print('{:<26}  {:>9.2f}  {:>12.2f}  {:>10}'.format(label, wall, cpu, size))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+# -*- coding: UTF-8 -*-
+"""
+Measure the per-call saving of prepared statements for the hot ``Database``
+queries, on a 100k row (indexed) ``ipam`` table.
+
+Every query is run twice: once as plain SQL that Postgres parses and plans on
+each call, and once via ``execute_prepared``.
+
+Usage::
+
+    PGHOST=/var/run/postgresql python3 benchmarks/bench_prepared.py
+
+The ``ipam`` and ``schema_version`` tables of the scratch database
+(``VLAB_BENCH_DBNAME``, default ``vlab_ipam_bench``) are dropped and recreated,
+so never point this at a real IPAM database.
+"""
+import os
+import time
+
+from vlab_ipam_api.lib import Database
+from vlab_ipam_api.lib.migrations import migrate
+from vlab_ipam_api.worker import UPDATE_ROUTABLE
+
+DBNAME = os.environ.get('VLAB_BENCH_DBNAME', 'vlab_ipam_bench')
+ROWS = int(os.environ.get('VLAB_BENCH_ROWS', 100000))
+REPEAT = int(os.environ.get('VLAB_BENCH_REPEAT', 2000))
+BATCH = 500 # probe results per worker UPDATE
+
+
+def populate(db):
+    """Create the ``ipam`` table, with its indexes, and ``ROWS`` records"""
+    db.execute('DROP TABLE IF EXISTS ipam, schema_version;')
+    migrate(db)
+    db.execute("""INSERT INTO ipam (conn_port, target_addr, target_port, target_name, target_component, routable)
+                  SELECT n, '10.' || (n / 65536) || '.' || (n / 256 %% 256) || '.' || (n %% 256), 22,
+                         'vm-' || n, 'component-' || (n %% 500), true
+                  FROM generate_series(1, %s) AS n;""", params=(ROWS,))
+    db.execute('ANALYZE ipam;')
+
+
+def timed(func, repeat=REPEAT):
+    """Run ``func`` ``repeat`` times
+
+    :Returns: Float - mean microseconds per call
+    """
+    func() # the prepared path pays its PREPARE here, once
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) * 1000000 / repeat
+
+
+def run(db):
+    """Time each hot query the API and worker issue
+
+    :Returns: List of (label, microseconds)
+    """
+    middle = ROWS // 2
+    addr = '10.{}.{}.{}'.format(middle // 65536, middle // 256 % 256, middle % 256)
+    name = 'vm-{}'.format(middle)
+    owners = ['vm-{}'.format(n) for n in range(1, BATCH + 1)]
+    addrs = ['10.{}.{}.{}'.format(n // 65536, n // 256 % 256, n % 256) for n in range(1, BATCH + 1)]
+    states = [True] * BATCH
+    return [
+        ('port_info', timed(lambda: db.port_info(middle))),
+        ('delete_port (no match)', timed(lambda: db.delete_port(ROWS + 1))),
+        ('lookup_port(name=...)', timed(lambda: db.lookup_port(name=name))),
+        ('lookup_port(addr=, component=)', timed(lambda: db.lookup_port(addr=addr, component='component-7'))),
+        ('lookup_port_json(limit=100)', timed(lambda: db.lookup_port_json(limit=100, after=middle))),
+        ('worker UPDATE ({} results)'.format(BATCH),
+         timed(lambda: db.execute_prepared(UPDATE_ROUTABLE, params=(owners, addrs, states)), REPEAT // 10)),
+    ]
+
+
+def main():
+    """Entry point"""
+    with Database(dbname=DBNAME) as db:
+        populate(db)
+        # The baseline; same SQL, but parsed and planned on every call
+        db.execute_prepared = db.execute
+        plain = run(db)
+        del db.execute_prepared
+        prepared = run(db)
+        db.execute('DROP TABLE ipam, schema_version;')
+    print('{} rows, mean of {} calls\n'.format(ROWS, REPEAT))
+    print('{:<32}  {:>10}  {:>13}  {:>7}'.format('query', 'plain (us)', 'prepared (us)', 'saving'))
+    for (label, slow), (_, fast) in zip(plain, prepared):
+        print('{:<32}  {:>10.1f}  {:>13.1f}  {:>6.0f}%'.format(label, slow, fast, (slow - fast) * 100 / slow))
+
+
+if __name__ == '__main__':
+    main()
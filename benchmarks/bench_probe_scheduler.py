@@ -0,0 +1,96 @@
+# -*- coding: UTF-8 -*-
+"""
+Simulate a day of vlab-worker probes, to compare a sweep every LOOP_INTERVAL
+against the adaptive ``ProbeScheduler``: how many probes each sends, and how
+long it takes to notice an address changed state.
+
+``VLAB_BENCH_RECORDS`` addresses are simulated. Most are stable, but every hour
+``VLAB_BENCH_CHANGE_PCT`` percent change state (a VM powered on or off), and
+``VLAB_BENCH_FLAPPING_PCT`` percent flip every few minutes. Nothing is pinged;
+a probe just reads the simulated state, so this runs in a second or two.
+
+Usage::
+
+    python3 benchmarks/bench_probe_scheduler.py
+"""
+import os
+import heapq
+import random
+
+from vlab_ipam_api import worker
+
+RECORDS = int(os.environ.get('VLAB_BENCH_RECORDS', 2000))
+HOURS = int(os.environ.get('VLAB_BENCH_HOURS', 24))
+CHANGE_PCT = float(os.environ.get('VLAB_BENCH_CHANGE_PCT', 2))
+FLAPPING_PCT = float(os.environ.get('VLAB_BENCH_FLAPPING_PCT', 1))
+FLAP_PERIOD = 240 # seconds
+MIN_INTERVAL = int(os.environ.get('VLAB_BENCH_MIN_INTERVAL', 60))
+MAX_INTERVAL = int(os.environ.get('VLAB_BENCH_MAX_INTERVAL', 1800))
+
+
+def make_events(seed):
+    """When each simulated address changes state
+
+    :Returns: Tuple (keys, events) - events is a sorted list of (time, key)
+    """
+    rand = random.Random(seed)
+    keys = ['10.0.{}.{}'.format(n // 250, n % 250 + 1) for n in range(RECORDS)]
+    events = []
+    for key in keys:
+        if rand.random() * 100 < FLAPPING_PCT:
+            start = rand.uniform(0, FLAP_PERIOD)
+            events += [(start + n * FLAP_PERIOD, key) for n in range(int(HOURS * 3600 / FLAP_PERIOD))]
+        for hour in range(HOURS):
+            if rand.random() * 100 < CHANGE_PCT:
+                events.append((hour * 3600 + rand.uniform(0, 3600), key))
+    events.sort()
+    return keys, events
+
+
+def simulate(scheduler, keys, events):
+    """Run the producer loop against the simulated addresses
+
+    :Returns: Tuple (probes, median and worst seconds to notice a change)
+    """
+    state = dict.fromkeys(keys, True)
+    found = dict(state) # what the probes last found
+    changed_at = {} # key -> when it changed, and the probes haven't noticed yet
+    delays = []
+    scheduler.sync(dict(state), now=0)
+    pending = list(events)
+    now, end = 0, HOURS * 3600
+    while now < end:
+        while pending and pending[0][0] <= now:
+            _, key = heapq.heappop(pending)
+            state[key] = not state[key]
+            if state[key] != found[key]:
+                changed_at.setdefault(key, now)
+            else:
+                changed_at.pop(key, None) # it changed back before a probe saw it
+        for key in scheduler.pop_due(now):
+            if state[key] != found[key]:
+                delays.append(now - changed_at.pop(key))
+            found[key] = state[key]
+            scheduler.record(key, state[key], now=now)
+        now += worker.SCHEDULE_TICK
+    delays.sort()
+    if not delays:
+        return scheduler.stats['probes'], 0, 0
+    return scheduler.stats['probes'], delays[len(delays) // 2], delays[-1]
+
+
+def main():
+    keys, events = make_events(seed=1)
+    print('{} records, {} hours, {} state changes\n'.format(RECORDS, HOURS, len(events)))
+    print('{:<28} {:>10} {:>14} {:>14}'.format('schedule', 'probes', 'median notice', 'worst notice'))
+    schedules = (('sweep every {}s'.format(worker.LOOP_INTERVAL), worker.LOOP_INTERVAL, worker.LOOP_INTERVAL),
+                 ('adaptive {}-{}s'.format(MIN_INTERVAL, MAX_INTERVAL), MIN_INTERVAL, MAX_INTERVAL))
+    for label, low, high in schedules:
+        scheduler = worker.ProbeScheduler(min_interval=low, max_interval=high, backoff=2.0)
+        heapq.heapify(events)
+        probes, median, worst = simulate(scheduler, keys, list(events))
+        print('{:<28} {:>10} {:>13.0f}s {:>13.0f}s'.format(label, probes, median, worst))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+# -*- coding: UTF-8 -*-
+"""
+Compare parsing the port mapping rules from two ``iptables -L`` listings (the
+removed ``FireWall._prettify_*_output`` methods) against parsing one
+``iptables-save`` with ``RuleSnapshot``, at 10k port mappings.
+
+Only the parsing is timed; the synthetic listings stand in for the command output.
+
+Usage::
+
+    python3 benchmarks/bench_snapshot_parser.py
+"""
+import os
+import time
+
+from vlab_ipam_api.lib.firewall import RuleSnapshot, TAG_PREFIX
+
+MAPPINGS = int(os.environ.get('VLAB_BENCH_MAPPINGS', 10000))
+ROUNDS = int(os.environ.get('VLAB_BENCH_ROUNDS', 20))
+
+
+def target(n):
+    """The target of the nth port mapping
+
+    :Returns: Tuple (address, port, conn_port)
+    """
+    return '10.{}.{}.{}'.format(n // 65536, (n // 256) % 256, n % 256), 22, 50000 + n
+
+
+def listings(mappings):
+    """Synthetic ``iptables -L`` output of the PREROUTING and FORWARD chains
+
+    :Returns: Tuple (nat, filter)
+    """
+    nat = ['Chain PREROUTING (policy ACCEPT)',
+           'num  target     prot opt source               destination']
+    forward = ['Chain FORWARD (policy ACCEPT)',
+               'num  target     prot opt source               destination',
+               '1    LOG        all  --  0.0.0.0/0            0.0.0.0/0            LOG flags 0 level 4',
+               '2    ACCEPT     all  --  0.0.0.0/0            0.0.0.0/0']
+    for n in range(mappings):
+        addr, port, conn_port = target(n)
+        nat.append('{:<4} DNAT       tcp  --  0.0.0.0/0            0.0.0.0/0            tcp dpt:{} /* vlab-ipam:{} */ to:{}:{}'.format(
+                   n + 1, conn_port, conn_port, addr, port))
+        forward.append('{:<4} ACCEPT     tcp  --  0.0.0.0/0            {:<20} tcp dpt:{} /* vlab-ipam:{} */'.format(
+                       n + 3, addr, port, conn_port))
+    return '\n'.join(nat) + '\n', '\n'.join(forward) + '\n'
+
+
+def save_output(mappings):
+    """Synthetic ``iptables-save`` output of the same rules
+
+    :Returns: String
+    """
+    nat = ['*nat', ':PREROUTING ACCEPT [0:0]', ':INPUT ACCEPT [0:0]', ':OUTPUT ACCEPT [0:0]', ':POSTROUTING ACCEPT [0:0]']
+    forward = ['*filter', ':INPUT ACCEPT [0:0]', ':FORWARD ACCEPT [0:0]', ':OUTPUT ACCEPT [0:0]',
+               '-A FORWARD -j LOG', '-A FORWARD -i ens192 -o ens160 -j ACCEPT']
+    for n in range(mappings):
+        addr, port, conn_port = target(n)
+        nat.append('-A PREROUTING -i ens160 -p tcp -m tcp --dport {0} -m comment --comment vlab-ipam:{0} '
+                   '-j DNAT --to-destination {1}:{2}'.format(conn_port, addr, port))
+        forward.append('-A FORWARD -d {}/32 -p tcp -m tcp --dport {} -m comment --comment vlab-ipam:{} -j ACCEPT'.format(
+                       addr, port, conn_port))
+    return '\n'.join(nat + ['COMMIT'] + forward + ['COMMIT']) + '\n'
+
+
+def legacy_parse_tag(columns):
+    for column in columns:
+        if column.startswith(TAG_PREFIX):
+            return int(column[len(TAG_PREFIX):])
+    return None
+
+
+def legacy_nat(output):
+    """The removed ``FireWall._prettify_nat_output``"""
+    rows = output.split('\n')[2:]
+    rules = {}
+    for row in rows:
+        if not row:
+            continue
+        columns = row.split()
+        rid = columns[0]
+        conn_port = [x for x in columns if x.startswith('dpt:')][-1].split(':')[-1]
+        target = [x for x in columns if x.startswith('to:')][-1]
+        _, target_ip, target_port = target.split(':')
+        rules[rid] = {'conn_port': int(conn_port), 'target_addr': target_ip, 'target_port': int(target_port)}
+        if legacy_parse_tag(columns) is not None:
+            rules[rid]['tagged'] = True
+    return rules
+
+
+def legacy_filter(output):
+    """The removed ``FireWall._prettify_filter_output``"""
+    rows = output.split('\n')[2:]
+    rules = {}
+    for row in rows:
+        if not row:
+            continue
+        columns = row.split()
+        rid = columns[0]
+        if rid in ('1', '2'):
+            continue
+        dports = [x for x in columns if x.startswith('dpt:')]
+        if not dports:
+            continue
+        rules[rid] = {'target_addr': columns[5], 'target_port': int(dports[0].split(':')[-1])}
+        tag = legacy_parse_tag(columns)
+        if tag is not None:
+            rules[rid]['conn_port'] = tag
+    return rules
+
+
+def show_both(text):
+    snapshot = RuleSnapshot(text)
+    return snapshot.show('nat'), snapshot.show('filter')
+
+
+def index_both(text):
+    snapshot = RuleSnapshot(text)
+    return snapshot.entries('nat'), snapshot.entries('filter')
+
+
+def best_of(func):
+    """The fastest of ROUNDS runs, in milliseconds
+
+    :Returns: Float
+    """
+    times = []
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times) * 1000
+
+
+def main():
+    nat, forward = listings(MAPPINGS)
+    text = save_output(MAPPINGS)
+    snapshot = RuleSnapshot(text)
+    assert snapshot.show('nat') == legacy_nat(nat)
+    assert snapshot.show('filter') == legacy_filter(forward)
+
+    legacy = best_of(lambda: (legacy_nat(nat), legacy_filter(forward)))
+    parse = best_of(lambda: RuleSnapshot(text))
+    parse_show = best_of(lambda: show_both(text))
+    parse_index = best_of(lambda: index_both(text))
+    print('{:,} port mappings, best of {} rounds'.format(MAPPINGS, ROUNDS))
+    print('{:<42} {:>8.1f} ms'.format('iptables -L x2, _prettify_*_output', legacy))
+    print('{:<42} {:>8.1f} ms'.format('iptables-save, RuleSnapshot', parse))
+    print('{:<42} {:>8.1f} ms'.format('iptables-save, RuleSnapshot + show x2', parse_show))
+    print('{:<42} {:>8.1f} ms'.format('iptables-save, RuleSnapshot + entries x2', parse_index))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+# -*- coding: UTF-8 -*-
+"""
+Compare the peak memory of building the GET /api/1/ipam/portmap response body
+for 200k port mappings:
+
+* ``lookup_port_json`` + ``splice_json`` (the whole result buffered client-side)
+* ``stream_ports_json`` + ``stream_json`` (server-side cursor, fetched in batches)
+
+Each path runs in its own child process, so the peak RSS of one doesn't hide the
+other's.
+
+Usage::
+
+    PGHOST=/var/run/postgresql python3 benchmarks/bench_stream_memory.py
+
+The ``ipam`` table of the scratch database (``VLAB_BENCH_DBNAME``, default
+``vlab_ipam_bench``) is dropped and recreated, so never point this at a real
+IPAM database.
+"""
+import os
+import sys
+import time
+import resource
+import subprocess
+
+from vlab_ipam_api.lib import Database
+from vlab_ipam_api.lib.migrations import MIGRATIONS
+from vlab_ipam_api.lib.views.streaming import splice_json, stream_json, json_object_chunks
+
+DBNAME = os.environ.get('VLAB_BENCH_DBNAME', 'vlab_ipam_bench')
+MAPPINGS = int(os.environ.get('VLAB_BENCH_MAPPINGS', 200000))
+
+
+def populate(db):
+    """Create the ``ipam`` table with ``MAPPINGS`` records"""
+    db.execute('DROP TABLE IF EXISTS ipam;')
+    create_table = [m for m in MIGRATIONS if m[0] == 1][0][2]
+    db.execute(create_table)
+    db.execute("""INSERT INTO ipam (conn_port, target_addr, target_port, target_name, target_component, routable)
+                  SELECT n, '192.168.' || (n / 256 %% 256) || '.' || (n %% 256), 22,
+                         'vm-' || n, 'OneFS', true
+                  FROM generate_series(1, %s) AS n;""", params=(MAPPINGS,))
+
+
+def buffered(db):
+    """Build the whole body in memory, then "send" it"""
+    ports, _ = db.lookup_port_json()
+    content = splice_json({'gateway_ip' : '10.1.1.1'}, 'ports', ports)
+    body = splice_json({'user' : 'bob'}, 'content', content)
+    return len(body)
+
+
+def streamed(db):
+    """Send the body as the batches arrive"""
+    ports = json_object_chunks(db.stream_ports_json())
+    content = stream_json({'gateway_ip' : '10.1.1.1'}, 'ports', ports)
+    return sum(len(chunk) for chunk in stream_json({'user' : 'bob'}, 'content', content))
+
+
+def child(mode):
+    """Run one path, and report the body size, wall time and peak RSS"""
+    func = {'buffered' : buffered, 'streamed' : streamed}[mode]
+    with Database(dbname=DBNAME) as db:
+        start = time.perf_counter()
+        size = func(db)
+        wall = (time.perf_counter() - start) * 1000
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print('{} {} {}'.format(size, wall, peak))
+
+
+def main():
+    """Entry point"""
+    with Database(dbname=DBNAME) as db:
+        populate(db)
+    results = []
+    for mode in ('buffered', 'streamed'):
+        output = subprocess.check_output([sys.executable, __file__, mode])
+        size, wall, peak = output.split()
+        results.append((mode, int(size), float(wall), float(peak)))
+    with Database(dbname=DBNAME) as db:
+        db.execute('DROP TABLE ipam;')
+    print('{} mappings\n'.format(MAPPINGS))
+    print('{:<10}  {:>10}  {:>9}  {:>14}'.format('path', 'body bytes', 'wall (ms)', 'peak RSS (MiB)'))
+    for mode, size, wall, peak in results:
+        print('{:<10}  {:>10}  {:>9.1f}  {:>14.1f}'.format(mode, size, wall, peak))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        child(sys.argv[1])
+    else:
+        main()
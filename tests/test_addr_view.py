@@ -45,6 +45,46 @@ class TestAddrView(unittest.TestCase):
 
         self.assertEqual(resp.status_code, expected)
 
+    @patch.object(addr, 'Database')
+    def test_get_page(self, fake_Database):
+        """GET on /api/1/ipam/addr returns the cursor for the next page when the page is full"""
+        fake_db = MagicMock()
+        fake_db.lookup_addr.return_value = {'vmA': {'addr': ['1.2.3.4']}, 'vmB': {'addr': ['1.2.3.5']}}
+        fake_Database.return_value.__enter__.return_value = fake_db
+        resp = self.app.get('/api/1/ipam/addr?limit=2&fields=addr',
+                            headers={'X-Auth': self.token})
+
+        _, kwargs = fake_db.lookup_addr.call_args
+
+        self.assertEqual(resp.json['next'], 'vmB')
+        self.assertEqual(kwargs['limit'], 2)
+        self.assertEqual(kwargs['fields'], ['addr'])
+
+    @patch.object(addr, 'Database')
+    def test_get_last_page(self, fake_Database):
+        """GET on /api/1/ipam/addr returns a null cursor on the last page"""
+        fake_db = MagicMock()
+        fake_db.lookup_addr.return_value = {'vmA': {'addr': ['1.2.3.4']}}
+        fake_Database.return_value.__enter__.return_value = fake_db
+        resp = self.app.get('/api/1/ipam/addr?limit=2&after=vm',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.json['next'], None)
+
+    def test_get_bad_limit(self):
+        """GET on /api/1/ipam/addr returns 400 if limit is not a positive number"""
+        resp = self.app.get('/api/1/ipam/addr?limit=0',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 400)
+
+    def test_get_bad_fields(self):
+        """GET on /api/1/ipam/addr returns 400 if asked for an unknown field"""
+        resp = self.app.get('/api/1/ipam/addr?fields=addr,password',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 400)
+
     @patch.object(addr, 'args_valid')
     def test_get_bad_args(self, fake_args_valid):
         """GET on /api/1/ipam/addr returns 400 if supplied with bad query parameters"""
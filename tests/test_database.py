@@ -2,6 +2,7 @@
 """
 Unit tests for the vlab_ipam_api.lib.database module
 """
+import re
 import types
 import unittest
 from mock import MagicMock, patch
@@ -9,6 +10,7 @@ from mock import MagicMock, patch
 import psycopg2
 
 from vlab_ipam_api.lib import database
+from vlab_ipam_api.lib.views import streaming
 
 
 class TestDatabase(unittest.TestCase):
@@ -19,6 +21,8 @@ class TestDatabase(unittest.TestCase):
         # mock away the psycopg2 module
         self.patcher = patch('vlab_ipam_api.lib.database.psycopg2.connect')
         self.mocked_connection = MagicMock()
+        self.mocked_connection.closed = 0
+        self.mocked_connection.get_transaction_status.return_value = database.TRANSACTION_STATUS_IDLE
         self.mocked_cursor = MagicMock()
         self.mocked_connection.cursor.return_value = self.mocked_cursor
         self.mocked_conn = self.patcher.start()
@@ -26,8 +30,18 @@ class TestDatabase(unittest.TestCase):
 
     def tearDown(self):
         """Runs after every test case"""
+        database.close_pools()
         self.patcher.stop()
 
+    def prepared_call(self):
+        """Obtain the SQL (with %s placeholders) and params of the last prepared statement executed"""
+        calls = [c[0] for c in self.mocked_cursor.execute.call_args_list]
+        run = calls[-1]
+        name = run[0].split()[1].rstrip(';')
+        prepare = [c[0] for c in calls if c[0].startswith('PREPARE {} AS '.format(name))][-1]
+        sql = re.sub(r'\$\d+', '%s', prepare[len('PREPARE {} AS '.format(name)):])
+        return sql, run[1]
+
     def test_init(self):
         """Simple test that we can instantiate Database class for testing"""
         db = database.Database()
@@ -36,16 +50,40 @@ class TestDatabase(unittest.TestCase):
         self.assertTrue(db._cursor is self.mocked_cursor)
 
     def test_context_manager(self):
-        """Database support use of `with` statement and auto-closes connection"""
+        """Database support use of `with` statement and auto-returns the connection to the pool"""
         with database.Database() as db:
             pass
-        self.assertTrue(self.mocked_connection.close.call_count is 1)
+        stats = database.get_pool().stats()
+
+        self.assertEqual(self.mocked_connection.close.call_count, 0)
+        self.assertEqual(stats['idle'], 1)
+        self.assertEqual(stats['in_use'], 0)
 
     def test_close(self):
-        """Calling Database.close() closes the connection to the DB"""
+        """Calling Database.close() returns the connection to the pool"""
+        db = database.Database()
+        db.close()
+        stats = database.get_pool().stats()
+
+        self.assertEqual(self.mocked_connection.close.call_count, 0)
+        self.assertEqual(stats['idle'], 1)
+
+    def test_close_twice(self):
+        """Calling Database.close() more than once only returns the connection once"""
         db = database.Database()
         db.close()
-        self.assertTrue(self.mocked_connection.close.call_count is 1)
+        db.close()
+        stats = database.get_pool().stats()
+
+        self.assertEqual(stats['idle'], 1)
+
+    def test_connection_reused(self):
+        """Database reuses pooled connections instead of reconnecting"""
+        for _ in range(5):
+            with database.Database() as db:
+                pass
+
+        self.assertEqual(self.mocked_conn.call_count, 1)
 
     def test_execute(self):
         """Happy path test for the Database.execute method"""
@@ -84,14 +122,114 @@ class TestDatabase(unittest.TestCase):
         result = db.execute(sql="SELECT * from FOO WHERE bar LIKE 'baz'")
         self.assertTrue(isinstance(result, list))
 
+    def test_transaction(self):
+        """``transaction`` commits once for every statement within the block"""
+        db = database.Database()
+        with db.transaction():
+            db.execute(sql="DELETE FROM ipam WHERE conn_port=(%s);", params=(1,))
+            db.execute(sql="DELETE FROM ipam WHERE conn_port=(%s);", params=(2,))
+
+        self.assertEqual(self.mocked_cursor.execute.call_count, 2)
+        self.assertEqual(self.mocked_connection.commit.call_count, 1)
+
+    def test_transaction_rollback(self):
+        """``transaction`` rolls back, and does not commit, if the block raises"""
+        db = database.Database()
+        with self.assertRaises(RuntimeError):
+            with db.transaction():
+                db.execute(sql="DELETE FROM ipam WHERE conn_port=(%s);", params=(1,))
+                raise RuntimeError('testing')
+
+        self.assertEqual(self.mocked_connection.commit.call_count, 0)
+        self.assertEqual(self.mocked_connection.rollback.call_count, 1)
+
+    def test_transaction_execute_error(self):
+        """``execute`` leaves the rollback to the ``transaction`` block"""
+        self.mocked_cursor.execute.side_effect = psycopg2.Error('testing')
+        db = database.Database()
+        with self.assertRaises(database.DatabaseError):
+            with db.transaction():
+                db.execute(sql="DELETE FROM ipam WHERE conn_port=(%s);", params=(1,))
+
+        self.assertEqual(self.mocked_connection.rollback.call_count, 1)
+
+    def test_transaction_nested(self):
+        """``transaction`` uses a SAVEPOINT for nested blocks"""
+        db = database.Database()
+        with db.transaction():
+            try:
+                with db.transaction():
+                    raise RuntimeError('testing')
+            except RuntimeError:
+                pass
+
+        sent_sql = [c[0][0] for c in self.mocked_cursor.execute.call_args_list]
+        expected = ['SAVEPOINT vlab_sp_1;', 'ROLLBACK TO SAVEPOINT vlab_sp_1;']
+
+        self.assertEqual(sent_sql, expected)
+        self.assertEqual(self.mocked_connection.rollback.call_count, 0)
+        self.assertEqual(self.mocked_connection.commit.call_count, 1)
+
     def test_add_port(self):
         """``add_port`` returns the port number upon success"""
+        self.mocked_cursor.fetchall.return_value = [(50000,)]
         db = database.Database()
         port = db.add_port(target_addr='1.1.1.1',
                            target_port=22,
                            target_name='myBox',
                            target_component='OneFS')
-        self.assertTrue(isinstance(port, int))
+        self.assertEqual(port, 50000)
+
+    def test_add_port_one_round_trip(self):
+        """``add_port`` finds and claims a free port with a single SQL statement"""
+        self.mocked_cursor.fetchall.return_value = [(50000,)]
+        db = database.Database()
+        db.add_port(target_addr='1.1.1.1',
+                    target_port=22,
+                    target_name='myBox',
+                    target_component='OneFS')
+
+        args, _ = self.mocked_cursor.execute.call_args
+        sql, params = args
+
+        self.assertEqual(self.mocked_cursor.execute.call_count, 1)
+        self.assertTrue('generate_series' in sql)
+        self.assertEqual(params[-3:-1], (database.const.VLAB_PORT_MIN, database.const.VLAB_PORT_MAX))
+
+    @patch.object(database.random, 'randint')
+    def test_add_port_random_start(self, fake_randint):
+        """``add_port`` searches from a random port, and wraps around the range"""
+        fake_randint.return_value = 50123
+        self.mocked_cursor.fetchall.return_value = [(50123,)]
+        db = database.Database()
+        db.add_port(target_addr='1.1.1.1',
+                    target_port=22,
+                    target_name='myBox',
+                    target_component='OneFS')
+
+        args, _ = self.mocked_cursor.execute.call_args
+        sql, params = args
+
+        self.assertTrue('ORDER BY free.port < %s, free.port' in sql)
+        self.assertEqual(params[-1], 50123)
+        fake_randint.assert_called_with(database.const.VLAB_PORT_MIN, database.const.VLAB_PORT_MAX)
+
+    @patch.object(database.random, 'randint')
+    def test_port_taken_new_start(self, fake_randint):
+        """``add_port`` picks a new starting port when it retries"""
+        fake_randint.side_effect = [50123, 50456]
+        self.mocked_cursor.execute.side_effect = [database.DatabaseError('testing', pgcode='23505'), None]
+        self.mocked_cursor.fetchall.return_value = [(50456,)]
+        db = database.Database()
+        db.add_port(target_addr='1.1.1.1',
+                    target_port=22,
+                    target_name='myBox',
+                    target_component='OneFS')
+
+        args, _ = self.mocked_cursor.execute.call_args
+        _, params = args
+
+        self.assertEqual(params[-1], 50456)
 
     def test_add_port_db_error(self):
         """``add_port`` raises DatabaseError for unexpected DB problems"""
@@ -106,9 +244,9 @@ class TestDatabase(unittest.TestCase):
                         target_component='OneFS')
 
     def test_port_taken(self):
-        """``add_port`` retries with a new random port number if the DB already
-        has a record for the requested conn_port"""
+        """``add_port`` retries if a concurrent request claimed the same conn_port"""
         self.mocked_cursor.execute.side_effect = [database.DatabaseError('testing', pgcode='23505'), None]
+        self.mocked_cursor.fetchall.return_value = [(50001,)]
 
         db = database.Database()
         port = db.add_port(target_addr='1.1.1.1',
@@ -117,6 +255,7 @@ class TestDatabase(unittest.TestCase):
                            target_component='OneFS')
 
         self.assertEqual(self.mocked_cursor.execute.call_count, 2)
+        self.assertEqual(port, 50001)
 
     def test_port_taken_runtime_Error(self):
         """``add_port`` raises RuntimeError if unable to add port to DB"""
@@ -129,13 +268,24 @@ class TestDatabase(unittest.TestCase):
                         target_name='myBox',
                         target_component='OneFS')
 
+    def test_add_port_range_full(self):
+        """``add_port`` raises RuntimeError without retrying when every port is taken"""
+        self.mocked_cursor.fetchall.return_value = []
+
+        db = database.Database()
+        with self.assertRaises(RuntimeError):
+            db.add_port(target_addr='1.1.1.1',
+                        target_port=22,
+                        target_name='myBox',
+                        target_component='OneFS')
+        self.assertEqual(self.mocked_cursor.execute.call_count, 1)
+
     def test_delete_port(self):
         """``delete_port`` executes the expected SQL to delete the record"""
         db = database.Database()
         db.delete_port(conn_port=9001)
 
-        args, _ = self.mocked_cursor.execute.call_args
-        sent_sql = args[0]
+        sent_sql, _ = self.prepared_call()
         expected_sql = "DELETE FROM ipam WHERE conn_port=(%s);"
 
         self.assertEqual(sent_sql, expected_sql)
@@ -162,7 +312,7 @@ class TestDatabase(unittest.TestCase):
 
     def test_lookup_addr_name(self):
         """``lookup_addr`` returns a dictionary when query via name param"""
-        self.mocked_cursor.fetchall.return_value = [('myTarget', '1.2.3.4', 'someComponent', True)]
+        self.mocked_cursor.fetchall.return_value = [('myTarget', 'someComponent', True, ['1.2.3.4'])]
 
         db = database.Database()
         result = db.lookup_addr(name='myTarget', addr=None, component=None)
@@ -172,7 +322,7 @@ class TestDatabase(unittest.TestCase):
 
     def test_lookup_addr_addr(self):
         """``lookup_addr`` returns a dictionary when query via addr param"""
-        self.mocked_cursor.fetchall.return_value = [('myTarget', '1.2.3.4', 'someComponent', True)]
+        self.mocked_cursor.fetchall.return_value = [('myTarget', 'someComponent', True, ['1.2.3.4'])]
 
         db = database.Database()
         result = db.lookup_addr(name=None, addr='1.2.3.4', component=None)
@@ -182,7 +332,7 @@ class TestDatabase(unittest.TestCase):
 
     def test_lookup_addr_component(self):
         """``lookup_addr`` returns a dictionary when query via component param"""
-        self.mocked_cursor.fetchall.return_value = [('myTarget', '1.2.3.4', 'someComponent', True)]
+        self.mocked_cursor.fetchall.return_value = [('myTarget', 'someComponent', True, ['1.2.3.4'])]
 
         db = database.Database()
         result = db.lookup_addr(name=None, addr=None, component='someComponent')
@@ -192,8 +342,7 @@ class TestDatabase(unittest.TestCase):
 
     def test_lookup_addr_multiple_ips(self):
         """``lookup_addr`` returns all IPs"""
-        self.mocked_cursor.fetchall.return_value = [('myTarget', '1.2.3.4', 'someComponent', True),
-                                                    ('myTarget', '2.3.4.5', 'someComponent', True)]
+        self.mocked_cursor.fetchall.return_value = [('myTarget', 'someComponent', True, ['1.2.3.4', '2.3.4.5'])]
 
         db = database.Database()
         result = db.lookup_addr(name=None, addr=None, component='someComponent')
@@ -203,7 +352,7 @@ class TestDatabase(unittest.TestCase):
 
     def test_lookup_addr_none(self):
         """``lookup_addr`` returns a dictionary when all params are none"""
-        self.mocked_cursor.fetchall.return_value = [('myTarget', '1.2.3.4', 'someComponent', True)]
+        self.mocked_cursor.fetchall.return_value = [('myTarget', 'someComponent', True, ['1.2.3.4'])]
 
         db = database.Database()
         result = db.lookup_addr(name=None, addr=None, component=None)
@@ -211,13 +360,33 @@ class TestDatabase(unittest.TestCase):
 
         self.assertEqual(result, expected)
 
+    def test_lookup_addr_grouped(self):
+        """``lookup_addr`` groups the rows per machine in the database"""
+        db = database.Database()
+        db.lookup_addr(name='myTarget', addr=None, component=None)
+
+        call_args, _ = self.mocked_cursor.execute.call_args
+        sql, params = call_args
+
+        self.assertTrue(sql.endswith('FROM ipam WHERE target_name LIKE (%s) GROUP BY target_name;'))
+        self.assertTrue('array_agg(DISTINCT target_addr)' in sql)
+        self.assertEqual(params, ('myTarget',))
+
+    def test_lookup_addr_empty(self):
+        """``lookup_addr`` returns an empty dictionary when nothing matches"""
+        self.mocked_cursor.fetchall.return_value = []
+
+        db = database.Database()
+        result = db.lookup_addr(name='nope', addr=None, component=None)
+
+        self.assertEqual(result, {})
+
     def test_lookup_port(self):
         """``lookup_port`` generates correct SQL when no clauses are supplied"""
         db = database.Database()
         db.lookup_port()
 
-        call_args, _ = self.mocked_cursor.execute.call_args
-        sql, _ = call_args
+        sql, _ = self.prepared_call()
         expected = 'SELECT conn_port, target_addr, target_name, target_port, target_component FROM ipam;'
 
         self.assertEqual(sql, expected)
@@ -227,8 +396,7 @@ class TestDatabase(unittest.TestCase):
         db = database.Database()
         db.lookup_port(name='foo')
 
-        call_args, _ = self.mocked_cursor.execute.call_args
-        sql, call_params = call_args
+        sql, call_params = self.prepared_call()
         expected_sql = 'SELECT conn_port, target_addr, target_name, target_port, target_component FROM ipam WHERE target_name LIKE (%s);'
         expected_params = ('foo',)
 
@@ -240,8 +408,7 @@ class TestDatabase(unittest.TestCase):
         db = database.Database()
         db.lookup_port(addr='192.168.1.2')
 
-        call_args, _ = self.mocked_cursor.execute.call_args
-        sql, call_params = call_args
+        sql, call_params = self.prepared_call()
         expected_sql = 'SELECT conn_port, target_addr, target_name, target_port, target_component FROM ipam WHERE target_addr LIKE (%s);'
         expected_params = ('192.168.1.2',)
 
@@ -253,8 +420,7 @@ class TestDatabase(unittest.TestCase):
         db = database.Database()
         db.lookup_port(component='OneFS')
 
-        call_args, _ = self.mocked_cursor.execute.call_args
-        sql, call_params = call_args
+        sql, call_params = self.prepared_call()
         expected_sql = 'SELECT conn_port, target_addr, target_name, target_port, target_component FROM ipam WHERE target_component LIKE (%s);'
         expected_params = ('OneFS',)
 
@@ -266,8 +432,7 @@ class TestDatabase(unittest.TestCase):
         db = database.Database()
         db.lookup_port(conn_port=9001)
 
-        call_args, _ = self.mocked_cursor.execute.call_args
-        sql, call_params = call_args
+        sql, call_params = self.prepared_call()
         expected_sql = 'SELECT conn_port, target_addr, target_name, target_port, target_component FROM ipam WHERE conn_port = (%s);'
         expected_params = (9001,)
 
@@ -279,8 +444,7 @@ class TestDatabase(unittest.TestCase):
         db = database.Database()
         db.lookup_port(target_port=22)
 
-        call_args, _ = self.mocked_cursor.execute.call_args
-        sql, call_params = call_args
+        sql, call_params = self.prepared_call()
         expected_sql = 'SELECT conn_port, target_addr, target_name, target_port, target_component FROM ipam WHERE target_port = (%s);'
         expected_params = (22,)
 
@@ -292,8 +456,7 @@ class TestDatabase(unittest.TestCase):
         db = database.Database()
         db.lookup_port(name='myVM', addr='1.2.3.4', component='CEE', conn_port=9001, target_port=443)
 
-        call_args, _ = self.mocked_cursor.execute.call_args
-        sql, call_params = call_args
+        sql, call_params = self.prepared_call()
         expected_sql = 'SELECT conn_port, target_addr, target_name, target_port, target_component FROM ipam WHERE target_name LIKE (%s) AND target_addr LIKE (%s) AND target_component LIKE (%s) AND conn_port = (%s) AND target_port = (%s);'
         expected_params = ('myVM', '1.2.3.4', 'CEE', 9001, 443)
 
@@ -319,6 +482,397 @@ class TestDatabase(unittest.TestCase):
 
         self.assertEqual(result, expected)
 
+    def test_lookup_port_json(self):
+        """``lookup_port_json`` returns the JSON document built by the database"""
+        self.mocked_cursor.fetchall.return_value = [('{"9001": {}}', 9001, 1)]
+
+        db = database.Database()
+        result = db.lookup_port_json()
+
+        self.assertEqual(result, ('{"9001": {}}', None))
+
+    def test_lookup_port_json_filters(self):
+        """``lookup_port_json`` generates the same filters as ``lookup_port``"""
+        self.mocked_cursor.fetchall.return_value = [('{}', None, 0)]
+
+        db = database.Database()
+        db.lookup_port_json(name='myVM', conn_port=9001)
+
+        sql, call_params = self.prepared_call()
+
+        self.assertTrue(sql.endswith('FROM ipam WHERE target_name LIKE (%s) AND conn_port = (%s);'))
+        self.assertEqual(call_params, ('myVM', 9001))
+
+    def test_lookup_port_json_page(self):
+        """``lookup_port_json`` returns the ``after`` value for the next page when the page is full"""
+        self.mocked_cursor.fetchall.return_value = [('{"9001": {}, "9002": {}}', 9002, 2)]
+
+        db = database.Database()
+        _, next_after = db.lookup_port_json(limit=2, after=9000)
+
+        sql, call_params = self.prepared_call()
+
+        self.assertTrue(sql.endswith('FROM (SELECT * FROM ipam WHERE conn_port > (%s) ORDER BY conn_port LIMIT (%s)) AS page;'))
+        self.assertEqual(call_params, (9000, 2))
+        self.assertEqual(next_after, 9002)
+
+    def test_lookup_port_json_last_page(self):
+        """``lookup_port_json`` returns None for the next ``after`` value on the last page"""
+        self.mocked_cursor.fetchall.return_value = [('{"9001": {}}', 9001, 1)]
+
+        db = database.Database()
+        _, next_after = db.lookup_port_json(limit=2)
+
+        self.assertEqual(next_after, None)
+
+    def test_lookup_port_json_fields(self):
+        """``lookup_port_json`` only builds the requested fields"""
+        self.mocked_cursor.fetchall.return_value = [('{}', None, 0)]
+
+        db = database.Database()
+        db.lookup_port_json(fields=['target_port'])
+
+        sql, _ = self.prepared_call()
+
+        self.assertTrue("json_build_object('target_port', target_port)" in sql)
+
+    def test_lookup_port_page(self):
+        """``lookup_port`` supports keyset pagination"""
+        db = database.Database()
+        db.lookup_port(limit=10, after=9001)
+
+        sql, call_params = self.prepared_call()
+        expected_sql = 'SELECT conn_port, target_addr, target_name, target_port, target_component FROM ipam WHERE conn_port > (%s) ORDER BY conn_port LIMIT (%s);'
+
+        self.assertEqual(sql, expected_sql)
+        self.assertEqual(call_params, (9001, 10))
+
+    def test_lookup_port_fields(self):
+        """``lookup_port`` only returns the requested fields"""
+        self.mocked_cursor.fetchall.return_value = [(9001, 22)]
+
+        db = database.Database()
+        result = db.lookup_port(fields=['target_port'])
+
+        sql, _ = self.prepared_call()
+
+        self.assertEqual(sql, 'SELECT conn_port, target_port FROM ipam;')
+        self.assertEqual(result, {9001: {'target_port': 22}})
+
+    def test_lookup_port_bad_field(self):
+        """``lookup_port`` raises ValueError for unknown fields"""
+        db = database.Database()
+
+        with self.assertRaises(ValueError):
+            db.lookup_port(fields=['target_port; DROP TABLE ipam'])
+
+    def test_lookup_addr_page(self):
+        """``lookup_addr`` supports keyset pagination"""
+        db = database.Database()
+        db.lookup_addr(name=None, addr=None, component='OneFS', limit=5, after='myVM')
+
+        call_args, _ = self.mocked_cursor.execute.call_args
+        sql, call_params = call_args
+
+        self.assertTrue(sql.endswith('WHERE target_component LIKE (%s) AND target_name > (%s) GROUP BY target_name ORDER BY target_name LIMIT (%s);'))
+        self.assertEqual(call_params, ('OneFS', 'myVM', 5))
+
+    def test_lookup_addr_fields(self):
+        """``lookup_addr`` only returns the requested fields"""
+        self.mocked_cursor.fetchall.return_value = [('myTarget', ['1.2.3.4'])]
+
+        db = database.Database()
+        result = db.lookup_addr(name=None, addr=None, component=None, fields=['addr'])
+
+        self.assertEqual(result, {'myTarget': {'addr': ['1.2.3.4']}})
+
+    def test_execute_prepared(self):
+        """``execute_prepared`` prepares the statement, then executes it by name"""
+        db = database.Database()
+        db.execute_prepared('SELECT * FROM ipam WHERE conn_port=(%s) AND target_name LIKE (%s);', params=(9001, 'myVM'))
+
+        calls = [c[0] for c in self.mocked_cursor.execute.call_args_list]
+        name = calls[1][0].split()[1]
+
+        self.assertEqual(calls[0], ('PREPARE {} AS SELECT * FROM ipam WHERE conn_port=($1) AND target_name LIKE ($2);'.format(name), None))
+        self.assertEqual(calls[1], ('EXECUTE {} (%s, %s);'.format(name), (9001, 'myVM')))
+
+    def test_execute_prepared_reuse(self):
+        """``execute_prepared`` only prepares a statement once per pooled connection"""
+        with database.Database() as db:
+            db.execute_prepared('SELECT * FROM ipam;')
+        with database.Database() as db:
+            db.execute_prepared('SELECT * FROM ipam;')
+
+        sent = [c[0][0] for c in self.mocked_cursor.execute.call_args_list]
+        prepares = [x for x in sent if x.startswith('PREPARE')]
+
+        self.assertEqual(len(prepares), 1)
+        self.assertEqual(len(sent), 3)
+
+    def test_execute_prepared_escaped(self):
+        """``execute_prepared`` unescapes literal percent signs in the PREPARE"""
+        db = database.Database()
+        db.execute_prepared("SELECT n %% 256 FROM ipam WHERE conn_port=(%s);", params=(9001,))
+
+        prepare = self.mocked_cursor.execute.call_args_list[0][0][0]
+
+        self.assertTrue(prepare.endswith('AS SELECT n % 256 FROM ipam WHERE conn_port=($1);'))
+
+    def test_execute_prepared_lost(self):
+        """``execute_prepared`` re-prepares a statement the session no longer has"""
+        db = database.Database()
+        db.execute_prepared('SELECT * FROM ipam;')
+        self.mocked_cursor.execute.side_effect = [database.DatabaseError('testing', pgcode='26000'), None, None]
+        db.execute_prepared('SELECT * FROM ipam;')
+
+        sent = [c[0][0] for c in self.mocked_cursor.execute.call_args_list]
+        prepares = [x for x in sent if x.startswith('PREPARE')]
+
+        self.assertEqual(len(prepares), 2)
+
+    def test_execute_prepared_lost_transaction(self):
+        """``execute_prepared`` does not retry within a transaction, because the transaction is aborted"""
+        db = database.Database()
+        db.execute_prepared('SELECT * FROM ipam;')
+        self.mocked_cursor.execute.side_effect = [database.DatabaseError('testing', pgcode='26000')]
+
+        with self.assertRaises(database.DatabaseError):
+            with db.transaction():
+                db.execute_prepared('SELECT * FROM ipam;')
+        self.assertEqual(db._prepared, set())
+
+    def test_execute_prepared_max(self):
+        """``execute_prepared`` runs the plain SQL once a connection has ``VLAB_DB_MAX_PREPARED`` statements"""
+        db = database.Database()
+        db._prepared.update('vlab_{}'.format(x) for x in range(database.const.VLAB_DB_MAX_PREPARED))
+        db.execute_prepared('SELECT conn_port FROM ipam;')
+
+        args, _ = self.mocked_cursor.execute.call_args
+
+        self.assertEqual(args, ('SELECT conn_port FROM ipam;', None))
+
+    def test_execute_prepared_discarded(self):
+        """Discarding a pooled connection forgets the statements prepared on it"""
+        db = database.Database()
+        db.execute_prepared('SELECT * FROM ipam;')
+        db._pool.putconn(db._connection, discard=True)
+
+        self.assertEqual(db._pool.prepared(self.mocked_connection), set())
+
+    def test_stream(self):
+        """``stream`` yields the rows in batches from a named (server-side) cursor"""
+        self.mocked_cursor.fetchmany.side_effect = [[(1,), (2,)], [(3,)], []]
+
+        db = database.Database()
+        result = list(db.stream('SELECT 1;', batch_size=2))
+        _, kwargs = self.mocked_connection.cursor.call_args
+
+        self.assertEqual(result, [[(1,), (2,)], [(3,)]])
+        self.assertTrue(kwargs['name'].startswith('vlab_stream_'))
+        self.mocked_cursor.fetchmany.assert_called_with(2)
+
+    def test_stream_commits(self):
+        """``stream`` closes the transaction that holds the cursor once exhausted"""
+        self.mocked_cursor.fetchmany.side_effect = [[]]
+
+        db = database.Database()
+        list(db.stream('SELECT 1;'))
+
+        self.assertTrue(self.mocked_connection.commit.called)
+        self.assertEqual(db._tx_depth, 0)
+
+    def test_stream_error(self):
+        """``stream`` raises DatabaseError, and rolls back, if the query fails"""
+        self.mocked_cursor.execute.side_effect = [psycopg2.Error('testing')]
+
+        db = database.Database()
+        with self.assertRaises(database.DatabaseError):
+            list(db.stream('SELECT 1;'))
+
+        self.assertTrue(self.mocked_connection.rollback.called)
+
+    def record_close_order(self):
+        """Note when the connection is rolled back, and when it's returned to the pool
+
+        :Returns: List
+        """
+        calls = []
+        def returned():
+            calls.append('putconn')
+            return database.TRANSACTION_STATUS_IDLE
+        self.mocked_connection.rollback.side_effect = lambda: calls.append('rollback')
+        self.mocked_connection.get_transaction_status.side_effect = returned
+        return calls
+
+    def test_stream_closed_early(self):
+        """``close`` rolls back a stream the caller stopped reading, before returning the connection"""
+        self.mocked_cursor.fetchmany.side_effect = [[(1,)], [(2,)], []]
+        calls = self.record_close_order()
+
+        db = database.Database()
+        batches = db.stream('SELECT 1;')
+        next(batches)
+        db.close()
+
+        self.assertEqual(calls, ['rollback', 'putconn'])
+        self.assertEqual(db._tx_depth, 0)
+
+    def test_stream_client_disconnect(self):
+        """A client disconnecting mid-body ends the stream before the connection is returned"""
+        self.mocked_cursor.fetchmany.side_effect = [[(9001, '{}')], [(9002, '{}')], []]
+        calls = self.record_close_order()
+
+        db = database.Database()
+        body = streaming.closing(streaming.json_object_chunks(db.stream_ports_json()), db)
+        chunks = iter(body)
+        next(chunks)
+        next(chunks)
+        body.close()
+
+        self.assertEqual(calls, ['rollback', 'putconn'])
+
+    def test_stream_ports_json(self):
+        """``stream_ports_json`` generates the same filters as ``lookup_port``"""
+        self.mocked_cursor.fetchmany.side_effect = [[(9001, '{}')], []]
+
+        db = database.Database()
+        result = list(db.stream_ports_json(name='myVM', after=9000))
+        call_args, _ = self.mocked_cursor.execute.call_args
+        sql, call_params = call_args
+
+        self.assertEqual(result, [[(9001, '{}')]])
+        self.assertTrue(sql.endswith('FROM ipam WHERE target_name LIKE (%s) AND conn_port > (%s);'))
+        self.assertEqual(call_params, ('myVM', 9000))
+
+
+class TestConnectionPool(unittest.TestCase):
+    """A suite of tests for the vlab_ipam_api.lib.database.ConnectionPool object"""
+
+    def setUp(self):
+        """Runs before every test case"""
+        self.patcher = patch('vlab_ipam_api.lib.database.psycopg2.connect')
+        self.mocked_conn = self.patcher.start()
+        self.mocked_conn.side_effect = self._make_connection
+
+    def tearDown(self):
+        """Runs after every test case"""
+        database.close_pools()
+        self.patcher.stop()
+
+    def _make_connection(self, **kwargs):
+        conn = MagicMock()
+        conn.closed = 0
+        conn.get_transaction_status.return_value = database.TRANSACTION_STATUS_IDLE
+        return conn
+
+    def _make_pool(self, minconn=0, maxconn=2, timeout=0, idle_check=30):
+        return database.ConnectionPool(minconn=minconn, maxconn=maxconn,
+                                       timeout=timeout, idle_check=idle_check,
+                                       user='postgres', dbname='vlab_ipam')
+
+    def test_minconn(self):
+        """``ConnectionPool`` opens ``minconn`` connections upon creation"""
+        pool = self._make_pool(minconn=2)
+
+        self.assertEqual(self.mocked_conn.call_count, 2)
+        self.assertEqual(pool.stats()['idle'], 2)
+
+    def test_maxconn_timeout(self):
+        """``ConnectionPool.getconn`` raises DatabaseError when every connection is in use"""
+        pool = self._make_pool(maxconn=1)
+        pool.getconn()
+
+        with self.assertRaises(database.DatabaseError):
+            pool.getconn()
+        self.assertEqual(pool.stats()['timeouts'], 1)
+
+    def test_reuse_lifo(self):
+        """``ConnectionPool`` hands out the most recently returned connection"""
+        pool = self._make_pool()
+        conn1 = pool.getconn()
+        conn2 = pool.getconn()
+        pool.putconn(conn1)
+        pool.putconn(conn2)
+
+        self.assertTrue(pool.getconn() is conn2)
+
+    def test_discard_closed(self):
+        """``ConnectionPool.getconn`` replaces connections that were closed while idle"""
+        pool = self._make_pool()
+        conn = pool.getconn()
+        pool.putconn(conn)
+        conn.closed = 1
+
+        new_conn = pool.getconn()
+
+        self.assertFalse(new_conn is conn)
+        self.assertEqual(pool.stats()['discarded'], 1)
+
+    def test_health_check(self):
+        """``ConnectionPool.getconn`` tests connections that have been idle for a while"""
+        pool = self._make_pool(idle_check=0)
+        conn = pool.getconn()
+        pool.putconn(conn)
+
+        pool.getconn()
+
+        self.assertEqual(pool.stats()['health_checks'], 1)
+        self.assertTrue(conn.cursor.return_value.execute.called)
+
+    def test_health_check_fails(self):
+        """``ConnectionPool.getconn`` discards connections that fail the health check"""
+        pool = self._make_pool(idle_check=0)
+        conn = pool.getconn()
+        pool.putconn(conn)
+        conn.cursor.return_value.execute.side_effect = psycopg2.OperationalError('testing')
+
+        new_conn = pool.getconn()
+
+        self.assertFalse(new_conn is conn)
+        self.assertTrue(conn.close.called)
+
+    def test_putconn_rollback(self):
+        """``ConnectionPool.putconn`` rolls back any open transaction"""
+        pool = self._make_pool()
+        conn = pool.getconn()
+        conn.get_transaction_status.return_value = database.psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+
+        pool.putconn(conn)
+
+        self.assertEqual(conn.rollback.call_count, 1)
+
+    def test_putconn_discard(self):
+        """``ConnectionPool.putconn`` closes the connection when told to discard it"""
+        pool = self._make_pool()
+        conn = pool.getconn()
+
+        pool.putconn(conn, discard=True)
+
+        self.assertTrue(conn.close.called)
+        self.assertEqual(pool.stats()['size'], 0)
+
+    def test_closeall(self):
+        """``ConnectionPool.closeall`` closes idle connections and refuses new checkouts"""
+        pool = self._make_pool(minconn=1)
+        pool.closeall()
+
+        with self.assertRaises(database.DatabaseError):
+            pool.getconn()
+        self.assertEqual(pool.stats()['size'], 0)
+
+    def test_get_pool_shared(self):
+        """``get_pool`` returns the same pool for the same database"""
+        self.assertTrue(database.get_pool() is database.get_pool())
+
+    def test_pool_stats(self):
+        """``pool_stats`` reports on every pool in the process"""
+        database.get_pool()
+
+        stats = database.pool_stats()
+
+        self.assertEqual(list(stats.keys()), ['postgres@vlab_ipam'])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,11 +1,41 @@
 # -*- coding: UTF-8 -*-
 """A suite of unit tests for the vlab_ipam_api.lib.firewall module"""
+import os
+import time
+import tempfile
 import textwrap
 import unittest
+from threading import Thread, Event
 from unittest.mock import patch, MagicMock, mock_open
 
 from vlab_ipam_api.lib import firewall
-
+from vlab_ipam_api.lib.exceptions import CliError
+
+
+SAVE_OUTPUT = """\
+# Generated by iptables-save v1.8.7 on Mon Oct 12 09:00:00 2026
+*nat
+:PREROUTING ACCEPT [0:0]
+:INPUT ACCEPT [0:0]
+:OUTPUT ACCEPT [0:0]
+:POSTROUTING ACCEPT [0:0]
+-A PREROUTING -i ens160 -p tcp -m tcp --dport 5632 -j DNAT --to-destination 1.1.1.1:22
+-A PREROUTING -i ens160 -p tcp -m tcp --dport 5633 -m comment --comment vlab-ipam:5633 -j DNAT --to-destination 2.2.2.2:443
+-A POSTROUTING -o ens160 -j MASQUERADE
+COMMIT
+# Completed on Mon Oct 12 09:00:00 2026
+# Generated by iptables-save v1.8.7 on Mon Oct 12 09:00:00 2026
+*filter
+:INPUT ACCEPT [0:0]
+:FORWARD ACCEPT [0:0]
+:OUTPUT ACCEPT [0:0]
+-A FORWARD -j LOG
+-A FORWARD -i ens192 -o ens160 -j ACCEPT
+-A FORWARD -d 1.1.1.1/32 -p tcp -m tcp --dport 22 -j ACCEPT
+-A FORWARD -d 2.2.2.2/32 -p tcp -m tcp --dport 443 -m comment --comment vlab-ipam:5633 -j ACCEPT
+COMMIT
+# Completed on Mon Oct 12 09:00:00 2026
+"""
 
 class TestFirewallInternals(unittest.TestCase):
     """A suite of test cases for the FireWall internal methods"""
@@ -14,53 +44,154 @@ class TestFirewallInternals(unittest.TestCase):
         """A simple test to verify we can initialize the FireWall object"""
         fw = firewall.FireWall()
 
-        self.assertTrue(hasattr(fw, '_rlock'))
+        self.assertTrue(hasattr(fw, '_lock'))
 
     def test_with(self):
         """FireWall support use of the with statement"""
-        fake_rlock = MagicMock()
+        fake_lock = MagicMock()
         fw = firewall.FireWall()
-        fw._rlock = fake_rlock
+        fw._lock = fake_lock
 
         with fw:
             pass
 
-        self.assertEqual(fake_rlock.acquire.call_count, 1)
-        self.assertEqual(fake_rlock.release.call_count, 1)
+        self.assertEqual(fake_lock.acquire_write.call_count, 1)
+        self.assertEqual(fake_lock.release_write.call_count, 1)
+
+    @patch.object(firewall, 'get_helper')
+    @patch.object(firewall, 'shell')
+    def test_run_cmd_sudo(self, fake_shell, fake_get_helper):
+        """``run_cmd`` runs the command via sudo when no helper is configured"""
+        with patch.object(firewall, 'const') as fake_const:
+            fake_const.VLAB_FW_HELPER = ''
+            firewall.run_cmd('sudo iptables-save')
+
+        self.assertTrue(fake_shell.run_cmd.called)
+        self.assertFalse(fake_get_helper.called)
+
+    @patch.object(firewall, 'get_helper')
+    @patch.object(firewall, 'shell')
+    def test_run_cmd_helper(self, fake_shell, fake_get_helper):
+        """``run_cmd`` sends the command to the helper daemon when one is configured"""
+        with patch.object(firewall, 'const') as fake_const:
+            fake_const.VLAB_FW_HELPER = '/run/vlab-ipam/firewall.sock'
+            firewall.run_cmd('sudo iptables-restore --noflush', stdin='*nat\nCOMMIT\n')
+
+        self.assertFalse(fake_shell.run_cmd.called)
+        fake_get_helper.return_value.run_cmd.assert_called_with('sudo iptables-restore --noflush', stdin='*nat\nCOMMIT\n')
+
+    def test_snapshot_nat(self):
+        """``RuleSnapshot`` parses the PREROUTING rules of ``iptables-save``"""
+        output = firewall.RuleSnapshot(SAVE_OUTPUT).show(table='nat')
+        expected = {'1': {'conn_port': 5632, 'target_addr': '1.1.1.1', 'target_port': 22},
+                    '2': {'conn_port': 5633, 'target_addr': '2.2.2.2', 'target_port': 443, 'tagged': True}}
 
-    def test_prettify_nat_output(self):
-        """``_prettify_nat_output`` parses the raw text into a usable data structure"""
-        example = """\
-        Chain PREROUTING (policy ACCEPT)
-        num  target     prot opt source               destination
-        1    DNAT       tcp  --  0.0.0.0/0            0.0.0.0/0            tcp dpt:6000 to:192.168.1.2:22
-        """
+        self.assertEqual(output, expected)
 
-        fw = firewall.FireWall()
-        output = fw._prettify_nat_output(textwrap.dedent(example))
-        expected = {'1': {'conn_port': 6000,
-                          'target_addr': '192.168.1.2',
-                          'target_port': 22}}
+    def test_snapshot_filter(self):
+        """``RuleSnapshot`` parses the FORWARD rules, skipping the ones that aren't port mappings"""
+        output = firewall.RuleSnapshot(SAVE_OUTPUT).show(table='filter')
+        expected = {'3': {'target_addr': '1.1.1.1', 'target_port': 22},
+                    '4': {'target_addr': '2.2.2.2', 'target_port': 443, 'conn_port': 5633}}
 
         self.assertEqual(output, expected)
 
-    def test_prettify_filter_output(self):
-        """``_prettify_filter_output`` parses the raw text into a usable data structure"""
-        example = """\
-        Chain FORWARD (policy ACCEPT)
-        num  target     prot opt source               destination
-        1    LOG        all  --  0.0.0.0/0            0.0.0.0/0            LOG flags 0 level 4
-        2    ACCEPT     all  --  0.0.0.0/0            0.0.0.0/0
-        3    ACCEPT     tcp  --  0.0.0.0/0            192.168.1.2          tcp dpt:22
-        """
+    def test_snapshot_raw(self):
+        """``RuleSnapshot`` returns the ``iptables-save`` rules of just the chain for the 'raw' format"""
+        output = firewall.RuleSnapshot(SAVE_OUTPUT).show(table='nat', format='raw')
+        expected = '-A PREROUTING -i ens160 -p tcp -m tcp --dport 5632 -j DNAT --to-destination 1.1.1.1:22\n' \
+                   '-A PREROUTING -i ens160 -p tcp -m tcp --dport 5633 -m comment --comment vlab-ipam:5633 -j DNAT --to-destination 2.2.2.2:443\n'
 
-        fw = firewall.FireWall()
-        output = fw._prettify_filter_output(textwrap.dedent(example))
-        expected = {'3': {'target_addr': '192.168.1.2', 'target_port': 22}}
+        self.assertEqual(output, expected)
+
+    def test_snapshot_entries(self):
+        """``RuleSnapshot`` produces the entries of a RuleIndex, keeping the rule positions"""
+        output = firewall.RuleSnapshot(SAVE_OUTPUT).entries('filter')
+        expected = [(None, None),
+                    (None, None),
+                    (('1.1.1.1', 22, None), '-p tcp -d 1.1.1.1 --dport 22 -j ACCEPT'),
+                    (('2.2.2.2', 443, 5633), '-p tcp -d 2.2.2.2 --dport 443 -m comment --comment vlab-ipam:5633 -j ACCEPT')]
+
+        self.assertEqual(output, expected)
+
+    def test_snapshot_match_set(self):
+        """``RuleSnapshot`` ignores the 'ipset' forward mode's match-set rule"""
+        text = '*filter\n-A FORWARD -m set --match-set vlab-ipam-forward dst,dst -j ACCEPT\nCOMMIT\n'
+
+        output = firewall.RuleSnapshot(text).show(table='filter')
+
+        self.assertEqual(output, {})
 
+    def test_snapshot_other_rules(self):
+        """``RuleSnapshot`` ignores negated matches, quoted comments, and other chains"""
+        text = textwrap.dedent("""\
+        *filter
+        -A FORWARD ! -d 1.1.1.1/32 -p tcp -m tcp --dport 22 -j ACCEPT
+        -A FORWARD -d 10.0.0.0/8 -p tcp -m tcp --dport 22 -j ACCEPT
+        -A FORWARD -d 3.3.3.3/32 -p tcp -m tcp --dport 80 -m comment --comment "vlab-ipam:6000" -j ACCEPT
+        -A INPUT -d 4.4.4.4/32 -p tcp -m tcp --dport 22 -j ACCEPT
+        COMMIT
+        """)
+
+        output = firewall.RuleSnapshot(text).show(table='filter')
+        expected = {'3': {'target_addr': '3.3.3.3', 'target_port': 80, 'conn_port': 6000}}
 
         self.assertEqual(output, expected)
 
+    def test_rule_index(self):
+        """``RuleIndex`` finds the first rule for duplicate rules"""
+        index = firewall.RuleIndex([(None, None), (('1.1.1.1', 22, None), 'first'), (('1.1.1.1', 22, None), 'second')])
+
+        self.assertEqual(index.find(('1.1.1.1', 22, None)), 'first')
+
+    def test_rule_index_delete_spec(self):
+        """``RuleIndex`` removes the first rule with a deleted rule specification"""
+        index = firewall.RuleIndex([(('1.1.1.1', 22, None), 'spec'), (('1.1.1.1', 22, None), 'spec')])
+        index.update(['spec'], [])
+
+        self.assertEqual(len(index), 1)
+        self.assertEqual(index.find(('1.1.1.1', 22, None)), 'spec')
+
+    def test_rule_index_delete_number(self):
+        """``RuleIndex`` removes a rule deleted by number"""
+        index = firewall.RuleIndex([(None, None), (('1.1.1.1', 22, None), 'spec')])
+        index.update([2], [])
+
+        self.assertTrue(index.find(('1.1.1.1', 22, None)) is None)
+
+    def test_rule_index_insert(self):
+        """``RuleIndex`` puts inserted rules ahead of the others, so later rule numbers stay right"""
+        index = firewall.RuleIndex([(('1.1.1.1', 22, None), 'spec')])
+        index.update([], [], [(None, 'inserted')])
+        index.update([2], [])
+
+        self.assertEqual(len(index), 1)
+        self.assertTrue(index.find(('1.1.1.1', 22, None)) is None)
+
+    def test_rule_index_missing(self):
+        """``RuleIndex`` returns None for unknown rules"""
+        index = firewall.RuleIndex([(None, None)])
+
+        self.assertTrue(index.find(('1.1.1.1', 22, None)) is None)
+
+    def test_forward_spec(self):
+        """``forward_spec`` tags the rule when given a conn_port"""
+        output = firewall.forward_spec(22, '1.1.1.1', 6000)
+        expected = '-p tcp -d 1.1.1.1 --dport 22 -m comment --comment vlab-ipam:6000 -j ACCEPT'
+
+        self.assertEqual(output, expected)
+
+    def test_prerouting_spec(self):
+        """``prerouting_spec`` tags the rule with its conn_port"""
+        output = firewall.prerouting_spec(6000, 22, '1.1.1.1')
+        expected = '-i ens160 -p tcp --dport 6000 -m comment --comment vlab-ipam:6000 -j DNAT --to 1.1.1.1:22'
+
+        self.assertEqual(output, expected)
+
+    def test_rule_key(self):
+        """``rule_key`` normalizes the port values"""
+        self.assertEqual(firewall.rule_key('1.1.1.1', '22', '6000'), ('1.1.1.1', 22, 6000))
+
 
 # Mock away run_cmd in every test case
 @patch('vlab_ipam_api.lib.firewall.run_cmd')
@@ -70,7 +201,7 @@ class TestFireWall(unittest.TestCase):
     @classmethod
     def setUp(cls):
         """Runs before every test case"""
-        cls.fw = firewall.FireWall()
+        cls.fw = firewall.FireWall(save_mode='sync')
 
     @classmethod
     def tearDown(cls):
@@ -86,46 +217,103 @@ class TestFireWall(unittest.TestCase):
         """``delete_rule`` runs the correct syntax to remove a rule by ID from iptables from the nat table"""
         self.fw.delete_rule(rule_id=9001, table='nat')
 
-        args, _ = fake_run_cmd.call_args
+        args, kwargs = fake_run_cmd.call_args
 
         syntax_sent = args[0]
-        expected = 'iptables -t nat -D PREROUTING 9001'
+        expected = 'sudo iptables-restore --noflush'
 
         self.assertEqual(syntax_sent, expected)
+        self.assertEqual(kwargs['stdin'], '*nat\n-D PREROUTING 9001\nCOMMIT\n')
 
     def test_delete_rule_filter(self, fake_run_cmd):
         """``delete_rule`` runs the correct syntax to remove a rule by ID from iptables from the filter table"""
         self.fw.delete_rule(rule_id=9001, table='filter')
 
-        args, _ = fake_run_cmd.call_args
+        args, kwargs = fake_run_cmd.call_args
 
         syntax_sent = args[0]
-        expected = 'iptables -t filter -D FORWARD 9001'
+        expected = 'sudo iptables-restore --noflush'
 
         self.assertEqual(syntax_sent, expected)
+        self.assertEqual(kwargs['stdin'], '*filter\n-D FORWARD 9001\nCOMMIT\n')
+
+    def test_apply(self, fake_run_cmd):
+        """``apply`` makes every change in the batch with one ``iptables-restore``"""
+        batch = firewall.RuleBatch()
+        batch.delete(3, table='filter')
+        batch.forward(target_port=22, target_addr='1.2.3.4')
+        batch.prerouting(conn_port=6000, target_port=22, target_addr='1.2.3.4')
+        self.fw.apply(batch)
+
+        _, kwargs = fake_run_cmd.call_args
+
+        self.assertEqual(fake_run_cmd.call_count, 1)
+        self.assertEqual(kwargs['stdin'], batch.render())
 
-    def test_save_rules_file(self, fake_run_cmd):
+    def test_apply_empty(self, fake_run_cmd):
+        """``apply`` does nothing for an empty batch"""
+        self.fw.apply(firewall.RuleBatch())
+
+        self.assertFalse(fake_run_cmd.called)
+
+    @patch.object(firewall, 'write_atomic')
+    def test_save_rules_file(self, fake_write_atomic, fake_run_cmd):
         """``save_rules`` persists the firewall rules to disk"""
         fake_result = MagicMock()
         fake_result.stdout = 'HelloWorld'
-        with patch('builtins.open', mock_open()) as mocked_file:
-            self.fw.save_rules()
+        fake_run_cmd.return_value = fake_result
+        self.fw.save_rules()
 
-        args, _ = mocked_file.call_args
-        the_file, mode = args
-        expected_file = '/etc/iptables/rules.v4'
-        expected_mode = 'w'
+        args, _ = fake_write_atomic.call_args
+        expected = ('/etc/iptables/rules.v4', 'HelloWorld')
 
-        self.assertEqual(the_file, expected_file)
-        self.assertEqual(mode, expected_mode)
+        self.assertEqual(args, expected)
 
-    def test_save_rules_cmd(self, fake_run_cmd):
-        """``save_rules`` obtains an accurate list of firewall rules"""
-        fake_result = MagicMock()
-        fake_result.stdout = 'HelloWorld'
-        with patch('builtins.open', mock_open()) as mocked_file:
+    @patch.object(firewall, 'write_atomic')
+    def test_save_rules_lock(self, fake_write_atomic, fake_run_cmd):
+        """``save_rules`` only holds the lock while ``iptables-save`` runs, not while writing the file"""
+        self.fw._lock = MagicMock()
+        locked = []
+        def dump(*args, **kwargs):
+            locked.append(not self.fw._lock.release_read.called)
+            return MagicMock()
+        fake_run_cmd.side_effect = dump
+        fake_write_atomic.side_effect = lambda *args: locked.append(not self.fw._lock.release_read.called)
+
+        self.fw.save_rules()
+
+        self.assertEqual(locked, [True, False])
+        self.assertEqual(self.fw._lock.acquire_read.call_count, self.fw._lock.release_read.call_count)
+
+    @patch.object(firewall, 'write_atomic')
+    def test_save_rules_save_lock(self, fake_write_atomic, fake_run_cmd):
+        """``save_rules`` holds the save lock until the file is written"""
+        held = []
+        self.fw._save_lock = MagicMock()
+        fake_write_atomic.side_effect = lambda *args: held.append(not self.fw._save_lock.hold.return_value.__exit__.called)
+
+        self.fw.save_rules()
+
+        self.assertEqual(held, [True])
+        self.assertTrue(self.fw._save_lock.hold.return_value.__exit__.called)
+
+    @patch.object(firewall, 'write_atomic')
+    def test_save_rules_error(self, fake_write_atomic, fake_run_cmd):
+        """``save_rules`` releases the lock if ``iptables-save`` fails"""
+        self.fw._lock = MagicMock()
+        fake_run_cmd.side_effect = [CliError('iptables-save', '', 'testing', 1)]
+
+        with self.assertRaises(CliError):
             self.fw.save_rules()
 
+        self.assertEqual(self.fw._lock.release_read.call_count, 1)
+        self.assertFalse(fake_write_atomic.called)
+
+    @patch.object(firewall, 'write_atomic')
+    def test_save_rules_cmd(self, fake_write_atomic, fake_run_cmd):
+        """``save_rules`` obtains an accurate list of firewall rules"""
+        self.fw.save_rules()
+
         args, _ = fake_run_cmd.call_args
         save_syntax = args[0]
         expected_syntax = 'sudo iptables-save'
@@ -133,85 +321,122 @@ class TestFireWall(unittest.TestCase):
         self.assertEqual(save_syntax, expected_syntax)
 
     def test_show_nat(self, fake_run_cmd):
-        """``show`` returns parsed output for the nat table by default"""
-        fake_prettify_nat_output = MagicMock()
-        fake_prettify_nat_output.return_value = {'woot' : True}
-        self.fw._prettify_nat_output = fake_prettify_nat_output
+        """``show`` returns parsed output for the nat table"""
+        fake_run_cmd.return_value.stdout = SAVE_OUTPUT
 
         output = self.fw.show(table='nat')
-        expected = {'woot': True}
-
-        self.assertEqual(output, expected)
 
-    def test_show_nat_raw(self, fake_run_cmd):
-        """``show`` returns the raw output when defining the format param for the nat table"""
-        self.fw._prettify_nat_output = MagicMock()
-        fake_result = MagicMock()
-        fake_result.stdout = 'woot'
-        fake_run_cmd.return_value = fake_result
-
-        output = self.fw.show(table='nat',format='raw')
-        expected = 'woot'
-
-        self.assertEqual(output, expected)
+        self.assertEqual(output['1'], {'conn_port': 5632, 'target_addr': '1.1.1.1', 'target_port': 22})
+        self.assertEqual(fake_run_cmd.call_args[0][0], 'sudo iptables-save')
 
     def test_show_filter(self, fake_run_cmd):
         """``show`` returns parsed output for the filter table by default"""
-        fake_prettify_filter_output = MagicMock()
-        fake_prettify_filter_output.return_value = {'woot' : True}
-        self.fw._prettify_filter_output = fake_prettify_filter_output
+        fake_run_cmd.return_value.stdout = SAVE_OUTPUT
 
-        output = self.fw.show(table='filter')
-        expected = {'woot': True}
+        output = self.fw.show()
 
-        self.assertEqual(output, expected)
+        self.assertEqual(output['3'], {'target_addr': '1.1.1.1', 'target_port': 22})
 
     def test_show_filter_raw(self, fake_run_cmd):
-        """``show`` returns the raw output when defining the format param for the filter table"""
-        self.fw._prettify_filter_output = MagicMock()
-        fake_result = MagicMock()
-        fake_result.stdout = 'woot'
-        fake_run_cmd.return_value = fake_result
+        """``show`` returns the rules of the chain when defining the format param"""
+        fake_run_cmd.return_value.stdout = SAVE_OUTPUT
 
-        output = self.fw.show(table='filter',format='raw')
-        expected = 'woot'
+        output = self.fw.show(table='filter', format='raw')
 
-        self.assertEqual(output, expected)
+        self.assertEqual(len(output.splitlines()), 4)
+        self.assertTrue(output.startswith('-A FORWARD -j LOG\n'))
+
+    def test_show_reads(self, fake_run_cmd):
+        """``show`` only holds the lock for reading"""
+        fake_run_cmd.return_value.stdout = SAVE_OUTPUT
+        self.fw._lock = MagicMock()
+
+        self.fw.show(table='nat')
+
+        self.assertTrue(self.fw._lock.read.called)
+        self.assertFalse(self.fw._lock.acquire_write.called)
+
+    def test_snapshot(self, fake_run_cmd):
+        """``snapshot`` lists both tables with one ``iptables-save``"""
+        fake_run_cmd.return_value.stdout = SAVE_OUTPUT
+
+        snapshot = self.fw.snapshot()
+        snapshot.show(table='nat')
+        snapshot.show(table='filter')
+
+        self.assertEqual(fake_run_cmd.call_count, 1)
 
     def test_show_value_error(self, fake_run_cmd):
         """``show`` raises ValueError if supplied with a bad table value"""
         with self.assertRaises(ValueError):
             self.fw.show(table='NoTable')
 
+    def listings(self, fake_run_cmd):
+        """Make ``iptables-save`` output two NAT rules, and (after the defaults) two FORWARD rules"""
+        fake_run_cmd.return_value.stdout = SAVE_OUTPUT
+
     def test_find_rule_filter(self, fake_run_cmd):
-        """``find_rule``returns the rule id when found in filter table"""
-        self.fw.show = MagicMock()
-        self.fw.show.return_value = {'3' : {'target_addr': '1.1.1.1', 'target_port': '9001'}}
+        """``find_rule`` returns the rule specification of an untagged rule in the filter table"""
+        self.listings(fake_run_cmd)
 
-        output = self.fw.find_rule(target_port='9001',
+        output = self.fw.find_rule(target_port='22',
                                    target_addr='1.1.1.1',
                                    table='filter')
-        expected = '3'
+        expected = '-p tcp -d 1.1.1.1 --dport 22 -j ACCEPT'
+
+        self.assertEqual(output, expected)
+
+    def test_find_rule_filter_tagged(self, fake_run_cmd):
+        """``find_rule`` returns the rule tagged with the conn_port in the filter table"""
+        self.listings(fake_run_cmd)
+
+        output = self.fw.find_rule(target_port=443,
+                                   target_addr='2.2.2.2',
+                                   table='filter',
+                                   conn_port=5633)
+        expected = '-p tcp -d 2.2.2.2 --dport 443 -m comment --comment vlab-ipam:5633 -j ACCEPT'
+
+        self.assertEqual(output, expected)
+
+    def test_find_rule_filter_legacy(self, fake_run_cmd):
+        """``find_rule`` falls back to the untagged rule for the target in the filter table"""
+        self.listings(fake_run_cmd)
+
+        output = self.fw.find_rule(target_port=22,
+                                   target_addr='1.1.1.1',
+                                   table='filter',
+                                   conn_port=5632)
+        expected = '-p tcp -d 1.1.1.1 --dport 22 -j ACCEPT'
 
         self.assertEqual(output, expected)
 
     def test_find_rule_nat(self, fake_run_cmd):
-        """``find_rule``returns the rule id when found in the nat table"""
-        self.fw.show = MagicMock()
-        self.fw.show.return_value = {'3' : {'target_addr': '1.1.1.1', 'target_port': '9001', 'conn_port': '5632'}}
+        """``find_rule`` returns the rule specification when found in the nat table"""
+        self.listings(fake_run_cmd)
 
-        output = self.fw.find_rule(target_port='9001',
+        output = self.fw.find_rule(target_port=22,
                                    target_addr='1.1.1.1',
                                    table='nat',
                                    conn_port='5632')
-        expected = '3'
+        expected = '-i ens160 -p tcp --dport 5632 -j DNAT --to 1.1.1.1:22'
+
+        self.assertEqual(output, expected)
+
+    def test_find_rule_nat_tagged(self, fake_run_cmd):
+        """``find_rule`` returns the tagged rule specification in the nat table"""
+        self.listings(fake_run_cmd)
+
+        output = self.fw.find_rule(target_port=443,
+                                   target_addr='2.2.2.2',
+                                   table='nat',
+                                   conn_port=5633)
+        expected = '-i ens160 -p tcp --dport 5633 -m comment --comment vlab-ipam:5633 -j DNAT --to 2.2.2.2:443'
 
         self.assertEqual(output, expected)
 
     def test_find_rule_nat_value_error(self, fake_run_cmd):
         """``find_rule`` raises ValueError is not supplied with param conn_port for the nat table"""
-        self.fw.show = MagicMock()
-        self.fw.show.return_value = {'3' : {'target_addr': '1.1.1.1', 'target_port': '9001', 'conn_port': '5632'}}
+        self.listings(fake_run_cmd)
 
         with self.assertRaises(ValueError):
             self.fw.find_rule(target_port='9001',
@@ -220,96 +445,128 @@ class TestFireWall(unittest.TestCase):
 
     def test_find_rule_runtime_error(self, fake_run_cmd):
         """``find_rule`` raises RuntimeError if no matching rule is found"""
-        self.fw.show = MagicMock()
-        self.fw.show.return_value = {'3' : {'target_addr': '1.1.1.1', 'target_port': '9001', 'conn_port': '5632'}}
+        self.listings(fake_run_cmd)
 
         with self.assertRaises(RuntimeError):
             self.fw.find_rule(target_port='99',
                               target_addr='1.2.3.4',
                               table='filter')
 
-    def test_prerouting_id(self, fake_run_cmd):
-        """``prerouting`` creates returns the ID upon success"""
-        self.fw.find_rule = MagicMock()
-        self.fw.find_rule.return_value = '8'
+    def test_find_rule_cached(self, fake_run_cmd):
+        """``find_rule`` only lists the rules once"""
+        self.listings(fake_run_cmd)
+
+        self.fw.find_rule(target_port=22, target_addr='1.1.1.1', table='filter')
+        self.fw.find_rule(target_port=22, target_addr='1.1.1.1', table='nat', conn_port=5632)
+        self.fw.find_rule(target_port=22, target_addr='1.1.1.1', table='filter')
+
+        self.assertEqual(fake_run_cmd.call_count, 1)
+
+    def test_index_apply(self, fake_run_cmd):
+        """``apply`` keeps the rule index up to date"""
+        self.listings(fake_run_cmd)
+        self.fw.load_index()
+        self.fw.save_rules = MagicMock()
+        self.fw.map_port(conn_port=5634, target_port=80, target_addr='3.3.3.3')
+
+        filter_id = self.fw.find_rule(target_port=80, target_addr='3.3.3.3', table='filter', conn_port=5634)
+        nat_id = self.fw.find_rule(target_port=80, target_addr='3.3.3.3', table='nat', conn_port=5634)
+
+        self.assertEqual(filter_id, firewall.forward_spec(80, '3.3.3.3', 5634))
+        self.assertEqual(nat_id, firewall.prerouting_spec(5634, 80, '3.3.3.3'))
+        self.assertEqual(fake_run_cmd.call_count, 2)
+
+    def test_index_delete(self, fake_run_cmd):
+        """Deleting a rule by specification removes it from the index"""
+        self.listings(fake_run_cmd)
+        filter_id = self.fw.find_rule(target_port=443, target_addr='2.2.2.2', table='filter', conn_port=5633)
+        self.fw.delete_rule(filter_id, table='filter')
+
+        with self.assertRaises(RuntimeError):
+            self.fw.find_rule(target_port=443, target_addr='2.2.2.2', table='filter', conn_port=5633)
 
+    def test_delete_rule_spec(self, fake_run_cmd):
+        """``delete_rule`` deletes by rule specification"""
+        self.fw.delete_rule('-p tcp -d 1.1.1.1 --dport 22 -j ACCEPT', table='filter')
+
+        _, kwargs = fake_run_cmd.call_args
+
+        self.assertEqual(kwargs['stdin'], '*filter\n-D FORWARD -p tcp -d 1.1.1.1 --dport 22 -j ACCEPT\nCOMMIT\n')
+
+    def test_index_apply_error(self, fake_run_cmd):
+        """The rule index is reloaded if ``iptables-restore`` fails"""
+        self.listings(fake_run_cmd)
+        self.fw.load_index()
+        fake_run_cmd.side_effect = [CliError('iptables-restore', '', 'testing', 1)]
+
+        with self.assertRaises(CliError):
+            self.fw.delete_rule('3', table='filter')
+
+        self.assertTrue(self.fw._index is None)
+
+    def test_prerouting_id(self, fake_run_cmd):
+        """``prerouting`` returns the rule specification upon success"""
         output = self.fw.prerouting(conn_port='8965', target_addr='5.2.3.2', target_port='22')
-        expected = '8'
+        expected = '-i ens160 -p tcp --dport 8965 -m comment --comment vlab-ipam:8965 -j DNAT --to 5.2.3.2:22'
 
         self.assertEqual(output, expected)
 
     def test_prerouting_cmd(self, fake_run_cmd):
         """``prerouting`` creates the correct rule in iptables"""
-        self.fw.find_rule = MagicMock()
-        self.fw.find_rule.return_value = '8'
-
         self.fw.prerouting(conn_port='8965', target_addr='5.2.3.2', target_port='22')
-        args, _ = fake_run_cmd.call_args
-        syntax_sent = args[0]
-        expected_syntax = 'sudo iptables -A PREROUTING -t nat -i ens160 -p tcp --dport 8965 -j DNAT --to 5.2.3.2:22'
+        _, kwargs = fake_run_cmd.call_args
+        rules_sent = kwargs['stdin']
+        expected_rules = '*nat\n-A PREROUTING -i ens160 -p tcp --dport 8965 -m comment --comment vlab-ipam:8965 -j DNAT --to 5.2.3.2:22\nCOMMIT\n'
 
-        self.assertEqual(syntax_sent, expected_syntax)
+        self.assertEqual(rules_sent, expected_rules)
 
-    def test_prerouting_runtime_error(self, fake_run_cmd):
-        """``prerouting`` raises RuntimeError if it's unable to find the rule id for a newly created rule"""
-        self.fw.find_rule = MagicMock()
-        self.fw.find_rule.side_effect = [RuntimeError('doh')]
+    def test_prerouting_no_listing(self, fake_run_cmd):
+        """``prerouting`` does not list the chain to find the new rule"""
+        self.fw.prerouting(conn_port='8965', target_addr='5.2.3.2', target_port='22')
 
-        with self.assertRaises(RuntimeError):
-            self.fw.prerouting(conn_port='8965', target_addr='5.2.3.2', target_port='22')
+        self.assertEqual(fake_run_cmd.call_count, 1)
 
     def test_forward_id(self, fake_run_cmd):
-        """``forward`` returns the rule id of the newly created iptables rule"""
-        self.fw.find_rule = MagicMock()
-        self.fw.find_rule.return_value = '7'
-
-        output = self.fw.forward(target_port='8965', target_addr='1.12.1.2')
-        expected = '7'
+        """``forward`` returns the rule specification of the newly created iptables rule"""
+        output = self.fw.forward(target_port='8965', target_addr='1.12.1.2', conn_port=6000)
+        expected = '-p tcp -d 1.12.1.2 --dport 8965 -m comment --comment vlab-ipam:6000 -j ACCEPT'
 
         self.assertEqual(output, expected)
 
     def test_forward_cmd(self, fake_run_cmd):
         """``forward`` creates the correct rule in iptables"""
-        self.fw.find_rule = MagicMock()
-        self.fw.find_rule.return_value = '7'
+        self.fw.forward(target_port='8965', target_addr='1.12.1.2', conn_port=6000)
 
-        self.fw.forward(target_port='8965', target_addr='1.12.1.2')
+        _, kwargs = fake_run_cmd.call_args
+        rules_sent = kwargs['stdin']
+        expected_rules = '*filter\n-A FORWARD -p tcp -d 1.12.1.2 --dport 8965 -m comment --comment vlab-ipam:6000 -j ACCEPT\nCOMMIT\n'
 
-        args, _ = fake_run_cmd.call_args
-        syntax_sent = args[0]
-        expected_syntax = 'sudo iptables -A FORWARD -p tcp -d 1.12.1.2 --dport 8965 -j ACCEPT'
+        self.assertEqual(rules_sent, expected_rules)
 
-        self.assertEqual(syntax_sent, expected_syntax)
+    def test_forward_no_listing(self, fake_run_cmd):
+        """``forward`` does not list the chain to find the new rule"""
+        self.fw.forward(target_port='8965', target_addr='1.12.1.2', conn_port=6000)
 
-    def test_forward_runtime_error(self, fake_run_cmd):
-        """``forward`` raises RuntimeError if it cannot find the rule id of the newly created rule"""
-        self.fw.find_rule = MagicMock()
-        self.fw.find_rule.side_effect = [RuntimeError('doh')]
+        self.assertEqual(fake_run_cmd.call_count, 1)
 
-        with self.assertRaises(RuntimeError):
-            self.fw.forward(target_port='8965', target_addr='1.12.1.2')
-
-    def test_map_port_ok(self, fake_run_cmd):
-        """``map_port`` returns a Tuple upon success"""
-        self.fw.forward = MagicMock()
-        self.fw.forward.return_value = '9'
-        self.fw.prerouting = MagicMock()
-        self.fw.prerouting.return_value = '23'
+    def test_map_port_batch(self, fake_run_cmd):
+        """``map_port`` creates both rules with a single ``iptables-restore``"""
         self.fw.save_rules = MagicMock()
 
-        forward_id, prerouting_id = self.fw.map_port(conn_port=5698,
-                                                     target_port=22,
-                                                     target_addr='8.6.5.3')
-        expected = ('9', '23')
+        self.fw.map_port(conn_port=5698,
+                         target_port=22,
+                         target_addr='8.6.5.3')
+
+        args, kwargs = fake_run_cmd.call_args
+        expected = '*filter\n-A FORWARD -p tcp -d 8.6.5.3 --dport 22 -m comment --comment vlab-ipam:5698 -j ACCEPT\nCOMMIT\n' \
+                   '*nat\n-A PREROUTING -i ens160 -p tcp --dport 5698 -m comment --comment vlab-ipam:5698 -j DNAT --to 8.6.5.3:22\nCOMMIT\n'
 
-        self.assertEqual((forward_id, prerouting_id), expected)
+        self.assertEqual(fake_run_cmd.call_count, 1)
+        self.assertEqual(args[0], 'sudo iptables-restore --noflush')
+        self.assertEqual(kwargs['stdin'], expected)
 
     def test_map_port_saves(self, fake_run_cmd):
         """``map_port`` auto-saves the rules upon success"""
-        self.fw.forward = MagicMock()
-        self.fw.forward.return_value = '9'
-        self.fw.prerouting = MagicMock()
-        self.fw.prerouting.return_value = '23'
         self.fw.save_rules = MagicMock()
 
         self.fw.map_port(conn_port=5698,
@@ -318,39 +575,605 @@ class TestFireWall(unittest.TestCase):
 
         self.assertEqual(self.fw.save_rules.call_count, 1)
 
+    def test_map_port_debounce(self, fake_run_cmd):
+        """``map_port`` leaves the saving to the background thread in the 'debounce' save mode"""
+        fw = firewall.FireWall(save_mode='debounce')
+        fw.save_rules = MagicMock()
+        fw._saver = MagicMock()
+
+        fw.map_port(conn_port=5698,
+                    target_port=22,
+                    target_addr='8.6.5.3')
+
+        self.assertFalse(fw.save_rules.called)
+        self.assertEqual(fw._saver.request.call_count, 1)
+
+    def test_save_error(self, fake_run_cmd):
+        """``save_error`` describes why the 'debounce' saves are failing"""
+        fw = firewall.FireWall(save_mode='debounce')
+        fw._saver.failure = (time.time(), 'testing')
+
+        expected = 'Unable to save the firewall rules for 0 seconds: testing'
+
+        self.assertEqual(fw.save_error(), expected)
+
+    def test_save_error_none(self, fake_run_cmd):
+        """``save_error`` returns None when the saves work"""
+        fw = firewall.FireWall(save_mode='debounce')
+
+        self.assertTrue(fw.save_error() is None)
+
+    def test_unmap_port_batch(self, fake_run_cmd):
+        """``unmap_port`` deletes both rules with a single ``iptables-restore``"""
+        self.fw.save_rules = MagicMock()
+
+        self.fw.unmap_port(nat_id='2', filter_id='3')
+
+        args, kwargs = fake_run_cmd.call_args
+        expected = '*filter\n-D FORWARD 3\nCOMMIT\n*nat\n-D PREROUTING 2\nCOMMIT\n'
+
+        self.assertEqual(fake_run_cmd.call_count, 1)
+        self.assertEqual(args[0], 'sudo iptables-restore --noflush')
+        self.assertEqual(kwargs['stdin'], expected)
+        self.assertEqual(self.fw.save_rules.call_count, 1)
+
+    def test_unmap_port_error(self, fake_run_cmd):
+        """``unmap_port`` does not save the rules if ``iptables-restore`` fails"""
+        fake_run_cmd.side_effect = [CliError('iptables-restore', '', 'testing', 1)]
+        self.fw.save_rules = MagicMock()
+
+        with self.assertRaises(CliError):
+            self.fw.unmap_port(nat_id='2', filter_id='3')
+
+        self.assertFalse(self.fw.save_rules.called)
+
+    def test_bad_save_mode(self, fake_run_cmd):
+        """FireWall raises ValueError for an unknown save mode"""
+        with self.assertRaises(ValueError):
+            firewall.FireWall(save_mode='sometimes')
+
+    def test_shared_firewall_abstract(self, fake_run_cmd):
+        """SharedFireWall can only be used via a backend"""
+        with self.assertRaises(TypeError):
+            firewall.SharedFireWall(lock_file='')
+
     def test_map_port_locks(self, fake_run_cmd):
         """``map_port`` locks the object while executing"""
-        self.fw.forward = MagicMock()
-        self.fw.forward.return_value = '9'
-        self.fw.prerouting = MagicMock()
-        self.fw.prerouting.return_value = '23'
         self.fw.save_rules = MagicMock()
-        self.fw._rlock = MagicMock()
+        self.fw._lock = MagicMock()
 
         self.fw.map_port(conn_port=5698,
                          target_port=22,
                          target_addr='8.6.5.3')
 
-        self.assertEqual(self.fw._rlock.acquire.call_count, 1)
+        self.assertTrue(self.fw._lock.acquire_write.called)
+        self.assertEqual(self.fw._lock.acquire_write.call_count, self.fw._lock.release_write.call_count)
 
-    def test_map_port_undo(self, fake_run_cmd):
-        """``map_port`` deletes the FORWARD rule if it fails to also create the PREROUTING rule"""
-        self.fw.forward = MagicMock()
-        self.fw.forward.return_value = '9'
-        self.fw.prerouting = MagicMock()
-        self.fw.prerouting.side_effect = [RuntimeError('testing')]
+    def test_map_port_error(self, fake_run_cmd):
+        """``map_port`` does not save the rules if ``iptables-restore`` fails"""
+        fake_run_cmd.side_effect = [CliError('iptables-restore', '', 'testing', 1)]
         self.fw.save_rules = MagicMock()
-        self.fw.delete_rule = MagicMock()
 
-        try:
+        with self.assertRaises(CliError):
             self.fw.map_port(conn_port=5698,
                              target_port=22,
                              target_addr='8.6.5.3')
-        except Exception:
-            pass
 
-        self.assertEqual(self.fw.delete_rule.call_count, 1)
+        self.assertFalse(self.fw.save_rules.called)
+
+
+# Mock away run_cmd in every test case
+@patch('vlab_ipam_api.lib.firewall.run_cmd')
+class TestFireWallIpset(unittest.TestCase):
+    """A suite of test cases for the FireWall object with the 'ipset' forward mode"""
+
+    @classmethod
+    def setUp(cls):
+        """Runs before every test case"""
+        cls.fw = firewall.FireWall(save_mode='sync', forward_mode='ipset', ipset_name='fwd')
+        cls.fw.save_rules = MagicMock()
+
+    @classmethod
+    def tearDown(cls):
+        """Runs after every test case"""
+        del cls.fw
+
+    def listings(self, fake_run_cmd, save=SAVE_OUTPUT):
+        """Make ``iptables-save`` output the rules"""
+        fake_run_cmd.return_value.stdout = save
+
+    def commands(self, fake_run_cmd):
+        """The commands run, excluding ``iptables-save``"""
+        return [c[0][0] for c in fake_run_cmd.call_args_list if c[0][0] != 'sudo iptables-save']
+
+    def test_bad_forward_mode(self, fake_run_cmd):
+        """FireWall raises ValueError for an unknown forward mode"""
+        with self.assertRaises(ValueError):
+            firewall.FireWall(forward_mode='magic')
+
+    def test_load_index_setup(self, fake_run_cmd):
+        """``load_index`` creates the set, its FORWARD rule, and members for the existing mappings"""
+        self.listings(fake_run_cmd)
+
+        self.fw.load_index()
+        restores = {c[0][0]: c[1].get('stdin') for c in fake_run_cmd.call_args_list}
+
+        expected = '*filter\n' \
+                   '-D FORWARD -p tcp -d 1.1.1.1 --dport 22 -j ACCEPT\n' \
+                   '-D FORWARD -p tcp -d 2.2.2.2 --dport 443 -m comment --comment vlab-ipam:5633 -j ACCEPT\n' \
+                   '-I FORWARD 1 -m set --match-set fwd dst,dst -j ACCEPT\n' \
+                   'COMMIT\n'
+
+        self.assertTrue('sudo ipset create fwd hash:ip,port -exist' in restores)
+        self.assertEqual(restores['sudo iptables-restore --noflush'], expected)
+        self.assertEqual(restores['sudo ipset restore -exist'],
+                         'add fwd 1.1.1.1,tcp:22\nadd fwd 2.2.2.2,tcp:443\n')
+
+    def test_load_index_members_first(self, fake_run_cmd):
+        """``load_index`` adds the set members before deleting the FORWARD rules they replace"""
+        self.listings(fake_run_cmd)
+
+        self.fw.load_index()
+        commands = self.commands(fake_run_cmd)
+
+        self.assertTrue(commands.index('sudo ipset restore -exist') < commands.index('sudo iptables-restore --noflush'))
+
+    def test_load_index_index(self, fake_run_cmd):
+        """``load_index`` leaves only the match-set rule, at the top of the FORWARD chain, in the index"""
+        self.listings(fake_run_cmd)
+
+        self.fw.load_index()
+
+        self.assertEqual(len(self.fw._index['filter']), 3)
+        self.assertEqual(self.fw._index['filter'].keys(), [])
+
+    def test_switch_modes(self, fake_run_cmd):
+        """Deleting a port mapping made with the 'rules' forward mode leaves no FORWARD rule behind"""
+        self.listings(fake_run_cmd)
+        filter_id = self.fw.find_rule(target_port=443, target_addr='2.2.2.2', table='filter', conn_port=5633)
+        nat_id = self.fw.find_rule(target_port=443, target_addr='2.2.2.2', table='nat', conn_port=5633)
+        fake_run_cmd.reset_mock()
+
+        self.fw.unmap_port(nat_id, filter_id)
+        calls = [(c[0][0], c[1].get('stdin')) for c in fake_run_cmd.call_args_list]
+        expected = [('sudo iptables-restore --noflush', '*nat\n-D PREROUTING {}\nCOMMIT\n'.format(nat_id)),
+                    ('sudo ipset del fwd 2.2.2.2,tcp:443 -exist', None)]
+
+        self.assertEqual(filter_id, 'set:2.2.2.2,tcp:443')
+        self.assertEqual(calls, expected)
+        self.assertEqual(self.fw._index['filter'].keys(), [])
+
+    def test_switch_modes_back(self, fake_run_cmd):
+        """With the 'rules' forward mode, ``load_index`` adds the FORWARD rules the 'ipset' mode didn't make"""
+        save = SAVE_OUTPUT.replace('-A FORWARD -d 2.2.2.2/32 -p tcp -m tcp --dport 443 -m comment --comment vlab-ipam:5633 -j ACCEPT\n',
+                                   '').replace('-A FORWARD -j LOG\n',
+                                               '-A FORWARD -m set --match-set fwd dst,dst -j ACCEPT\n-A FORWARD -j LOG\n')
+        self.listings(fake_run_cmd, save=save)
+        fw = firewall.FireWall(save_mode='sync', forward_mode='rules', ipset_name='fwd')
+
+        fw.load_index()
+        restores = {c[0][0]: c[1].get('stdin') for c in fake_run_cmd.call_args_list}
+        expected = '*filter\n' \
+                   '-D FORWARD 1\n' \
+                   '-A FORWARD -p tcp -d 2.2.2.2 --dport 443 -m comment --comment vlab-ipam:5633 -j ACCEPT\n' \
+                   'COMMIT\n'
+
+        self.assertEqual(restores['sudo iptables-restore --noflush'], expected)
+
+    def test_switch_modes_back_find(self, fake_run_cmd):
+        """With the 'rules' forward mode, a port mapping made with the 'ipset' mode can be found"""
+        save = SAVE_OUTPUT.replace('-A FORWARD -d 2.2.2.2/32 -p tcp -m tcp --dport 443 -m comment --comment vlab-ipam:5633 -j ACCEPT\n',
+                                   '-A FORWARD -m set --match-set fwd dst,dst -j ACCEPT\n')
+        self.listings(fake_run_cmd, save=save)
+        fw = firewall.FireWall(save_mode='sync', forward_mode='rules', ipset_name='fwd')
+
+        output = fw.find_rule(target_port=443, target_addr='2.2.2.2', table='filter', conn_port=5633)
+        expected = '-p tcp -d 2.2.2.2 --dport 443 -m comment --comment vlab-ipam:5633 -j ACCEPT'
+
+        self.assertEqual(output, expected)
+
+    def test_switch_modes_back_no_set(self, fake_run_cmd):
+        """With the 'rules' forward mode, ``load_index`` changes nothing if the 'ipset' mode was never used"""
+        self.listings(fake_run_cmd)
+        fw = firewall.FireWall(save_mode='sync', forward_mode='rules', ipset_name='fwd')
+
+        fw.load_index()
+
+        self.assertEqual(self.commands(fake_run_cmd), [])
+
+    def test_load_index_rule_exists(self, fake_run_cmd):
+        """``load_index`` does not add a second match-set rule"""
+        save = SAVE_OUTPUT.replace('vlab-ipam:5633 -j ACCEPT\n',
+                                   'vlab-ipam:5633 -j ACCEPT\n-A FORWARD -m set --match-set fwd dst,dst -j ACCEPT\n')
+        self.listings(fake_run_cmd, save=save)
+
+        self.fw.load_index()
+        restores = {c[0][0]: c[1].get('stdin') for c in fake_run_cmd.call_args_list}
 
+        self.assertFalse('--match-set' in restores['sudo iptables-restore --noflush'])
+
+    def test_map_port(self, fake_run_cmd):
+        """``map_port`` adds a set member instead of a FORWARD rule"""
+        self.fw._index = {'filter': firewall.RuleIndex([]), 'nat': firewall.RuleIndex([])}
+
+        self.fw.map_port(conn_port=5698, target_port=22, target_addr='8.6.5.3')
+        calls = {c[0][0]: c[1].get('stdin') for c in fake_run_cmd.call_args_list}
+        expected = '*nat\n-A PREROUTING -i ens160 -p tcp --dport 5698 -m comment --comment vlab-ipam:5698 -j DNAT --to 8.6.5.3:22\nCOMMIT\n'
+
+        self.assertTrue('sudo ipset add fwd 8.6.5.3,tcp:22 -exist' in calls)
+        self.assertEqual(calls['sudo iptables-restore --noflush'], expected)
+
+    def test_map_port_shared_member(self, fake_run_cmd):
+        """``map_port`` only adds a member once for port mappings to the same target"""
+        self.fw._index = {'filter': firewall.RuleIndex([]), 'nat': firewall.RuleIndex([])}
+
+        self.fw.map_port(conn_port=5698, target_port=22, target_addr='8.6.5.3')
+        self.fw.map_port(conn_port=5699, target_port=22, target_addr='8.6.5.3')
+        adds = [c for c in self.commands(fake_run_cmd) if c.startswith('sudo ipset add')]
+
+        self.assertEqual(len(adds), 1)
+
+    def test_map_port_error(self, fake_run_cmd):
+        """``map_port`` removes the set member if adding the NAT rule fails"""
+        self.fw._index = {'filter': firewall.RuleIndex([]), 'nat': firewall.RuleIndex([])}
+        fake_run_cmd.side_effect = [MagicMock(),
+                                    CliError('iptables-restore', '', 'testing', 1),
+                                    MagicMock()]
+
+        with self.assertRaises(CliError):
+            self.fw.map_port(conn_port=5698, target_port=22, target_addr='8.6.5.3')
+
+        self.assertEqual(fake_run_cmd.call_args[0][0], 'sudo ipset del fwd 8.6.5.3,tcp:22 -exist')
+        self.assertFalse(self.fw._members)
+
+    def test_find_rule_filter(self, fake_run_cmd):
+        """``find_rule`` returns the set member of a port mapping in the filter table"""
+        self.listings(fake_run_cmd)
+
+        output = self.fw.find_rule(target_port=22, target_addr='1.1.1.1', table='filter', conn_port=5632)
+        expected = 'set:1.1.1.1,tcp:22'
+
+        self.assertEqual(output, expected)
+
+    def test_delete_rule_shared_member(self, fake_run_cmd):
+        """``delete_rule`` keeps a set member that another port mapping still uses"""
+        self.fw._index = {'filter': firewall.RuleIndex([]), 'nat': firewall.RuleIndex([])}
+        self.fw.map_port(conn_port=5698, target_port=22, target_addr='8.6.5.3')
+        self.fw.map_port(conn_port=5699, target_port=22, target_addr='8.6.5.3')
+        fake_run_cmd.reset_mock()
+
+        self.fw.delete_rule('set:8.6.5.3,tcp:22', table='filter')
+
+        self.assertFalse(fake_run_cmd.called)
+
+    def test_delete_rule_last_member(self, fake_run_cmd):
+        """``delete_rule`` removes a set member once no port mapping uses it"""
+        self.fw._index = {'filter': firewall.RuleIndex([]), 'nat': firewall.RuleIndex([])}
+        self.fw.map_port(conn_port=5698, target_port=22, target_addr='8.6.5.3')
+
+        self.fw.delete_rule('set:8.6.5.3,tcp:22', table='filter')
+
+        self.assertEqual(fake_run_cmd.call_args[0][0], 'sudo ipset del fwd 8.6.5.3,tcp:22 -exist')
+
+    def test_unmap_port(self, fake_run_cmd):
+        """``unmap_port`` deletes the NAT rule, then removes the set member"""
+        self.fw._index = {'filter': firewall.RuleIndex([]), 'nat': firewall.RuleIndex([])}
+        self.fw.map_port(conn_port=5698, target_port=22, target_addr='8.6.5.3')
+        fake_run_cmd.reset_mock()
+
+        nat_id = firewall.prerouting_spec(5698, 22, '8.6.5.3')
+        self.fw.unmap_port(nat_id=nat_id, filter_id='set:8.6.5.3,tcp:22')
+        calls = [(c[0][0], c[1].get('stdin')) for c in fake_run_cmd.call_args_list]
+        expected = [('sudo iptables-restore --noflush', '*nat\n-D PREROUTING {}\nCOMMIT\n'.format(nat_id)),
+                    ('sudo ipset del fwd 8.6.5.3,tcp:22 -exist', None)]
+
+        self.assertEqual(calls, expected)
+
+    def test_forward(self, fake_run_cmd):
+        """``forward`` adds a set member, and returns its rule ID"""
+        self.fw._index = {'filter': firewall.RuleIndex([]), 'nat': firewall.RuleIndex([])}
+
+        output = self.fw.forward(target_port=22, target_addr='8.6.5.3', conn_port=5698)
+
+        self.assertEqual(output, 'set:8.6.5.3,tcp:22')
+        self.assertEqual(fake_run_cmd.call_args[0][0], 'sudo ipset add fwd 8.6.5.3,tcp:22 -exist')
+
+    @patch.object(firewall, 'write_atomic')
+    def test_save_rules_ipsets(self, fake_write_atomic, fake_run_cmd):
+        """``save_rules`` also persists the set members"""
+        fw = firewall.FireWall(save_mode='sync', forward_mode='ipset', ipset_name='fwd')
+        fake_result = MagicMock()
+        fake_result.stdout = 'HelloWorld'
+        fake_run_cmd.return_value = fake_result
+
+        fw.save_rules()
+        written = [c[0][0] for c in fake_write_atomic.call_args_list]
+
+        self.assertEqual(written, ['/etc/iptables/ipsets', '/etc/iptables/rules.v4'])
+        self.assertEqual(fake_run_cmd.call_args_list[1][0][0], 'sudo ipset save fwd')
+
+
+@patch('vlab_ipam_api.lib.firewall.run_cmd')
+class TestFireWallProcessLock(unittest.TestCase):
+    """A suite of test cases for serializing changes between processes"""
+
+    def setUp(self):
+        """Runs before every test case"""
+        self.tmp = tempfile.TemporaryDirectory()
+        self.lock_file = os.path.join(self.tmp.name, 'fw.lock')
+        # Two objects sharing a lock file behave like two worker processes
+        self.fw_a = firewall.FireWall(save_mode='sync', lock_file=self.lock_file)
+        self.fw_b = firewall.FireWall(save_mode='sync', lock_file=self.lock_file)
+        for fw in (self.fw_a, self.fw_b):
+            fw.request_save = MagicMock()
+
+    def tearDown(self):
+        """Runs after every test case"""
+        self.tmp.cleanup()
+
+    def generation(self):
+        with open(self.lock_file) as the_file:
+            return int(the_file.read() or 0)
+
+    def test_change_bumps_generation(self, fake_run_cmd):
+        """A change increments the generation in the lock file"""
+        fake_run_cmd.return_value.stdout = SAVE_OUTPUT
+        self.fw_a.map_port(conn_port=5698, target_port=22, target_addr='8.6.5.3')
+
+        self.assertEqual(self.generation(), 1)
+
+    def test_read_keeps_generation(self, fake_run_cmd):
+        """Looking up a rule doesn't change the generation"""
+        fake_run_cmd.return_value.stdout = SAVE_OUTPUT
+        self.fw_a.find_rule(target_port=443, target_addr='2.2.2.2', table='nat', conn_port=5633)
+
+        self.assertEqual(self.generation(), 0)
+
+    def test_nested_bumps_once(self, fake_run_cmd):
+        """Changes within one ``with`` statement increment the generation once, on exit"""
+        fake_run_cmd.return_value.stdout = SAVE_OUTPUT
+        with self.fw_a:
+            self.fw_a.map_port(conn_port=5698, target_port=22, target_addr='8.6.5.3')
+            self.fw_a.map_port(conn_port=5699, target_port=22, target_addr='8.6.5.4')
+            self.assertEqual(self.generation(), 0)
+
+        self.assertEqual(self.generation(), 1)
+
+    def test_other_process_change(self, fake_run_cmd):
+        """A change by another process drops the index, so it's reloaded from iptables"""
+        fake_run_cmd.return_value.stdout = SAVE_OUTPUT
+        self.fw_b.load_index()
+        self.fw_a.map_port(conn_port=5698, target_port=22, target_addr='8.6.5.3')
+        fake_run_cmd.return_value.stdout = SAVE_OUTPUT.replace('--dport 5633 ', '--dport 5698 ').replace(
+                                           'vlab-ipam:5633 -j DNAT --to-destination 2.2.2.2:443',
+                                           'vlab-ipam:5698 -j DNAT --to-destination 8.6.5.3:22')
+        fake_run_cmd.reset_mock()
+
+        output = self.fw_b.find_rule(target_port=22, target_addr='8.6.5.3', table='nat', conn_port=5698)
+
+        self.assertIn('--dport 5698', output)
+        self.assertEqual(fake_run_cmd.call_args[0][0], 'sudo iptables-save')
+
+    def test_own_change_keeps_index(self, fake_run_cmd):
+        """The process that made a change keeps its index"""
+        fake_run_cmd.return_value.stdout = SAVE_OUTPUT
+        self.fw_a.load_index()
+        self.fw_a.map_port(conn_port=5698, target_port=22, target_addr='8.6.5.3')
+        fake_run_cmd.reset_mock()
+
+        self.fw_a.find_rule(target_port=22, target_addr='8.6.5.3', table='nat', conn_port=5698)
+
+        self.assertFalse(fake_run_cmd.called)
+
+    def test_excludes_other_process(self, fake_run_cmd):
+        """Only one process at a time holds the lock"""
+        done = []
+        with self.fw_a:
+            thread = Thread(target=lambda: done.append(self.fw_b.__enter__()))
+            thread.start()
+            thread.join(0.1)
+            self.assertEqual(done, [])
+        thread.join(1)
+
+        self.assertEqual(done, [None])
+
+    def test_no_lock_file(self, fake_run_cmd):
+        """An empty lock_file only locks within the process"""
+        fw = firewall.FireWall(lock_file='')
+        with fw:
+            self.assertTrue(fw._process_fd is None)
+
+    def test_released_on_error(self, fake_run_cmd):
+        """The lock is released when the change fails"""
+        fake_run_cmd.side_effect = CliError('iptables-restore', '', 'testing', 1)
+        self.fw_a._index = {'filter': firewall.RuleIndex([]), 'nat': firewall.RuleIndex([])}
+        with self.assertRaises(CliError):
+            self.fw_a.delete_rule(rule_id='-i ens160 -j DNAT', table='nat')
+
+        self.assertTrue(self.fw_a._process_fd is None)
+        self.assertEqual(self.generation(), 1)
+
+
+class TestRuleSaver(unittest.TestCase):
+    """A suite of test cases for the RuleSaver object"""
+
+    def test_coalesces(self):
+        """``RuleSaver`` saves once for a burst of requests"""
+        fake_save = MagicMock()
+        saver = firewall.RuleSaver(fake_save, delay=0.2)
+        for _ in range(10):
+            saver.request()
+        time.sleep(0.1)
+        saver.request()
+        time.sleep(0.5)
+
+        # The 1st request saves right away; the rest wait out the delay together
+        self.assertTrue(fake_save.call_count <= 2)
+        self.assertEqual(saver.stats['requests'], 11)
+        self.assertFalse(saver._dirty)
+
+    def test_flush(self):
+        """``flush`` saves an outstanding request right away"""
+        fake_save = MagicMock()
+        saver = firewall.RuleSaver(fake_save, delay=60)
+        saver._last_save = time.time()
+        saver.request()
+        saver.flush()
+
+        self.assertEqual(fake_save.call_count, 1)
+
+    def test_flush_nothing(self):
+        """``flush`` does nothing without an outstanding request"""
+        fake_save = MagicMock()
+        saver = firewall.RuleSaver(fake_save, delay=60)
+        saver.flush()
+
+        self.assertFalse(fake_save.called)
+
+    def test_flush_waits(self):
+        """``flush`` waits for a save the background thread already started"""
+        started = Event()
+        release = Event()
+        saved = []
+        def slow_save():
+            started.set()
+            release.wait(1)
+            saved.append(True)
+        saver = firewall.RuleSaver(slow_save, delay=0)
+        saver.request()
+        started.wait(1)
+        flusher = Thread(target=saver.flush)
+        flusher.start()
+        flusher.join(0.1)
+        self.assertTrue(flusher.is_alive())
+        release.set()
+        flusher.join(1)
+
+        self.assertEqual(saved, [True])
+
+    def test_error_retries(self):
+        """``RuleSaver`` keeps the request outstanding if the save fails"""
+        fake_save = MagicMock()
+        fake_save.side_effect = [RuntimeError('testing')]
+        saver = firewall.RuleSaver(fake_save, delay=60)
+        saver._dirty = True
+        saver.flush()
+
+        self.assertTrue(saver._dirty)
+        self.assertEqual(saver.stats['errors'], 1)
+
+    @patch.object(firewall, 'logger')
+    def test_error_logged(self, fake_logger):
+        """``RuleSaver`` logs a failed save, with the traceback"""
+        fake_save = MagicMock()
+        fake_save.side_effect = [RuntimeError('testing')]
+        saver = firewall.RuleSaver(fake_save, delay=60)
+        saver._dirty = True
+        saver.flush()
+
+        self.assertTrue(fake_logger.exception.called)
+
+    def test_error_failure(self):
+        """``RuleSaver`` records the error of a failed save"""
+        fake_save = MagicMock()
+        fake_save.side_effect = [RuntimeError('testing')]
+        saver = firewall.RuleSaver(fake_save, delay=60)
+        saver._dirty = True
+        saver.flush()
+
+        self.assertEqual(saver.failure[1], 'testing')
+
+    def test_error_since(self):
+        """``RuleSaver`` keeps the time of the 1st failed save in a row"""
+        fake_save = MagicMock()
+        fake_save.side_effect = [RuntimeError('testing'), RuntimeError('again')]
+        saver = firewall.RuleSaver(fake_save, delay=0)
+        saver._dirty = True
+        saver.flush()
+        since = saver.failure[0]
+        saver.flush()
+
+        self.assertEqual(saver.failure, (since, 'again'))
+
+    def test_error_cleared(self):
+        """``RuleSaver`` clears the failure once a save works"""
+        fake_save = MagicMock()
+        fake_save.side_effect = [RuntimeError('testing'), None]
+        saver = firewall.RuleSaver(fake_save, delay=0)
+        saver._dirty = True
+        saver.flush()
+        saver.flush()
+
+        self.assertTrue(saver.failure is None)
+
+
+class TestWriteAtomic(unittest.TestCase):
+    """A suite of test cases for the ``write_atomic`` function"""
+
+    def test_write_atomic(self):
+        """``write_atomic`` replaces the file content, and leaves no temp file behind"""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'rules.v4')
+            with open(path, 'w') as the_file:
+                the_file.write('old')
+            firewall.write_atomic(path, 'new')
+
+            with open(path) as the_file:
+                content = the_file.read()
+            leftovers = os.listdir(tmp_dir)
+
+        self.assertEqual(content, 'new')
+        self.assertEqual(leftovers, ['rules.v4'])
+
+
+class TestRuleBatch(unittest.TestCase):
+    """A suite of test cases for the RuleBatch object"""
+
+    def test_render_deletes_first(self):
+        """``RuleBatch`` deletes rules from the highest number down, before appending"""
+        batch = firewall.RuleBatch()
+        batch.forward(target_port=22, target_addr='1.2.3.4')
+        batch.delete('3', table='filter')
+        batch.delete('7', table='filter')
+
+        output = batch.render()
+        expected = '*filter\n-D FORWARD 7\n-D FORWARD 3\n-A FORWARD -p tcp -d 1.2.3.4 --dport 22 -j ACCEPT\nCOMMIT\n'
+
+        self.assertEqual(output, expected)
+
+    def test_render_inserts(self):
+        """``RuleBatch`` inserts rules at the top of the chain, in the order supplied"""
+        batch = firewall.RuleBatch()
+        batch.insert('filter', 'first')
+        batch.insert('filter', 'second')
+        batch.delete('3', table='filter')
+
+        output = batch.render()
+        expected = '*filter\n-D FORWARD 3\n-I FORWARD 1 second\n-I FORWARD 1 first\nCOMMIT\n'
+
+        self.assertEqual(output, expected)
+
+    def test_render_skips_empty_tables(self):
+        """``RuleBatch`` only includes the tables it changes"""
+        batch = firewall.RuleBatch()
+        batch.delete('3', table='nat')
+
+        self.assertEqual(batch.render(), '*nat\n-D PREROUTING 3\nCOMMIT\n')
+
+    def test_len(self):
+        """``RuleBatch`` supports len()"""
+        batch = firewall.RuleBatch()
+        batch.delete('3', table='nat')
+        batch.forward(target_port=22, target_addr='1.2.3.4')
+
+        self.assertEqual(len(batch), 2)
+
+    def test_delete_value_error(self):
+        """``RuleBatch`` raises ValueError if supplied table is not supported"""
+        batch = firewall.RuleBatch()
+
+        with self.assertRaises(ValueError):
+            batch.delete('3', table='NoTable')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,154 @@
+# -*- coding: UTF-8 -*-
+"""A suite of tests for the firewall_helper.py module"""
+import os
+import socket
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch, MagicMock
+
+from vlab_ipam_api import firewall_helper
+from vlab_ipam_api.lib import helper_client
+
+
+def stand_in_helper(path, outputs=None):
+    """Start a FirewallHelper that records the commands, instead of running them
+
+    :Returns: Tuple (server, list of (cmd, stdin) it was sent)
+    """
+    ran = []
+    outputs = outputs or {}
+    def runner(cmd, stdin=None):
+        ran.append((cmd, stdin))
+        return outputs.get(cmd, {'stdout' : '', 'stderr' : '', 'exit_code' : 0})
+    server = firewall_helper.FirewallHelper(path, MagicMock(), runner=runner)
+    threading.Thread(target=server.serve_forever, args=(0.01,), daemon=True).start()
+    return server, ran
+
+
+class TestAllowed(unittest.TestCase):
+    """A suite of test cases for the ``allowed`` function"""
+
+    def test_backend_commands(self):
+        """``allowed`` permits every command the firewall backends run"""
+        commands = ['iptables-save',
+                    'iptables-restore --noflush',
+                    'ipset create vlab-ipam-forward hash:ip,port -exist',
+                    'ipset add vlab-ipam-forward 1.2.3.4,tcp:22 -exist',
+                    'ipset del vlab-ipam-forward 1.2.3.4,tcp:22 -exist',
+                    'ipset save vlab-ipam-forward',
+                    'ipset restore -exist',
+                    'nft -f -',
+                    'nft -j list table ip vlab_ipam',
+                    'nft list table ip vlab_ipam']
+
+        self.assertEqual([c for c in commands if not firewall_helper.allowed(c)], [])
+
+    def test_other_commands(self):
+        """``allowed`` refuses anything else"""
+        commands = ['rm -rf /',
+                    'iptables -F',
+                    'iptables-restore',
+                    'ipset destroy vlab-ipam-forward',
+                    'ipset add vlab-ipam-forward 1.2.3.4,tcp:22 -exist; reboot',
+                    'nft flush ruleset']
+
+        self.assertEqual([c for c in commands if firewall_helper.allowed(c)], [])
+
+
+class TestRunBatch(unittest.TestCase):
+    """A suite of test cases for the ``run_batch`` function"""
+
+    def test_in_order(self):
+        """``run_batch`` runs every command, in order"""
+        runner = MagicMock(return_value={'stdout' : '', 'stderr' : '', 'exit_code' : 0})
+        batch = [{'cmd' : 'iptables-save', 'stdin' : None},
+                 {'cmd' : 'iptables-restore --noflush', 'stdin' : '*nat\nCOMMIT\n'}]
+        results = firewall_helper.run_batch(batch, runner=runner)
+
+        self.assertEqual(len(results), 2)
+        self.assertEqual(runner.call_args_list[1][0], ('iptables-restore --noflush', '*nat\nCOMMIT\n'))
+
+    def test_stops_on_failure(self):
+        """``run_batch`` doesn't run the commands after one that fails"""
+        runner = MagicMock(return_value={'stdout' : '', 'stderr' : 'doh', 'exit_code' : 1})
+        batch = [{'cmd' : 'iptables-save'}, {'cmd' : 'iptables-save'}]
+        results = firewall_helper.run_batch(batch, runner=runner)
+
+        self.assertEqual(len(results), 1)
+        self.assertEqual(runner.call_count, 1)
+
+    def test_not_allowed(self):
+        """``run_batch`` never runs a command that isn't allowed"""
+        runner = MagicMock()
+        results = firewall_helper.run_batch([{'cmd' : 'reboot'}], runner=runner)
+
+        self.assertFalse(runner.called)
+        self.assertEqual(results[0]['exit_code'], firewall_helper.NOT_ALLOWED)
+
+    @patch.object(firewall_helper.subprocess, 'run')
+    def test_execute(self, fake_run):
+        """``execute`` runs the command without a shell, and returns its output"""
+        fake_run.return_value.stdout = 'some rules'
+        fake_run.return_value.stderr = ''
+        fake_run.return_value.returncode = 0
+        result = firewall_helper.execute('iptables-save')
+
+        self.assertEqual(fake_run.call_args[0][0], ['iptables-save'])
+        self.assertEqual(result, {'stdout' : 'some rules', 'stderr' : '', 'exit_code' : 0})
+
+    @patch.object(firewall_helper.subprocess, 'run')
+    def test_execute_missing(self, fake_run):
+        """``execute`` returns an error result if the command doesn't exist"""
+        fake_run.side_effect = FileNotFoundError('no such file')
+        result = firewall_helper.execute('nft -f -', stdin='')
+
+        self.assertEqual(result['exit_code'], 1)
+
+
+class TestFirewallHelper(unittest.TestCase):
+    """A suite of test cases for the FirewallHelper server"""
+
+    def setUp(self):
+        """Runs before every test case"""
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'firewall.sock')
+        self.server, self.ran = stand_in_helper(self.path)
+
+    def tearDown(self):
+        """Runs after every test case"""
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp.cleanup()
+
+    def test_socket_mode(self):
+        """Only the owner and group can connect"""
+        mode = os.stat(self.path).st_mode & 0o777
+
+        self.assertEqual(mode, 0o660)
+
+    def test_several_requests(self):
+        """One connection can send several requests"""
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        with sock:
+            for _ in range(3):
+                helper_client.send_msg(sock, {'batch' : [{'cmd' : 'iptables-save', 'stdin' : None}]})
+                reply = helper_client.recv_msg(sock)
+
+        self.assertEqual(len(self.ran), 3)
+        self.assertEqual(reply['results'][0]['exit_code'], 0)
+
+    def test_malformed(self):
+        """A malformed request gets an error reply"""
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        with sock:
+            helper_client.send_msg(sock, {'not_a_batch' : []})
+            reply = helper_client.recv_msg(sock)
+
+        self.assertIn('error', reply)
+
+
+if __name__ == '__main__':
+    unittest.main()
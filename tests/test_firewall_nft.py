@@ -0,0 +1,384 @@
+# -*- coding: UTF-8 -*-
+"""A suite of unit tests for the vlab_ipam_api.lib.firewall_nft module"""
+import os
+import tempfile
+import unittest
+from unittest.mock import patch, MagicMock
+
+import ujson
+
+from vlab_ipam_api.lib import firewall, firewall_nft
+
+
+TABLE_LISTING = ujson.dumps({'nftables': [
+    {'metainfo': {'version': '0.9.8', 'json_schema_version': 1}},
+    {'table': {'family': 'ip', 'name': 'vlab_ipam', 'handle': 1}},
+    {'map': {'family': 'ip', 'name': 'portmap', 'table': 'vlab_ipam', 'type': 'inet_service',
+             'handle': 2, 'map': ['ipv4_addr', 'inet_service'],
+             'elem': [[5632, {'concat': ['1.1.1.1', 22]}],
+                      [5633, {'concat': ['2.2.2.2', 443]}],
+                      [5634, {'concat': ['2.2.2.2', 443]}]]}},
+    {'set': {'family': 'ip', 'name': 'forward', 'table': 'vlab_ipam', 'type': ['ipv4_addr', 'inet_service'],
+             'handle': 3, 'elem': [{'concat': ['1.1.1.1', 22]}, {'concat': ['2.2.2.2', 443]}]}},
+]})
+
+
+class TestElements(unittest.TestCase):
+    """A suite of test cases for formatting map and set elements"""
+
+    def test_map_element(self):
+        """``map_element`` formats a ``portmap`` element"""
+        self.assertEqual(firewall_nft.map_element('5698', '22', '8.6.5.3'), '5698 : 8.6.5.3 . 22')
+
+    def test_map_element_key(self):
+        """``map_element`` formats just the key, when there's no target"""
+        self.assertEqual(firewall_nft.map_element('5698'), '5698')
+
+    def test_set_element(self):
+        """``set_element`` formats a ``forward`` element"""
+        self.assertEqual(firewall_nft.set_element('8.6.5.3', '22'), '8.6.5.3 . 22')
+
+
+class TestGetFirewall(unittest.TestCase):
+    """A suite of test cases for the ``get_firewall`` function"""
+
+    def test_iptables(self):
+        """``get_firewall`` returns a FireWall for the 'iptables' backend"""
+        self.assertTrue(isinstance(firewall.get_firewall('iptables'), firewall.FireWall))
+
+    def test_nftables(self):
+        """``get_firewall`` returns an NftFireWall for the 'nftables' backend"""
+        fw = firewall.get_firewall('nftables', save_mode='sync')
+
+        self.assertTrue(isinstance(fw, firewall_nft.NftFireWall))
+        self.assertEqual(fw.save_mode, 'sync')
+
+    def test_bad_backend(self):
+        """``get_firewall`` raises ValueError for an unknown backend"""
+        with self.assertRaises(ValueError):
+            firewall.get_firewall('pf')
+
+
+# Mock away run_cmd in every test case
+@patch.object(firewall_nft, 'run_cmd')
+class TestNftFireWall(unittest.TestCase):
+    """A suite of test cases for the NftFireWall object"""
+
+    @classmethod
+    def setUp(cls):
+        """Runs before every test case"""
+        cls.fw = firewall_nft.NftFireWall(save_mode='sync', table_name='vlab_ipam')
+        cls.fw.save_rules = MagicMock()
+
+    @classmethod
+    def tearDown(cls):
+        """Runs after every test case"""
+        del cls.fw
+
+    def listing(self, fake_run_cmd):
+        """Make ``nft -j list table`` output the TABLE_LISTING"""
+        result = MagicMock()
+        result.stdout = TABLE_LISTING
+        fake_run_cmd.return_value = result
+
+    def test_bad_save_mode(self, fake_run_cmd):
+        """NftFireWall raises ValueError for an unknown save mode"""
+        with self.assertRaises(ValueError):
+            firewall_nft.NftFireWall(save_mode='sometimes')
+
+    def test_with(self, fake_run_cmd):
+        """NftFireWall supports use of the with statement"""
+        self.fw._lock = MagicMock()
+
+        with self.fw:
+            pass
+
+        self.assertEqual(self.fw._lock.acquire_write.call_count, 1)
+        self.assertEqual(self.fw._lock.release_write.call_count, 1)
+
+    def test_load_index(self, fake_run_cmd):
+        """``load_index`` loads the port mappings, and counts the mappings per target"""
+        self.listing(fake_run_cmd)
+
+        self.fw.load_index()
+
+        self.assertEqual(self.fw._maps[5633], ('2.2.2.2', 443))
+        self.assertEqual(self.fw._members[('2.2.2.2', 443)], 2)
+
+    def test_load_index_creates_table(self, fake_run_cmd):
+        """``load_index`` creates the table when it doesn't exist"""
+        fake_run_cmd.side_effect = [firewall_nft.CliError('nft', '', 'No such file or directory', 1), MagicMock()]
+
+        self.fw.load_index()
+        args, kwargs = fake_run_cmd.call_args
+
+        self.assertEqual(args[0], 'sudo nft -f -')
+        self.assertTrue('dnat ip addr . port to tcp dport map @portmap' in kwargs['stdin'])
+        self.assertEqual(self.fw._maps, {})
+
+    def test_load_index_creates_table_bytes(self, fake_run_cmd):
+        """``load_index`` creates the table when ``nft`` reports it doesn't exist on stderr as bytes"""
+        fake_run_cmd.side_effect = [firewall_nft.CliError('nft', b'', b'Error: No such file or directory', 1), MagicMock()]
+
+        self.fw.load_index()
+        args, _ = fake_run_cmd.call_args
+
+        self.assertEqual(args[0], 'sudo nft -f -')
+
+    def test_load_index_error(self, fake_run_cmd):
+        """``load_index`` raises errors other than a missing table"""
+        fake_run_cmd.side_effect = [firewall_nft.CliError('nft', '', 'Operation not permitted', 1), MagicMock()]
+
+        with self.assertRaises(firewall_nft.CliError):
+            self.fw.load_index()
+
+        self.assertEqual(fake_run_cmd.call_count, 1)
+
+    def test_map_port(self, fake_run_cmd):
+        """``map_port`` adds the map and set elements with one ``nft -f``"""
+        self.fw._maps = {}
+
+        self.fw.map_port(conn_port=5698, target_port=22, target_addr='8.6.5.3')
+        args, kwargs = fake_run_cmd.call_args
+        expected = 'add element ip vlab_ipam portmap { 5698 : 8.6.5.3 . 22 }\n' \
+                   'add element ip vlab_ipam forward { 8.6.5.3 . 22 }\n'
+
+        self.assertEqual(fake_run_cmd.call_count, 1)
+        self.assertEqual(args[0], 'sudo nft -f -')
+        self.assertEqual(kwargs['stdin'], expected)
+
+    def test_other_process_change(self, fake_run_cmd):
+        """A change by another process (sharing the lock file) drops the cached port mappings"""
+        with tempfile.TemporaryDirectory() as tmp:
+            lock_file = os.path.join(tmp, 'fw.lock')
+            fw_a = firewall_nft.NftFireWall(save_mode='sync', lock_file=lock_file)
+            fw_b = firewall_nft.NftFireWall(save_mode='sync', lock_file=lock_file)
+            fw_a.request_save = fw_b.request_save = MagicMock()
+            self.listing(fake_run_cmd)
+            fw_b.load_index()
+            fw_a.map_port(conn_port=5698, target_port=22, target_addr='8.6.5.3')
+            with fw_b:
+                cached = fw_b._maps
+
+        self.assertTrue(cached is None)
+
+    def test_map_port_shared_target(self, fake_run_cmd):
+        """``map_port`` only adds the set element once for port mappings to the same target"""
+        self.fw._maps = {}
+
+        self.fw.map_port(conn_port=5698, target_port=22, target_addr='8.6.5.3')
+        self.fw.map_port(conn_port=5699, target_port=22, target_addr='8.6.5.3')
+        _, kwargs = fake_run_cmd.call_args
+        expected = 'add element ip vlab_ipam portmap { 5699 : 8.6.5.3 . 22 }\n'
+
+        self.assertEqual(kwargs['stdin'], expected)
+
+    def test_map_port_saves(self, fake_run_cmd):
+        """``map_port`` auto-saves upon success"""
+        self.fw._maps = {}
+
+        self.fw.map_port(conn_port=5698, target_port=22, target_addr='8.6.5.3')
+
+        self.assertEqual(self.fw.save_rules.call_count, 1)
+
+    def test_map_port_error(self, fake_run_cmd):
+        """``map_port`` does not save, nor record the mapping, if ``nft`` fails"""
+        self.fw._maps = {}
+        fake_run_cmd.side_effect = [firewall_nft.CliError('nft', '', 'testing', 1)]
+
+        with self.assertRaises(firewall_nft.CliError):
+            self.fw.map_port(conn_port=5698, target_port=22, target_addr='8.6.5.3')
+
+        self.assertFalse(self.fw.save_rules.called)
+        self.assertFalse(self.fw._members[('8.6.5.3', 22)])
+
+    def test_find_rule_nat(self, fake_run_cmd):
+        """``find_rule`` returns the ``portmap`` key for the nat table"""
+        self.listing(fake_run_cmd)
+
+        output = self.fw.find_rule(target_port='443', target_addr='2.2.2.2', table='nat', conn_port='5633')
+
+        self.assertEqual(output, '5633')
+
+    def test_find_rule_filter(self, fake_run_cmd):
+        """``find_rule`` returns the ``forward`` element for the filter table"""
+        self.listing(fake_run_cmd)
+
+        output = self.fw.find_rule(target_port=22, target_addr='1.1.1.1', table='filter', conn_port=5632)
+
+        self.assertEqual(output, '1.1.1.1 . 22')
+
+    def test_find_rule_wrong_target(self, fake_run_cmd):
+        """``find_rule`` raises RuntimeError if the conn_port maps to a different target"""
+        self.listing(fake_run_cmd)
+
+        with self.assertRaises(RuntimeError):
+            self.fw.find_rule(target_port=22, target_addr='2.2.2.2', table='nat', conn_port=5633)
+
+    def test_find_rule_no_record(self, fake_run_cmd):
+        """``find_rule`` returns None when there's no database record for the port mapping"""
+        self.listing(fake_run_cmd)
+
+        output = self.fw.find_rule(target_port=None, target_addr=None, table='filter', conn_port=5633)
+
+        self.assertTrue(output is None)
+
+    def test_find_rule_nat_conn_port(self, fake_run_cmd):
+        """``find_rule`` raises ValueError if the conn_port is not supplied for the nat table"""
+        with self.assertRaises(ValueError):
+            self.fw.find_rule(target_port=22, target_addr='1.1.1.1', table='nat')
+
+    def test_find_rule_bad_table(self, fake_run_cmd):
+        """``find_rule`` raises ValueError for an unknown table"""
+        with self.assertRaises(ValueError):
+            self.fw.find_rule(target_port=22, target_addr='1.1.1.1', table='mangle', conn_port=5632)
+
+    def test_delete_rule_nat(self, fake_run_cmd):
+        """``delete_rule`` deletes the ``portmap`` element for the nat table"""
+        self.listing(fake_run_cmd)
+        self.fw.load_index()
+
+        self.fw.delete_rule('5632', table='nat')
+        _, kwargs = fake_run_cmd.call_args
+
+        self.assertEqual(kwargs['stdin'], 'delete element ip vlab_ipam portmap { 5632 }\n')
+        self.assertFalse(5632 in self.fw._maps)
+
+    def test_delete_rule_shared_target(self, fake_run_cmd):
+        """``delete_rule`` keeps a ``forward`` element that another port mapping still uses"""
+        self.listing(fake_run_cmd)
+        self.fw.load_index()
+        fake_run_cmd.reset_mock()
+
+        self.fw.delete_rule('2.2.2.2 . 443', table='filter')
+
+        self.assertFalse(fake_run_cmd.called)
+
+    def test_delete_rule_last_target(self, fake_run_cmd):
+        """``delete_rule`` deletes a ``forward`` element once no port mapping uses it"""
+        self.listing(fake_run_cmd)
+        self.fw.load_index()
+
+        self.fw.delete_rule('1.1.1.1 . 22', table='filter')
+        _, kwargs = fake_run_cmd.call_args
+
+        self.assertEqual(kwargs['stdin'], 'delete element ip vlab_ipam forward { 1.1.1.1 . 22 }\n')
+
+    def test_unmap_port(self, fake_run_cmd):
+        """``unmap_port`` deletes the ``portmap`` and last ``forward`` element with one ``nft -f``"""
+        self.listing(fake_run_cmd)
+        self.fw.load_index()
+        fake_run_cmd.reset_mock()
+
+        self.fw.unmap_port('5632', '1.1.1.1 . 22')
+        _, kwargs = fake_run_cmd.call_args
+        expected = 'delete element ip vlab_ipam portmap { 5632 }\ndelete element ip vlab_ipam forward { 1.1.1.1 . 22 }\n'
+
+        self.assertEqual(fake_run_cmd.call_count, 1)
+        self.assertEqual(kwargs['stdin'], expected)
+        self.assertFalse(5632 in self.fw._maps)
+        self.assertFalse(('1.1.1.1', 22) in self.fw._members)
+
+    def test_unmap_port_shared_target(self, fake_run_cmd):
+        """``unmap_port`` keeps a ``forward`` element that another port mapping still uses"""
+        self.listing(fake_run_cmd)
+        self.fw.load_index()
+        fake_run_cmd.reset_mock()
+
+        self.fw.unmap_port('5633', '2.2.2.2 . 443')
+        _, kwargs = fake_run_cmd.call_args
+
+        self.assertEqual(kwargs['stdin'], 'delete element ip vlab_ipam portmap { 5633 }\n')
+        self.assertEqual(self.fw._members[('2.2.2.2', 443)], 1)
+
+    def test_forward(self, fake_run_cmd):
+        """``forward`` adds the ``forward`` element, and returns it as the rule ID"""
+        self.fw._maps = {}
+
+        output = self.fw.forward(target_port=22, target_addr='8.6.5.3', conn_port=5698)
+        _, kwargs = fake_run_cmd.call_args
+
+        self.assertEqual(output, '8.6.5.3 . 22')
+        self.assertEqual(kwargs['stdin'], 'add element ip vlab_ipam forward { 8.6.5.3 . 22 }\n')
+
+    def test_prerouting(self, fake_run_cmd):
+        """``prerouting`` adds the ``portmap`` element, and returns its key as the rule ID"""
+        self.fw._maps = {}
+
+        output = self.fw.prerouting(conn_port=5698, target_port=22, target_addr='8.6.5.3')
+
+        self.assertEqual(output, '5698')
+        self.assertEqual(self.fw._maps[5698], ('8.6.5.3', 22))
+
+    def test_show_nat(self, fake_run_cmd):
+        """``show`` parses the ``portmap`` elements for the nat table"""
+        self.listing(fake_run_cmd)
+
+        output = self.fw.show(table='nat')
+        expected = {'conn_port': 5632, 'target_addr': '1.1.1.1', 'target_port': 22}
+
+        self.assertEqual(output['5632'], expected)
+        self.assertEqual(fake_run_cmd.call_args[0][0], 'sudo nft -j list table ip vlab_ipam')
+
+    def test_show_filter(self, fake_run_cmd):
+        """``show`` parses the ``forward`` elements for the filter table"""
+        self.listing(fake_run_cmd)
+
+        output = self.fw.show(table='filter')
+        expected = {'1.1.1.1 . 22': {'target_addr': '1.1.1.1', 'target_port': 22},
+                    '2.2.2.2 . 443': {'target_addr': '2.2.2.2', 'target_port': 443}}
+
+        self.assertEqual(output, expected)
+
+    def test_show_raw(self, fake_run_cmd):
+        """``show`` returns the JSON of the ``portmap`` map when the format is 'raw'"""
+        self.listing(fake_run_cmd)
+
+        output = self.fw.show(table='nat', format='raw')
+
+        self.assertEqual(ujson.loads(output)['map']['name'], 'portmap')
+
+    def test_snapshot(self, fake_run_cmd):
+        """``snapshot`` lists the map and set with one ``nft`` command"""
+        self.listing(fake_run_cmd)
+
+        snapshot = self.fw.snapshot()
+        snapshot.show(table='nat')
+        snapshot.show(table='filter')
+
+        self.assertEqual(fake_run_cmd.call_count, 1)
+
+    def test_show_value_error(self, fake_run_cmd):
+        """``show`` raises ValueError if supplied with a bad table value"""
+        with self.assertRaises(ValueError):
+            self.fw.show(table='NoTable')
+
+    @patch.object(firewall_nft, 'write_atomic')
+    def test_save_rules(self, fake_write_atomic, fake_run_cmd):
+        """``save_rules`` writes the table such that loading it replaces the current one"""
+        fw = firewall_nft.NftFireWall(save_mode='sync', table_name='vlab_ipam')
+        fake_run_cmd.return_value.stdout = 'table ip vlab_ipam {}\n'
+
+        fw.save_rules()
+        args, _ = fake_write_atomic.call_args
+        expected = ('/etc/nftables.d/vlab_ipam.nft',
+                    'table ip vlab_ipam\nflush table ip vlab_ipam\ntable ip vlab_ipam {}\n')
+
+        self.assertEqual(args, expected)
+
+
+    @patch.object(firewall_nft, 'write_atomic')
+    def test_save_rules_lock(self, fake_write_atomic, fake_run_cmd):
+        """``save_rules`` only holds the lock while listing the table, not while writing the file"""
+        fw = firewall_nft.NftFireWall(save_mode='sync', table_name='vlab_ipam')
+        fw._lock = MagicMock()
+        fake_run_cmd.return_value.stdout = 'table ip vlab_ipam {}\n'
+        fake_write_atomic.side_effect = lambda *args: self.assertTrue(fw._lock.release_read.called)
+
+        fw.save_rules()
+
+        self.assertEqual(fake_write_atomic.call_count, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,11 +2,13 @@
 """
 A suite of tests for the healthcheck API end point
 """
+import time
 import unittest
 from unittest.mock import patch
 
 from flask import Flask
 
+from vlab_ipam_api.lib import firewall
 from vlab_ipam_api.lib.views import healthcheck
 
 
@@ -17,11 +19,12 @@ class TestHealthView(unittest.TestCase):
     def setUp(cls):
         """Runs before every test case"""
         app = Flask(__name__)
+        app.firewall = firewall.FireWall(lock_file='')
         healthcheck.HealthView.register(app)
         app.config['TESTING'] = True
         cls.app = app.test_client()
 
-    @patch.object(healthcheck.firewall, 'run_cmd')
+    @patch.object(firewall, 'run_cmd')
     @patch.object(healthcheck, 'Database')
     def test_health_check_ok(self, fake_Database, fake_run_cmd):
         """Healthcheck returns HTTP 200 when everything is OK"""
@@ -31,7 +34,7 @@ class TestHealthView(unittest.TestCase):
 
         self.assertEqual(expected, resp.status_code)
 
-    @patch.object(healthcheck.firewall, 'run_cmd')
+    @patch.object(firewall, 'run_cmd')
     @patch.object(healthcheck, 'Database')
     def test_health_check_keys(self, fake_Database, fake_run_cmd):
         """Healthcheck returns expected info in JSON response"""
@@ -42,7 +45,7 @@ class TestHealthView(unittest.TestCase):
         # set() avoids false positives due to order
         self.assertEqual(set(expected), set(actual))
 
-    @patch.object(healthcheck.firewall, 'run_cmd')
+    @patch.object(firewall, 'run_cmd')
     @patch.object(healthcheck, 'Database')
     def test_health_check_db_error(self, fake_Database, fake_run_cmd):
         """The healthcheck returns HTTP 500 when the database generates an error"""
@@ -53,6 +56,28 @@ class TestHealthView(unittest.TestCase):
 
         self.assertEqual(expected, resp.status_code)
 
+    @patch.object(firewall, 'run_cmd')
+    @patch.object(healthcheck, 'Database')
+    def test_health_check_save_error(self, fake_Database, fake_run_cmd):
+        """The healthcheck returns HTTP 500 when the firewall rules can't be saved"""
+        self.app.application.firewall._saver.failure = (time.time(), 'testing')
+        resp = self.app.get('/api/1/ipam/healthcheck')
+
+        expected = 500
+
+        self.assertEqual(expected, resp.status_code)
+
+    @patch.object(firewall, 'run_cmd')
+    @patch.object(healthcheck, 'Database')
+    def test_health_check_save_error_msg(self, fake_Database, fake_run_cmd):
+        """The healthcheck describes why the firewall rules can't be saved"""
+        self.app.application.firewall._saver.failure = (time.time(), 'testing')
+        resp = self.app.get('/api/1/ipam/healthcheck')
+
+        expected = 'Unable to save the firewall rules for 0 seconds: testing'
+
+        self.assertEqual(expected, resp.json['error'])
+
 
 if __name__ == '__main__':
     unittest.main()
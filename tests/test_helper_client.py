@@ -0,0 +1,138 @@
+# -*- coding: UTF-8 -*-
+"""A suite of unit tests for the vlab_ipam_api.lib.helper_client module"""
+import os
+import socket
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+
+from vlab_ipam_api.lib import helper_client
+from tests.test_firewall_helper import stand_in_helper
+
+
+class TestMessages(unittest.TestCase):
+    """A suite of test cases for the message framing"""
+
+    def test_round_trip(self):
+        """``recv_msg`` reads what ``send_msg`` wrote"""
+        left, right = socket.socketpair()
+        with left, right:
+            helper_client.send_msg(left, {'batch' : [{'cmd' : 'iptables-save', 'stdin' : 'é' * 1000}]})
+            output = helper_client.recv_msg(right)
+
+        self.assertEqual(output['batch'][0]['stdin'], 'é' * 1000)
+
+    def test_closed(self):
+        """``recv_msg`` returns None when the peer closed the connection"""
+        left, right = socket.socketpair()
+        left.close()
+        with right:
+            output = helper_client.recv_msg(right)
+
+        self.assertTrue(output is None)
+
+    def test_closed_mid_message(self):
+        """``recv_msg`` raises ConnectionError if the connection closes mid-message"""
+        left, right = socket.socketpair()
+        left.sendall(helper_client.HEADER.pack(10) + b'{}')
+        left.close()
+        with right:
+            with self.assertRaises(ConnectionError):
+                helper_client.recv_msg(right)
+
+    def test_too_big(self):
+        """``recv_msg`` raises ValueError rather than read an enormous message"""
+        left, right = socket.socketpair()
+        with left, right:
+            left.sendall(helper_client.HEADER.pack(helper_client.MAX_MESSAGE + 1))
+            with self.assertRaises(ValueError):
+                helper_client.recv_msg(right)
+
+    def test_strip_sudo(self):
+        """``strip_sudo`` removes a leading sudo"""
+        self.assertEqual(helper_client.strip_sudo('sudo iptables-save'), 'iptables-save')
+        self.assertEqual(helper_client.strip_sudo('iptables-save'), 'iptables-save')
+
+
+class TestHelperClient(unittest.TestCase):
+    """A suite of test cases for the HelperClient object, against a stand-in helper"""
+
+    def setUp(self):
+        """Runs before every test case"""
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'firewall.sock')
+        outputs = {'iptables-save' : {'stdout' : '*nat\nCOMMIT\n', 'stderr' : '', 'exit_code' : 0},
+                   'iptables-restore --noflush' : {'stdout' : '', 'stderr' : 'line 2 failed', 'exit_code' : 1}}
+        self.server, self.ran = stand_in_helper(self.path, outputs)
+        self.client = helper_client.HelperClient(self.path, timeout=5)
+
+    def tearDown(self):
+        """Runs after every test case"""
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp.cleanup()
+
+    def test_run_cmd(self):
+        """``run_cmd`` returns the output, like ``shell.run_cmd``"""
+        result = self.client.run_cmd('sudo iptables-save')
+
+        self.assertEqual(result.stdout, '*nat\nCOMMIT\n')
+        self.assertEqual(result.command, 'sudo iptables-save')
+        self.assertEqual(self.ran, [('iptables-save', None)])
+
+    def test_run_cmd_error(self):
+        """``run_cmd`` raises CliError when the command fails"""
+        with self.assertRaises(helper_client.CliError) as caught:
+            self.client.run_cmd('sudo iptables-restore --noflush', stdin='*nat\n')
+
+        self.assertEqual(caught.exception.stderr, 'line 2 failed')
+
+    def test_run_cmd_not_allowed(self):
+        """``run_cmd`` raises CliError when the helper refuses the command"""
+        with self.assertRaises(helper_client.CliError):
+            self.client.run_cmd('sudo reboot')
+
+        self.assertEqual(self.ran, [])
+
+    def test_run_cmd_unreachable(self):
+        """``run_cmd`` raises CliError when the helper isn't running"""
+        client = helper_client.HelperClient(os.path.join(self.tmp.name, 'nope.sock'))
+        with self.assertRaises(helper_client.CliError):
+            client.run_cmd('sudo iptables-save')
+
+    def test_run_batch(self):
+        """``run`` sends several commands at once, and stops at the first failure"""
+        results = self.client.run([('sudo iptables-save', None),
+                                   ('sudo iptables-restore --noflush', '*nat\n'),
+                                   ('sudo iptables-save', None)])
+
+        self.assertEqual([r.exit_code for r in results], [0, 1])
+        self.assertEqual(len(self.ran), 2)
+
+    def test_reuses_connection(self):
+        """The connection stays open between requests"""
+        self.client.run_cmd('sudo iptables-save')
+        sock = self.client._local.sock
+        self.client.run_cmd('sudo iptables-save')
+
+        self.assertTrue(self.client._local.sock is sock)
+
+    def test_reconnects(self):
+        """A connection the helper closed (i.e. restarted) is replaced before use"""
+        self.client.run_cmd('sudo iptables-save')
+        self.server.shutdown()
+        self.server.server_close()
+        self.server, self.ran = stand_in_helper(self.path)
+
+        result = self.client.run_cmd('sudo iptables-save')
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual(len(self.ran), 1)
+
+    def test_get_helper(self):
+        """``get_helper`` shares one client per socket"""
+        self.assertTrue(helper_client.get_helper(self.path) is helper_client.get_helper(self.path))
+
+
+if __name__ == '__main__':
+    unittest.main()
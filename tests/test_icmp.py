@@ -0,0 +1,213 @@
+# -*- coding: UTF-8 -*-
+"""A suite of unit tests for the icmp.py module"""
+import socket
+import asyncio
+import unittest
+from unittest.mock import MagicMock
+
+from vlab_ipam_api.lib import icmp
+
+
+def reply_for(packet, raw=False):
+    """The echo reply a target sends for an echo request"""
+    reply = icmp.HEADER.pack(icmp.ECHO_REPLY, 0, 0, *icmp.HEADER.unpack_from(packet)[3:]) + packet[icmp.HEADER.size:]
+    if raw:
+        reply = b'\x45' + b'\x00' * 19 + reply # a 20 byte IP header
+    return reply
+
+
+def can_open_icmp_socket():
+    for kind in (socket.SOCK_DGRAM, socket.SOCK_RAW):
+        try:
+            socket.socket(socket.AF_INET, kind, socket.IPPROTO_ICMP).close()
+        except OSError:
+            continue
+        return True
+    return False
+
+
+class TestPackets(unittest.TestCase):
+    """A suite of test cases for building and parsing ICMP packets"""
+
+    def test_checksum(self):
+        """``checksum`` of a packet that includes its checksum is zero"""
+        packet = icmp.echo_request(1234, 5, b'abcdefg')
+
+        self.assertEqual(icmp.checksum(packet), 0)
+
+    def test_echo_request(self):
+        """``echo_request`` sets the type, identifier and sequence"""
+        packet = icmp.echo_request(1234, 5, b'spam')
+        icmp_type, code, _, ident, seq = icmp.HEADER.unpack_from(packet)
+
+        self.assertEqual((icmp_type, code, ident, seq), (icmp.ECHO_REQUEST, 0, 1234, 5))
+        self.assertTrue(packet.endswith(b'spam'))
+
+    def test_parse_reply(self):
+        """``parse_reply`` returns the identifier, sequence and payload"""
+        data = reply_for(icmp.echo_request(1234, 5, b'spam'))
+
+        self.assertEqual(icmp.parse_reply(data, raw=False), (1234, 5, b'spam'))
+
+    def test_parse_reply_raw(self):
+        """``parse_reply`` skips the IP header of a packet from a raw socket"""
+        data = reply_for(icmp.echo_request(1234, 5, b'spam'), raw=True)
+
+        self.assertEqual(icmp.parse_reply(data, raw=True), (1234, 5, b'spam'))
+
+    def test_parse_reply_request(self):
+        """``parse_reply`` ignores echo requests, i.e. our own on a raw socket via loopback"""
+        data = icmp.echo_request(1234, 5, b'spam')
+
+        self.assertTrue(icmp.parse_reply(data, raw=False) is None)
+
+    def test_parse_reply_short(self):
+        """``parse_reply`` ignores truncated packets"""
+        self.assertTrue(icmp.parse_reply(b'\x00\x00', raw=False) is None)
+        self.assertTrue(icmp.parse_reply(b'', raw=True) is None)
+
+
+class TestIcmpProber(unittest.TestCase):
+    """A suite of test cases for the IcmpProber object"""
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.sock = MagicMock()
+        self.sock.type = socket.SOCK_DGRAM
+        self.sock.fileno.return_value = 99
+        self.loop.add_reader = MagicMock()
+        self.loop.remove_reader = MagicMock()
+        self.loop.remove_writer = MagicMock()
+        self.prober = icmp.IcmpProber(count=2, interval=0.01, timeout=0.02)
+        self.prober.open(self.loop, sock=self.sock)
+
+    def tearDown(self):
+        self.prober.close()
+        self.loop.close()
+
+    def answer(self, source=None, raw=False):
+        """Make the target of every echo request reply"""
+        def sendto(packet, dest):
+            self.loop.call_soon(self.prober.handle, reply_for(packet, raw=raw), source or dest[0])
+        self.sock.sendto.side_effect = sendto
+
+    def test_probe_reply(self):
+        """``IcmpProber.probe`` returns True when the address replies"""
+        self.answer()
+        result = self.loop.run_until_complete(self.prober.probe('10.1.1.1'))
+
+        self.assertTrue(result)
+        self.assertEqual(self.prober.stats['sent'], 1)
+
+    def test_probe_timeout(self):
+        """``IcmpProber.probe`` returns False after ``count`` echo requests go unanswered"""
+        result = self.loop.run_until_complete(self.prober.probe('10.1.1.1'))
+
+        self.assertFalse(result)
+        self.assertEqual(self.prober.stats['sent'], 2)
+
+    def test_probe_other_source(self):
+        """``IcmpProber.probe`` ignores a reply from another address"""
+        self.answer(source='10.9.9.9')
+        result = self.loop.run_until_complete(self.prober.probe('10.1.1.1'))
+
+        self.assertFalse(result)
+
+    def test_probe_send_error(self):
+        """``IcmpProber.probe`` treats an address the kernel can't route to as not pingable"""
+        self.sock.sendto.side_effect = OSError('No route to host')
+        result = self.loop.run_until_complete(self.prober.probe('10.1.1.1'))
+
+        self.assertFalse(result)
+        self.assertEqual(self.prober.stats['send_errors'], 2)
+
+    def test_probe_releases_seq(self):
+        """``IcmpProber.probe`` frees its sequence numbers once done"""
+        self.answer()
+        self.loop.run_until_complete(self.prober.probe('10.1.1.1'))
+
+        self.assertEqual(self.prober._pending, {})
+
+    def test_probe_raw_ident(self):
+        """``IcmpProber`` ignores replies to another process's probes on a raw socket"""
+        self.prober._raw = True
+        self.prober._ident = 1
+        def sendto(packet, dest):
+            other = icmp.echo_request(2, icmp.HEADER.unpack_from(packet)[4], self.prober._payload)
+            self.loop.call_soon(self.prober.handle, reply_for(other, raw=True), dest[0])
+        self.sock.sendto.side_effect = sendto
+        result = self.loop.run_until_complete(self.prober.probe('10.1.1.1'))
+
+        self.assertFalse(result)
+
+    def test_probe_raw(self):
+        """``IcmpProber`` matches replies on a raw socket"""
+        self.prober._raw = True
+        self.answer(raw=True)
+        result = self.loop.run_until_complete(self.prober.probe('10.1.1.1'))
+
+        self.assertTrue(result)
+
+    def test_probe_many(self):
+        """``IcmpProber.probe_many`` demultiplexes concurrent probes"""
+        def sendto(packet, dest):
+            if dest[0].endswith('.1'):
+                self.loop.call_soon(self.prober.handle, reply_for(packet), dest[0])
+        self.sock.sendto.side_effect = sendto
+        addrs = ['10.1.{}.{}'.format(x, y) for x in range(10) for y in range(1, 3)]
+        result = self.loop.run_until_complete(self.prober.probe_many(addrs, max_in_flight=5))
+        expected = {addr: addr.endswith('.1') for addr in addrs}
+
+        self.assertEqual(result, expected)
+
+    def test_send_blocked(self):
+        """``IcmpProber`` waits for the socket to be writable when its buffer is full"""
+        self.answer()
+        answer = self.sock.sendto.side_effect
+        blocked = [BlockingIOError()]
+        def sendto(packet, dest):
+            if blocked:
+                raise blocked.pop()
+            answer(packet, dest)
+        self.sock.sendto.side_effect = sendto
+        def add_writer(fd, callback):
+            self.loop.call_soon(callback)
+        self.loop.add_writer = add_writer
+        result = self.loop.run_until_complete(self.prober.probe('10.1.1.1'))
+
+        self.assertTrue(result)
+
+    def test_allocate_seq_skips_pending(self):
+        """``IcmpProber`` never reuses the sequence number of a pending echo request"""
+        self.prober._pending[0] = ('10.1.1.1', None)
+
+        self.assertEqual(self.prober._allocate_seq(), 1)
+
+    def test_allocate_seq_exhausted(self):
+        """``IcmpProber`` raises RuntimeError if every sequence number is in use"""
+        self.prober._pending = dict.fromkeys(range(0x10000))
+
+        with self.assertRaises(RuntimeError):
+            self.prober._allocate_seq()
+
+
+@unittest.skipUnless(can_open_icmp_socket(), 'Needs an ICMP socket (root, or net.ipv4.ping_group_range)')
+class TestIcmpProberLoopback(unittest.TestCase):
+    """Probes real addresses via the loopback interface"""
+
+    def test_loopback(self):
+        """``IcmpProber`` finds that loopback addresses reply"""
+        loop = asyncio.new_event_loop()
+        prober = icmp.IcmpProber(count=1, timeout=1)
+        prober.open(loop)
+        try:
+            result = loop.run_until_complete(prober.probe_many(['127.0.0.1', '127.0.0.2']))
+        finally:
+            prober.close()
+            loop.close()
+
+        self.assertEqual(result, {'127.0.0.1': True, '127.0.0.2': True})
+
+
+if __name__ == '__main__':
+    unittest.main()
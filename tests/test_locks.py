@@ -0,0 +1,185 @@
+# -*- coding: UTF-8 -*-
+"""A suite of unit tests for the vlab_ipam_api.lib.locks module"""
+import os
+import time
+import tempfile
+import unittest
+from threading import Thread, Event
+
+from vlab_ipam_api.lib import locks
+
+
+class TestRWLock(unittest.TestCase):
+    """A suite of test cases for the RWLock object"""
+
+    def setUp(self):
+        """Runs before every test case"""
+        self.lock = locks.RWLock()
+
+    def in_thread(self, func):
+        """Run ``func`` in another thread, and return an Event set once it's done"""
+        done = Event()
+        def target():
+            func()
+            done.set()
+        Thread(target=target, daemon=True).start()
+        return done
+
+    def test_readers_share(self):
+        """Several threads can hold the lock for reading at once"""
+        with self.lock.read():
+            done = self.in_thread(lambda: self.lock.read().__enter__())
+
+            self.assertTrue(done.wait(1))
+
+    def test_writer_excludes_readers(self):
+        """A reader waits for the writer to release the lock"""
+        with self.lock.write():
+            done = self.in_thread(lambda: self.lock.read().__enter__())
+
+            self.assertFalse(done.wait(0.1))
+        self.assertTrue(done.wait(1))
+
+    def test_reader_excludes_writers(self):
+        """A writer waits for the readers to release the lock"""
+        with self.lock.read():
+            done = self.in_thread(lambda: self.lock.write().__enter__())
+
+            self.assertFalse(done.wait(0.1))
+        self.assertTrue(done.wait(1))
+
+    def test_waiting_writer_blocks_new_readers(self):
+        """Once a writer is waiting, new readers wait behind it"""
+        order = []
+        def write():
+            with self.lock.write():
+                order.append('write')
+        def read():
+            with self.lock.read():
+                order.append('read')
+
+        with self.lock.read():
+            writer = self.in_thread(write)
+            while not self.lock._writers_waiting:
+                time.sleep(0.001)
+            reader = self.in_thread(read)
+
+            self.assertFalse(reader.wait(0.1))
+        self.assertTrue(writer.wait(1) and reader.wait(1))
+        self.assertEqual(order, ['write', 'read'])
+
+    def test_readers_turn_after_write(self):
+        """The readers waiting when a write finishes go before the next writer"""
+        order = []
+        def write():
+            with self.lock.write():
+                order.append('write')
+        def read():
+            with self.lock.read():
+                order.append('read')
+
+        self.lock.acquire_write()
+        reader = self.in_thread(read)
+        while not self.lock._readers_waiting:
+            time.sleep(0.001)
+        writer = self.in_thread(write)
+        while not self.lock._writers_waiting:
+            time.sleep(0.001)
+        self.lock.release_write()
+
+        self.assertTrue(writer.wait(1) and reader.wait(1))
+        self.assertEqual(order, ['read', 'write'])
+
+    def test_write_reentrant(self):
+        """The writer can acquire the lock again, to read or write"""
+        with self.lock.write():
+            with self.lock.write():
+                with self.lock.read():
+                    pass
+            self.assertEqual(self.lock._writer_depth, 1)
+        self.assertTrue(self.lock._writer is None)
+
+    def test_read_reentrant(self):
+        """A reader can read again, even with a writer waiting"""
+        with self.lock.read():
+            self.in_thread(lambda: self.lock.write().__enter__())
+            while not self.lock._writers_waiting:
+                time.sleep(0.001)
+            with self.lock.read():
+                depth = self.lock._readers.copy()
+
+        self.assertEqual(list(depth.values()), [2])
+
+    def test_no_upgrade(self):
+        """A reader that tries to write raises RuntimeError"""
+        with self.lock.read():
+            with self.assertRaises(RuntimeError):
+                self.lock.acquire_write()
+
+    def test_release_write_not_owner(self):
+        """Releasing a write lock held by another thread raises RuntimeError"""
+        with self.assertRaises(RuntimeError):
+            self.lock.release_write()
+
+
+class TestProcessLock(unittest.TestCase):
+    """A suite of test cases for the ProcessLock object"""
+
+    def setUp(self):
+        """Runs before every test case"""
+        self.tmp = tempfile.TemporaryDirectory()
+        self.lock = locks.ProcessLock(os.path.join(self.tmp.name, 'test.lock'))
+
+    def tearDown(self):
+        """Runs after every test case"""
+        self.tmp.cleanup()
+
+    def test_creates_file(self):
+        """The lock file is created if needed"""
+        with self.lock.hold():
+            pass
+
+        self.assertTrue(os.path.exists(self.lock.path))
+
+    def test_generation_default(self):
+        """A new lock file is generation zero"""
+        with self.lock.hold() as fd:
+            generation = locks.ProcessLock.generation(fd)
+
+        self.assertEqual(generation, 0)
+
+    def test_bump(self):
+        """``bump`` increments the generation, which persists between holds"""
+        with self.lock.hold() as fd:
+            locks.ProcessLock.bump(fd)
+            locks.ProcessLock.bump(fd)
+        with self.lock.hold() as fd:
+            generation = locks.ProcessLock.generation(fd)
+
+        self.assertEqual(generation, 2)
+
+    def test_generation_garbage(self):
+        """An unreadable generation counts as zero"""
+        with open(self.lock.path, 'w') as the_file:
+            the_file.write('not a number')
+        with self.lock.hold() as fd:
+            generation = locks.ProcessLock.generation(fd)
+
+        self.assertEqual(generation, 0)
+
+    def test_exclusive(self):
+        """Another holder, even within the same process, waits for the lock"""
+        other = locks.ProcessLock(self.lock.path)
+        done = Event()
+        def target():
+            with other.hold():
+                done.set()
+        with self.lock.hold():
+            Thread(target=target, daemon=True).start()
+
+            self.assertFalse(done.wait(0.1))
+        self.assertTrue(done.wait(1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+# -*- coding: UTF-8 -*-
+"""A suite of unit tests for the vlab_ipam_api.lib.migrations module"""
+import unittest
+from unittest.mock import MagicMock
+
+from vlab_ipam_api.lib import migrations
+
+
+class TestMigrations(unittest.TestCase):
+    """A suite of test cases for the migrations module"""
+
+    def test_versions_unique(self):
+        """Every migration has a unique version number"""
+        versions = [m[0] for m in migrations.MIGRATIONS]
+
+        self.assertEqual(len(versions), len(set(versions)))
+
+    def test_pending(self):
+        """``pending`` returns the migrations not yet applied, in version order"""
+        output = [m[0] for m in migrations.pending(applied={1})]
+        expected = sorted(m[0] for m in migrations.MIGRATIONS if m[0] != 1)
+
+        self.assertEqual(output, expected)
+
+    def test_migrate(self):
+        """``migrate`` applies and records every pending migration"""
+        fake_db = MagicMock()
+        fake_db.execute.return_value = []
+
+        output = migrations.migrate(fake_db)
+        expected = [m[0] for m in migrations.MIGRATIONS]
+        recorded = [c for c in fake_db.execute.call_args_list if 'INSERT INTO schema_version' in c[0][0]]
+
+        self.assertEqual(output, expected)
+        self.assertEqual(len(recorded), len(expected))
+
+    def test_migrate_up_to_date(self):
+        """``migrate`` does nothing when every migration has been applied"""
+        fake_db = MagicMock()
+        fake_db.execute.return_value = [(m[0],) for m in migrations.MIGRATIONS]
+
+        output = migrations.migrate(fake_db)
+
+        self.assertEqual(output, [])
+
+    def test_migrate_locks(self):
+        """``migrate`` takes an advisory lock so concurrent processes don't collide"""
+        fake_db = MagicMock()
+        fake_db.execute.return_value = []
+
+        migrations.migrate(fake_db)
+        args, _ = fake_db.execute.call_args_list[0]
+
+        self.assertTrue('pg_advisory_xact_lock' in args[0])
+
+    def test_migrate_transaction(self):
+        """``migrate`` runs within a single transaction"""
+        fake_db = MagicMock()
+        fake_db.execute.return_value = []
+
+        migrations.migrate(fake_db)
+
+        self.assertEqual(fake_db.transaction.call_count, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -46,16 +46,93 @@ class TestPortMapView(unittest.TestCase):
         """GET on /api/1/ipam/portmap returns the port mapping rules"""
         fake_ip.return_value = 'some.ip.value'
         fake_db = MagicMock()
-        fake_db.lookup_port.return_value = {'worked': True}
-        fake_Database.return_value.__enter__.return_value = fake_db
+        fake_db.stream_ports_json.return_value = [[(9001, '{"worked":true}')]]
+        fake_Database.return_value = fake_db
         resp = self.app.get('/api/1/ipam/portmap',
                             headers={'X-Auth': self.token})
 
         output = resp.json['content']
-        expected = {'gateway_ip': 'some.ip.value', 'ports': {'worked': True}}
+        expected = {'gateway_ip': 'some.ip.value', 'ports': {'9001': {'worked': True}}}
 
         self.assertEqual(output, expected)
 
+    @patch.object(portmap, 'get_ip')
+    @patch.object(portmap, 'Database')
+    def test_get_streamed_closes(self, fake_Database, fake_ip):
+        """GET on /api/1/ipam/portmap closes the database connection once the response is sent"""
+        fake_ip.return_value = 'some.ip.value'
+        fake_db = MagicMock()
+        fake_db.stream_ports_json.return_value = [[(9001, '{}')], [(9002, '{}')]]
+        fake_Database.return_value = fake_db
+        resp = self.app.get('/api/1/ipam/portmap',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(set(resp.json['content']['ports'].keys()), {'9001', '9002'})
+        self.assertTrue(fake_db.close.called)
+
+    @patch.object(portmap, 'get_ip')
+    @patch.object(portmap, 'Database')
+    def test_head_closes(self, fake_Database, fake_ip):
+        """HEAD on /api/1/ipam/portmap closes the database connection, though no body is sent"""
+        fake_ip.return_value = 'some.ip.value'
+        fake_db = MagicMock()
+        fake_db.stream_ports_json.return_value = [[(9001, '{}')], [(9002, '{}')]]
+        fake_Database.return_value = fake_db
+        # Don't let the API contract hook read the body
+        with patch.object(portmap.PortMapView, 'after_request', lambda self, name, response: response):
+            resp = self.app.head('/api/1/ipam/portmap',
+                                 headers={'X-Auth': self.token})
+            # What the WSGI server does once the response is sent
+            resp.close()
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(fake_db.close.called)
+
+    @patch.object(portmap, 'get_ip')
+    @patch.object(portmap, 'Database')
+    def test_get_streamed_error(self, fake_Database, fake_ip):
+        """GET on /api/1/ipam/portmap returns HTTP 500 if the streamed query fails"""
+        fake_ip.return_value = 'some.ip.value'
+        fake_db = MagicMock()
+        fake_db.stream_ports_json.side_effect = [RuntimeError('testing')]
+        fake_Database.return_value = fake_db
+        resp = self.app.get('/api/1/ipam/portmap',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 500)
+        self.assertTrue(fake_db.close.called)
+
+    @patch.object(portmap, 'get_ip')
+    @patch.object(portmap, 'Database')
+    def test_get_page(self, fake_Database, fake_ip):
+        """GET on /api/1/ipam/portmap returns the cursor for the next page"""
+        fake_ip.return_value = 'some.ip.value'
+        fake_db = MagicMock()
+        fake_db.lookup_port_json.return_value = ('{"9001":{"target_port":22}}', 9001)
+        fake_Database.return_value.__enter__.return_value = fake_db
+        resp = self.app.get('/api/1/ipam/portmap?limit=1&after=9000&fields=target_port',
+                            headers={'X-Auth': self.token})
+
+        _, kwargs = fake_db.lookup_port_json.call_args
+
+        self.assertEqual(resp.json['next'], 9001)
+        self.assertEqual(resp.json['content']['ports'], {'9001': {'target_port': 22}})
+        self.assertEqual((kwargs['limit'], kwargs['after'], kwargs['fields']), (1, 9000, ['target_port']))
+
+    def test_get_bad_after(self):
+        """GET on /api/1/ipam/portmap returns HTTP 400 if after is not a number"""
+        resp = self.app.get('/api/1/ipam/portmap?limit=1&after=foo',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 400)
+
+    def test_get_bad_fields(self):
+        """GET on /api/1/ipam/portmap returns HTTP 400 if asked for an unknown field"""
+        resp = self.app.get('/api/1/ipam/portmap?fields=routable',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 400)
+
     @patch.object(portmap, 'Database')
     def test_get_bad_conn_port(self, fake_Database):
         """GET on /api/1/ipam/portmap returns HTTP 400 is supplied with a bad value for conn_port"""
@@ -84,7 +161,7 @@ class TestPortMapView(unittest.TestCase):
     @patch.object(portmap, 'Database')
     def test_get_doh_status(self, fake_Database):
         """GET on /api/1/ipam/portmap returns HTTP 500 upon error"""
-        fake_Database.return_value.__enter__.side_effect = [RuntimeError('testing')]
+        fake_Database.side_effect = [RuntimeError('testing')]
         resp = self.app.get('/api/1/ipam/portmap',
                             headers={'X-Auth': self.token})
 
@@ -95,7 +172,7 @@ class TestPortMapView(unittest.TestCase):
     @patch.object(portmap, 'Database')
     def test_get_doh_msg(self, fake_Database):
         """GET on /api/1/ipam/portmap sets the error in the response upon failure"""
-        fake_Database.return_value.__enter__.side_effect = [RuntimeError('testing')]
+        fake_Database.side_effect = [RuntimeError('testing')]
         resp = self.app.get('/api/1/ipam/portmap',
                             headers={'X-Auth': self.token})
 
@@ -143,6 +220,79 @@ class TestPortMapView(unittest.TestCase):
 
         self.assertEqual(resp.status_code, 500)
 
+    @patch.object(portmap, 'Database')
+    def test_port_firewall_error_rollback(self, fake_Database):
+        """POST on /api/1/ipam/portmap rolls back the new record if unable to add firewall rule"""
+        fake_db = MagicMock()
+        fake_Database.return_value.__enter__.return_value = fake_db
+        self.fake_firewall.map_port.side_effect = [OSError('testing')]
+        resp = self.app.post('/api/1/ipam/portmap',
+                             headers={'X-Auth': self.token},
+                             json={'target_addr': '1.1.1.1',
+                                   'target_port': 5698,
+                                   'target_name': "myBox",
+                                   'target_component': "OneFS"})
+
+        args, _ = fake_db.transaction.return_value.__exit__.call_args
+        exc_type = args[0]
+
+        self.assertTrue(exc_type is OSError)
+        self.assertFalse(fake_db.delete_port.called)
+
+    @patch.object(portmap, 'Database')
+    def test_port_commit_under_lock(self, fake_Database):
+        """POST on /api/1/ipam/portmap commits the new record before unlocking the firewall"""
+        calls = []
+        fake_db = MagicMock()
+        fake_Database.return_value.__enter__.return_value = fake_db
+        fake_db.transaction.return_value.__exit__.side_effect = lambda *args: calls.append('commit')
+        self.fake_firewall.__exit__.side_effect = lambda *args: calls.append('unlock')
+        self.app.post('/api/1/ipam/portmap',
+                      headers={'X-Auth': self.token},
+                      json={'target_addr': '1.1.1.1',
+                            'target_port': 5698,
+                            'target_name': "myBox",
+                            'target_component': "OneFS"})
+
+        self.assertEqual(calls, ['commit', 'unlock'])
+
+    @patch.object(portmap, 'Database')
+    def test_port_commit_error(self, fake_Database):
+        """POST on /api/1/ipam/portmap deletes the new firewall rules if the record cannot be committed"""
+        fake_db = MagicMock()
+        fake_db.add_port.return_value = 5000
+        fake_Database.return_value.__enter__.return_value = fake_db
+        fake_db.transaction.return_value.__exit__.side_effect = portmap.DatabaseError('testing', pgcode='40001')
+        self.fake_firewall.__exit__.return_value = False
+        self.fake_firewall.find_rule.side_effect = ['nat-rule', 'filter-rule']
+        resp = self.app.post('/api/1/ipam/portmap',
+                             headers={'X-Auth': self.token},
+                             json={'target_addr': '1.1.1.1',
+                                   'target_port': 5698,
+                                   'target_name': "myBox",
+                                   'target_component': "OneFS"})
+
+        self.assertEqual(resp.status_code, 500)
+        self.fake_firewall.unmap_port.assert_called_once_with('nat-rule', 'filter-rule')
+
+    @patch.object(portmap, 'Database')
+    def test_port_firewall_error_no_unmap(self, fake_Database):
+        """POST on /api/1/ipam/portmap does not delete rules if the firewall update failed"""
+        fake_db = MagicMock()
+        fake_Database.return_value.__enter__.return_value = fake_db
+        fake_db.transaction.return_value.__exit__.return_value = False
+        self.fake_firewall.__exit__.return_value = False
+        self.fake_firewall.map_port.side_effect = [OSError('testing')]
+        resp = self.app.post('/api/1/ipam/portmap',
+                             headers={'X-Auth': self.token},
+                             json={'target_addr': '1.1.1.1',
+                                   'target_port': 5698,
+                                   'target_name': "myBox",
+                                   'target_component': "OneFS"})
+
+        self.assertEqual(resp.status_code, 500)
+        self.assertFalse(self.fake_firewall.unmap_port.called)
+
     @patch.object(portmap, 'remove_port_map')
     @patch.object(portmap, 'records_valid')
     @patch.object(portmap, 'Database')
@@ -175,6 +325,63 @@ class TestPortMapView(unittest.TestCase):
         self.assertEqual(resp.status_code, 500)
 
 
+    @patch.object(portmap, 'remove_port_map')
+    @patch.object(portmap, 'records_valid')
+    @patch.object(portmap, 'Database')
+    def test_delete_commit_under_lock(self, fake_Database, fake_records_valid, fake_remove_port_map):
+        """DELETE on /api/1/ipam/portmap commits the record delete before unlocking the firewall"""
+        calls = []
+        fake_db = MagicMock()
+        fake_db.port_info.return_value = (22, '1.2.3.4')
+        fake_Database.return_value.__enter__.return_value = fake_db
+        fake_db.transaction.return_value.__exit__.side_effect = lambda *args: calls.append('commit')
+        self.fake_firewall.__exit__.side_effect = lambda *args: calls.append('unlock')
+        fake_records_valid.return_value = ('', 200)
+        fake_remove_port_map.return_value = (None, 200)
+        self.app.delete('/api/1/ipam/portmap',
+                        headers={'X-Auth': self.token},
+                        json={'conn_port': 5698})
+
+        self.assertEqual(calls, ['commit', 'unlock'])
+
+    @patch.object(portmap, 'remove_port_map')
+    @patch.object(portmap, 'records_valid')
+    @patch.object(portmap, 'Database')
+    def test_delete_commit_error(self, fake_Database, fake_records_valid, fake_remove_port_map):
+        """DELETE on /api/1/ipam/portmap re-creates the firewall rules if the record delete cannot be committed"""
+        fake_db = MagicMock()
+        fake_db.port_info.return_value = (22, '1.2.3.4')
+        fake_Database.return_value.__enter__.return_value = fake_db
+        fake_db.transaction.return_value.__exit__.side_effect = portmap.DatabaseError('testing', pgcode='40001')
+        self.fake_firewall.__exit__.return_value = False
+        fake_records_valid.return_value = ('', 200)
+        fake_remove_port_map.return_value = (None, 200)
+        resp = self.app.delete('/api/1/ipam/portmap',
+                               headers={'X-Auth': self.token},
+                               json={'conn_port': 5698})
+
+        self.assertEqual(resp.status_code, 500)
+        self.fake_firewall.map_port.assert_called_once_with(5698, 22, '1.2.3.4')
+
+    @patch.object(portmap, 'remove_port_map')
+    @patch.object(portmap, 'records_valid')
+    @patch.object(portmap, 'Database')
+    def test_delete_error_no_remap(self, fake_Database, fake_records_valid, fake_remove_port_map):
+        """DELETE on /api/1/ipam/portmap leaves the undo to ``remove_port_map`` when it fails"""
+        fake_db = MagicMock()
+        fake_db.port_info.return_value = (22, '1.2.3.4')
+        fake_Database.return_value.__enter__.return_value = fake_db
+        fake_db.transaction.return_value.__exit__.side_effect = portmap.DatabaseError('testing', pgcode='40001')
+        self.fake_firewall.__exit__.return_value = False
+        fake_records_valid.return_value = ('', 200)
+        fake_remove_port_map.return_value = ('testing', 500)
+        self.app.delete('/api/1/ipam/portmap',
+                        headers={'X-Auth': self.token},
+                        json={'conn_port': 5698})
+
+        self.assertFalse(self.fake_firewall.map_port.called)
+
+
 class TestPortMapRecordsValid(unittest.TestCase):
     """A suite of test cases for the ``records_valid`` function"""
 
@@ -264,10 +471,24 @@ class TestRemovePortMap(unittest.TestCase):
 
         self.assertEqual(output, expected)
 
-    def test_remove_port_map_delete_2_fails(self):
-        """``remove_port_map`` returns an error and HTTP 500 if unable to delete the 2nd iptables rule"""
+    def test_remove_port_map_one_batch(self):
+        """``remove_port_map`` deletes both iptables rules together"""
+        fake_db = MagicMock()
+        with self.full_app.app_context():
+            portmap.remove_port_map(nat_id='2',
+                                    filter_id='3',
+                                    target_port='22',
+                                    target_addr='2.3.4.5',
+                                    conn_port=2345,
+                                    db=fake_db)
+
+        self.fake_firewall.unmap_port.assert_called_once_with('2', '3')
+        self.assertFalse(self.fake_firewall.delete_rule.called)
+
+    def test_remove_port_map_delete_fails(self):
+        """``remove_port_map`` returns an error and HTTP 500 if unable to delete the iptables rules"""
         fake_db = MagicMock()
-        self.fake_firewall.delete_rule.side_effect = [None, RuntimeError('testing')]
+        self.fake_firewall.unmap_port.side_effect = [RuntimeError('testing')]
         with self.full_app.app_context():
             output = portmap.remove_port_map(nat_id='2',
                                              filter_id='3',
@@ -280,19 +501,21 @@ class TestRemovePortMap(unittest.TestCase):
 
         self.assertEqual(output, expected)
 
-    def test_remove_port_map_delete_2_undo(self):
-        """``remove_port_map`` remakes the 1st rule if deleting the 2nd rule fails"""
+    def test_remove_port_map_delete_fails_keeps_record(self):
+        """``remove_port_map`` neither deletes the record nor re-creates rules if deleting the iptables rules fails"""
         fake_db = MagicMock()
-        self.fake_firewall.delete_rule.side_effect = [None, RuntimeError('testing')]
+        self.fake_firewall.unmap_port.side_effect = [RuntimeError('testing')]
         with self.full_app.app_context():
-            output = portmap.remove_port_map(nat_id='2',
-                                             filter_id='3',
-                                             target_port='22',
-                                             target_addr='2.3.4.5',
-                                             conn_port=2345,
-                                             db=fake_db)
-
-        self.assertEqual(self.fake_firewall.forward.call_count, 1)
+            portmap.remove_port_map(nat_id='2',
+                                    filter_id='3',
+                                    target_port='22',
+                                    target_addr='2.3.4.5',
+                                    conn_port=2345,
+                                    db=fake_db)
+
+        self.assertFalse(fake_db.delete_port.called)
+        self.assertFalse(self.fake_firewall.forward.called)
+        self.assertFalse(self.fake_firewall.map_port.called)
 
     def test_remove_port_map_db_fail(self):
         """``remove_port_map`` returns an error and HTTP 500 if unable delete the DB record"""
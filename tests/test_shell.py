@@ -20,6 +20,11 @@ class TestShell(unittest.TestCase):
         """Running a command that has a non-zero exit code raises CliError"""
         self.assertRaises(CliError, shell.run_cmd, 'not a command')
 
+    def test_stdin(self):
+        """``run_cmd`` sends the supplied text to the command's standard in"""
+        result = shell.run_cmd('cat', stdin='hello world')
+        self.assertEqual(result.stdout, 'hello world')
+
     def test_cli_result_attributes(self):
         """Verify that the CliResult object attributes remain stable"""
         # NEVER REMOVE OR MODIFY A VALUE IN THIS LIST
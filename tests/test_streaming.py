@@ -0,0 +1,136 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the vlab_ipam_api.lib.views.streaming module
+"""
+import unittest
+from unittest.mock import MagicMock
+
+import ujson
+
+from vlab_ipam_api.lib.views import streaming
+
+
+class TestSpliceJson(unittest.TestCase):
+    """A suite of test cases for the ``splice_json`` function"""
+
+    def test_splice_json(self):
+        """``splice_json`` adds pre-encoded JSON to the encoded document"""
+        output = streaming.splice_json({'user': 'bob'}, 'content', '{"ports":{"9001":{}}}')
+        expected = {'user': 'bob', 'content': {'ports': {'9001': {}}}}
+
+        self.assertEqual(ujson.loads(output), expected)
+
+    def test_splice_json_empty(self):
+        """``splice_json`` supports an empty document"""
+        output = streaming.splice_json({}, 'ports', '{}')
+        expected = {'ports': {}}
+
+        self.assertEqual(ujson.loads(output), expected)
+
+
+class TestStreamJson(unittest.TestCase):
+    """A suite of test cases for the ``stream_json`` function"""
+
+    def test_stream_json(self):
+        """``stream_json`` adds the chunked value to the encoded document"""
+        output = ''.join(streaming.stream_json({'user': 'bob'}, 'ports', ['{"9001"', ':{}}']))
+        expected = {'user': 'bob', 'ports': {'9001': {}}}
+
+        self.assertEqual(ujson.loads(output), expected)
+
+    def test_stream_json_empty(self):
+        """``stream_json`` supports an empty document"""
+        output = ''.join(streaming.stream_json({}, 'ports', ['{}']))
+        expected = {'ports': {}}
+
+        self.assertEqual(ujson.loads(output), expected)
+
+    def test_stream_json_nested(self):
+        """``stream_json`` output can be the chunks of another ``stream_json``"""
+        inner = streaming.stream_json({'gateway_ip': '1.2.3.4'}, 'ports', ['{}'])
+        output = ''.join(streaming.stream_json({'user': 'bob'}, 'content', inner))
+        expected = {'user': 'bob', 'content': {'gateway_ip': '1.2.3.4', 'ports': {}}}
+
+        self.assertEqual(ujson.loads(output), expected)
+
+
+class TestChunks(unittest.TestCase):
+    """A suite of test cases for the ``json_object_chunks`` and ``json_array_chunks`` functions"""
+
+    def test_json_object_chunks(self):
+        """``json_object_chunks`` joins the batches into one JSON object"""
+        batches = [[(9001, '{"a":1}'), (9002, '{}')], [], [(9003, 'null')]]
+        output = ''.join(streaming.json_object_chunks(batches))
+        expected = {'9001': {'a': 1}, '9002': {}, '9003': None}
+
+        self.assertEqual(ujson.loads(output), expected)
+
+    def test_json_object_chunks_empty(self):
+        """``json_object_chunks`` returns an empty object when there are no batches"""
+        output = ''.join(streaming.json_object_chunks([]))
+
+        self.assertEqual(output, '{}')
+
+    def test_json_array_chunks(self):
+        """``json_array_chunks`` joins the batches into one JSON array"""
+        batches = [[(9001, 'a', True)], [], [(9002, 'b', None)]]
+        output = ''.join(streaming.json_array_chunks(batches))
+        expected = [[9001, 'a', True], [9002, 'b', None]]
+
+        self.assertEqual(ujson.loads(output), expected)
+
+    def test_json_array_chunks_empty(self):
+        """``json_array_chunks`` returns an empty array when there are no batches"""
+        output = ''.join(streaming.json_array_chunks([]))
+
+        self.assertEqual(output, '[]')
+
+
+class TestClosing(unittest.TestCase):
+    """A suite of test cases for the ``closing`` function"""
+
+    def test_closing(self):
+        """``closing`` closes the resource once the chunks are exhausted"""
+        resource = MagicMock()
+        output = list(streaming.closing(['a', 'b'], resource))
+
+        self.assertEqual(output, ['a', 'b'])
+        self.assertTrue(resource.close.called)
+
+    def test_closing_early(self):
+        """``closing`` closes the resource if the client disconnects mid-stream"""
+        resource = MagicMock()
+        body = streaming.closing(['a', 'b'], resource)
+        next(iter(body))
+        body.close()
+
+        self.assertTrue(resource.close.called)
+
+    def test_closing_not_read(self):
+        """``closing`` closes the resource even if the body is never read, i.e. for a HEAD request"""
+        resource = MagicMock()
+        body = streaming.closing(['a', 'b'], resource)
+        body.close()
+
+        self.assertTrue(resource.close.called)
+
+    def test_closing_early_order(self):
+        """``closing`` closes the chunks before the resource they come from"""
+        calls = []
+        def chunks():
+            try:
+                yield 'a'
+                yield 'b'
+            finally:
+                calls.append('chunks')
+        resource = MagicMock()
+        resource.close.side_effect = lambda: calls.append('resource')
+        body = streaming.closing(chunks(), resource)
+        next(iter(body))
+        body.close()
+
+        self.assertEqual(calls, ['chunks', 'resource'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -10,13 +10,13 @@ class TestWorker(unittest.TestCase):
     """A suite of test cases for the worker.py module"""
 
     @patch.object(worker, 'pingable')
-    @patch.object(worker, 'update_record')
-    def test_worker_thread(self, fake_update_record, fake_pingable):
+    def test_worker_thread(self, fake_pingable):
         """``Worker`` correctly subclasses threading.Thread"""
         fake_queue = MagicMock()
-        fake_queue.get.return_value = ('myBox', '1.2.3.4')
+        fake_queue.get.return_value = '1.2.3.4'
         fake_logger = MagicMock()
-        t = worker.Worker(tid=1, logger=fake_logger, work_queue=fake_queue)
+        fake_writer = MagicMock()
+        t = worker.Worker(tid=1, logger=fake_logger, work_queue=fake_queue, writer=fake_writer)
         t.start()
         t.keep_running = False
         t.join()
@@ -24,53 +24,53 @@ class TestWorker(unittest.TestCase):
         self.assertTrue(isinstance(t, worker.threading.Thread))
 
     @patch.object(worker, 'pingable')
-    @patch.object(worker, 'update_record')
-    def test_worker_thread_not_pingable(self, fake_update_record, fake_pingable):
+    def test_worker_thread_not_pingable(self, fake_pingable):
         """``Worker.run`` updates the IPAM database if the IP is not pingable"""
         fake_queue = MagicMock()
-        fake_queue.get.return_value = ('myBox', '1.2.3.4')
+        fake_queue.get.return_value = '1.2.3.4'
         fake_logger = MagicMock()
+        fake_writer = MagicMock()
         fake_pingable.return_value = False
-        t = worker.Worker(tid=1, logger=fake_logger, work_queue=fake_queue)
+        t = worker.Worker(tid=1, logger=fake_logger, work_queue=fake_queue, writer=fake_writer)
         t.start()
         t.keep_running = False
         t.join()
 
-        args, kwargs = fake_update_record.call_args
-        expected_args = ('myBox', '1.2.3.4')
+        args, kwargs = fake_writer.add.call_args
+        expected_args = ('1.2.3.4',)
         expected_kwargs = {'routable': False}
 
         self.assertEqual(args, expected_args)
         self.assertEqual(kwargs, expected_kwargs)
 
     @patch.object(worker, 'pingable')
-    @patch.object(worker, 'update_record')
-    def test_worker_thread_pingable(self, fake_update_record, fake_pingable):
+    def test_worker_thread_pingable(self, fake_pingable):
         """``Worker.run`` updates the IPAM database if the IP is pingable"""
         fake_queue = MagicMock()
-        fake_queue.get.return_value = ('myBox', '1.2.3.4')
+        fake_queue.get.return_value = '1.2.3.4'
         fake_logger = MagicMock()
+        fake_writer = MagicMock()
         fake_pingable.return_value = True
-        t = worker.Worker(tid=1, logger=fake_logger, work_queue=fake_queue)
+        t = worker.Worker(tid=1, logger=fake_logger, work_queue=fake_queue, writer=fake_writer)
         t.start()
         t.keep_running = False
         t.join()
 
-        args, kwargs = fake_update_record.call_args
-        expected_args = ('myBox', '1.2.3.4')
+        args, kwargs = fake_writer.add.call_args
+        expected_args = ('1.2.3.4',)
         expected_kwargs = {'routable': True}
 
         self.assertEqual(args, expected_args)
         self.assertEqual(kwargs, expected_kwargs)
 
     @patch.object(worker, 'pingable')
-    @patch.object(worker, 'update_record')
-    def test_worker_thread_empty_queue(self, fake_update_record, fake_pingable):
+    def test_worker_thread_empty_queue(self, fake_pingable):
         """``Worker.run`` does not block indefinitely when pulling from the work queue"""
         fake_queue = MagicMock()
         fake_queue.get.side_effect = [worker.queue.Empty('testing') for x in range(500)]
         fake_logger = MagicMock()
-        t = worker.Worker(tid=1, logger=fake_logger, work_queue=fake_queue)
+        fake_writer = MagicMock()
+        t = worker.Worker(tid=1, logger=fake_logger, work_queue=fake_queue, writer=fake_writer)
         t.start()
         t.keep_running = False
         t.join()
@@ -82,16 +82,16 @@ class TestWorker(unittest.TestCase):
         self.assertEqual(message, expected)
 
     @patch.object(worker, 'pingable')
-    @patch.object(worker, 'update_record')
-    def test_worker_thread_crash(self, fake_update_record, fake_pingable):
+    def test_worker_thread_crash(self, fake_pingable):
         """``Worker.run`` terminates upon error"""
         # NOTE - this test case creates a traceback in the unittest output
         # even though everything works as expected; i.e. a SPAM traceback
         fake_queue = MagicMock()
         fake_queue.get.side_effect = [Exception('SPAM from thread; ignore')]
         fake_logger = MagicMock()
+        fake_writer = MagicMock()
 
-        t = worker.Worker(tid=1, logger=fake_logger, work_queue=fake_queue)
+        t = worker.Worker(tid=1, logger=fake_logger, work_queue=fake_queue, writer=fake_writer)
         t.start()
         t.join()
 
@@ -112,35 +112,60 @@ class TestWorker(unittest.TestCase):
 
         self.assertFalse(ok)
 
-    @patch.object(worker, 'Database')
-    def test_update_record_is_routable(self, fake_Database):
-        """``update_record`` generates the correct SQL when the target is routable"""
-        fake_db = MagicMock()
-        fake_Database.return_value.__enter__.return_value = fake_db
-        worker.update_record('someBox', '1.2.3.4', True)
+    @patch.object(worker.shell, 'run_cmd')
+    def test_reachable_neighbours(self, fake_run_cmd):
+        """``reachable_neighbours`` returns the addresses of the REACHABLE neighbour entries"""
+        fake_run_cmd.return_value.stdout = '1.2.3.4 lladdr 00:50:56:aa:bb:cc REACHABLE\n' \
+                                           '1.2.3.5 lladdr 00:50:56:aa:bb:cd REACHABLE\n\n'
 
-        args, kwargs = fake_db.execute.call_args
-        sql = args[0]
-        expected_sql = "UPDATE ipam SET routable=true WHERE target_name LIKE (%s) and target_addr LIKE (%s);"
-        expected_kwargs = {'params': ('someBox', '1.2.3.4')}
+        output = worker.reachable_neighbours('ens192')
+        args, _ = fake_run_cmd.call_args
 
-        self.assertEqual(sql.lower(), expected_sql.lower())
-        self.assertEqual(kwargs, expected_kwargs)
+        self.assertEqual(output, {'1.2.3.4', '1.2.3.5'})
+        self.assertEqual(args[0], 'ip -4 neigh show dev ens192 nud reachable')
+
+    @patch.object(worker.shell, 'run_cmd')
+    def test_reachable_neighbours_error(self, fake_run_cmd):
+        """``reachable_neighbours`` raises CliError if the neighbour table can't be read"""
+        fake_run_cmd.side_effect = worker.shell.CliError(command='ip', stdout='', stderr='testing', exit_code=1)
+
+        with self.assertRaises(worker.shell.CliError):
+            worker.reachable_neighbours('ens192')
 
     @patch.object(worker, 'Database')
-    def test_update_record_is_not_routable(self, fake_Database):
-        """``update_record`` generates the correct SQL when the target is not routable"""
+    def test_update_records(self, fake_Database):
+        """``update_records`` writes every result with a single UPDATE statement"""
         fake_db = MagicMock()
+        fake_db.execute_prepared.return_value = [(50000,)]
         fake_Database.return_value.__enter__.return_value = fake_db
-        worker.update_record('someBox', '1.2.3.4', False)
+        changed = worker.update_records({'1.2.3.4': True, '2.3.4.5': False})
 
-        args, kwargs = fake_db.execute.call_args
+        args, kwargs = fake_db.execute_prepared.call_args
         sql = args[0]
-        expected_sql = "UPDATE ipam SET routable=false WHERE target_name LIKE (%s) and target_addr LIKE (%s);"
-        expected_kwargs = {'params': ('someBox', '1.2.3.4')}
 
-        self.assertEqual(sql.lower(), expected_sql.lower())
-        self.assertEqual(kwargs, expected_kwargs)
+        self.assertEqual(fake_db.execute_prepared.call_count, 1)
+        self.assertTrue('unnest(%s::text[], %s::boolean[])' in sql)
+        self.assertTrue('IS DISTINCT FROM' in sql)
+        self.assertEqual(kwargs, {'params': (['1.2.3.4', '2.3.4.5'], [True, False])})
+        self.assertEqual(changed, 1)
+
+    def test_known_states(self):
+        """``known_states`` maps addresses to their routable value"""
+        records = [('1.2.3.4', True, 1), ('2.3.4.5', None, 2)]
+
+        output = worker.known_states(records)
+        expected = {'1.2.3.4': True, '2.3.4.5': None}
+
+        self.assertEqual(output, expected)
+
+    def test_known_states_disagree(self):
+        """``known_states`` uses None when the rows for an address disagree"""
+        records = [('1.2.3.4', True, 1), ('1.2.3.4', False, 1)]
+
+        output = worker.known_states(records)
+        expected = {'1.2.3.4': None}
+
+        self.assertEqual(output, expected)
 
     def test_workers_ok(self):
         """``workers_ok`` returns True if all threads are alive"""
@@ -174,74 +199,216 @@ class TestWorker(unittest.TestCase):
 
         self.assertEqual(2, fake_queue.get.call_count)
 
+    @patch.object(worker, 'reachable_neighbours')
     @patch.object(worker, 'Database')
-    def test_do_work(self, fake_Database):
+    def test_do_work(self, fake_Database, fake_reachable_neighbours):
         """``do_work`` returns None upon exit"""
         fake_db = MagicMock()
-        fake_db.execute.return_value = [('someBox', '1.2.3.4')]
+        fake_db.execute.return_value = [('1.2.3.4', True, 1)]
         fake_Database.return_value.__enter__.return_value = fake_db
         fake_thread = MagicMock()
         fake_thread.is_alive.return_value = False
         fake_threads = [fake_thread]
         fake_logger = MagicMock()
-        fake_work_queue = MagicMock()
+        fake_work_queue = worker.WorkQueue()
 
-        output = worker.do_work(worker_threads=fake_threads, work_queue=fake_work_queue, logger=fake_logger)
+        output = worker.do_work(worker_threads=fake_threads, work_queue=fake_work_queue, writer=MagicMock(), logger=fake_logger)
         expected = None
 
         self.assertEqual(output, expected)
 
+    @patch.object(worker, 'reachable_neighbours')
     @patch.object(worker, 'Database')
-    def test_do_work_producer(self, fake_Database):
+    def test_do_work_producer(self, fake_Database, fake_reachable_neighbours):
         """``do_work`` is the producer thread, and puts tasks into the work queue"""
         fake_db = MagicMock()
-        fake_db.execute.return_value = [('someBox', '1.2.3.4')]
+        fake_db.execute.return_value = [('1.2.3.4', True, 1)]
         fake_Database.return_value.__enter__.return_value = fake_db
         fake_thread = MagicMock()
         fake_thread.is_alive.return_value = False
         fake_threads = [fake_thread]
         fake_logger = MagicMock()
-        fake_work_queue = MagicMock()
+        fake_work_queue = worker.WorkQueue()
 
-        worker.do_work(worker_threads=fake_threads, work_queue=fake_work_queue, logger=fake_logger)
+        worker.do_work(worker_threads=fake_threads, work_queue=fake_work_queue, writer=MagicMock(), logger=fake_logger)
 
-        self.assertTrue(fake_work_queue.put.called)
+        self.assertEqual(fake_work_queue.stats['max_depth'], 1)
 
+    @patch.object(worker, 'reachable_neighbours')
     @patch.object(worker, 'drain_queue')
     @patch.object(worker, 'Database')
-    def test_do_work_drains_queue(self, fake_Database, fake_drain_queue):
+    def test_do_work_drains_queue(self, fake_Database, fake_drain_queue, fake_reachable_neighbours):
         """``do_work`` empties any tasks in the queue if a worker crashes"""
         fake_db = MagicMock()
-        fake_db.execute.return_value = [('someBox', '1.2.3.4')]
+        fake_db.execute.return_value = [('1.2.3.4', True, 1)]
         fake_Database.return_value.__enter__.return_value = fake_db
         fake_thread = MagicMock()
         fake_thread.is_alive.return_value = False
         fake_threads = [fake_thread]
         fake_logger = MagicMock()
-        fake_work_queue = MagicMock()
+        fake_work_queue = worker.WorkQueue()
 
-        worker.do_work(worker_threads=fake_threads, work_queue=fake_work_queue, logger=fake_logger)
+        worker.do_work(worker_threads=fake_threads, work_queue=fake_work_queue, writer=MagicMock(), logger=fake_logger)
 
         self.assertTrue(fake_drain_queue.called)
 
+    @patch.object(worker, 'reachable_neighbours')
     @patch.object(worker.time, 'sleep')
     @patch.object(worker, 'drain_queue')
     @patch.object(worker, 'Database')
-    def test_do_work_sleeps(self, fake_Database, fake_drain_queue, fake_sleep):
+    def test_do_work_sleeps(self, fake_Database, fake_drain_queue, fake_sleep, fake_reachable_neighbours):
         """``do_work`` sleeps after producing work tasks"""
         fake_db = MagicMock()
-        fake_db.execute.return_value = [('someBox', '1.2.3.4')]
+        fake_db.execute.return_value = [('1.2.3.4', True, 1)]
         fake_Database.return_value.__enter__.return_value = fake_db
         fake_thread = MagicMock()
         fake_thread.is_alive.side_effect = [True, False]
         fake_threads = [fake_thread]
         fake_logger = MagicMock()
-        fake_work_queue = MagicMock()
+        fake_work_queue = worker.WorkQueue()
 
-        worker.do_work(worker_threads=fake_threads, work_queue=fake_work_queue, logger=fake_logger)
+        worker.do_work(worker_threads=fake_threads, work_queue=fake_work_queue, writer=MagicMock(), logger=fake_logger)
 
         self.assertTrue(fake_sleep.called)
 
+    @patch.object(worker, 'reachable_neighbours')
+    @patch.object(worker.time, 'sleep')
+    @patch.object(worker, 'drain_queue')
+    @patch.object(worker, 'Database')
+    def test_do_work_scheduled(self, fake_Database, fake_drain_queue, fake_sleep, fake_reachable_neighbours):
+        """``do_work`` only puts the records that are due into the work queue"""
+        fake_db = MagicMock()
+        fake_db.execute.return_value = [('1.2.3.4', True, 1)]
+        fake_Database.return_value.__enter__.return_value = fake_db
+        fake_thread = MagicMock()
+        fake_thread.is_alive.side_effect = [True, False]
+        fake_work_queue = worker.WorkQueue()
+        scheduler = worker.ProbeScheduler()
+
+        worker.do_work(worker_threads=[fake_thread], work_queue=fake_work_queue, writer=MagicMock(),
+                       logger=MagicMock(), scheduler=scheduler)
+
+        self.assertEqual(fake_work_queue.qsize(), 1)
+
+    @patch.object(worker, 'reachable_neighbours')
+    @patch.object(worker.time, 'sleep')
+    @patch.object(worker, 'drain_queue')
+    @patch.object(worker, 'Database')
+    def test_do_work_per_address(self, fake_Database, fake_drain_queue, fake_sleep, fake_reachable_neighbours):
+        """``do_work`` queues an address once, however many records have it"""
+        fake_db = MagicMock()
+        fake_db.execute.return_value = [('1.2.3.4', True, 3), ('1.2.3.4', None, 1), ('1.2.3.5', False, 2)]
+        fake_Database.return_value.__enter__.return_value = fake_db
+        fake_thread = MagicMock()
+        fake_thread.is_alive.side_effect = [True, False]
+        work_queue = worker.WorkQueue()
+
+        worker.do_work(worker_threads=[fake_thread], work_queue=work_queue, writer=MagicMock(),
+                       logger=MagicMock(), scheduler=worker.ProbeScheduler())
+        queued = sorted(work_queue.get_nowait() for _ in range(work_queue.qsize()))
+
+        self.assertEqual(queued, ['1.2.3.4', '1.2.3.5'])
+
+    @patch.object(worker, 'reachable_neighbours')
+    @patch.object(worker.time, 'sleep')
+    @patch.object(worker, 'drain_queue')
+    @patch.object(worker, 'Database')
+    def test_do_work_backpressure(self, fake_Database, fake_drain_queue, fake_sleep, fake_reachable_neighbours):
+        """``do_work`` only takes as many due records as fit in the work queue, and waits for room"""
+        fake_db = MagicMock()
+        fake_db.execute.return_value = [('1.2.3.{}'.format(n), True, 1) for n in range(5)]
+        fake_Database.return_value.__enter__.return_value = fake_db
+        fake_thread = MagicMock()
+        fake_thread.is_alive.side_effect = [True, False]
+        work_queue = worker.WorkQueue(maxsize=2)
+        work_queue.wait_for_room = MagicMock()
+        scheduler = worker.ProbeScheduler()
+
+        worker.do_work(worker_threads=[fake_thread], work_queue=work_queue, writer=MagicMock(),
+                       logger=MagicMock(), scheduler=scheduler)
+
+        self.assertEqual(work_queue.qsize(), 2)
+        self.assertEqual(len(scheduler.pop_due()), 3) # still due
+        self.assertTrue(work_queue.wait_for_room.called)
+        self.assertFalse(fake_sleep.called)
+
+    @patch.object(worker, 'reachable_neighbours')
+    @patch.object(worker.time, 'sleep')
+    @patch.object(worker, 'drain_queue')
+    @patch.object(worker, 'Database')
+    def test_do_work_passive(self, fake_Database, fake_drain_queue, fake_sleep, fake_reachable_neighbours):
+        """``do_work`` records REACHABLE neighbours as routable, and only probes the other addresses"""
+        fake_db = MagicMock()
+        fake_db.execute.return_value = [('1.2.3.4', None, 1), ('1.2.3.5', None, 1)]
+        fake_Database.return_value.__enter__.return_value = fake_db
+        fake_reachable_neighbours.return_value = {'1.2.3.4', '9.9.9.9'}
+        fake_thread = MagicMock()
+        fake_thread.is_alive.side_effect = [True, False]
+        fake_writer = MagicMock()
+        work_queue = worker.WorkQueue()
+
+        worker.do_work(worker_threads=[fake_thread], work_queue=work_queue, writer=fake_writer,
+                       logger=MagicMock(), scheduler=worker.ProbeScheduler())
+
+        fake_writer.add.assert_called_once_with('1.2.3.4', routable=True)
+        self.assertEqual(work_queue.get_nowait(), '1.2.3.5')
+        self.assertEqual(work_queue.qsize(), 0)
+
+    @patch.object(worker, 'reachable_neighbours')
+    @patch.object(worker.time, 'sleep')
+    @patch.object(worker, 'drain_queue')
+    @patch.object(worker, 'Database')
+    def test_do_work_passive_read_once(self, fake_Database, fake_drain_queue, fake_sleep, fake_reachable_neighbours):
+        """``do_work`` reads the neighbour table once for all the addresses that are due together"""
+        fake_db = MagicMock()
+        fake_db.execute.return_value = [('1.2.3.{}'.format(n), None, 1) for n in range(50)]
+        fake_Database.return_value.__enter__.return_value = fake_db
+        fake_reachable_neighbours.return_value = set()
+        fake_thread = MagicMock()
+        fake_thread.is_alive.return_value = False
+
+        worker.do_work(worker_threads=[fake_thread], work_queue=worker.WorkQueue(), writer=MagicMock(),
+                       logger=MagicMock(), scheduler=worker.ProbeScheduler())
+
+        self.assertEqual(fake_reachable_neighbours.call_count, 1)
+
+    @patch.object(worker, 'reachable_neighbours')
+    @patch.object(worker.time, 'sleep')
+    @patch.object(worker, 'drain_queue')
+    @patch.object(worker, 'Database')
+    def test_do_work_passive_error(self, fake_Database, fake_drain_queue, fake_sleep, fake_reachable_neighbours):
+        """``do_work`` probes every address if the neighbour table can't be read"""
+        fake_db = MagicMock()
+        fake_db.execute.return_value = [('1.2.3.4', None, 1)]
+        fake_Database.return_value.__enter__.return_value = fake_db
+        fake_reachable_neighbours.side_effect = worker.shell.CliError(command='ip', stdout='', stderr='testing',
+                                                                      exit_code=1)
+        fake_thread = MagicMock()
+        fake_thread.is_alive.return_value = False
+        work_queue = worker.WorkQueue()
+
+        worker.do_work(worker_threads=[fake_thread], work_queue=work_queue, writer=MagicMock(),
+                       logger=MagicMock(), scheduler=worker.ProbeScheduler())
+
+        self.assertEqual(work_queue.qsize(), 1)
+
+    @patch.object(worker, 'reachable_neighbours')
+    @patch.object(worker.time, 'sleep')
+    @patch.object(worker, 'drain_queue')
+    @patch.object(worker, 'Database')
+    def test_do_work_default_scheduler(self, fake_Database, fake_drain_queue, fake_sleep, fake_reachable_neighbours):
+        """``do_work`` has the writer report results to its scheduler"""
+        fake_db = MagicMock()
+        fake_db.execute.return_value = [('1.2.3.4', True, 1)]
+        fake_Database.return_value.__enter__.return_value = fake_db
+        fake_thread = MagicMock()
+        fake_thread.is_alive.return_value = False
+        fake_writer = MagicMock()
+
+        worker.do_work(worker_threads=[fake_thread], work_queue=worker.WorkQueue(), writer=fake_writer, logger=MagicMock())
+
+        self.assertTrue(isinstance(fake_writer.scheduler, worker.ProbeScheduler))
+
 
 
     def test_terminate_workers(self):
@@ -262,21 +429,412 @@ class TestWorker(unittest.TestCase):
         fake_queue = MagicMock()
         fake_logger = MagicMock()
 
-        worker_threads = worker.make_workers(fake_queue, fake_logger)
+        worker_threads = worker.make_workers(fake_queue, MagicMock(), fake_logger)
         started = worker_threads[0].start.called
 
         self.assertTrue(started)
         self.assertEqual(len(worker_threads), worker.THREAD_COUNT)
 
+    @patch.object(worker, 'IcmpWorker')
+    def test_make_workers_icmp(self, fake_IcmpWorker):
+        """``make_workers`` creates one thread for the 'icmp' prober"""
+        worker_threads = worker.make_workers(MagicMock(), MagicMock(), MagicMock(), prober='icmp')
+
+        self.assertEqual(len(worker_threads), 1)
+        self.assertTrue(worker_threads[0].start.called)
+
+    def test_make_workers_unknown(self):
+        """``make_workers`` raises ValueError for an unknown prober"""
+        with self.assertRaises(ValueError):
+            worker.make_workers(MagicMock(), MagicMock(), MagicMock(), prober='carrier-pigeon')
+
+    @patch.object(worker, 'StatusWriter')
     @patch.object(worker, 'do_work')
     @patch.object(worker, 'make_workers')
     @patch.object(worker, 'get_logger')
-    def test_main_logger(self, fake_get_logger, fake_make_workers, fake_do_work):
+    def test_main_prober(self, fake_get_logger, fake_make_workers, fake_do_work, fake_StatusWriter):
+        """``main`` passes the prober to ``make_workers``"""
+        worker.main(prober='icmp')
+
+        _, kwargs = fake_make_workers.call_args
+
+        self.assertEqual(kwargs['prober'], 'icmp')
+
+    @patch.object(worker, 'StatusWriter')
+    @patch.object(worker, 'do_work')
+    @patch.object(worker, 'make_workers')
+    @patch.object(worker, 'get_logger')
+    def test_main_logger(self, fake_get_logger, fake_make_workers, fake_do_work, fake_StatusWriter):
         """``main`` creates the logging object"""
         worker.main()
 
         self.assertTrue(fake_get_logger.called)
 
 
+class FakeProber(object):
+    """Stands in for ``IcmpProber``; the addresses in ``alive`` reply"""
+    def __init__(self, alive=(), error=None):
+        self.alive = alive
+        self.error = error
+        self.in_flight = 0
+        self.most_in_flight = 0
+        self.closed = False
+
+    def open(self, loop):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    async def probe(self, addr):
+        if self.error:
+            raise self.error
+        self.in_flight += 1
+        self.most_in_flight = max(self.most_in_flight, self.in_flight)
+        await worker.asyncio.sleep(0.01)
+        self.in_flight -= 1
+        return addr in self.alive
+
+
+class TestIcmpWorker(unittest.TestCase):
+    """A suite of test cases for the worker.IcmpWorker object"""
+
+    def run_worker(self, prober, tasks, max_in_flight=1000, writer=None):
+        """Run an IcmpWorker until it has pulled every task from the queue"""
+        work_queue = worker.queue.Queue()
+        for task in tasks:
+            work_queue.put(task)
+        fake_writer = writer or MagicMock()
+        t = worker.IcmpWorker(tid=0, logger=MagicMock(), work_queue=work_queue, writer=fake_writer,
+                              max_in_flight=max_in_flight)
+        with patch.object(worker, 'IcmpProber', return_value=prober), \
+             patch.object(worker, 'THREAD_POLL_TIMEOUT', 0.05):
+            t.start()
+            while not work_queue.empty() and t.is_alive():
+                worker.time.sleep(0.01)
+            worker.time.sleep(0.1) # so it also finds the queue empty
+            t.keep_running = False
+            t.join()
+        return t, fake_writer
+
+    def test_results(self):
+        """``IcmpWorker`` records the result of every probe"""
+        tasks = ['1.2.3.4', '1.2.3.5']
+        _, fake_writer = self.run_worker(FakeProber(alive=['1.2.3.4']), tasks)
+
+        recorded = sorted(x[0] + (x[1]['routable'],) for x in fake_writer.add.call_args_list)
+        expected = [('1.2.3.4', True), ('1.2.3.5', False)]
+
+        self.assertEqual(recorded, expected)
+
+    def test_results_off_loop(self):
+        """``IcmpWorker`` doesn't record results on the thread running the probes"""
+        threads = []
+        fake_writer = MagicMock()
+        fake_writer.add.side_effect = lambda *args, **kwargs: threads.append(worker.threading.current_thread())
+        t, _ = self.run_worker(FakeProber(alive=['1.2.3.4']), ['1.2.3.4'], writer=fake_writer)
+
+        self.assertEqual(len(threads), 1)
+        self.assertFalse(threads[0] is t)
+
+    def test_concurrent(self):
+        """``IcmpWorker`` runs many probes at once"""
+        prober = FakeProber()
+        tasks = ['10.0.0.{}'.format(n) for n in range(50)]
+        self.run_worker(prober, tasks)
+
+        self.assertTrue(prober.most_in_flight > 1)
+
+    def test_max_in_flight(self):
+        """``IcmpWorker`` limits how many probes are in flight"""
+        prober = FakeProber()
+        tasks = ['10.0.0.{}'.format(n) for n in range(50)]
+        _, fake_writer = self.run_worker(prober, tasks, max_in_flight=5)
+
+        self.assertEqual(prober.most_in_flight, 5)
+        self.assertEqual(fake_writer.add.call_count, 50)
+
+    def test_empty_queue(self):
+        """``IcmpWorker`` flushes stale results while the queue is empty"""
+        _, fake_writer = self.run_worker(FakeProber(), [])
+
+        self.assertTrue(fake_writer.flush_if_stale.called)
+
+    def test_crash(self):
+        """``IcmpWorker`` terminates, and closes its socket, upon error"""
+        # NOTE - this creates a traceback in the unittest output, like Worker's crash test
+        prober = FakeProber(error=RuntimeError('SPAM from thread; ignore'))
+        t, _ = self.run_worker(prober, ['10.0.0.1'])
+
+        self.assertFalse(t.keep_running)
+        self.assertTrue(prober.closed)
+
+
+class TestStatusWriter(unittest.TestCase):
+    """A suite of test cases for the worker.StatusWriter object"""
+
+    def setUp(self):
+        """Runs before every test case"""
+        self.patcher = patch.object(worker, 'update_records')
+        self.fake_update_records = self.patcher.start()
+        self.fake_update_records.return_value = 1
+        self.writer = worker.StatusWriter(logger=MagicMock(), flush_size=2, flush_interval=60)
+
+    def tearDown(self):
+        """Runs after every test case"""
+        self.patcher.stop()
+
+    def test_batches(self):
+        """``StatusWriter`` writes results once it has ``flush_size`` of them"""
+        self.writer.add('1.2.3.4', True)
+        self.assertFalse(self.fake_update_records.called)
+        self.writer.add('2.3.4.5', True)
+
+        args, _ = self.fake_update_records.call_args
+        expected = {'1.2.3.4': True, '2.3.4.5': True}
+
+        self.assertEqual(args[0], expected)
+
+    def test_unchanged(self):
+        """``StatusWriter`` drops results that match the known state"""
+        self.writer.set_known({'1.2.3.4': True})
+        self.writer.add('1.2.3.4', True)
+
+        self.assertEqual(self.writer.flush(), 0)
+        self.assertFalse(self.fake_update_records.called)
+        self.assertEqual(self.writer.stats['unchanged'], 1)
+
+    def test_changed(self):
+        """``StatusWriter`` writes results that differ from the known state"""
+        self.writer.set_known({'1.2.3.4': True})
+        self.writer.add('1.2.3.4', False)
+        self.writer.flush()
+
+        args, _ = self.fake_update_records.call_args
+
+        self.assertEqual(args[0], {'1.2.3.4': False})
+
+    def test_remembers_writes(self):
+        """``StatusWriter`` does not rewrite a value it already wrote"""
+        self.writer.add('1.2.3.4', False)
+        self.writer.flush()
+        self.writer.add('1.2.3.4', False)
+        self.writer.flush()
+
+        self.assertEqual(self.fake_update_records.call_count, 1)
+
+    def test_flush_if_stale(self):
+        """``StatusWriter.flush_if_stale`` writes results that have waited ``flush_interval``"""
+        self.writer.flush_interval = 0
+        self.writer._pending['1.2.3.4'] = True
+        self.writer._oldest = 0
+
+        self.writer.flush_if_stale()
+
+        self.assertTrue(self.fake_update_records.called)
+
+    def test_scheduler(self):
+        """``StatusWriter`` tells the scheduler about every result, changed or not"""
+        self.writer.scheduler = MagicMock()
+        self.writer.set_known({'1.2.3.4': True})
+        self.writer.add('1.2.3.4', True)
+
+        self.writer.scheduler.record.assert_called_with('1.2.3.4', True)
+
+    def test_flush_if_stale_fresh(self):
+        """``StatusWriter.flush_if_stale`` waits for ``flush_interval``"""
+        self.writer.add('1.2.3.4', True)
+
+        self.writer.flush_if_stale()
+
+        self.assertFalse(self.fake_update_records.called)
+
+
+
+class TestProbeScheduler(unittest.TestCase):
+    """A suite of test cases for the worker.ProbeScheduler object"""
+
+    def setUp(self):
+        self.scheduler = worker.ProbeScheduler(min_interval=60, max_interval=600, backoff=2)
+        self.key = '1.2.3.4'
+        self.scheduler.sync({self.key: True}, now=0)
+
+    def test_bad_bounds(self):
+        """``ProbeScheduler`` raises ValueError if min_interval exceeds max_interval"""
+        with self.assertRaises(ValueError):
+            worker.ProbeScheduler(min_interval=600, max_interval=60)
+
+    def test_new_due(self):
+        """``ProbeScheduler`` probes new records right away"""
+        self.assertEqual(self.scheduler.pop_due(now=0), [self.key])
+
+    def test_not_due_twice(self):
+        """``ProbeScheduler`` does not hand out a record again until its result is recorded"""
+        self.scheduler.pop_due(now=0)
+
+        self.assertEqual(self.scheduler.pop_due(now=10000), [])
+        self.assertTrue(self.scheduler.next_due() is None)
+
+    def test_backoff(self):
+        """``ProbeScheduler`` waits longer after each unchanged result"""
+        intervals = []
+        now = 0
+        for _ in range(6):
+            self.scheduler.pop_due(now=now)
+            self.scheduler.record(self.key, True, now=now)
+            intervals.append(self.scheduler.next_due() - now)
+            now = self.scheduler.next_due()
+
+        self.assertEqual(intervals, [120, 240, 480, 600, 600, 600])
+
+    def test_tighten(self):
+        """``ProbeScheduler`` probes a record again soon after its result changes"""
+        for now in (0, 120, 360):
+            self.scheduler.pop_due(now=now)
+            self.scheduler.record(self.key, True, now=now)
+        self.scheduler.pop_due(now=840)
+        self.scheduler.record(self.key, False, now=840)
+
+        self.assertEqual(self.scheduler.next_due(), 900)
+        self.assertEqual(self.scheduler.stats['tightened'], 1)
+
+    def test_pop_due_order(self):
+        """``ProbeScheduler.pop_due`` only returns the records that are due"""
+        other = '1.2.3.5'
+        self.scheduler.sync({self.key: True, other: True}, now=0)
+        self.scheduler.pop_due(now=0)
+        self.scheduler.record(self.key, True, now=0)
+        self.scheduler.record(other, False, now=0)
+
+        self.assertEqual(self.scheduler.pop_due(now=100), [other])
+
+    def test_deleted(self):
+        """``ProbeScheduler.sync`` forgets records that were deleted"""
+        self.scheduler.sync({}, now=0)
+
+        self.assertEqual(self.scheduler.pop_due(now=0), [])
+        self.assertEqual(len(self.scheduler), 0)
+
+    def test_deleted_while_probed(self):
+        """``ProbeScheduler.record`` ignores the result of a record deleted while it was probed"""
+        self.scheduler.pop_due(now=0)
+        self.scheduler.sync({}, now=0)
+        self.scheduler.record(self.key, True, now=0)
+
+        self.assertTrue(self.scheduler.next_due() is None)
+
+    def test_row_added(self):
+        """``ProbeScheduler.sync`` probes a record soon if its rows disagree, i.e. one was just added"""
+        self.scheduler.pop_due(now=0)
+        self.scheduler.record(self.key, True, now=0)
+        self.scheduler.sync({self.key: None}, now=50)
+
+        self.assertEqual(self.scheduler.pop_due(now=50), [self.key])
+
+    def test_pop_due_limit(self):
+        """``ProbeScheduler.pop_due`` takes at most ``limit`` records, most overdue first"""
+        keys = ['1.2.3.{}'.format(n) for n in range(3)]
+        scheduler = worker.ProbeScheduler()
+        for n in range(len(keys)):
+            scheduler.sync(dict.fromkeys(keys[:n + 1], True), now=10 - n) # later keys are more overdue
+
+        self.assertEqual(scheduler.pop_due(now=10, limit=2), [keys[2], keys[1]])
+        self.assertEqual(scheduler.pop_due(now=10), [keys[0]])
+
+    def test_max_lag(self):
+        """``ProbeScheduler`` tracks how late probes are handed out"""
+        self.scheduler.pop_due(now=42)
+
+        self.assertEqual(self.scheduler.stats['max_lag'], 42)
+
+    def test_saved(self):
+        """``ProbeScheduler`` counts the probes saved, compared to a sweep every LOOP_INTERVAL"""
+        scheduler = worker.ProbeScheduler(min_interval=worker.LOOP_INTERVAL, max_interval=worker.LOOP_INTERVAL * 4)
+        scheduler.sync({self.key: True}, now=0)
+        scheduler.pop_due(now=0)
+        scheduler.record(self.key, True, now=0)
+
+        self.assertEqual(scheduler.stats['saved'], 1)
+
+
+class TestWorkQueue(unittest.TestCase):
+    """A suite of test cases for the worker.WorkQueue object"""
+
+    def setUp(self):
+        self.work_queue = worker.WorkQueue(maxsize=2)
+
+    def test_fifo(self):
+        """``WorkQueue`` hands out records in the order they were queued"""
+        self.work_queue.put('1.2.3.4')
+        self.work_queue.put('1.2.3.5')
+
+        self.assertEqual(self.work_queue.get(), '1.2.3.4')
+        self.assertEqual(self.work_queue.get_nowait(), '1.2.3.5')
+
+    def test_coalesce(self):
+        """``WorkQueue`` does not queue a record that's already queued"""
+        self.assertTrue(self.work_queue.put('1.2.3.4'))
+        self.assertFalse(self.work_queue.put('1.2.3.4'))
+
+        self.assertEqual(self.work_queue.qsize(), 1)
+        self.assertEqual(self.work_queue.stats['coalesced'], 1)
+
+    def test_requeue(self):
+        """``WorkQueue`` queues a record again once a worker took it"""
+        self.work_queue.put('1.2.3.4')
+        self.work_queue.get()
+
+        self.assertTrue(self.work_queue.put('1.2.3.4'))
+
+    def test_coalesce_when_full(self):
+        """``WorkQueue`` coalesces, instead of blocking, when a full queue already holds the record"""
+        self.work_queue.put('1.2.3.4')
+        self.work_queue.put('1.2.3.5')
+
+        self.assertFalse(self.work_queue.put('1.2.3.4', timeout=0.01))
+
+    def test_full(self):
+        """``WorkQueue.put`` raises queue.Full when there's no room in time"""
+        self.work_queue.put('1.2.3.4')
+        self.work_queue.put('1.2.3.5')
+
+        with self.assertRaises(worker.queue.Full):
+            self.work_queue.put('1.2.3.6', timeout=0.01)
+        with self.assertRaises(worker.queue.Full):
+            self.work_queue.put('1.2.3.6', block=False)
+
+    def test_room(self):
+        """``WorkQueue.room`` is how many more records fit"""
+        self.work_queue.put('1.2.3.4')
+
+        self.assertEqual(self.work_queue.room(), 1)
+        self.assertTrue(worker.WorkQueue(maxsize=0).room() is None)
+
+    def test_wait_for_room(self):
+        """``WorkQueue.wait_for_room`` returns once a worker takes a record"""
+        self.work_queue.put('1.2.3.4')
+        self.work_queue.put('1.2.3.5')
+        taker = worker.threading.Timer(0.01, self.work_queue.get)
+        taker.start()
+
+        self.assertTrue(self.work_queue.wait_for_room(timeout=5))
+        taker.join()
+
+    def test_wait_for_room_timeout(self):
+        """``WorkQueue.wait_for_room`` returns False if the queue stays full"""
+        self.work_queue.put('1.2.3.4')
+        self.work_queue.put('1.2.3.5')
+
+        self.assertFalse(self.work_queue.wait_for_room(timeout=0.01))
+
+    def test_max_depth(self):
+        """``WorkQueue`` tracks the most records it held"""
+        self.work_queue.put('1.2.3.4')
+        self.work_queue.put('1.2.3.5')
+        self.work_queue.get()
+
+        self.assertEqual(self.work_queue.stats['max_depth'], 2)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,13 +1,24 @@
 # -*- coding: UTF-8 -*-
+import atexit
+
 from flask import Flask
 
-from vlab_ipam_api.lib import const
+from vlab_ipam_api.lib import const, Database
 from vlab_ipam_api.lib.views import HealthView, PortMapView, AddrView
-from vlab_ipam_api.lib.firewall import FireWall
+from vlab_ipam_api.lib.firewall import get_firewall
+from vlab_ipam_api.lib.database import close_pools
+from vlab_ipam_api.lib.migrations import migrate
+
 
+with Database() as db:
+    migrate(db)
+# uWSGI forks workers after loading this module; don't leave them an inherited socket
+close_pools()
 
 app = Flask(__name__)
-app.firewall = FireWall() # Attach to app, and call within views via ``current_app``
+app.firewall = get_firewall() # Attach to app, and call within views via ``current_app``
+app.firewall.load_index()
+atexit.register(app.firewall.flush) # write any rule changes still waiting to be saved
 
 AddrView.register(app)
 HealthView.register(app)
@@ -0,0 +1,189 @@
+# -*- coding: UTF-8 -*-
+"""
+This script runs the firewall commands of the API, as root, on request over a
+Unix socket. The API then never forks ``sudo`` while handling a request; a
+change costs a round trip on the socket, plus the firewall command itself.
+
+Only the commands the firewall backends use are allowed (see ``ALLOWED``). The
+socket is only accessible to root, and the group in ``VLAB_FW_HELPER_GROUP``.
+The protocol is documented in ``vlab_ipam_api.lib.helper_client``.
+"""
+import os
+import re
+import grp
+import socket
+import threading
+import socketserver
+import subprocess
+
+from setproctitle import setproctitle
+
+from vlab_ipam_api.lib import const, get_logger
+from vlab_ipam_api.lib.helper_client import DEFAULT_SOCKET, send_msg, recv_msg
+
+LOG_FILE = '/var/log/vlab_ipam_firewall_helper.log'
+_NAME = r'[\w.-]+'
+# Every command the firewall backends run, without the ``sudo``
+ALLOWED = [re.compile(x) for x in (
+    r'iptables-save',
+    r'iptables-restore --noflush',
+    r'ipset create {} hash:ip,port -exist'.format(_NAME),
+    r'ipset (add|del) {} [0-9.]+,tcp:[0-9]+ -exist'.format(_NAME),
+    r'ipset save {}'.format(_NAME),
+    r'ipset restore -exist',
+    r'nft -f -',
+    r'nft (-j )?list table ip {}'.format(_NAME),
+)]
+NOT_ALLOWED = 126 # like a shell, for a command it won't run
+
+
+def allowed(cmd):
+    """Determine if the helper may run a command
+
+    :Returns: Boolean
+
+    :param cmd: The command, without ``sudo``
+    :type cmd: String
+    """
+    return any(pattern.fullmatch(cmd) for pattern in ALLOWED)
+
+
+def execute(cmd, stdin=None):
+    """Run a command, as the helper does
+
+    :Returns: Dictionary
+
+    :param cmd: The command to run
+    :type cmd: String
+
+    :param stdin: Text to send to the command's standard in stream
+    :type stdin: String
+    """
+    try:
+        proc = subprocess.run(cmd.split(), input=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                              universal_newlines=True)
+    except OSError as doh:
+        return {'stdout' : '', 'stderr' : '%s' % doh, 'exit_code' : 1}
+    return {'stdout' : proc.stdout, 'stderr' : proc.stderr, 'exit_code' : proc.returncode}
+
+
+def run_batch(batch, runner=execute):
+    """Run the commands of a request in order, until one fails
+
+    :Returns: List - The result of each command that ran
+
+    :param batch: The commands; each a dictionary with "cmd" and "stdin"
+    :type batch: List
+
+    :param runner: Runs one allowed command, like ``execute``
+    :type runner: Callable
+    """
+    results = []
+    for op in batch:
+        cmd = op['cmd']
+        if not allowed(cmd):
+            result = {'stdout' : '', 'stderr' : 'Not allowed: {}'.format(cmd), 'exit_code' : NOT_ALLOWED}
+        else:
+            result = runner(cmd, op.get('stdin'))
+        results.append(result)
+        if result['exit_code']:
+            break
+    return results
+
+
+class RequestHandler(socketserver.BaseRequestHandler):
+    """Serves one connection, which can send any number of requests"""
+
+    def setup(self):
+        with self.server.connections_lock:
+            self.server.connections.add(self.request)
+
+    def finish(self):
+        with self.server.connections_lock:
+            self.server.connections.discard(self.request)
+
+    def handle(self):
+        while True:
+            try:
+                request = recv_msg(self.request)
+            except (OSError, ValueError) as doh:
+                self.server.log.error('Dropping connection: %s', doh)
+                return
+            if request is None:
+                return
+            try:
+                reply = {'results' : run_batch(request['batch'], runner=self.server.runner)}
+            except (KeyError, TypeError) as doh:
+                reply = {'error' : 'Malformed request: {}'.format(doh)}
+            for result in reply.get('results', []):
+                if result['exit_code']:
+                    self.server.log.error('Command failed: %s', result['stderr'].strip())
+            try:
+                send_msg(self.request, reply)
+            except OSError:
+                return
+
+
+class FirewallHelper(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """The helper daemon. Every connection gets a thread, so the listings of
+    several uWSGI workers run in parallel.
+
+    :param path: Where to create the Unix socket; an existing one is replaced
+    :type path: String
+
+    :param log: Where to log failed commands
+    :type log: logging.Logger
+
+    :param runner: Runs one allowed command. Tests and benchmarks supply a
+                   stand-in, so nothing needs root. Default is ``execute``
+    :type runner: Callable
+
+    :param group: The group, besides root, that may connect
+    :type group: String
+    """
+    daemon_threads = True
+
+    def __init__(self, path, log, runner=execute, group=None):
+        self.log = log
+        self.runner = runner
+        self.connections = set()
+        self.connections_lock = threading.Lock()
+        if os.path.exists(path):
+            os.unlink(path)
+        # No window where the socket is accessible to everyone
+        old_umask = os.umask(0o117)
+        try:
+            super(FirewallHelper, self).__init__(path, RequestHandler)
+        finally:
+            os.umask(old_umask)
+        if group:
+            os.chown(path, -1, grp.getgrnam(group).gr_gid)
+
+    def server_close(self):
+        """Stop listening, and close every connection, so clients know to reconnect"""
+        super(FirewallHelper, self).server_close()
+        with self.connections_lock:
+            for sock in self.connections:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+
+def main():
+    """Entry point for script"""
+    log = get_logger(name=__name__, log_file=LOG_FILE)
+    path = const.VLAB_FW_HELPER or DEFAULT_SOCKET
+    log.info('Firewall helper listening on {}'.format(path))
+    server = FirewallHelper(path, log, group=const.VLAB_FW_HELPER_GROUP)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(path)
+    log.info('Firewall helper stopping')
+
+
+if __name__ == '__main__':
+    setproctitle('IPAM-firewall-helper')
+    main()
@@ -19,6 +19,36 @@ DEFINED = OrderedDict([
             ('VLAB_PORT_MIN', int(environ.get('VLAB_PORT_MIN', 50000))),
             ('VLAB_PORT_MAX', int(environ.get('VLAB_PORT_MAX', 50100))),
             ('VLAB_INSERT_MAX_TRIES', int(environ.get('VLAB_INSERT_MAX_TRIES', 100))),
+            ('VLAB_DB_POOL_MIN', int(environ.get('VLAB_DB_POOL_MIN', 1))),
+            ('VLAB_DB_POOL_MAX', int(environ.get('VLAB_DB_POOL_MAX', 10))),
+            ('VLAB_DB_POOL_TIMEOUT', int(environ.get('VLAB_DB_POOL_TIMEOUT', 30))),
+            ('VLAB_DB_POOL_IDLE_CHECK', int(environ.get('VLAB_DB_POOL_IDLE_CHECK', 30))),
+            ('VLAB_DB_STREAM_BATCH', int(environ.get('VLAB_DB_STREAM_BATCH', 1000))),
+            ('VLAB_DB_MAX_PREPARED', int(environ.get('VLAB_DB_MAX_PREPARED', 64))),
+            # 'sync' writes the rules file within every change, 'debounce' coalesces writes in a background thread
+            ('VLAB_FW_SAVE_MODE', environ.get('VLAB_FW_SAVE_MODE', 'sync')),
+            ('VLAB_FW_SAVE_DELAY', int(environ.get('VLAB_FW_SAVE_DELAY', 1000))), # milliseconds
+            # 'iptables' or 'nftables'
+            ('VLAB_FW_BACKEND', environ.get('VLAB_FW_BACKEND', 'iptables')),
+            ('VLAB_NFT_TABLE', environ.get('VLAB_NFT_TABLE', 'vlab_ipam')),
+            # 'rules' adds a FORWARD rule per port mapping, 'ipset' adds a member to one set matched by a single rule
+            ('VLAB_FW_FORWARD_MODE', environ.get('VLAB_FW_FORWARD_MODE', 'rules')),
+            ('VLAB_FW_IPSET', environ.get('VLAB_FW_IPSET', 'vlab-ipam-forward')),
+            # Serializes firewall changes between processes (i.e. uWSGI workers); empty to only lock within a process
+            ('VLAB_FW_LOCK_FILE', environ.get('VLAB_FW_LOCK_FILE', '/run/lock/vlab-ipam-firewall.lock')),
+            # The Unix socket of the firewall helper daemon; empty to run the firewall commands via sudo
+            ('VLAB_FW_HELPER', environ.get('VLAB_FW_HELPER', '')),
+            ('VLAB_FW_HELPER_GROUP', environ.get('VLAB_FW_HELPER_GROUP', '')),
+            # How vlab-worker probes addresses; 'ping' forks /bin/ping per address, 'icmp' shares one ICMP socket
+            ('VLAB_WORKER_PROBER', environ.get('VLAB_WORKER_PROBER', 'ping')),
+            ('VLAB_WORKER_MAX_IN_FLIGHT', int(environ.get('VLAB_WORKER_MAX_IN_FLIGHT', 1000))),
+            # Seconds between probes of an address; changed and new ones start at the min, then
+            # the interval grows by the backoff factor each time the result is unchanged
+            ('VLAB_WORKER_MIN_INTERVAL', int(environ.get('VLAB_WORKER_MIN_INTERVAL', 60))),
+            ('VLAB_WORKER_MAX_INTERVAL', int(environ.get('VLAB_WORKER_MAX_INTERVAL', 1800))),
+            ('VLAB_WORKER_BACKOFF', float(environ.get('VLAB_WORKER_BACKOFF', 2.0))),
+            # The most probes vlab-worker queues for its threads; due probes wait in the schedule beyond that
+            ('VLAB_WORKER_QUEUE_SIZE', int(environ.get('VLAB_WORKER_QUEUE_SIZE', 2000))),
             ('VLAB_VERIFY_TOKEN', environ.get('VLAB_VERIFY_TOKEN', False)),
             ('VLAB_LOG_TARGET', environ.get('VLAB_LOG_TARGET', 'localhost:9092')),
             ('VLAB_DDNS_KEY', environ.get('VLAB_DDNS_KEY', 'PpULFMK6UQXYhFUot++fhNcmAumx+N7GcRfzO75NgL6RBA3gdJrw1KwraVR4QkhNoL23ySpdgTpWA1dUke2ZsA==')),
@@ -1,13 +1,312 @@
 # -*- coding: UTF-8 -*-
 """This module creates a simpler way to work with the vLab IPAM database"""
+import os
+import re
+import time
 import random
+import weakref
+import hashlib
+import itertools
+from functools import lru_cache
+from threading import Condition, Lock
+from contextlib import contextmanager
+from collections import OrderedDict
 
 import psycopg2
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
 
 from vlab_ipam_api.lib import const
 from vlab_ipam_api.lib.exceptions import DatabaseError
 
 
+_POOLS = {}
+_POOLS_LOCK = Lock()
+_CURSOR_IDS = itertools.count()
+# SQLSTATE for "prepared statement does not exist"
+INVALID_SQL_STATEMENT_NAME = '26000'
+# The fields a caller can ask ``lookup_port`` for, and the column that holds it
+PORT_FIELDS = OrderedDict([('target_addr', 'target_addr'),
+                           ('name', 'target_name'),
+                           ('target_port', 'target_port'),
+                           ('component', 'target_component')])
+# The fields a caller can ask ``lookup_addr`` for, and how it's aggregated per machine
+ADDR_FIELDS = OrderedDict([('component', 'min(target_component)'),
+                           ('routable', 'bool_and(routable)'),
+                           ('addr', 'array_agg(DISTINCT target_addr)')])
+
+
+class ConnectionPool(object):
+    """A thread-safe pool of connections to a single PostgreSQL database.
+
+    Connections are handed out LIFO, so a lightly loaded process keeps reusing
+    the same (warm) connection. Idle connections are health checked before they
+    are handed out again, and broken connections are discarded and replaced.
+    When all ``maxconn`` connections are in use, callers block for up to
+    ``timeout`` seconds waiting for one to be returned.
+
+    :param minconn: The number of connections to open when the pool is created.
+    :type minconn: Integer
+
+    :param maxconn: The most connections the pool will ever have open at once.
+    :type maxconn: Integer
+
+    :param timeout: How long to wait for a free connection before giving up.
+    :type timeout: Integer
+
+    :param idle_check: Connections idle for at least this many seconds are
+                       tested with ``SELECT 1`` before being reused.
+    :type idle_check: Integer
+
+    :param connect_kwargs: The parameters passed to ``psycopg2.connect``
+    :type connect_kwargs: Dictionary
+    """
+    def __init__(self, minconn, maxconn, timeout, idle_check, **connect_kwargs):
+        self.minconn = minconn
+        self.maxconn = max(1, maxconn)
+        self.timeout = timeout
+        self.idle_check = idle_check
+        self._connect_kwargs = connect_kwargs
+        self._cond = Condition()
+        self._idle = [] # (connection, returned_at) pairs; the end is the "hot" side
+        self._in_use = set()
+        self._prepared = {} # connection -> names of the statements prepared on it
+        self._size = 0
+        self._closed = False
+        self._stats = {'created' : 0, 'reused' : 0, 'discarded' : 0,
+                       'health_checks' : 0, 'waits' : 0, 'timeouts' : 0}
+        for _ in range(min(minconn, self.maxconn)):
+            self._size += 1
+            self._idle.append((self._connect(), time.time()))
+
+    def _connect(self):
+        """Open a new connection to the database
+
+        :Returns: psycopg2.extensions.connection
+        """
+        try:
+            conn = psycopg2.connect(**self._connect_kwargs)
+        except psycopg2.Error as doh:
+            raise DatabaseError(message=doh.pgerror or '%s' % doh, pgcode=doh.pgcode)
+        self._count('created')
+        return conn
+
+    def _count(self, stat):
+        """Increment one of the usage counters"""
+        # The Condition uses an RLock, so this is safe while already holding it
+        with self._cond:
+            self._stats[stat] += 1
+
+    def getconn(self):
+        """Check out a connection. Must be given back via ``putconn``.
+
+        :Returns: psycopg2.extensions.connection
+
+        :Raises: DatabaseError
+        """
+        deadline = time.time() + self.timeout
+        while True:
+            with self._cond:
+                conn, returned_at = self._reserve(deadline)
+            if conn is None:
+                # A slot was reserved for us; connect without holding the lock
+                try:
+                    conn = self._connect()
+                except Exception:
+                    self._release_slot()
+                    raise
+            elif not self._healthy(conn, returned_at):
+                self._close(conn)
+                self._release_slot()
+                continue
+            else:
+                self._count('reused')
+            with self._cond:
+                self._in_use.add(conn)
+            return conn
+
+    def _reserve(self, deadline):
+        """Pop an idle connection, or reserve a slot for a new one. Caller must
+        hold ``self._cond``.
+
+        :Returns: Tuple (connection or None, returned_at or None)
+        """
+        while True:
+            if self._closed:
+                raise DatabaseError(message='Database connection pool is closed', pgcode=None)
+            elif self._idle:
+                return self._idle.pop()
+            elif self._size < self.maxconn:
+                self._size += 1
+                return None, None
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                self._stats['timeouts'] += 1
+                error = 'Timed out after {} seconds waiting for a database connection'.format(self.timeout)
+                raise DatabaseError(message=error, pgcode=None)
+            self._stats['waits'] += 1
+            self._cond.wait(remaining)
+
+    def _release_slot(self):
+        """Give back a reserved slot after failing to connect, or discarding a connection"""
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def _healthy(self, conn, returned_at):
+        """Verify that an idle connection is still usable.
+
+        :Returns: Boolean
+
+        :param conn: The connection to check
+        :type conn: psycopg2.extensions.connection
+
+        :param returned_at: The epoch timestamp of when the connection went idle
+        :type returned_at: Float
+        """
+        if conn.closed:
+            return False
+        if time.time() - returned_at < self.idle_check:
+            return True
+        self._count('health_checks')
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1;')
+            cursor.close()
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+    def prepared(self, conn):
+        """Obtain the names of the statements prepared on a connection. Prepared
+        statements live as long as the session, so this outlives any one ``Database``.
+
+        :Returns: Set
+
+        :param conn: The connection obtained from ``getconn``
+        :type conn: psycopg2.extensions.connection
+        """
+        with self._cond:
+            return self._prepared.setdefault(conn, set())
+
+    def _close(self, conn):
+        """Close a connection that will not be reused"""
+        self._count('discarded')
+        with self._cond:
+            self._prepared.pop(conn, None)
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def putconn(self, conn, discard=False):
+        """Return a connection to the pool.
+
+        Any open transaction is rolled back so the next user gets a clean session.
+
+        :Returns: None
+
+        :param conn: The connection obtained from ``getconn``
+        :type conn: psycopg2.extensions.connection
+
+        :param discard: Set to True to close the connection instead of reusing it
+        :type discard: Boolean
+        """
+        if not (discard or conn.closed):
+            try:
+                if conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                discard = True
+        with self._cond:
+            self._in_use.discard(conn)
+            if discard or conn.closed or self._closed:
+                self._size -= 1
+                self._close(conn)
+            else:
+                self._idle.append((conn, time.time()))
+            self._cond.notify()
+
+    def closeall(self):
+        """Close every idle connection, and any in-use connection once it's returned.
+
+        :Returns: None
+        """
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._size -= 1
+                self._close(conn)
+            self._cond.notify_all()
+
+    def stats(self):
+        """Obtain usage counters for the pool
+
+        :Returns: Dictionary
+        """
+        with self._cond:
+            info = dict(self._stats)
+            info['size'] = self._size
+            info['idle'] = len(self._idle)
+            info['in_use'] = len(self._in_use)
+            info['min'] = self.minconn
+            info['max'] = self.maxconn
+        return info
+
+
+def get_pool(user='postgres', dbname='vlab_ipam'):
+    """Obtain the process-wide connection pool for a database, creating it if needed.
+
+    Pools are tracked per process ID so that a forked child (i.e. a uWSGI worker)
+    never shares sockets with its parent.
+
+    :Returns: ConnectionPool
+
+    :param user: The username when connection to the database
+    :type user: String
+
+    :param dbname: The specific database to connection to
+    :type dbname: String
+    """
+    key = (os.getpid(), user, dbname)
+    with _POOLS_LOCK:
+        pool = _POOLS.get(key, None)
+        if pool is None:
+            pool = ConnectionPool(minconn=const.VLAB_DB_POOL_MIN,
+                                  maxconn=const.VLAB_DB_POOL_MAX,
+                                  timeout=const.VLAB_DB_POOL_TIMEOUT,
+                                  idle_check=const.VLAB_DB_POOL_IDLE_CHECK,
+                                  user=user,
+                                  dbname=dbname)
+            _POOLS[key] = pool
+    return pool
+
+
+def pool_stats():
+    """Obtain the usage counters of every connection pool in this process
+
+    :Returns: Dictionary
+    """
+    pid = os.getpid()
+    with _POOLS_LOCK:
+        pools = [(k, v) for k, v in _POOLS.items() if k[0] == pid]
+    return {'{}@{}'.format(user, dbname) : pool.stats() for (_, user, dbname), pool in pools}
+
+
+def close_pools():
+    """Close every connection pool in this process. Call when shutting down.
+
+    :Returns: None
+    """
+    pid = os.getpid()
+    with _POOLS_LOCK:
+        keys = [k for k in _POOLS.keys() if k[0] == pid]
+        pools = [_POOLS.pop(k) for k in keys]
+    for pool in pools:
+        pool.closeall()
+
+
 class Database(object):
     """Simplifies communication with the database.
 
@@ -26,11 +325,19 @@ class Database(object):
     :type dbname: String, default insightiq
     """
     def __init__(self, user='postgres', dbname='vlab_ipam'):
-        self._connection = psycopg2.connect(user=user, dbname=dbname)
-        self._cursor = self._connection.cursor()
+        self._pool = get_pool(user=user, dbname=dbname)
+        self._tx_depth = 0
+        self._streams = weakref.WeakSet() # unfinished ``stream`` generators
+        self._connection = self._pool.getconn()
+        self._prepared = self._pool.prepared(self._connection)
+        try:
+            self._cursor = self._connection.cursor()
+        except psycopg2.Error as doh:
+            self._pool.putconn(self._connection, discard=True)
+            raise DatabaseError(message=doh.pgerror or '%s' % doh, pgcode=doh.pgcode)
 
     def __enter__(self):
-        """Enables use of the ``with`` statement to auto close database connection
+        """Enables use of the ``with`` statement to auto return the database connection
         https://docs.python.org/2.7/reference/datamodel.html#with-statement-context-managers
 
         Example::
@@ -41,10 +348,58 @@ class Database(object):
         return self
 
     def __exit__(self, exc_type, exc_value, the_traceback):
-        self._connection.close()
+        self.close()
+
+    @contextmanager
+    def transaction(self):
+        """Group every ``execute`` within the ``with`` block into one commit. If
+        the block raises, everything in it is rolled back.
+
+        Nesting is supported; inner blocks use a SAVEPOINT, so an inner failure
+        only undoes the inner block and the outer block decides what to do.
+
+        Example::
+
+          with Database() as db:
+              with db.transaction():
+                  target_port, target_addr = db.port_info(conn_port)
+                  db.delete_port(conn_port)
+        """
+        savepoint = 'vlab_sp_{}'.format(self._tx_depth)
+        nested = self._tx_depth > 0
+        if nested:
+            self._run('SAVEPOINT {};'.format(savepoint))
+        self._tx_depth += 1
+        try:
+            yield self
+        except BaseException:
+            self._tx_depth -= 1
+            if nested:
+                self._run('ROLLBACK TO SAVEPOINT {};'.format(savepoint))
+            else:
+                self._connection.rollback()
+            raise
+        else:
+            self._tx_depth -= 1
+            if nested:
+                self._run('RELEASE SAVEPOINT {};'.format(savepoint))
+            else:
+                try:
+                    self._connection.commit()
+                except psycopg2.Error as doh:
+                    self._connection.rollback()
+                    raise DatabaseError(message=doh.pgerror, pgcode=doh.pgcode)
+
+    def _run(self, sql):
+        """Issue transaction control SQL; i.e. SAVEPOINT"""
+        try:
+            self._cursor.execute(sql)
+        except psycopg2.Error as doh:
+            raise DatabaseError(message=doh.pgerror, pgcode=doh.pgcode)
 
     def execute(self, sql, params=None):
-        """Run a single SQL command
+        """Run a single SQL command. Commits immediately, unless called within
+        a ``transaction()`` block.
 
         :Returns: List
 
@@ -56,10 +411,13 @@ class Database(object):
         """
         try:
             self._cursor.execute(sql, params)
-            self._connection.commit()
+            if not self._tx_depth:
+                self._connection.commit()
         except psycopg2.Error as doh:
             # All psycopg2 Exceptions are subclassed from psycopg2.Error
-            self._connection.rollback()
+            if not self._tx_depth:
+                # Within a transaction, the ``transaction`` block owns the rollback
+                self._connection.rollback()
             raise DatabaseError(message=doh.pgerror, pgcode=doh.pgcode)
         else:
             if self._cursor.description is None:
@@ -67,16 +425,118 @@ class Database(object):
             else:
                 return self._cursor.fetchall()
 
+    def execute_prepared(self, sql, params=None):
+        """Like ``execute``, but Postgres only parses and plans the statement the
+        first time it's used on a pooled connection. Later calls just send the
+        name of the statement and its parameters.
+
+        Intended for the hot statements whose text only varies by which filters
+        are used; every distinct ``sql`` becomes its own prepared statement.
+
+        :Returns: List
+
+        :param sql: **Required** The SQL syntax to execute
+        :type sql: String
+
+        :param params: The values to use in a parameterized SQL query
+        :type params: Iterable
+        """
+        name, prepare, run = _prepared_statement(sql)
+        for retry in (True, False):
+            if name not in self._prepared:
+                if len(self._prepared) >= const.VLAB_DB_MAX_PREPARED:
+                    # Don't let an unbounded number of statement shapes pile up in the session
+                    return self.execute(sql, params)
+                self.execute(prepare)
+                self._prepared.add(name)
+            try:
+                return self.execute(run, params)
+            except DatabaseError as doh:
+                if doh.pgcode != INVALID_SQL_STATEMENT_NAME:
+                    raise
+                # The session lost the statement; i.e. DISCARD ALL
+                self._prepared.discard(name)
+                if self._tx_depth or not retry:
+                    # The caller's transaction is aborted, so it has to retry
+                    raise
+
+    def stream(self, sql, params=None, batch_size=None):
+        """Run a query with a server-side cursor, and yield the rows in batches.
+
+        Unlike ``execute``, the result set is never buffered in full on the client,
+        so memory use is bounded by ``batch_size`` no matter how big the table is.
+        The query runs when the first batch is requested, and the Database must
+        remain open until the generator is exhausted (or closed).
+
+        :Returns: Generator of Lists
+
+        :param sql: **Required** The SQL syntax to execute
+        :type sql: String
+
+        :param params: The values to use in a parameterized SQL query
+        :type params: Iterable
+
+        :param batch_size: How many rows to fetch per round trip. Default is ``VLAB_DB_STREAM_BATCH``
+        :type batch_size: Integer
+        """
+        batches = self._stream(sql, params, batch_size or const.VLAB_DB_STREAM_BATCH)
+        # So ``close`` can end it while the connection is still ours
+        self._streams.add(batches)
+        return batches
+
+    def _stream(self, sql, params, batch_size):
+        """The generator behind ``stream``"""
+        # Named cursors only live within a transaction
+        with self.transaction():
+            cursor = self._connection.cursor(name='vlab_stream_{}'.format(next(_CURSOR_IDS)))
+            try:
+                cursor.execute(sql, params)
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    yield rows
+            except psycopg2.Error as doh:
+                raise DatabaseError(message=doh.pgerror, pgcode=doh.pgcode)
+            finally:
+                try:
+                    cursor.close()
+                except psycopg2.Error:
+                    pass
+
     def close(self):
-        """Disconnect from the database"""
-        self._connection.close()
+        """Return the connection to the pool. Safe to call more than once."""
+        if self._connection is None:
+            return
+        # A stream the caller stopped reading (i.e. the client disconnected) is
+        # still inside its transaction; end it before giving up the connection
+        for batches in list(self._streams):
+            try:
+                batches.close()
+            except (psycopg2.Error, DatabaseError):
+                pass # the pool rolls back, or discards, the connection
+        try:
+            self._cursor.close()
+        except psycopg2.Error:
+            pass
+        self._pool.putconn(self._connection)
+        self._connection = None
 
     def add_port(self, target_addr, target_port, target_name, target_component):
         """Create the record for a port mapping rule. Returns the local connection
         port that maps to the remote machine target port.
 
+        A free port between ``VLAB_PORT_MIN`` and ``VLAB_PORT_MAX`` is found and
+        claimed in a single INSERT, so allocation always succeeds while any port
+        is free. The search starts at a random port and wraps around the range,
+        so a port that was just deleted isn't handed straight to another target,
+        and concurrent requests rarely want the same port. A retry only happens
+        if a concurrent request claims the same port first.
+
         :Returns: Integer
 
+        :Raises: RuntimeError (when every port in the range is taken)
+
         :param target_addr: The IP address of the remote machine.
         :type target_addr: String
 
@@ -90,14 +550,21 @@ class Database(object):
         :type target_component: String
         """
         sql = """INSERT INTO ipam (conn_port, target_addr, target_port, target_name, target_component)\
-                 VALUES (%s, %s, %s, %s, %s);"""
+                 SELECT free.port, %s, %s, %s, %s FROM generate_series(%s, %s) AS free(port)\
+                 WHERE NOT EXISTS (SELECT 1 FROM ipam WHERE ipam.conn_port = free.port)\
+                 ORDER BY free.port < %s, free.port LIMIT 1 RETURNING conn_port;"""
         for _ in range(const.VLAB_INSERT_MAX_TRIES):
-            conn_port = random.randint(const.VLAB_PORT_MIN, const.VLAB_PORT_MAX)
+            start = random.randint(const.VLAB_PORT_MIN, const.VLAB_PORT_MAX)
+            params = (target_addr, target_port, target_name, target_component,
+                      const.VLAB_PORT_MIN, const.VLAB_PORT_MAX, start)
             try:
-                self.execute(sql=sql, params=(conn_port, target_addr, target_port, target_name, target_component))
+                # Within a caller's transaction, this is a SAVEPOINT so a lost race
+                # doesn't abort everything else the caller has done
+                with self.transaction():
+                    rows = self.execute(sql=sql, params=params)
             except DatabaseError as doh:
                 if doh.pgcode == '23505':
-                    # port already in use
+                    # a concurrent request claimed the same port
                     continue
                 else:
                     raise doh
@@ -107,6 +574,9 @@ class Database(object):
         else:
             # max tries exceeded
             raise RuntimeError('Failed to create port map after %s tries' % const.VLAB_INSERT_MAX_TRIES)
+        if not rows:
+            raise RuntimeError('No free ports between %s and %s' % (const.VLAB_PORT_MIN, const.VLAB_PORT_MAX))
+        conn_port = rows[0][0]
         return conn_port
 
     def delete_port(self, conn_port):
@@ -118,7 +588,7 @@ class Database(object):
         :type conn_port: Integer
         """
         sql = "DELETE FROM ipam WHERE conn_port=(%s);"
-        self.execute(sql=sql, params=(conn_port,))
+        self.execute_prepared(sql=sql, params=(conn_port,))
 
     def port_info(self, conn_port):
         """Obtain the remote port and remote address that a local port maps to.
@@ -129,14 +599,14 @@ class Database(object):
         :type conn_port: Integer
         """
         sql = "SELECT target_port, target_addr FROM ipam WHERE conn_port=(%s);"
-        rows = list(self.execute(sql, params=(conn_port,)))
+        rows = list(self.execute_prepared(sql, params=(conn_port,)))
         if rows:
             target_port, target_addr = rows[0]
         else:
             target_port, target_addr = None, None
         return target_port, target_addr
 
-    def lookup_addr(self, name, addr, component):
+    def lookup_addr(self, name, addr, component, limit=None, after=None, fields=None):
         """Obtain information about a machine in a lab.
 
         :Returns: Dictionary
@@ -149,34 +619,50 @@ class Database(object):
 
         :param component: The type of vLab component to look up (i.e. OneFS, ESRS, etc)
         :type component: String
+
+        :param limit: Return at most this many machines, ordered by name.
+        :type limit: Integer
+
+        :param after: Only return machines whose name sorts after this value.
+        :type after: String
+
+        :param fields: Which of ``ADDR_FIELDS`` to include per machine. Default is all of them.
+        :type fields: List
         """
-        # No nested SQL queries so DISTINCT is OK
-        # Using DISTINCT because the table is unique across conn_port
+        fields = _check_fields(fields, ADDR_FIELDS)
+        # One row per machine; a machine can have multiple IPs, and multiple
+        # port maps per IP, so the addresses are de-duplicated while grouping
+        sql = "SELECT target_name, {} FROM ipam{} GROUP BY target_name{};"
+        columns = ', '.join(ADDR_FIELDS[x] for x in fields)
+        clauses = []
+        params = []
         if addr:
-            sql = "SELECT DISTINCT target_name, target_addr, target_component, routable FROM ipam WHERE target_addr LIKE (%s);"
-            params=(addr,)
+            clauses.append("target_addr LIKE (%s)")
+            params.append(addr)
         elif name:
-            sql = "SELECT DISTINCT target_name, target_addr, target_component, routable FROM ipam WHERE target_name LIKE (%s);"
-            params=(name,)
+            clauses.append("target_name LIKE (%s)")
+            params.append(name)
         elif component:
-            sql = "SELECT DISTINCT target_name, target_addr, target_component, routable FROM ipam WHERE target_component LIKE (%s);"
-            params=(component,)
-        else:
-            sql = "SELECT DISTINCT target_name, target_addr, target_component, routable FROM ipam;"
-            params=None
-        data = self.execute(sql, params=params)
+            clauses.append("target_component LIKE (%s)")
+            params.append(component)
+        if after is not None:
+            clauses.append("target_name > (%s)")
+            params.append(after)
+        where = ''
+        if clauses:
+            where = ' WHERE {}'.format(' AND '.join(clauses))
+        page = ''
+        if limit:
+            page = ' ORDER BY target_name LIMIT (%s)'
+            params.append(limit)
+        data = self.execute(sql.format(columns, where, page), params=tuple(params) or None)
         answer = {}
-        if data:
-            for the_name, the_addr, the_component, routable in data:
-                result = answer.setdefault(the_name, {})
-                result['component'] = the_component
-                result['routable'] = routable
-                # Might have multiple IPs on a single machine
-                ips = result.setdefault('addr', [])
-                ips.append(the_addr)
+        for row in data:
+            answer[row[0]] = dict(zip(fields, row[1:]))
         return answer
 
-    def lookup_port(self, name=None, addr=None, component=None, conn_port=None, target_port=None):
+    def lookup_port(self, name=None, addr=None, component=None, conn_port=None, target_port=None,
+                    limit=None, after=None, fields=None):
         """Obtain port mapping information
 
         :Returns: Dictionary
@@ -193,39 +679,197 @@ class Database(object):
         :param conn_port: The connection port
         :type conn_port: Integer
 
+        :param target_port: The port on the VM
+        :type target_port: Integer
+
+        :param limit: Return at most this many port maps, ordered by conn_port.
+        :type limit: Integer
+
+        :param after: Only return port maps with a conn_port greater than this value.
+        :type after: Integer
+
+        :param fields: Which of ``PORT_FIELDS`` to include per port map. Default is all of them.
+        :type fields: List
+        """
+        fields = _check_fields(fields, PORT_FIELDS)
+        columns = ', '.join(['conn_port'] + [PORT_FIELDS[x] for x in fields])
+        sql = "SELECT {} FROM ipam".format(columns)
+        where, params = _port_filters(name, addr, component, conn_port, target_port, after)
+        if where:
+            query = "{} WHERE {}".format(sql, where)
+        else:
+            query = sql
+        if limit:
+            query = "{} ORDER BY conn_port LIMIT (%s)".format(query)
+            params += (limit,)
+        data = self.execute_prepared("{};".format(query), params=params)
+        answer = {}
+        for row in data:
+            answer[row[0]] = dict(zip(fields, row[1:]))
+        return answer
+
+    def lookup_port_json(self, name=None, addr=None, component=None, conn_port=None, target_port=None,
+                         limit=None, after=None, fields=None):
+        """Like ``lookup_port``, but the database builds the answer as a JSON
+        document. Avoids materializing every row in Python when the caller is
+        just going to serialize the answer anyway.
+
+        :Returns: Tuple (JSON String, next ``after`` value or None when on the last page)
+
+        :param name: The name of the VM
+        :type name: String
+
+        :param addr: The IP address of the VM
+        :type addr: String
+
+        :param component: The category of VM (i.e. OneFS, InsightIQ, etc)
+        :type component: String
+
         :param conn_port: The connection port
         :type conn_port: Integer
+
+        :param target_port: The port on the VM
+        :type target_port: Integer
+
+        :param limit: Return at most this many port maps, ordered by conn_port.
+        :type limit: Integer
+
+        :param after: Only return port maps with a conn_port greater than this value.
+        :type after: Integer
+
+        :param fields: Which of ``PORT_FIELDS`` to include per port map. Default is all of them.
+        :type fields: List
         """
-        sql = "SELECT conn_port, target_addr, target_name, target_port, target_component FROM ipam"
-        clauses = []
-        params = []
-        if name:
-            clauses.append("target_name LIKE (%s)")
-            params.append(name)
-        if addr:
-            clauses.append('target_addr LIKE (%s)')
-            params.append(addr)
-        if component:
-            clauses.append('target_component LIKE (%s)')
-            params.append(component)
-        if conn_port:
-            clauses.append('conn_port = (%s)')
-            params.append(conn_port)
-        if target_port:
-            clauses.append('target_port = (%s)')
-            params.append(target_port)
-        where = ' AND '.join(clauses)
+        fields = _check_fields(fields, PORT_FIELDS)
+        members = ', '.join("'{}', {}".format(x, PORT_FIELDS[x]) for x in fields)
+        # Cast to text, otherwise psycopg2 decodes the JSON for us
+        sql = """SELECT COALESCE(json_object_agg(conn_port, json_build_object({})), '{{}}')::text,\
+                 max(conn_port), count(*) FROM {}"""
+        where, params = _port_filters(name, addr, component, conn_port, target_port, after)
+        source = 'ipam'
+        if where:
+            source = 'ipam WHERE {}'.format(where)
+        if limit:
+            source = '(SELECT * FROM {} ORDER BY conn_port LIMIT (%s)) AS page'.format(source)
+            params += (limit,)
+        data = self.execute_prepared("{};".format(sql.format(members, source)), params=params)
+        ports, last_port, count = data[0]
+        if limit and count >= limit:
+            next_after = last_port
+        else:
+            next_after = None
+        return ports, next_after
+
+    def stream_ports_json(self, name=None, addr=None, component=None, conn_port=None, target_port=None,
+                          after=None, fields=None, batch_size=None):
+        """Like ``lookup_port_json``, but streams the port maps in batches via
+        ``stream`` instead of building one big document.
+
+        :Returns: Generator of Lists of (conn_port, JSON String)
+
+        :param name: The name of the VM
+        :type name: String
+
+        :param addr: The IP address of the VM
+        :type addr: String
+
+        :param component: The category of VM (i.e. OneFS, InsightIQ, etc)
+        :type component: String
+
+        :param conn_port: The connection port
+        :type conn_port: Integer
+
+        :param target_port: The port on the VM
+        :type target_port: Integer
+
+        :param after: Only return port maps with a conn_port greater than this value.
+        :type after: Integer
+
+        :param fields: Which of ``PORT_FIELDS`` to include per port map. Default is all of them.
+        :type fields: List
+
+        :param batch_size: How many port maps to fetch per round trip.
+        :type batch_size: Integer
+        """
+        fields = _check_fields(fields, PORT_FIELDS)
+        members = ', '.join("'{}', {}".format(x, PORT_FIELDS[x]) for x in fields)
+        sql = "SELECT conn_port, json_build_object({})::text FROM ipam".format(members)
+        where, params = _port_filters(name, addr, component, conn_port, target_port, after)
         if where:
             query = "{} WHERE {};".format(sql, where)
         else:
             query = "{};".format(sql)
-        data = self.execute(query, params=tuple(params))
-        answer = {}
-        if data:
-            for the_port, the_addr, the_name, the_target_port, the_component in data:
-                result = answer.setdefault(the_port, {})
-                result['name'] = the_name
-                result['target_addr'] = the_addr
-                result['target_port'] = the_target_port
-                result['component'] = the_component
-        return answer
+        return self.stream(query, params=params, batch_size=batch_size)
+
+
+@lru_cache(maxsize=256)
+def _prepared_statement(sql):
+    """Translate a parameterized query into the SQL to prepare it, and to run it.
+
+    The name is derived from the query text, so each filter combination gets its
+    own statement, and every connection uses the same name for the same query.
+
+    :Returns: Tuple (name, PREPARE SQL, EXECUTE SQL)
+
+    :param sql: A query that uses ``%s`` placeholders
+    :type sql: String
+    """
+    name = 'vlab_{}'.format(hashlib.sha1(sql.encode()).hexdigest()[:16])
+    numbers = itertools.count(1)
+    # PREPARE uses $1, $2, etc and is sent without params, so unescape any %%
+    body = re.sub('%[%s]', lambda m: '%' if m.group() == '%%' else '${}'.format(next(numbers)), sql)
+    count = next(numbers) - 1
+    args = ''
+    if count:
+        args = ' ({})'.format(', '.join(['%s'] * count))
+    return name, 'PREPARE {} AS {}'.format(name, body), 'EXECUTE {}{};'.format(name, args)
+
+
+def _check_fields(fields, allowed):
+    """Default to every field, and reject unknown fields. Never let a
+    caller-supplied string near the SQL.
+
+    :Returns: List
+
+    :Raises: ValueError
+
+    :param fields: The fields the caller asked for
+    :type fields: List
+
+    :param allowed: The fields that can be asked for
+    :type allowed: OrderedDict
+    """
+    if not fields:
+        return list(allowed.keys())
+    unknown = [x for x in fields if x not in allowed]
+    if unknown:
+        raise ValueError('Unknown field(s): {}'.format(', '.join(unknown)))
+    return list(fields)
+
+
+def _port_filters(name, addr, component, conn_port, target_port, after=None):
+    """Build the WHERE clause for looking up port mapping records
+
+    :Returns: Tuple (where clause, params)
+    """
+    clauses = []
+    params = []
+    if name:
+        clauses.append("target_name LIKE (%s)")
+        params.append(name)
+    if addr:
+        clauses.append('target_addr LIKE (%s)')
+        params.append(addr)
+    if component:
+        clauses.append('target_component LIKE (%s)')
+        params.append(component)
+    if conn_port:
+        clauses.append('conn_port = (%s)')
+        params.append(conn_port)
+    if target_port:
+        clauses.append('target_port = (%s)')
+        params.append(target_port)
+    if after is not None:
+        clauses.append('conn_port > (%s)')
+        params.append(after)
+    return ' AND '.join(clauses), tuple(params)
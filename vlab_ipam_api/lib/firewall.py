@@ -2,13 +2,802 @@
 """
 This module enables modifications to the Linux Netfilter firewall
 """
-from threading import RLock
+import os
+import abc
+import time
+import contextlib
+from collections import Counter
+from threading import Condition, Thread
 
-from vlab_ipam_api.lib.shell import run_cmd, CliResult
-from vlab_ipam_api.lib.exceptions import CliError
+from vlab_api_common import get_logger
 
+from vlab_ipam_api.lib import const
+from vlab_ipam_api.lib.locks import RWLock, ProcessLock
+from vlab_ipam_api.lib import shell
+from vlab_ipam_api.lib.helper_client import get_helper
 
-class FireWall(object):
+
+# The chain in each table that holds the port mapping rules
+CHAINS = {'nat' : 'PREROUTING', 'filter' : 'FORWARD'}
+# Every rule for a port mapping gets a comment of this prefix, plus its conn_port
+TAG_PREFIX = 'vlab-ipam:'
+RULES_FILE = '/etc/iptables/rules.v4'
+IPSET_FILE = '/etc/iptables/ipsets'
+SAVE_MODES = ('sync', 'debounce')
+BACKENDS = ('iptables', 'nftables')
+FORWARD_MODES = ('rules', 'ipset')
+# The rule ID of a port mapping's FORWARD "rule" when using the 'ipset' forward mode
+MEMBER_PREFIX = 'set:'
+
+logger = get_logger(__name__, loglevel=const.VLAB_IPAM_LOG_LEVEL)
+
+def run_cmd(cli_syntax, stdin=None):
+    """Run a firewall command; via the helper daemon when ``VLAB_FW_HELPER`` is
+    set, so the API doesn't fork ``sudo``, else like ``shell.run_cmd``.
+
+    :Returns: CliResult
+
+    :Raises: CliError (when exit code is not zero)
+
+    :param cli_syntax: The command to run, i.e. ``sudo iptables-save``
+    :type cli_syntax: String
+
+    :param stdin: Text to send to the command's standard in stream
+    :type stdin: String
+    """
+    if const.VLAB_FW_HELPER:
+        return get_helper(const.VLAB_FW_HELPER).run_cmd(cli_syntax, stdin=stdin)
+    return shell.run_cmd(cli_syntax, stdin=stdin)
+
+
+def rule_key(target_addr, target_port, conn_port=None):
+    """Normalize the values that identify a port mapping rule, so a lookup
+    matches no matter if the ports were supplied as strings or integers.
+
+    :Returns: Tuple
+
+    :param target_addr: The IP address of the remote machine
+    :type target_addr: String
+
+    :param target_port: The TCP port on the remote machine
+    :type target_port: Integer
+
+    :param conn_port: The local port that maps to the remote port. Untagged
+                      (legacy) FORWARD rules don't have one.
+    :type conn_port: Integer
+    """
+    if target_port is not None:
+        target_port = int(target_port)
+    if conn_port is not None:
+        conn_port = int(conn_port)
+    return target_addr, target_port, conn_port
+
+
+def rule_tag(conn_port):
+    """The comment that ties a rule to its port mapping
+
+    :Returns: String
+
+    :param conn_port: The local port of the port mapping
+    :type conn_port: Integer
+    """
+    return '{}{}'.format(TAG_PREFIX, conn_port)
+
+
+def forward_spec(target_port, target_addr, conn_port=None):
+    """The rule specification of a FORWARD rule; i.e. what follows ``-A FORWARD``
+
+    :Returns: String
+
+    :parm target_port: The TCP port on the remote machines to map.
+    :type target_port: Integer
+
+    :param target_addr: The IP address of the remote machien to map to.
+    :type target_addr: String
+
+    :param conn_port: The local port of the port mapping. Omit to describe an untagged (legacy) rule.
+    :type conn_port: Integer
+    """
+    if conn_port is None:
+        return '-p tcp -d {} --dport {} -j ACCEPT'.format(target_addr, target_port)
+    return '-p tcp -d {} --dport {} -m comment --comment {} -j ACCEPT'.format(target_addr, target_port, rule_tag(conn_port))
+
+
+def prerouting_spec(conn_port, target_port, target_addr, tagged=True):
+    """The rule specification of a PREROUTING rule; i.e. what follows ``-A PREROUTING``
+
+    :Returns: String
+
+    :parm conn_port: The TCP port on the local machine to map.
+    :type target_port: Integer
+
+    :parm target_port: The TCP port on the remote machines to map.
+    :type target_port: Integer
+
+    :param target_addr: The IP address of the remote machien to map to.
+    :type target_addr: String
+
+    :param tagged: Set to False to describe an untagged (legacy) rule
+    :type tagged: Boolean
+    """
+    if not tagged:
+        return '-i ens160 -p tcp --dport {} -j DNAT --to {}:{}'.format(conn_port, target_addr, target_port)
+    return '-i ens160 -p tcp --dport {} -m comment --comment {} -j DNAT --to {}:{}'.format(conn_port, rule_tag(conn_port),
+                                                                                         target_addr, target_port)
+
+
+def get_firewall(backend=None, **kwargs):
+    """Create the firewall object for the configured backend. Both have the same API.
+
+    :Returns: FireWall or NftFireWall
+
+    :Raises: ValueError
+
+    :param backend: Either 'iptables' or 'nftables'. Default is ``VLAB_FW_BACKEND``
+    :type backend: String
+
+    :param kwargs: Passed to the backend's constructor
+    :type kwargs: Dictionary
+    """
+    backend = backend or const.VLAB_FW_BACKEND
+    if backend == 'iptables':
+        return FireWall(**kwargs)
+    elif backend == 'nftables':
+        # Imported here; that module builds on this one
+        from vlab_ipam_api.lib.firewall_nft import NftFireWall
+        return NftFireWall(**kwargs)
+    raise ValueError('Param "backend" must be one of {}, supplied: {}'.format(BACKENDS, backend))
+
+
+def set_member(target_addr, target_port):
+    """The ``hash:ip,port`` ipset member that lets packets be forwarded to a port mapping target
+
+    :Returns: String
+
+    :param target_addr: The IP address of the remote machine
+    :type target_addr: String
+
+    :param target_port: The TCP port on the remote machine
+    :type target_port: Integer
+    """
+    return '{},tcp:{}'.format(target_addr, target_port)
+
+
+def match_set_spec(set_name):
+    """The rule specification of the single FORWARD rule used by the 'ipset' forward mode
+
+    :Returns: String
+
+    :param set_name: The name of the ipset
+    :type set_name: String
+    """
+    return '-m set --match-set {} dst,dst -j ACCEPT'.format(set_name)
+
+
+class RuleIndex(object):
+    """Tracks the port mapping rules within a chain, so a rule can be found
+    without listing the chain.
+
+    :param rules: The (``rule_key``, rule specification) of every rule in the
+                  chain, in order. Use (None, None) for rules that are not port
+                  mappings (i.e. the default FORWARD rules).
+    :type rules: List
+    """
+    def __init__(self, rules):
+        self._rules = list(rules)
+        self._specs = {}
+        self._reindex()
+
+    def __len__(self):
+        return len(self._rules)
+
+    def _reindex(self):
+        """Rebuild the lookup table from the ordered list of rules"""
+        self._specs = {}
+        for key, spec in self._rules:
+            if key is not None:
+                self._specs.setdefault(key, []).append(spec)
+
+    def find(self, key):
+        """Obtain the rule specification of a port mapping rule. If several rules
+        match, it's the first one; the same one ``iptables -D`` would remove.
+
+        :Returns: String or None
+
+        :param key: The output of ``rule_key``
+        :type key: Tuple
+        """
+        specs = self._specs.get(key, None)
+        if specs:
+            return specs[0]
+        return None
+
+    def keys(self):
+        """Obtain the ``rule_key`` of every port mapping rule, in order
+
+        :Returns: List
+        """
+        return [key for key, _ in self._rules if key is not None]
+
+    def update(self, deletes, appends, inserts=()):
+        """Record the changes made by a RuleBatch
+
+        :Returns: None
+
+        :param deletes: The rule numbers (highest first), or rule specifications deleted
+        :type deletes: List
+
+        :param appends: The (``rule_key``, rule specification) of each rule appended, in order
+        :type appends: List
+
+        :param inserts: The (``rule_key``, rule specification) of each rule inserted
+                        at the top of the chain, in order
+        :type inserts: List
+        """
+        for rule_id in deletes:
+            if isinstance(rule_id, int):
+                del self._rules[rule_id - 1]
+                continue
+            for idx, (_, spec) in enumerate(self._rules):
+                if spec == rule_id:
+                    del self._rules[idx]
+                    break
+        self._rules[0:0] = inserts
+        self._rules.extend(appends)
+        self._reindex()
+
+
+class RuleBatch(object):
+    """A set of rule changes to apply with a single ``iptables-restore``. The
+    changes to each table are committed as a unit.
+
+    Within a chain, deletes are applied before inserts and appends. Deleting by rule
+    specification (what ``find_rule`` returns) is preferred, because it's not
+    affected by other rules being added or removed. Deletes by rule number are
+    applied first, from the highest number down, so that one delete doesn't
+    renumber the rules of another.
+
+    Example::
+
+        batch = RuleBatch()
+        batch.forward(target_port=22, target_addr='192.168.1.2', conn_port=6000)
+        batch.prerouting(conn_port=6000, target_port=22, target_addr='192.168.1.2')
+        firewall.apply(batch)
+    """
+    def __init__(self):
+        self._deletes = {'nat' : [], 'filter' : []}
+        self._inserts = {'nat' : [], 'filter' : []}
+        self._appends = {'nat' : [], 'filter' : []}
+
+    def __len__(self):
+        return sum(len(x) for changes in (self._deletes, self._inserts, self._appends) for x in changes.values())
+
+    def forward(self, target_port, target_addr, conn_port=None):
+        """Add the FORWARD rule in the "filter" table for a port mapping
+
+        :Returns: String - The rule specification
+
+        :parm target_port: The TCP port on the remote machines to map.
+        :type target_port: Integer
+
+        :param target_addr: The IP address of the remote machien to map to.
+        :type target_addr: String
+
+        :param conn_port: The local port of the port mapping; used to tag the rule
+        :type conn_port: Integer
+        """
+        spec = forward_spec(target_port, target_addr, conn_port)
+        self._appends['filter'].append((rule_key(target_addr, target_port, conn_port), spec))
+        return spec
+
+    def prerouting(self, conn_port, target_port, target_addr):
+        """Add the PREROUTING rule in the "nat" table for a port mapping
+
+        :Returns: String - The rule specification
+
+        :parm conn_port: The TCP port on the local machine to map.
+        :type target_port: Integer
+
+        :parm target_port: The TCP port on the remote machines to map.
+        :type target_port: Integer
+
+        :param target_addr: The IP address of the remote machien to map to.
+        :type target_addr: String
+        """
+        spec = prerouting_spec(conn_port, target_port, target_addr)
+        self._appends['nat'].append((rule_key(target_addr, target_port, conn_port), spec))
+        return spec
+
+    def append(self, table, spec, key=None):
+        """Add any rule to the end of a chain
+
+        :Returns: String - The rule specification
+
+        :param table: Either 'filter' or 'nat'
+        :type table: String
+
+        :param spec: The rule specification; i.e. what follows ``-A <chain>``
+        :type spec: String
+
+        :param key: The ``rule_key``, if the rule is for a port mapping
+        :type key: Tuple
+        """
+        self._appends[table].append((key, spec))
+        return spec
+
+    def insert(self, table, spec, key=None):
+        """Add any rule to the top of a chain, so it's checked before the others
+
+        :Returns: String - The rule specification
+
+        :param table: Either 'filter' or 'nat'
+        :type table: String
+
+        :param spec: The rule specification; i.e. what follows ``-I <chain> 1``
+        :type spec: String
+
+        :param key: The ``rule_key``, if the rule is for a port mapping
+        :type key: Tuple
+        """
+        self._inserts[table].append((key, spec))
+        return spec
+
+    def delete(self, rule_id, table):
+        """Remove a rule
+
+        :Returns: None
+
+        :Raises: ValueError
+
+        :param rule_id: The rule specification (from ``find_rule``), or rule number, to delete
+        :type rule_id: String
+
+        :param table: The specific table within iptables to delete a rule from.
+                      Must be either 'filter' or 'nat'.
+        :type table: String
+        """
+        table = table.lower()
+        if table not in CHAINS:
+            raise ValueError('Param "table" must be either "nat" or "filter", supplied: {}'.format(table))
+        rule_id = '{}'.format(rule_id)
+        if rule_id.isdigit():
+            rule_id = int(rule_id)
+        self._deletes[table].append(rule_id)
+
+    def changes(self, table):
+        """Obtain the changes to a table, in the order they are applied
+
+        :Returns: Tuple (rules deleted, (``rule_key``, rule specification) of each
+                  rule appended, and of each rule inserted)
+
+        :param table: Either 'filter' or 'nat'
+        :type table: String
+        """
+        numbers = sorted(set(x for x in self._deletes[table] if isinstance(x, int)), reverse=True)
+        specs = [x for x in self._deletes[table] if not isinstance(x, int)]
+        return numbers + specs, list(self._appends[table]), list(self._inserts[table])
+
+    def render(self):
+        """Produce the input for ``iptables-restore``
+
+        :Returns: String
+        """
+        lines = []
+        for table in sorted(CHAINS.keys()):
+            deletes, appends, inserts = self.changes(table)
+            if not (deletes or appends or inserts):
+                continue
+            lines.append('*{}'.format(table))
+            for rule_id in deletes:
+                lines.append('-D {} {}'.format(CHAINS[table], rule_id))
+            # Each one goes above the last, so insert them in reverse
+            for _, spec in reversed(inserts):
+                lines.append('-I {} 1 {}'.format(CHAINS[table], spec))
+            for _, spec in appends:
+                lines.append('-A {} {}'.format(CHAINS[table], spec))
+            lines.append('COMMIT')
+        return '\n'.join(lines) + '\n'
+
+
+class RuleSnapshot(object):
+    """The port mapping rules of both tables, parsed in one pass over the output
+    of a single ``iptables-save``.
+
+    Each rule of the PREROUTING and FORWARD chains is kept as a tuple of
+    (target_addr, target_port, conn_port, tagged), or None if it's not a port
+    mapping rule; the rule number is its position plus one.
+
+    :param text: The output of ``iptables-save``
+    :type text: String
+    """
+    # The options of an ``iptables-save`` rule that describe a port mapping
+    OPTIONS = frozenset(('-d', '--dport', '--to-destination', '--comment', '-j'))
+
+    def __init__(self, text):
+        self._rules = {table : [] for table in CHAINS}
+        self._lines = {table : [] for table in CHAINS}
+        prefixes = {table : '-A {} '.format(chain) for table, chain in CHAINS.items()}
+        table = None
+        prefix = None
+        for line in text.split('\n'):
+            if line.startswith('*'):
+                table = line[1:].strip()
+                prefix = prefixes.get(table, None)
+            elif prefix is not None and line.startswith(prefix):
+                self._lines[table].append(line)
+                self._rules[table].append(_parse_save_rule(line, nat=table == 'nat'))
+
+    def entries(self, table):
+        """The rules of a table, as ``RuleIndex`` consumes them
+
+        :Returns: List of (``rule_key``, rule specification), or (None, None) for other rules
+
+        :param table: Either 'filter' or 'nat'
+        :type table: String
+        """
+        entries = []
+        for rule in self._rules[table]:
+            if rule is None:
+                entries.append((None, None))
+                continue
+            target_addr, target_port, conn_port, tagged = rule
+            if table == 'nat':
+                spec = prerouting_spec(conn_port, target_port, target_addr, tagged=tagged)
+            else:
+                spec = forward_spec(target_port, target_addr, conn_port)
+            entries.append((rule_key(target_addr, target_port, conn_port), spec))
+        return entries
+
+    def rule_number(self, table, text):
+        """Find any rule of the chain, by what its ``iptables-save`` line contains
+
+        :Returns: Integer or None
+
+        :param table: Either 'filter' or 'nat'
+        :type table: String
+
+        :param text: Part of the rule; i.e. ``--match-set vlab-ipam-forward``
+        :type text: String
+        """
+        for number, line in enumerate(self._lines[table], 1):
+            if text in line:
+                return number
+        return None
+
+    def show(self, table='filter', format='parsed'):
+        """Display the port mapping rules of a table
+
+        :Returns: String or Dictionary
+
+        :Raises: ValueError
+
+        :param table: Either 'filter' or 'nat'
+        :type table: String, default "filter"
+
+        :param format: Set to 'raw' for the ``iptables-save`` rules of the chain, or 'parsed' for just the important stuff
+        :type format: String, default 'parsed'
+        """
+        table = table.lower()
+        if table not in CHAINS:
+            raise ValueError('Param "table" must be either "nat" or "filter", supplied: {}'.format(table))
+        if format.lower() != 'parsed':
+            return ''.join('{}\n'.format(line) for line in self._lines[table])
+        rules = {}
+        for number, rule in enumerate(self._rules[table], 1):
+            if rule is None:
+                continue
+            target_addr, target_port, conn_port, tagged = rule
+            info = {'target_addr' : target_addr, 'target_port' : target_port}
+            if conn_port is not None:
+                info['conn_port'] = conn_port
+            if tagged and table == 'nat':
+                info['tagged'] = True
+            rules['{}'.format(number)] = info
+        return rules
+
+
+def _parse_save_rule(line, nat):
+    """Parse one PREROUTING or FORWARD rule, as output by ``iptables-save``
+
+    :Returns: Tuple (target_addr, target_port, conn_port, tagged), or None if it's not a port mapping rule
+
+    :param line: The rule; i.e. ``-A FORWARD -d 192.168.1.2/32 -p tcp -m tcp --dport 22 -j ACCEPT``
+    :type line: String
+
+    :param nat: Set to True for a PREROUTING rule
+    :type nat: Boolean
+    """
+    # Examples of rules:
+    # -A PREROUTING -i ens160 -p tcp -m tcp --dport 6000 -j DNAT --to-destination 192.168.1.2:22
+    # -A PREROUTING -i ens160 -p tcp -m tcp --dport 6001 -m comment --comment vlab-ipam:6001 -j DNAT --to-destination 192.168.1.2:22
+    # -A FORWARD -d 192.168.1.2/32 -p tcp -m tcp --dport 22 -m comment --comment vlab-ipam:6001 -j ACCEPT
+    options = {}
+    tokens = line.split()
+    for idx in range(2, len(tokens) - 1):
+        if tokens[idx] in RuleSnapshot.OPTIONS and tokens[idx - 1] != '!':
+            options[tokens[idx]] = tokens[idx + 1]
+    tag = options.get('--comment', '').strip('"')
+    tagged = tag.startswith(TAG_PREFIX)
+    try:
+        if nat:
+            if options.get('-j') != 'DNAT' or '--dport' not in options:
+                return None
+            target_addr, target_port = options['--to-destination'].split(':')
+            return target_addr, int(target_port), int(options['--dport']), tagged
+        if options.get('-j') != 'ACCEPT' or '--dport' not in options:
+            return None
+        target_addr, _, mask = options['-d'].partition('/')
+        if mask not in ('', '32'):
+            return None
+        conn_port = int(tag[len(TAG_PREFIX):]) if tagged else None
+        return target_addr, int(options['--dport']), conn_port, tagged
+    except (KeyError, ValueError):
+        # i.e. a port range, or DNAT to an address without a port
+        return None
+
+
+def write_atomic(path, text):
+    """Replace a file such that readers (or a crash) only ever see the old or the
+    new content, never a partial write.
+
+    :Returns: None
+
+    :param path: The file to replace
+    :type path: String
+
+    :param text: The new content of the file
+    :type text: String
+    """
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as the_file:
+        the_file.write(text)
+        the_file.flush()
+        os.fsync(the_file.fileno())
+    os.replace(tmp_path, path)
+    # Make the rename itself durable
+    dir_fd = os.open(os.path.dirname(path) or '.', os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+class RuleSaver(object):
+    """Coalesces requests to save the firewall rules. A background thread does
+    the saving, at most once every ``delay`` seconds, no matter how many
+    requests are made in between.
+
+    :param save: The function that saves the rules
+    :type save: Callable
+
+    :param delay: The minimum number of seconds between saves
+    :type delay: Float
+    """
+    def __init__(self, save, delay):
+        self._save = save
+        self.delay = delay
+        self._cond = Condition()
+        self._dirty = False
+        self._saving = False
+        self._last_save = 0
+        self._thread = None
+        self.stats = {'requests' : 0, 'saves' : 0, 'errors' : 0}
+        # (time of the 1st failed save in a row, error of the latest one); None once a save works
+        self.failure = None
+
+    def request(self):
+        """Ask for the rules to be saved soon. Never blocks on the save itself.
+
+        :Returns: None
+        """
+        with self._cond:
+            self.stats['requests'] += 1
+            self._dirty = True
+            # Started on demand, so a forked (i.e. uWSGI) worker gets its own thread
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = Thread(target=self._run, name='RuleSaver', daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def _run(self):
+        """The body of the background thread"""
+        while True:
+            with self._cond:
+                while not self._dirty:
+                    self._cond.wait()
+                # Let more requests pile up until the delay since the last save has passed
+                remaining = self._last_save + self.delay - time.time()
+                while remaining > 0 and self._dirty:
+                    self._cond.wait(remaining)
+                    remaining = self._last_save + self.delay - time.time()
+            self.flush()
+
+    def flush(self):
+        """Save the rules now, if there's an outstanding request. Call on shutdown;
+        it waits for a save the background thread already started.
+
+        :Returns: None
+        """
+        with self._cond:
+            while self._saving:
+                self._cond.wait()
+            if not self._dirty:
+                return
+            self._dirty = False
+            self._saving = True
+        try:
+            self._save()
+        except Exception as doh:
+            logger.exception('Failed to save the firewall rules, retrying in %s seconds', self.delay)
+            with self._cond:
+                self.stats['errors'] += 1
+                since = self.failure[0] if self.failure else time.time()
+                self.failure = (since, '%s' % doh)
+                # Try again once the delay has passed
+                self._dirty = True
+        else:
+            with self._cond:
+                self.stats['saves'] += 1
+                self.failure = None
+        finally:
+            with self._cond:
+                self._last_save = time.time()
+                self._saving = False
+                self._cond.notify_all()
+
+
+class SharedFireWall(metaclass=abc.ABCMeta):
+    """The locking shared by the firewall backends, so several processes (i.e.
+    uWSGI workers) can change the same firewall.
+
+    Within a process, changes hold an RWLock for writing. The outermost change
+    (i.e. ``with`` statement) of a thread also holds a ``flock`` on the lock file,
+    so only one process at a time makes changes. The lock file holds a
+    generation counter, bumped by every process that changed the firewall; when
+    it differs from the last one seen, the rules were changed by another process,
+    so the cached copy of them is dropped (see ``_invalidate``) and reloaded.
+
+    Saving the rules holds a second lock file (the first plus ``.save``), so
+    the processes don't write the rules file at the same time, and the last
+    save always lists the latest rules.
+
+    :param save_mode: How to persist rule changes; 'sync' or 'debounce'. Default is ``VLAB_FW_SAVE_MODE``
+    :type save_mode: String
+
+    :param save_delay: For the 'debounce' mode, the minimum milliseconds between
+                       writes of the rules file. Default is ``VLAB_FW_SAVE_DELAY``
+    :type save_delay: Integer
+
+    :param lock_file: The file for ``flock``; an empty string only locks
+                      within this process. Default is ``VLAB_FW_LOCK_FILE``
+    :type lock_file: String
+    """
+    def __init__(self, save_mode=None, save_delay=None, lock_file=None):
+        save_mode = save_mode or const.VLAB_FW_SAVE_MODE
+        if save_mode not in SAVE_MODES:
+            raise ValueError('Param "save_mode" must be one of {}, supplied: {}'.format(SAVE_MODES, save_mode))
+        if save_delay is None:
+            save_delay = const.VLAB_FW_SAVE_DELAY
+        self.save_mode = save_mode
+        self._saver = RuleSaver(self.save_rules, save_delay / 1000.0)
+        if lock_file is None:
+            lock_file = const.VLAB_FW_LOCK_FILE
+        # Changes hold this lock for writing; the thread that owns it can acquire
+        # it again without blocking, and must release it for every acquire.
+        # Thankfully Python makes this easy via Context Managers (i.e. ``with``
+        # statement) (http://book.pythontips.com/en/latest/context_managers.html)
+        # Listing the rules only holds it for reading, so reads run in parallel.
+        self._lock = RWLock()
+        self._process_lock = ProcessLock(lock_file) if lock_file else None
+        self._save_lock = ProcessLock(lock_file + '.save') if lock_file else None
+        self._process_fd = None
+        self._depth = 0 # how many ``with`` statements the writer is within
+        self._generation = None # of the lock file, when last held
+        self._changed = False
+
+    def __enter__(self):
+        """Enable use of the ``with`` statement to serialize changes to the firewall.
+        Holds the lock for writing; readers (i.e. ``show``) wait until it's released."""
+        self._lock.acquire_write()
+        if self._depth == 0 and self._process_lock is not None:
+            try:
+                self._process_fd = self._process_lock.acquire()
+                generation = ProcessLock.generation(self._process_fd)
+            except Exception:
+                if self._process_fd is not None:
+                    self._process_lock.release(self._process_fd)
+                    self._process_fd = None
+                self._lock.release_write()
+                raise
+            if self._generation is not None and generation != self._generation:
+                # Another process changed the rules
+                self._invalidate()
+            self._generation = generation
+        self._depth += 1
+
+    def __exit__(self, exc_type, exc_value, the_traceback):
+        self._depth -= 1
+        try:
+            if self._depth == 0 and self._process_fd is not None:
+                try:
+                    if self._changed:
+                        self._generation = ProcessLock.bump(self._process_fd)
+                finally:
+                    self._changed = False
+                    self._process_lock.release(self._process_fd)
+                    self._process_fd = None
+        finally:
+            self._lock.release_write()
+
+    @abc.abstractmethod
+    def _invalidate(self):
+        """Drop the cached copy of the rules. Caller must hold the lock."""
+
+    @abc.abstractmethod
+    def save_rules(self):
+        """Make the current firewall config persist reboots"""
+
+    def _hold_save_lock(self):
+        """Serialize writing the rules file with the other processes
+
+        :Returns: A context manager
+        """
+        if self._save_lock is None:
+            return contextlib.suppress()
+        return self._save_lock.hold()
+
+    @contextlib.contextmanager
+    def _saving(self):
+        """Hold the locks for saving the rules, within a ``with`` statement.
+        Call the function it yields once the rules are dumped; that releases the
+        lock, so changes don't wait while the file is written. The save lock is
+        held until the ``with`` block ends.
+        """
+        # Always the read lock, then the save lock; a writer might be saving too
+        self._lock.acquire_read()
+        reading = [True]
+        def dumped():
+            if reading:
+                reading.pop()
+                self._lock.release_read()
+        try:
+            with self._hold_save_lock():
+                yield dumped
+        finally:
+            dumped()
+
+    def request_save(self):
+        """Persist the firewall config per the ``save_mode``; right away for
+        'sync', or soon (coalesced with other requests) for 'debounce'.
+
+        :Returns: None
+        """
+        if self.save_mode == 'sync':
+            self.save_rules()
+        else:
+            self._saver.request()
+
+    def flush(self):
+        """Write any outstanding 'debounce' save. Call before exiting.
+
+        :Returns: None
+        """
+        self._saver.flush()
+
+    def save_error(self):
+        """Describe why the 'debounce' saves are failing, if they are; until one
+        works, the rules file doesn't list the latest changes.
+
+        :Returns: String or None
+        """
+        failure = self._saver.failure
+        if failure is None:
+            return None
+        since, error = failure
+        return 'Unable to save the firewall rules for {} seconds: {}'.format(int(time.time() - since), error)
+
+
+class FireWall(SharedFireWall):
     """A thread-safe way to manipulate iptables
 
     If you need to perform several modifications to iptables, use a ``with``
@@ -21,27 +810,202 @@ class FireWall(object):
         with firewall:
             firewall.delete_rule(rule_id, table='nat')
             firewall.delete_rule(other_id, table='filter')
+
+    To make several changes atomically (and with a single ``iptables-restore``),
+    use a RuleBatch with ``apply``.
+
+    Rule lookups are answered from an in-memory index of the NAT PREROUTING and
+    FORWARD chains. It's loaded from iptables on first use (or by ``load_index``),
+    and kept up to date by ``apply``, so it only sees changes made via this object.
+
+    With the 'debounce' save mode, changes are persisted by a background thread
+    shortly afterwards; call ``flush`` before exiting.
+
+    With the 'ipset' forward mode, the FORWARD chain has one rule that accepts
+    packets to any member of a ``hash:ip,port`` set, so the per-packet cost
+    doesn't grow with the number of port mappings. Mapping a port adds the
+    target to the set; the member is removed once no port mapping uses it.
+
+    :param save_mode: How to persist rule changes; 'sync' or 'debounce'. Default is ``VLAB_FW_SAVE_MODE``
+    :type save_mode: String
+
+    :param save_delay: For the 'debounce' mode, the minimum milliseconds between
+                       writes of the rules file. Default is ``VLAB_FW_SAVE_DELAY``
+    :type save_delay: Integer
+
+    :param forward_mode: How to let mapped packets through the FORWARD chain;
+                         'rules' or 'ipset'. Default is ``VLAB_FW_FORWARD_MODE``
+    :type forward_mode: String
+
+    :param ipset_name: For the 'ipset' mode, the set of targets to forward to.
+                       Default is ``VLAB_FW_IPSET``
+    :type ipset_name: String
+
+    :param lock_file: Serializes changes with other processes; see ``SharedFireWall``.
+                      Default is ``VLAB_FW_LOCK_FILE``
+    :type lock_file: String
     """
 
-    def __init__(self):
-        # This lock can be acquired multiple times by the same thread that owns
-        # it without blocking. This comes with the responsibility of that thread
-        # to also release the lock for every call to acquire it. Thankfully
-        # Python makes this easy via Context Managers (i.e. ``with`` statement)
-        # (http://book.pythontips.com/en/latest/context_managers.html)
-        self._rlock = RLock()
+    def __init__(self, save_mode=None, save_delay=None, forward_mode=None, ipset_name=None, lock_file=None):
+        forward_mode = forward_mode or const.VLAB_FW_FORWARD_MODE
+        if forward_mode not in FORWARD_MODES:
+            raise ValueError('Param "forward_mode" must be one of {}, supplied: {}'.format(FORWARD_MODES, forward_mode))
+        super().__init__(save_mode=save_mode, save_delay=save_delay, lock_file=lock_file)
+        self.forward_mode = forward_mode
+        self.ipset_name = ipset_name or const.VLAB_FW_IPSET
+        # (target_addr, target_port) -> how many port mappings use that ipset member
+        self._members = Counter()
+        self._index = None # table -> RuleIndex; loaded on first use
 
-    def __enter__(self):
-        """Enable use of the ``with`` statement to serialize changes to iptables"""
-        self._rlock.acquire()
+    def _invalidate(self):
+        """Drop the index and ipset member counts. Caller must hold the lock."""
+        self._index = None
+        self._members = None # rebuilt by ``load_index``
 
-    def __exit__(self, exc_type, exc_value, the_traceback):
-        self._rlock.release()
+    def load_index(self):
+        """(Re)build the in-memory index of the port mapping rules from iptables.
+
+        :Returns: None
+        """
+        with self:
+            snapshot = self.snapshot()
+            self._index = {table : RuleIndex(snapshot.entries(table)) for table in CHAINS}
+            if self.forward_mode == 'ipset':
+                self._setup_ipset(snapshot)
+            else:
+                self._teardown_ipset(snapshot)
+
+    def snapshot(self):
+        """Obtain the port mapping rules of both tables, with a single ``iptables-save``
+
+        :Returns: RuleSnapshot
+        """
+        with self._lock.read():
+            result = run_cmd('sudo iptables-save')
+        return RuleSnapshot(result.stdout)
+
+    def _setup_ipset(self, snapshot):
+        """Create the ipset and its FORWARD rule, if needed, and add a member for
+        every existing port mapping. The FORWARD rules of those port mappings
+        (i.e. made with the 'rules' forward mode) are deleted, in the same
+        ``iptables-restore`` that adds the match-set rule. Caller must hold the lock.
+
+        :Returns: None
+
+        :param snapshot: The current rules
+        :type snapshot: RuleSnapshot
+        """
+        run_cmd('sudo ipset create {} hash:ip,port -exist'.format(self.ipset_name))
+        self._members = Counter((addr, port) for addr, port, _ in self._index['nat'].keys())
+        if self._members:
+            # Added before their FORWARD rules are deleted, so no packets are dropped
+            members = ['add {} {}'.format(self.ipset_name, set_member(*x)) for x in sorted(self._members)]
+            run_cmd('sudo ipset restore -exist', stdin='\n'.join(members) + '\n')
+        batch = RuleBatch()
+        if snapshot.rule_number('filter', '--match-set {} '.format(self.ipset_name)) is None:
+            # At the top of the chain, so it's checked before any other rule
+            batch.insert('filter', match_set_spec(self.ipset_name))
+        for key, spec in snapshot.entries('filter'):
+            if key is not None and key[:2] in self._members:
+                batch.delete(spec, table='filter')
+        self.apply(batch)
+
+    def _teardown_ipset(self, snapshot):
+        """Undo ``_setup_ipset``, when switching back to the 'rules' forward mode.
+        Adds a FORWARD rule for every port mapping that lacks one (i.e. made with
+        the 'ipset' forward mode), and deletes the match-set rule, with one
+        ``iptables-restore``. Caller must hold the lock.
+
+        :Returns: None
+
+        :param snapshot: The current rules
+        :type snapshot: RuleSnapshot
+        """
+        number = snapshot.rule_number('filter', '--match-set {} '.format(self.ipset_name))
+        if number is None:
+            return
+        batch = RuleBatch()
+        for target_addr, target_port, conn_port in self._index['nat'].keys():
+            if self._index['filter'].find(rule_key(target_addr, target_port, conn_port)):
+                continue
+            elif self._index['filter'].find(rule_key(target_addr, target_port)):
+                continue
+            batch.forward(target_port=target_port, target_addr=target_addr, conn_port=conn_port)
+        batch.delete(number, table='filter')
+        self.apply(batch)
+
+    def _acquire_member(self, target_port, target_addr):
+        """Add a port mapping's target to the ipset. Caller must hold the lock.
+
+        :Returns: String - The rule ID of the member
+
+        :param target_port: The TCP port on the remote machine
+        :type target_port: Integer
+
+        :param target_addr: The IP address of the remote machine
+        :type target_addr: String
+        """
+        if self._index is None:
+            self.load_index()
+        member = (target_addr, int(target_port))
+        if not self._members[member]:
+            self._changed = True
+            run_cmd('sudo ipset add {} {} -exist'.format(self.ipset_name, set_member(*member)))
+        self._members[member] += 1
+        return MEMBER_PREFIX + set_member(*member)
+
+    def _release_member(self, member_id):
+        """Stop using an ipset member; it's removed once no port mapping uses it.
+        Caller must hold the lock.
+
+        :Returns: None
+
+        :param member_id: The rule ID from ``_acquire_member`` or ``find_rule``
+        :type member_id: String
+        """
+        if self._members is None:
+            # Another process changed the rules; don't remove a member that's still used
+            self.load_index()
+        target_addr, target_port = member_id[len(MEMBER_PREFIX):].split(',tcp:')
+        member = (target_addr, int(target_port))
+        if self._members[member] <= 1:
+            self._changed = True
+            run_cmd('sudo ipset del {} {} -exist'.format(self.ipset_name, set_member(*member)))
+            del self._members[member]
+        else:
+            self._members[member] -= 1
+
+    def apply(self, batch):
+        """Make every change in a RuleBatch with one ``iptables-restore``. The
+        changes to each table are committed as a unit.
+
+        :Returns: None
+
+        :Raises: CliError
+
+        :param batch: The rule changes to make
+        :type batch: RuleBatch
+        """
+        if not len(batch):
+            return
+        with self:
+            self._changed = True
+            try:
+                run_cmd('sudo iptables-restore --noflush', stdin=batch.render())
+            except Exception:
+                # One table might have been committed; reload to find out
+                self._index = None
+                raise
+            if self._index is not None:
+                for table, index in self._index.items():
+                    index.update(*batch.changes(table))
 
     def map_port(self, conn_port, target_port, target_addr):
-        """Create a port mapping rule to forward packets past the NAT firewall
+        """Create a port mapping rule to forward packets past the NAT firewall.
+        Both rules are tagged with the conn_port, and created with one
+        ``iptables-restore``.
 
-        :Returns: Tuple
+        :Returns: None
 
         :param conn_port: The TCP port on the local system user's will connect to
         :type conn_port: Integer
@@ -52,40 +1016,71 @@ class FireWall(object):
         :param target_addr: The IP address of the remote machien to map to.
         :type target_addr: String
         """
+        batch = RuleBatch()
+        batch.prerouting(conn_port=conn_port, target_port=target_port, target_addr=target_addr)
         with self:
-            forward_id = self.forward(target_port=target_port, target_addr=target_addr)
-            try:
-                prerouting_id = self.prerouting(conn_port=conn_port, target_port=target_port, target_addr=target_addr)
-            except (CliError, RuntimeError) as doh:
-                self.delete_rule(forward_id, table='filter')
-                raise doh
+            if self.forward_mode == 'ipset':
+                member_id = self._acquire_member(target_port, target_addr)
+                try:
+                    self.apply(batch)
+                except Exception:
+                    self._release_member(member_id)
+                    raise
             else:
-                self.save_rules()
-                return forward_id, prerouting_id
+                batch.forward(target_port=target_port, target_addr=target_addr, conn_port=conn_port)
+                self.apply(batch)
+        self.request_save()
+
+    def unmap_port(self, nat_id, filter_id):
+        """Delete both rules of a port mapping with one ``iptables-restore``;
+        the undo of ``map_port``.
 
-    def forward(self, target_port, target_addr):
+        :Returns: None
+
+        :param nat_id: The ID for the rule to delete from the nat table (from ``find_rule``)
+        :type nat_id: String
+
+        :param filter_id: The ID for the rule to delete from the filter table (from ``find_rule``)
+        :type filter_id: String
+        """
+        batch = RuleBatch()
+        batch.delete(nat_id, table='nat')
+        with self:
+            if '{}'.format(filter_id).startswith(MEMBER_PREFIX):
+                # Once the DNAT is gone, nothing is forwarded via the member
+                self.apply(batch)
+                self._release_member(filter_id)
+            else:
+                batch.delete(filter_id, table='filter')
+                self.apply(batch)
+        self.request_save()
+
+    def forward(self, target_port, target_addr, conn_port=None):
         """Create the FORWARD rule in the "filter" table
 
-        :Returns: Integer - Rule ID
+        :Returns: String - Rule ID (the rule specification)
 
         :parm target_port: The TCP port on the remote machines to map.
         :type target_port: Integer
 
         :param target_addr: The IP address of the remote machien to map to.
         :type target_addr: String
+
+        :param conn_port: The local port of the port mapping; used to tag the rule
+        :type conn_port: Integer
         """
-        run_cmd('sudo iptables -A FORWARD -p tcp -d {} --dport {} -j ACCEPT'.format(target_addr, target_port))
-        try:
-            forward_id = self.find_rule(target_port, target_addr, table='filter')
-        except RuntimeError:
-            raise RuntimeError('Unable to find newly created FORWARD rule for {}:{}'.format(target_addr, target_port))
-        else:
-            return forward_id
+        if self.forward_mode == 'ipset':
+            with self:
+                return self._acquire_member(target_port, target_addr)
+        batch = RuleBatch()
+        forward_id = batch.forward(target_port=target_port, target_addr=target_addr, conn_port=conn_port)
+        self.apply(batch)
+        return forward_id
 
     def prerouting(self, conn_port, target_port, target_addr):
         """Create the PREROUTING rule in the "nat" table
 
-        :Returns: Integer - Rule ID
+        :Returns: String - Rule ID (the rule specification)
 
         :parm conn_port: The TCP port on the local machine to map.
         :type target_port: Integer
@@ -96,18 +1091,19 @@ class FireWall(object):
         :param target_addr: The IP address of the remote machien to map to.
         :type target_addr: String
         """
-        run_cmd('sudo iptables -A PREROUTING -t nat -i ens160 -p tcp --dport {} -j DNAT --to {}:{}'.format(conn_port, target_addr, target_port))
-        try:
-            prerouting_id = self.find_rule(target_port, target_addr, table='nat', conn_port=conn_port)
-        except RuntimeError:
-            raise RuntimeError('Unable to find newly created PERROUTING rule for port {} to {}:{}'.format(conn_port, target_addr, target_port))
-        else:
-            return prerouting_id
+        batch = RuleBatch()
+        prerouting_id = batch.prerouting(conn_port=conn_port, target_port=target_port, target_addr=target_addr)
+        self.apply(batch)
+        return prerouting_id
 
     def find_rule(self, target_port, target_addr, table, conn_port=None):
-        """Iterate defines rules, and find the rule ID. Returns zero if no rule found.
+        """Look up the rule ID of a port mapping rule. The ID is the rule
+        specification, which stays valid no matter what other rules are added
+        or deleted.
+
+        :Returns: String
 
-        :Returns: Integer
+        :Raises: RuntimeError (when no rule is found), ValueError
 
         :param target_port: The TCP port on the remote machines to map to.
         :type target_port: Integer
@@ -119,19 +1115,26 @@ class FireWall(object):
                       Must be either 'filter' or 'nat'.
         :type table: String
 
-        :conn_port: The local port that maps to a remote port. Used for NAT table lookups.
+        :conn_port: The local port that maps to a remote port. Required for NAT table
+                    lookups. For the filter table, it finds the rule tagged with the
+                    conn_port, or else an untagged (legacy) rule for the target.
         :conn_port: Integer
         """
-        if table.lower() == 'nat' and conn_port is None:
+        table = table.lower()
+        if table not in CHAINS:
+            raise ValueError('Param "table" must be either "nat" or "filter", supplied: {}'.format(table))
+        elif table == 'nat' and conn_port is None:
             error = "Must supply conn_port when looking up NAT rules"
             raise ValueError(error)
-        rules = self.show(table=table)
-        current_id = 0
-        for rule_id, info in rules.items():
-            if info['target_addr'] == target_addr and info['target_port'] == target_port:
-                if conn_port == info.get('conn_port', None):
-                    current_id = rule_id
-                    break
+        with self:
+            if self._index is None:
+                self.load_index()
+            if table == 'filter' and self.forward_mode == 'ipset' and target_port is not None:
+                if self._members[(target_addr, int(target_port))]:
+                    return MEMBER_PREFIX + set_member(target_addr, target_port)
+            current_id = self._index[table].find(rule_key(target_addr, target_port, conn_port))
+            if not current_id and table == 'filter' and conn_port is not None:
+                current_id = self._index[table].find(rule_key(target_addr, target_port))
         if not current_id:
             raise RuntimeError('Unable to find iptable rule')
         else:
@@ -142,28 +1145,32 @@ class FireWall(object):
 
         :Returns: None
 
-        :param rule_id: The rule by number to delete in the supplied table
+        :param rule_id: The rule specification (from ``find_rule``), or rule number, to delete
         :type rule_id: String
 
         :param table: The specific table within iptables to delete a rule from.
                       Must be either 'filter' or 'nat'.
         :type table: String
         """
-        with self:
-            if table.lower() == 'nat':
-                chain = 'PREROUTING'
-            elif table.lower() == 'filter':
-                chain = 'FORWARD'
-            else:
-                raise ValueError('Param "table" must be either "nat" or "filter", supplied: {}'.format(table))
-            run_cmd('iptables -t {} -D {} {}'.format(table, chain, rule_id))
+        if '{}'.format(rule_id).startswith(MEMBER_PREFIX):
+            with self:
+                self._release_member(rule_id)
+            return
+        batch = RuleBatch()
+        batch.delete(rule_id, table=table)
+        self.apply(batch)
 
     def save_rules(self):
         """Make the current firewall config persist reboots"""
-        with self:
+        with self._saving() as dumped:
             result = run_cmd('sudo iptables-save')
-            with open('/etc/iptables/rules.v4', 'w') as the_file:
-                the_file.write(result.stdout)
+            if self.forward_mode == 'ipset':
+                members = run_cmd('sudo ipset save {}'.format(self.ipset_name))
+            dumped()
+            if self.forward_mode == 'ipset':
+                # The rules reference the set, so it must be restored first on boot
+                write_atomic(IPSET_FILE, members.stdout)
+            write_atomic(RULES_FILE, result.stdout)
 
     def show(self, table='filter', format='parsed'):
         """Display configured firewall rules for a given table
@@ -175,79 +1182,9 @@ class FireWall(object):
         :param table: The specific iptable table to view, must be either 'filter' or 'nat'
         :type table: String, default "filter"
 
-        :param format: Set to 'raw' for unprocess output, or 'parsed' for just the important stuff
+        :param format: Set to 'raw' for the ``iptables-save`` rules of the chain, or 'parsed' for just the important stuff
         :type format: String, default 'parsed'
         """
-        with self:
-            if table.lower() == 'nat':
-                result = run_cmd('sudo iptables --numeric -L PREROUTING -t nat --line-numbers')
-                if format.lower() == 'parsed':
-                    return self._prettify_nat_output(result.stdout)
-                else:
-                    return result.stdout
-            elif table.lower() == 'filter':
-                result = run_cmd('sudo iptables --numeric -L FORWARD -t filter --line-numbers')
-                if format.lower() == 'parsed':
-                    return self._prettify_filter_output(result.stdout)
-                else:
-                    return result.stdout
-            else:
-                raise ValueError('Param "table" must be either "nat" or "filter", supplied: {}'.format(table))
-
-    def _prettify_nat_output(self, output):
-        """Takes the ``iptables`` output, and turns it into a user-friendly object
-
-        :Returns: Dictionary
-
-        :param output: The raw output from the ``iptables`` command
-        :type output: String
-        """
-        # Example of output:
-        # Chain PREROUTING (policy ACCEPT)
-        # num  target     prot opt source               destination
-        # 1    DNAT       tcp  --  0.0.0.0/0            0.0.0.0/0            tcp dpt:6000 to:192.168.1.2:22
-        rows = output.split('\n')[2:]
-        rules = {}
-        for row in rows:
-            if not row:
-                # trailing newline chars...
-                continue
-            columns = row.split()
-            rid = columns[0]
-            conn_port = columns[-2].split(':')[-1]
-            target = columns[-1]
-            _, target_ip, target_port = target.split(':')
-            rules[rid] = {'conn_port': int(conn_port),
-                         'target_addr': target_ip,
-                         'target_port': int(target_port),
-                        }
-        return rules
-
-    def _prettify_filter_output(self, output):
-        """Takes the ``iptables`` output, and turns it into a user-friendly object
-
-        :Returns: Dictionary
-
-        :param output: Th raw output from the ``iptables`` command
-        :type output: String
-        """
-        # Example of output:
-        # Chain FORWARD (policy ACCEPT)
-        # num  target     prot opt source               destination
-        # 1    LOG        all  --  0.0.0.0/0            0.0.0.0/0            LOG flags 0 level 4
-        # 2    ACCEPT     all  --  0.0.0.0/0            0.0.0.0/0
-        # 3    ACCEPT     tcp  --  0.0.0.0/0            192.168.1.2          tcp dpt:22
-        rows = output.split('\n')[2:]
-        rules = {}
-        for row in rows:
-            if not row:
-                continue
-            columns = row.split()
-            rid = columns[0]
-            if rid in ('1', '2'):
-                # default rules; skip
-                continue
-            target_ip = columns[5]
-            target_port = columns[7].split(':')[-1]
-            rules[rid] = {'target_addr': target_ip, 'target_port': int(target_port)}
-        return rules
+        if table.lower() not in CHAINS:
+            raise ValueError('Param "table" must be either "nat" or "filter", supplied: {}'.format(table))
+        return self.snapshot().show(table, format=format)
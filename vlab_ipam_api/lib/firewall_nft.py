@@ -0,0 +1,469 @@
+# -*- coding: UTF-8
+"""
+An nftables backend for the port mapping firewall.
+
+Instead of one DNAT rule (and one ACCEPT rule) per port mapping, the port
+mappings are elements of a verdict map, and the targets are elements of a set,
+within a dedicated table::
+
+    table ip vlab_ipam {
+        map portmap {
+            type inet_service : ipv4_addr . inet_service
+        }
+        set forward {
+            type ipv4_addr . inet_service
+        }
+        chain prerouting {
+            type nat hook prerouting priority dstnat; policy accept;
+            iifname "ens160" meta l4proto tcp dnat ip addr . port to tcp dport map @portmap
+        }
+        chain forward {
+            type filter hook forward priority filter; policy accept;
+            ip daddr . tcp dport @forward accept
+        }
+    }
+
+Looking up a map or set is a hash lookup, so the per-packet cost doesn't grow
+with the number of port mappings. Every change is one ``nft -f`` transaction.
+
+.. note::
+    An accept verdict only ends the evaluation of its own chain. If another
+    table drops forwarded packets by default, it must accept the mapped
+    targets itself; the ``forward`` set doesn't override it.
+"""
+from collections import Counter
+
+import ujson
+
+from vlab_ipam_api.lib import const
+from vlab_ipam_api.lib.exceptions import CliError
+from vlab_ipam_api.lib.firewall import CHAINS, SharedFireWall, run_cmd, write_atomic
+
+
+# Loaded by nftables.service on boot; ``flush table`` makes loading it idempotent
+RULES_FILE = '/etc/nftables.d/vlab_ipam.nft'
+DEFINITION = """\
+table ip {table} {{
+    map portmap {{
+        type inet_service : ipv4_addr . inet_service
+    }}
+    set forward {{
+        type ipv4_addr . inet_service
+    }}
+    chain prerouting {{
+        type nat hook prerouting priority dstnat; policy accept;
+        iifname "ens160" meta l4proto tcp dnat ip addr . port to tcp dport map @portmap
+    }}
+    chain forward {{
+        type filter hook forward priority filter; policy accept;
+        ip daddr . tcp dport @forward accept
+    }}
+}}
+"""
+
+
+def map_element(conn_port, target_port=None, target_addr=None):
+    """An element of the ``portmap`` verdict map; the key only, if no target is supplied
+
+    :Returns: String
+
+    :param conn_port: The TCP port on the local machine
+    :type conn_port: Integer
+
+    :param target_port: The TCP port on the remote machine
+    :type target_port: Integer
+
+    :param target_addr: The IP address of the remote machine
+    :type target_addr: String
+    """
+    if target_addr is None:
+        return '{}'.format(int(conn_port))
+    return '{} : {} . {}'.format(int(conn_port), target_addr, int(target_port))
+
+
+def set_element(target_addr, target_port):
+    """An element of the ``forward`` set
+
+    :Returns: String
+
+    :param target_addr: The IP address of the remote machine
+    :type target_addr: String
+
+    :param target_port: The TCP port on the remote machine
+    :type target_port: Integer
+    """
+    return '{} . {}'.format(target_addr, int(target_port))
+
+
+class NftFireWall(SharedFireWall):
+    """A thread-safe way to manipulate the port mappings, using nftables.
+
+    It has the same API as ``FireWall``, so the views work with either backend.
+    The rule IDs it returns are map and set elements, not rule specifications.
+
+    Example::
+
+        firewall = NftFireWall()
+        with firewall:
+            firewall.delete_rule(nat_id, table='nat')
+            firewall.delete_rule(filter_id, table='filter')
+
+    :param save_mode: When to persist changes to disk; 'sync' or 'debounce'.
+                      Default is ``VLAB_FW_SAVE_MODE``
+    :type save_mode: String
+
+    :param save_delay: For the 'debounce' mode, the minimum milliseconds between
+                       writes of the rules file. Default is ``VLAB_FW_SAVE_DELAY``
+    :type save_delay: Integer
+
+    :param table_name: The nftables table that holds the port mappings.
+                       Default is ``VLAB_NFT_TABLE``
+    :type table_name: String
+
+    :param lock_file: Serializes changes with other processes; see ``SharedFireWall``.
+                      Default is ``VLAB_FW_LOCK_FILE``
+    :type lock_file: String
+    """
+
+    def __init__(self, save_mode=None, save_delay=None, table_name=None, lock_file=None):
+        super().__init__(save_mode=save_mode, save_delay=save_delay, lock_file=lock_file)
+        self.table_name = table_name or const.VLAB_NFT_TABLE
+        self._maps = None # conn_port -> (target_addr, target_port); loaded on first use
+        # (target_addr, target_port) -> how many port mappings use that ``forward`` element
+        self._members = Counter()
+
+    def _invalidate(self):
+        """Drop the cached port mappings. Caller must hold the lock."""
+        self._maps = None
+        self._members = Counter()
+
+    def load_index(self):
+        """(Re)load the port mappings from nftables, creating the table if needed.
+
+        :Returns: None
+        """
+        with self:
+            try:
+                snapshot = self.snapshot()
+            except CliError as doh:
+                stderr = doh.stderr
+                if isinstance(stderr, bytes):
+                    stderr = stderr.decode(errors='replace')
+                if 'No such file or directory' not in '{}'.format(stderr):
+                    raise
+                # First run on this host; the table doesn't exist yet
+                self.apply([DEFINITION.format(table=self.table_name)])
+                snapshot = NftSnapshot([])
+            maps = {}
+            # Orphaned elements are kept (count zero) until a port mapping deletes them
+            members = Counter({target : 0 for target in snapshot.targets})
+            for conn_port, target_addr, target_port in snapshot.maps:
+                maps[conn_port] = (target_addr, target_port)
+                members[(target_addr, target_port)] += 1
+            self._maps = maps
+            self._members = members
+
+    def snapshot(self):
+        """Obtain the port mappings and forwarded targets, with a single ``nft --json`` listing
+
+        :Returns: NftSnapshot
+        """
+        with self._lock.read():
+            result = run_cmd('sudo nft -j list table ip {}'.format(self.table_name))
+        return NftSnapshot(ujson.loads(result.stdout).get('nftables', []))
+
+    def apply(self, commands):
+        """Make several changes with a single ``nft -f`` transaction; they all
+        take effect, or none do.
+
+        :Returns: None
+
+        :Raises: CliError
+
+        :param commands: The nft commands to run
+        :type commands: List
+        """
+        if not commands:
+            return
+        with self:
+            self._changed = True
+            try:
+                run_cmd('sudo nft -f -', stdin='\n'.join(commands) + '\n')
+            except Exception:
+                self._maps = None
+                raise
+
+    def _ensure_loaded(self):
+        """Load the port mappings, if not already loaded. Caller must hold the lock."""
+        if self._maps is None:
+            self.load_index()
+
+    def _element_cmd(self, action, kind, element):
+        """An ``add element``/``delete element`` command
+
+        :Returns: String
+        """
+        return '{} element ip {} {} {{ {} }}'.format(action, self.table_name, kind, element)
+
+    def map_port(self, conn_port, target_port, target_addr):
+        """Create a port mapping, with one ``nft -f`` transaction.
+
+        :Returns: None
+
+        :param conn_port: The TCP port on the local system user's will connect to
+        :type conn_port: Integer
+
+        :parm target_port: The TCP port on the remote machines to map to.
+        :type target_port: Integer
+
+        :param target_addr: The IP address of the remote machien to map to.
+        :type target_addr: String
+        """
+        target = (target_addr, int(target_port))
+        with self:
+            self._ensure_loaded()
+            commands = [self._element_cmd('add', 'portmap', map_element(conn_port, target_port, target_addr))]
+            if not self._members[target]:
+                commands.append(self._element_cmd('add', 'forward', set_element(*target)))
+            self.apply(commands)
+            self._maps[int(conn_port)] = target
+            self._members[target] += 1
+        self.request_save()
+
+    def unmap_port(self, nat_id, filter_id):
+        """Delete a port mapping, with one ``nft -f`` transaction; the undo of
+        ``map_port``. The ``forward`` set element is only removed once no port
+        mapping uses it.
+
+        :Returns: None
+
+        :param nat_id: The rule ID of the ``portmap`` map key (from ``find_rule``)
+        :type nat_id: String
+
+        :param filter_id: The rule ID of the ``forward`` set element (from ``find_rule``)
+        :type filter_id: String
+        """
+        conn_port = int(nat_id)
+        target_addr, target_port = filter_id.split(' . ')
+        target = (target_addr, int(target_port))
+        with self:
+            self._ensure_loaded()
+            commands = [self._element_cmd('delete', 'portmap', map_element(conn_port))]
+            last = self._members[target] <= 1
+            if last:
+                commands.append(self._element_cmd('delete', 'forward', set_element(*target)))
+            self.apply(commands)
+            self._maps.pop(conn_port, None)
+            if last:
+                del self._members[target]
+            else:
+                self._members[target] -= 1
+        self.request_save()
+
+    def forward(self, target_port, target_addr, conn_port=None):
+        """Let packets be forwarded to a target
+
+        :Returns: String - Rule ID (the ``forward`` set element)
+
+        :parm target_port: The TCP port on the remote machines to map.
+        :type target_port: Integer
+
+        :param target_addr: The IP address of the remote machien to map to.
+        :type target_addr: String
+
+        :param conn_port: Unused; the set is shared by every port mapping to the target
+        :type conn_port: Integer
+        """
+        target = (target_addr, int(target_port))
+        with self:
+            self._ensure_loaded()
+            if not self._members[target]:
+                self.apply([self._element_cmd('add', 'forward', set_element(*target))])
+            self._members[target] += 1
+        return set_element(*target)
+
+    def prerouting(self, conn_port, target_port, target_addr):
+        """Create the DNAT for a port mapping
+
+        :Returns: String - Rule ID (the ``portmap`` map key)
+
+        :parm conn_port: The TCP port on the local machine to map.
+        :type target_port: Integer
+
+        :parm target_port: The TCP port on the remote machines to map.
+        :type target_port: Integer
+
+        :param target_addr: The IP address of the remote machien to map to.
+        :type target_addr: String
+        """
+        with self:
+            self._ensure_loaded()
+            self.apply([self._element_cmd('add', 'portmap', map_element(conn_port, target_port, target_addr))])
+            self._maps[int(conn_port)] = (target_addr, int(target_port))
+        return map_element(conn_port)
+
+    def find_rule(self, target_port, target_addr, table, conn_port=None):
+        """Look up the rule ID of a port mapping.
+
+        :Returns: String, or None when there's no ``target_port`` (i.e. no database record)
+
+        :Raises: RuntimeError (when no rule is found), ValueError
+
+        :param target_port: The TCP port on the remote machines to map to.
+        :type target_port: Integer
+
+        :param target_addr: The IP address of the remote machien to map to.
+        :type target_addr: String
+
+        :param table: Either 'nat' (the ``portmap`` map) or 'filter' (the ``forward`` set)
+        :type table: String
+
+        :conn_port: The local port that maps to a remote port. Required for NAT table lookups.
+        :conn_port: Integer
+        """
+        table = table.lower()
+        if table not in CHAINS:
+            raise ValueError('Param "table" must be either "nat" or "filter", supplied: {}'.format(table))
+        elif table == 'nat' and conn_port is None:
+            error = "Must supply conn_port when looking up NAT rules"
+            raise ValueError(error)
+        elif target_port is None:
+            return None
+        target = (target_addr, int(target_port))
+        with self:
+            self._ensure_loaded()
+            if table == 'nat' and self._maps.get(int(conn_port)) == target:
+                return map_element(conn_port)
+            elif table == 'filter' and target in self._members:
+                return set_element(*target)
+        raise RuntimeError('Unable to find nftables element')
+
+    def delete_rule(self, rule_id, table):
+        """Destroy part of a port mapping. The ``forward`` set element is only
+        removed once no port mapping uses it.
+
+        :Returns: None
+
+        :param rule_id: The rule ID from ``find_rule``
+        :type rule_id: String
+
+        :param table: Either 'filter' or 'nat'
+        :type table: String
+        """
+        table = table.lower()
+        if table not in CHAINS:
+            raise ValueError('Param "table" must be either "nat" or "filter", supplied: {}'.format(table))
+        with self:
+            self._ensure_loaded()
+            if table == 'nat':
+                conn_port = int(rule_id)
+                self.apply([self._element_cmd('delete', 'portmap', map_element(conn_port))])
+                self._maps.pop(conn_port, None)
+                return
+            target_addr, target_port = rule_id.split(' . ')
+            target = (target_addr, int(target_port))
+            if self._members[target] <= 1:
+                self.apply([self._element_cmd('delete', 'forward', set_element(*target))])
+                del self._members[target]
+            else:
+                self._members[target] -= 1
+
+    def save_rules(self):
+        """Make the current port mappings persist reboots"""
+        with self._saving() as dumped:
+            result = run_cmd('sudo nft list table ip {}'.format(self.table_name))
+            dumped()
+            header = 'table ip {0}\nflush table ip {0}\n'.format(self.table_name)
+            write_atomic(RULES_FILE, header + result.stdout)
+
+    def show(self, table='filter', format='parsed'):
+        """Display the port mappings ('nat') or forwarded targets ('filter')
+
+        :Returns: String or Dictionary
+
+        :Raises: ValueError
+
+        :param table: Either 'filter' (the ``forward`` set) or 'nat' (the ``portmap`` map)
+        :type table: String, default "filter"
+
+        :param format: Set to 'raw' for the ``nft --json`` listing, or 'parsed' for just the important stuff
+        :type format: String, default 'parsed'
+        """
+        if table.lower() not in CHAINS:
+            raise ValueError('Param "table" must be either "nat" or "filter", supplied: {}'.format(table))
+        return self.snapshot().show(table, format=format)
+
+
+class NftSnapshot(object):
+    """The port mappings and forwarded targets, parsed from one ``nft --json`` listing
+    of the table. The counterpart of ``RuleSnapshot`` for the nftables backend.
+
+    :param listing: The value of the "nftables" key in the listing
+    :type listing: List
+    """
+    def __init__(self, listing):
+        self._objects = {}
+        self.maps = [] # (conn_port, target_addr, target_port)
+        self.targets = [] # (target_addr, target_port)
+        for obj in listing:
+            if obj.get('map', {}).get('name') == 'portmap':
+                self._objects['nat'] = obj
+                self.maps.extend(_map_elements(obj['map']))
+            elif obj.get('set', {}).get('name') == 'forward':
+                self._objects['filter'] = obj
+                self.targets.extend(_set_elements(obj['set']))
+
+    def show(self, table='filter', format='parsed'):
+        """Display the ``portmap`` map ('nat') or ``forward`` set ('filter')
+
+        :Returns: String or Dictionary
+
+        :Raises: ValueError
+
+        :param table: Either 'filter' or 'nat'
+        :type table: String, default "filter"
+
+        :param format: Set to 'raw' for the JSON of the map or set, or 'parsed' for just the important stuff
+        :type format: String, default 'parsed'
+        """
+        table = table.lower()
+        if table not in CHAINS:
+            raise ValueError('Param "table" must be either "nat" or "filter", supplied: {}'.format(table))
+        if format.lower() != 'parsed':
+            return ujson.dumps(self._objects.get(table, {}))
+        if table == 'nat':
+            return {map_element(conn_port) : {'conn_port' : conn_port,
+                                              'target_addr' : target_addr,
+                                              'target_port' : target_port}
+                    for conn_port, target_addr, target_port in self.maps}
+        return {set_element(target_addr, target_port) : {'target_addr' : target_addr,
+                                                          'target_port' : target_port}
+                for target_addr, target_port in self.targets}
+
+
+def _map_elements(nft_map):
+    """Parse the elements of the ``portmap`` map, as listed by ``nft --json``
+
+    :Returns: Generator of Tuples (conn_port, target_addr, target_port)
+
+    :param nft_map: The value of a "map" object
+    :type nft_map: Dictionary
+    """
+    # i.e. {"elem": [[6000, {"concat": ["192.168.1.2", 22]}]], ...}
+    for conn_port, target in nft_map.get('elem', []):
+        target_addr, target_port = target['concat']
+        yield int(conn_port), target_addr, int(target_port)
+
+
+def _set_elements(nft_set):
+    """Parse the elements of the ``forward`` set, as listed by ``nft --json``
+
+    :Returns: Generator of Tuples (target_addr, target_port)
+
+    :param nft_set: The value of a "set" object
+    :type nft_set: Dictionary
+    """
+    # i.e. {"elem": [{"concat": ["192.168.1.2", 22]}], ...}
+    for element in nft_set.get('elem', []):
+        target_addr, target_port = element['concat']
+        yield target_addr, int(target_port)
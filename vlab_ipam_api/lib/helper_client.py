@@ -0,0 +1,215 @@
+# -*- coding: UTF-8 -*-
+"""
+Talk to the firewall helper daemon (see ``vlab_ipam_api.firewall_helper``),
+which runs the firewall commands as root, so the API doesn't fork ``sudo``
+for every change.
+
+Every message is a 4 byte (big endian) length, then that many bytes of JSON.
+A request is a batch of commands; the helper runs them in order, stopping at
+the first one that fails, and replies with the result of each it ran::
+
+    {"batch": [{"cmd": "iptables-restore --noflush", "stdin": "*nat\\n..."}]}
+    {"results": [{"stdout": "", "stderr": "", "exit_code": 0}]}
+
+Example::
+
+    helper = get_helper(DEFAULT_SOCKET)
+    result = helper.run_cmd('sudo iptables-save')
+"""
+import os
+import socket
+import select
+import struct
+import threading
+
+import ujson
+
+from vlab_ipam_api.lib.shell import CliResult
+from vlab_ipam_api.lib.exceptions import CliError
+
+DEFAULT_SOCKET = '/run/vlab-ipam/firewall.sock'
+HEADER = struct.Struct('>I')
+MAX_MESSAGE = 64 * 1024 * 1024 # iptables-save of a very large ruleset is a few MB
+
+
+def send_msg(sock, obj):
+    """Write one message to a socket
+
+    :Returns: None
+
+    :param sock: The connected socket
+    :type sock: socket.socket
+
+    :param obj: The message
+    :type obj: Dictionary
+    """
+    body = ujson.dumps(obj).encode()
+    sock.sendall(HEADER.pack(len(body)) + body)
+
+
+def recv_msg(sock):
+    """Read one message from a socket
+
+    :Returns: Dictionary, or None if the peer closed the connection
+
+    :Raises: ValueError (if the message is too big)
+
+    :param sock: The connected socket
+    :type sock: socket.socket
+    """
+    header = _recv_exactly(sock, HEADER.size)
+    if header is None:
+        return None
+    size, = HEADER.unpack(header)
+    if size > MAX_MESSAGE:
+        raise ValueError('Message of {} bytes exceeds the limit of {}'.format(size, MAX_MESSAGE))
+    body = _recv_exactly(sock, size)
+    if body is None:
+        raise ConnectionError('Connection closed mid-message')
+    return ujson.loads(body.decode())
+
+
+def _recv_exactly(sock, size):
+    """Read ``size`` bytes, or None if the connection was closed first"""
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 1024 * 1024))
+        if not chunk:
+            if chunks:
+                raise ConnectionError('Connection closed mid-message')
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def strip_sudo(cli_syntax):
+    """The helper already runs as root
+
+    :Returns: String
+    """
+    if cli_syntax.startswith('sudo '):
+        return cli_syntax[len('sudo '):]
+    return cli_syntax
+
+
+class HelperClient(object):
+    """Sends commands to the firewall helper daemon. Thread-safe; every thread
+    (and every forked process, i.e. uWSGI worker) gets a connection of its own,
+    so listings can run in parallel.
+
+    :param path: The Unix socket of the helper
+    :type path: String
+
+    :param timeout: Seconds to wait for a reply
+    :type timeout: Float
+    """
+    def __init__(self, path, timeout=30):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        """The calling thread's connection, opened if needed
+
+        :Returns: socket.socket
+        """
+        sock = getattr(self._local, 'sock', None)
+        if sock is not None and self._local.pid == os.getpid():
+            # An idle connection has nothing to read, unless the helper closed it (i.e. restarted)
+            if not select.select([sock], [], [], 0)[0]:
+                return sock
+            self._discard()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.path)
+        except Exception:
+            sock.close()
+            raise
+        self._local.sock = sock
+        self._local.pid = os.getpid()
+        return sock
+
+    def _discard(self):
+        """Close the calling thread's connection, i.e. after an error"""
+        sock = getattr(self._local, 'sock', None)
+        self._local.sock = None
+        if sock is not None and self._local.pid == os.getpid():
+            sock.close()
+
+    def _exchange(self, request):
+        """Send a request and read the reply. Never resent; the helper might
+        have run some of it.
+
+        :Returns: Dictionary
+        """
+        try:
+            sock = self._connection()
+            send_msg(sock, request)
+            reply = recv_msg(sock)
+            if reply is None:
+                raise ConnectionError('The firewall helper closed the connection')
+            return reply
+        except (OSError, ValueError):
+            self._discard()
+            raise
+
+    def run(self, batch):
+        """Run several commands, in order, with one round trip. Stops at the
+        first command that fails.
+
+        :Returns: List of CliResult - One per command that ran
+
+        :param batch: The (cli_syntax, stdin) of each command; stdin can be None
+        :type batch: List
+        """
+        request = {'batch' : [{'cmd' : strip_sudo(cmd), 'stdin' : stdin} for cmd, stdin in batch]}
+        reply = self._exchange(request)
+        if 'error' in reply:
+            raise CliError(batch[0][0], '', reply['error'], 1, message='Firewall helper error')
+        results = []
+        for (cmd, _), result in zip(batch, reply['results']):
+            results.append(CliResult(cmd, result['stdout'], result['stderr'], result['exit_code']))
+        return results
+
+    def run_cmd(self, cli_syntax, stdin=None):
+        """Drop-in for ``shell.run_cmd``
+
+        :Returns: CliResult
+
+        :Raises: CliError (when exit code is not zero)
+
+        :param cli_syntax: The command to run; a leading ``sudo`` is ignored
+        :type cli_syntax: String
+
+        :param stdin: Text to send to the command's standard in stream
+        :type stdin: String
+        """
+        try:
+            result, = self.run([(cli_syntax, stdin)])
+        except (OSError, ValueError) as doh:
+            raise CliError(cli_syntax, '', '%s' % doh, 1, message='Firewall helper unreachable')
+        if result.exit_code:
+            raise CliError(cli_syntax, result.stdout, result.stderr, result.exit_code)
+        return result
+
+
+_CLIENTS = {}
+_CLIENTS_LOCK = threading.Lock()
+
+
+def get_helper(path):
+    """Obtain the shared client for a helper socket
+
+    :Returns: HelperClient
+
+    :param path: The Unix socket of the helper
+    :type path: String
+    """
+    with _CLIENTS_LOCK:
+        client = _CLIENTS.get(path)
+        if client is None:
+            client = HelperClient(path)
+            _CLIENTS[path] = client
+        return client
@@ -0,0 +1,274 @@
+# -*- coding: UTF-8 -*-
+"""
+An asyncio ICMP echo ("ping") engine. One socket carries every probe, so
+thousands can be in flight at once, without a process or thread for each.
+
+The socket is an unprivileged ICMP datagram socket where the kernel allows it
+(see ``net.ipv4.ping_group_range``), else a raw socket, which needs root (or
+CAP_NET_RAW). Replies are matched to probes by sequence number, plus the
+identifier and payload on a raw socket, which sees every ICMP packet of the host.
+
+Example::
+
+    loop = asyncio.get_event_loop()
+    prober = IcmpProber(iface='ens192')
+    prober.open(loop)
+    results = loop.run_until_complete(prober.probe_many(['192.168.1.2', '192.168.1.3']))
+    prober.close()
+"""
+import os
+import socket
+import struct
+import asyncio
+
+ECHO_REPLY = 0
+ECHO_REQUEST = 8
+HEADER = struct.Struct('!BBHHH') # type, code, checksum, identifier, sequence
+SO_BINDTODEVICE = getattr(socket, 'SO_BINDTODEVICE', 25)
+
+
+def checksum(data):
+    """The Internet checksum (RFC 1071) of some bytes
+
+    :Returns: Integer
+    """
+    if len(data) % 2:
+        data += b'\x00'
+    total = sum(struct.unpack('!{}H'.format(len(data) // 2), data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+
+def echo_request(ident, seq, payload):
+    """Build an ICMP echo request
+
+    :Returns: Bytes
+
+    :param ident: The identifier; the kernel replaces it on a datagram socket
+    :type ident: Integer
+
+    :param seq: The sequence number
+    :type seq: Integer
+
+    :param payload: The data the target echoes back
+    :type payload: Bytes
+    """
+    header = HEADER.pack(ECHO_REQUEST, 0, 0, ident, seq)
+    return HEADER.pack(ECHO_REQUEST, 0, checksum(header + payload), ident, seq) + payload
+
+
+def parse_reply(data, raw):
+    """Extract the identifier, sequence and payload of an echo reply
+
+    :Returns: Tuple (ident, seq, payload), or None if it's not an echo reply
+
+    :param data: What the socket received
+    :type data: Bytes
+
+    :param raw: True if ``data`` starts with the IP header, as on a raw socket
+    :type raw: Boolean
+    """
+    if raw:
+        if not data:
+            return None
+        data = data[(data[0] & 0x0f) * 4:]
+    if len(data) < HEADER.size:
+        return None
+    icmp_type, _, _, ident, seq = HEADER.unpack_from(data)
+    if icmp_type != ECHO_REPLY:
+        return None
+    return ident, seq, data[HEADER.size:]
+
+
+class IcmpProber(object):
+    """Probes addresses with ICMP echo requests, like ``ping -c count -W timeout``:
+    an address is reachable if any of the ``count`` echoes is answered.
+
+    :param count: The most echo requests to send per probe
+    :type count: Integer
+
+    :param interval: Seconds between the echo requests of a probe
+    :type interval: Float
+
+    :param timeout: Seconds to wait for a reply after the last echo request
+    :type timeout: Float
+
+    :param iface: Only send and receive via this network interface, like ``ping -I``
+    :type iface: String
+    """
+    def __init__(self, count=3, interval=1.0, timeout=2.0, iface=None):
+        self.count = count
+        self.interval = interval
+        self.timeout = timeout
+        self.iface = iface
+        self.stats = {'probes' : 0, 'reachable' : 0, 'sent' : 0, 'replies' : 0, 'send_errors' : 0}
+        self._sock = None
+        self._raw = False
+        self._loop = None
+        self._ident = os.getpid() & 0xffff
+        self._payload = os.urandom(8) # tells our replies from those of another raw socket with the same ident
+        self._pending = {} # seq -> (addr, future of the probe)
+        self._next_seq = 0
+        self._writable = None
+
+    def open(self, loop, sock=None):
+        """Create the socket, and start reading replies within an event loop
+
+        :Returns: None
+
+        :param loop: The event loop the probes run in
+        :type loop: asyncio.AbstractEventLoop
+
+        :param sock: Use this socket instead; it's assumed to be raw if it's a SOCK_RAW
+        :type sock: socket.socket
+        """
+        if sock is None:
+            try:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+            except PermissionError:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+            if self.iface:
+                sock.setsockopt(socket.SOL_SOCKET, SO_BINDTODEVICE, self.iface.encode())
+        self._raw = sock.type == socket.SOCK_RAW
+        sock.setblocking(False)
+        self._sock = sock
+        self._loop = loop
+        loop.add_reader(sock.fileno(), self._on_readable)
+
+    def close(self):
+        """Stop reading replies, and close the socket
+
+        :Returns: None
+        """
+        if self._sock is not None:
+            self._loop.remove_reader(self._sock.fileno())
+            self._loop.remove_writer(self._sock.fileno())
+            self._sock.close()
+            self._sock = None
+
+    def _allocate_seq(self):
+        """A sequence number no pending echo uses
+
+        :Returns: Integer
+
+        :Raises: RuntimeError (if all 65536 are in use)
+        """
+        for _ in range(0x10000):
+            seq = self._next_seq
+            self._next_seq = (seq + 1) & 0xffff
+            if seq not in self._pending:
+                return seq
+        raise RuntimeError('Too many ICMP echo requests in flight')
+
+    def _on_readable(self):
+        """Resolve the probes that replies arrived for"""
+        while True:
+            try:
+                data, source = self._sock.recvfrom(2048)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                # i.e. a queued ICMP error; the probe will time out
+                continue
+            self.handle(data, source[0])
+
+    def handle(self, data, source):
+        """Match a received packet to its probe
+
+        :Returns: Boolean - True if it answered a pending probe
+
+        :param data: The packet
+        :type data: Bytes
+
+        :param source: The address it came from
+        :type source: String
+        """
+        reply = parse_reply(data, self._raw)
+        if reply is None:
+            return False
+        ident, seq, payload = reply
+        if self._raw and (ident != self._ident or payload != self._payload):
+            return False
+        addr, future = self._pending.get(seq, (None, None))
+        if addr != source or future.done():
+            return False
+        self.stats['replies'] += 1
+        future.set_result(True)
+        return True
+
+    async def _send(self, addr, seq):
+        """Send an echo request, waiting for room in the socket buffer if needed
+
+        :Returns: Boolean - False if the kernel refused it, i.e. no route to the address
+        """
+        packet = echo_request(self._ident, seq, self._payload)
+        while True:
+            try:
+                self._sock.sendto(packet, (addr, 0))
+            except (BlockingIOError, InterruptedError):
+                await self._wait_writable()
+            except OSError:
+                self.stats['send_errors'] += 1
+                return False
+            else:
+                self.stats['sent'] += 1
+                return True
+
+    async def _wait_writable(self):
+        """Block (this coroutine) until the socket can send again"""
+        if self._writable is None:
+            self._writable = self._loop.create_future()
+            self._loop.add_writer(self._sock.fileno(), self._on_writable)
+        await asyncio.shield(self._writable)
+
+    def _on_writable(self):
+        self._loop.remove_writer(self._sock.fileno())
+        writable, self._writable = self._writable, None
+        if not writable.done():
+            writable.set_result(None)
+
+    async def probe(self, addr):
+        """Determine if an address answers ICMP echo requests
+
+        :Returns: Boolean
+
+        :param addr: The IPv4 address to probe
+        :type addr: String
+        """
+        self.stats['probes'] += 1
+        future = self._loop.create_future()
+        seqs = []
+        try:
+            for n in range(self.count):
+                seq = self._allocate_seq()
+                self._pending[seq] = (addr, future)
+                seqs.append(seq)
+                await self._send(addr, seq)
+                wait = self.interval if n < self.count - 1 else self.timeout
+                done, _ = await asyncio.wait([future], timeout=wait)
+                if done:
+                    self.stats['reachable'] += 1
+                    return True
+            return False
+        finally:
+            for seq in seqs:
+                del self._pending[seq]
+
+    async def probe_many(self, addrs, max_in_flight=1000):
+        """Probe many addresses concurrently
+
+        :Returns: Dictionary - Maps each address to True if it's reachable
+
+        :param addrs: The IPv4 addresses to probe
+        :type addrs: Iterable
+
+        :param max_in_flight: The most probes to run at once
+        :type max_in_flight: Integer
+        """
+        limit = asyncio.Semaphore(max_in_flight)
+        async def bounded(addr):
+            async with limit:
+                return addr, await self.probe(addr)
+        results = await asyncio.gather(*[bounded(addr) for addr in set(addrs)])
+        return dict(results)
@@ -0,0 +1,219 @@
+# -*- coding: UTF-8 -*-
+"""
+Locks for the objects that several threads, or processes, of the API share.
+
+Example::
+
+    lock = RWLock()
+    with lock.read():
+        # Any number of threads can be in here at once...
+        pass
+    with lock.write():
+        # ...but only when no thread is in here
+        pass
+
+    with ProcessLock('/run/lock/example.lock').hold() as fd:
+        # Only one thread, of any process, is in here
+        generation = ProcessLock.generation(fd)
+"""
+import os
+import fcntl
+from contextlib import contextmanager
+from threading import Condition, Lock, get_ident
+
+
+class RWLock(object):
+    """Lets many threads read at once, while writes are exclusive.
+
+    The writer can acquire the lock (to read or write) again without blocking,
+    like a ``threading.RLock``; so can a reader, to read. Once a writer is
+    waiting, new readers wait too, so a steady stream of reads can't starve a
+    write. In turn, the readers waiting when a write finishes go before the
+    next writer, so a steady stream of writes can't starve the reads. A reader
+    that tries to write raises RuntimeError, instead of deadlocking with
+    another reader doing the same.
+    """
+    def __init__(self):
+        self._cond = Condition(Lock())
+        self._readers = {} # thread ident -> depth
+        self._readers_waiting = 0
+        self._read_turn = 0 # how many more readers may go ahead of a waiting writer
+        self._writer = None
+        self._writer_depth = 0
+        self._writers_waiting = 0
+
+    def acquire_read(self):
+        """Block until no thread is writing, or waiting to write.
+
+        :Returns: None
+        """
+        me = get_ident()
+        with self._cond:
+            if self._writer == me:
+                self._writer_depth += 1
+                return
+            if me not in self._readers:
+                self._readers_waiting += 1
+                try:
+                    while self._writer is not None or (self._writers_waiting and not self._read_turn):
+                        self._cond.wait()
+                    if self._read_turn:
+                        self._read_turn -= 1
+                finally:
+                    self._readers_waiting -= 1
+                    if self._read_turn > self._readers_waiting:
+                        # A reader given a turn stopped waiting (i.e. interrupted); don't hold up the writers
+                        self._read_turn = self._readers_waiting
+                        self._cond.notify_all()
+            self._readers[me] = self._readers.get(me, 0) + 1
+
+    def release_read(self):
+        """Undo one ``acquire_read``
+
+        :Returns: None
+        """
+        me = get_ident()
+        with self._cond:
+            if self._writer == me:
+                self._writer_depth -= 1
+                return
+            depth = self._readers[me] - 1
+            if depth:
+                self._readers[me] = depth
+            else:
+                del self._readers[me]
+                if not self._readers:
+                    self._cond.notify_all()
+
+    def acquire_write(self):
+        """Block until no other thread is reading or writing.
+
+        :Returns: None
+
+        :Raises: RuntimeError (if the calling thread is reading)
+        """
+        me = get_ident()
+        with self._cond:
+            if self._writer == me:
+                self._writer_depth += 1
+                return
+            if me in self._readers:
+                raise RuntimeError('Cannot upgrade a read lock to a write lock')
+            self._writers_waiting += 1
+            try:
+                while self._writer is not None or self._readers or self._read_turn:
+                    self._cond.wait()
+            finally:
+                self._writers_waiting -= 1
+            self._writer = me
+            self._writer_depth = 1
+
+    def release_write(self):
+        """Undo one ``acquire_write``
+
+        :Returns: None
+        """
+        with self._cond:
+            if self._writer != get_ident():
+                raise RuntimeError('Cannot release a write lock the thread does not hold')
+            self._writer_depth -= 1
+            if not self._writer_depth:
+                self._writer = None
+                self._read_turn = self._readers_waiting
+                self._cond.notify_all()
+
+    @contextmanager
+    def read(self):
+        """Hold the lock for reading, within a ``with`` statement"""
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def write(self):
+        """Hold the lock for writing, within a ``with`` statement"""
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+
+class ProcessLock(object):
+    """An exclusive lock shared by every process (and thread) that uses the same
+    file, via ``flock``. The file also holds a generation counter; bump it after
+    changing the shared state, so other processes know their cached copy of it
+    is stale.
+
+    Every hold opens the file anew, so each thread, and each forked worker
+    (i.e. uWSGI), gets a lock of its own. It's not reentrant.
+
+    :param path: The lock file; it's created if needed
+    :type path: String
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def acquire(self):
+        """Block until no other holder has the lock.
+
+        :Returns: Integer - The file descriptor to pass to ``release``
+        """
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        except Exception:
+            os.close(fd)
+            raise
+        return fd
+
+    def release(self, fd):
+        """Undo ``acquire``
+
+        :Returns: None
+
+        :param fd: The file descriptor from ``acquire``
+        :type fd: Integer
+        """
+        # Closing the file releases the lock
+        os.close(fd)
+
+    @contextmanager
+    def hold(self):
+        """Hold the lock within a ``with`` statement, which yields the file descriptor"""
+        fd = self.acquire()
+        try:
+            yield fd
+        finally:
+            self.release(fd)
+
+    @staticmethod
+    def generation(fd):
+        """Read the generation counter. Caller must hold the lock.
+
+        :Returns: Integer
+
+        :param fd: The file descriptor from ``acquire``
+        :type fd: Integer
+        """
+        try:
+            return int(os.pread(fd, 32, 0) or 0)
+        except ValueError:
+            return 0
+
+    @staticmethod
+    def bump(fd):
+        """Increment the generation counter. Caller must hold the lock.
+
+        :Returns: Integer - The new generation
+
+        :param fd: The file descriptor from ``acquire``
+        :type fd: Integer
+        """
+        generation = ProcessLock.generation(fd) + 1
+        data = '{}\n'.format(generation).encode()
+        os.pwrite(fd, data, 0)
+        os.ftruncate(fd, len(data))
+        return generation
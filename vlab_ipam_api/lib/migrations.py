@@ -0,0 +1,86 @@
+# -*- coding: UTF-8 -*-
+"""
+Versioned schema changes for the vLab IPAM database.
+
+Every migration has a unique, increasing version number and is applied exactly
+once. The versions already applied are recorded in the ``schema_version`` table.
+Never edit or remove a migration once it has shipped; add a new one instead.
+
+Example::
+
+    from vlab_ipam_api.lib import Database
+    from vlab_ipam_api.lib.migrations import migrate
+
+    with Database() as db:
+        applied = migrate(db)
+"""
+
+
+# Arbitrary, but constant, key for pg_advisory_xact_lock. Prevents several
+# uWSGI workers from running the same migration at the same time.
+MIGRATION_LOCK_ID = 1868849491
+
+SCHEMA_VERSION_TABLE = """CREATE TABLE IF NOT EXISTS schema_version(
+                            version INT PRIMARY KEY NOT NULL,
+                            description TEXT,
+                            applied TIMESTAMP WITH TIME ZONE DEFAULT now()
+                          );"""
+
+# (version, description, SQL)
+MIGRATIONS = (
+    (1, 'Create the ipam table',
+     """CREATE TABLE IF NOT EXISTS ipam(
+          conn_port INT PRIMARY KEY NOT NULL,
+          target_addr TEXT,
+          target_port INT,
+          target_name TEXT,
+          target_component TEXT,
+          routable  Boolean
+        );"""),
+    # The *_pattern_ops operator class lets the LIKE filters in lookup_addr and
+    # lookup_port use the index (for values without a leading wildcard), and
+    # still supports the plain equality the worker updates with.
+    (2, 'Index the ipam lookup columns',
+     """CREATE INDEX IF NOT EXISTS ipam_target_name_addr_idx ON ipam (target_name text_pattern_ops, target_addr text_pattern_ops);
+        CREATE INDEX IF NOT EXISTS ipam_target_addr_idx ON ipam (target_addr text_pattern_ops);
+        CREATE INDEX IF NOT EXISTS ipam_target_component_idx ON ipam (target_component text_pattern_ops);
+        ANALYZE ipam;"""),
+    # The *_pattern_ops indexes can't do the ORDER BY target_name, nor the
+    # target_name > (after) comparison, of paging through lookup_addr.
+    (3, 'Index the ipam target_name for paging',
+     """CREATE INDEX IF NOT EXISTS ipam_target_name_idx ON ipam (target_name);
+        ANALYZE ipam;"""),
+)
+
+
+def pending(applied):
+    """Determine which migrations still need to run, in the order to run them.
+
+    :Returns: List
+
+    :param applied: The version numbers already recorded in the database
+    :type applied: Set
+    """
+    return [m for m in sorted(MIGRATIONS) if m[0] not in applied]
+
+
+def migrate(db):
+    """Apply every pending migration within a single transaction.
+
+    :Returns: List - The version numbers that were applied
+
+    :param db: An instantiated connection to the IPAM database
+    :type db: vlab_ipam_api.lib.database.Database
+    """
+    done = []
+    with db.transaction():
+        db.execute('SELECT pg_advisory_xact_lock(%s);', params=(MIGRATION_LOCK_ID,))
+        db.execute(SCHEMA_VERSION_TABLE)
+        applied = set(row[0] for row in db.execute('SELECT version FROM schema_version;'))
+        for version, description, sql in pending(applied):
+            db.execute(sql)
+            db.execute('INSERT INTO schema_version (version, description) VALUES (%s, %s);',
+                       params=(version, description))
+            done.append(version)
+    return done
+
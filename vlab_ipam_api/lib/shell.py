@@ -49,7 +49,7 @@ class CliResult(_CliResult):
     pass
 
 
-def run_cmd(cli_syntax):
+def run_cmd(cli_syntax, stdin=None):
     """Execute a simple CLI command.
 
     This function blocks until the CLI command returns and does not support the
@@ -61,16 +61,23 @@ def run_cmd(cli_syntax):
 
     :param cli_syntax: The CLI command to run.
     :type cli_syntax: String
+
+    :param stdin: Text to send to the command's standard in stream
+    :type stdin: String
     """
     CliResult = namedtuple('CliResult', 'command stdout stderr exit_code')
+    if stdin is None:
+        stdin_pipe, stdin_data = None, None
+    else:
+        stdin_pipe, stdin_data = subprocess.PIPE, stdin.encode()
     try:
-        proc = subprocess.Popen(cli_syntax.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        proc = subprocess.Popen(cli_syntax.split(), stdin=stdin_pipe, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     except OSError as doh:
         stdout = ''
         stderr = '%s' % doh
         exit_code = 1
     else:
-        stdout, stderr = proc.communicate()
+        stdout, stderr = proc.communicate(stdin_data)
         exit_code = proc.returncode
     if exit_code:
         raise CliError(cli_syntax, stdout, stderr, exit_code)
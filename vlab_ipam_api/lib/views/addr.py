@@ -9,7 +9,9 @@ from flask_classy import request, Response
 from vlab_api_common import BaseView, describe, get_logger, requires
 
 from vlab_ipam_api.lib import const, Database
+from vlab_ipam_api.lib.database import ADDR_FIELDS
 from vlab_ipam_api.lib.exceptions import DatabaseError
+from vlab_ipam_api.lib.views.paging import page_args
 
 logger = get_logger(__name__, loglevel=const.VLAB_IPAM_LOG_LEVEL)
 
@@ -32,6 +34,18 @@ class AddrView(BaseView):
                            "component": {
                                "description": "Obtain the IP addresses and names of machines of a supplied component type",
                                "type": "string"
+                           },
+                           "limit": {
+                               "description": "Return at most this many machines, ordered by name. The response includes 'next' to supply as 'after' for the next page",
+                               "type": "integer"
+                           },
+                           "after": {
+                               "description": "Only return machines whose name sorts after this value",
+                               "type": "string"
+                           },
+                           "fields": {
+                               "description": "Comma separated list of the fields to return per machine (addr, component, routable)",
+                               "type": "string"
                            }
                        },
                       }
@@ -46,9 +60,21 @@ class AddrView(BaseView):
         name = request.args.get('name', None)
         addr = request.args.get('addr', '')
         component = request.args.get('component', None)
-        if args_valid(name=name, addr=addr, component=component):
+        limit, after, fields, page_error = page_args(request.args, ADDR_FIELDS.keys(), after_type=str)
+        if page_error:
+            resp_data['error'] = page_error
+            status_code = 400
+        elif args_valid(name=name, addr=addr, component=component):
             with Database() as db:
-                resp_data['content'] = db.lookup_addr(name=name, addr=addr, component=component)
+                resp_data['content'] = db.lookup_addr(name=name, addr=addr, component=component,
+                                                      limit=limit, after=after, fields=fields)
+            if limit:
+                # The answer is in database order, so the last name on a full page
+                # is the cursor for the next; don't sort in Python, the collation differs
+                if len(resp_data['content']) >= limit:
+                    resp_data['next'] = list(resp_data['content'].keys())[-1]
+                else:
+                    resp_data['next'] = None
         else:
             resp_data['error'] = 'Params are mutually exclusive. Supplied: name={}, addr={}, component={}'.format(name, addr, component)
             status_code = 400
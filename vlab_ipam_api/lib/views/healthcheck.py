@@ -3,13 +3,16 @@
 Enables Health checks for the power API
 """
 from time import time
+import itertools
 import pkg_resources
 
 import ujson
+from flask import current_app
 from flask_classy import FlaskView, Response
 
 
-from vlab_ipam_api.lib import Database, firewall
+from vlab_ipam_api.lib import Database
+from vlab_ipam_api.lib.views.streaming import stream_json, json_array_chunks, closing
 
 class HealthView(FlaskView):
     """
@@ -23,17 +26,34 @@ class HealthView(FlaskView):
         resp = {}
         status = 200
         resp['version'] = pkg_resources.get_distribution('vlab-ipam-api').version
-        fwall = firewall.FireWall()
+        # The app's own firewall object, so the listing shares the lock of its changes
+        fwall = current_app.firewall
         try:
-            with Database() as db:
-                resp['database'] = list(db.execute("select * from ipam;"))
+            # Both tables from one listing of the rules
+            snapshot = fwall.snapshot()
             resp['firewall'] = {}
-            resp['firewall']['nat'] = fwall.show(table='nat', format='raw')
-            resp['firewall']['filter'] = fwall.show(table='filter', format='raw')
+            resp['firewall']['nat'] = snapshot.show(table='nat', format='raw')
+            resp['firewall']['filter'] = snapshot.show(table='filter', format='raw')
+            # A stuck 'debounce' save means a reboot would lose the latest changes
+            save_error = fwall.save_error()
+            if save_error:
+                raise RuntimeError(save_error)
+            # Stream the table, instead of holding every row in memory
+            db = Database()
+            try:
+                rows = iter(db.stream("select * from ipam;"))
+                first = next(rows, [])
+            except Exception:
+                db.close()
+                raise
         except Exception as doh:
             resp['error'] = '%s' % doh
             status = 500
-        response = Response(ujson.dumps(resp))
+            body = ujson.dumps(resp)
+        else:
+            rows = json_array_chunks(itertools.chain([first], rows))
+            body = closing(stream_json(resp, 'database', rows), db)
+        response = Response(body)
         response.status_code = status
         response.headers['Content-Type'] = 'application/json'
         return response
@@ -0,0 +1,44 @@
+# -*- coding: UTF-8 -*-
+"""
+Handling for the ``limit``, ``after`` and ``fields`` query parameters shared by
+the listing API end points.
+"""
+
+
+def page_args(args, allowed_fields, after_type):
+    """Parse the paging and field projection query parameters. If a value is not
+    valid, an error message is returned.
+
+    :Returns: Tuple (limit, after, fields, error)
+
+    :param args: The query parameters of the request
+    :type args: werkzeug.datastructures.MultiDict
+
+    :param allowed_fields: The field names a caller can ask for
+    :type allowed_fields: Iterable
+
+    :param after_type: The type of the key the listing is ordered by (i.e. int)
+    :type after_type: Type
+    """
+    error = None
+    limit = args.get('limit', None)
+    after = args.get('after', None)
+    fields = args.get('fields', None)
+    if limit is not None:
+        try:
+            limit = int(limit)
+            if limit < 1:
+                raise ValueError()
+        except ValueError:
+            error = 'Param limit must be a positive number, supplied: {}'.format(limit)
+    if after is not None:
+        try:
+            after = after_type(after)
+        except ValueError:
+            error = 'Param after must be a {}, supplied: {}'.format(after_type.__name__, after)
+    if fields is not None:
+        fields = [x.strip() for x in fields.split(',') if x.strip()]
+        if not fields or [x for x in fields if x not in allowed_fields]:
+            error = 'Param fields must be a comma separated list of: {}, supplied: {}'.format(', '.join(allowed_fields),
+                                                                                              args.get('fields'))
+    return limit, after, fields, error
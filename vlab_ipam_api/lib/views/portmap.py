@@ -3,6 +3,7 @@
 Defines the RESTful API for managing Port Map rules in the NAT firewall
 """
 import random
+import itertools
 
 import ujson
 from flask import current_app
@@ -11,7 +12,10 @@ from vlab_api_common import BaseView, describe, get_logger, requires, validate_i
 
 from vlab_ipam_api.lib import const, Database
 from vlab_ipam_api.ddns_updater import get_ip
+from vlab_ipam_api.lib.database import PORT_FIELDS
 from vlab_ipam_api.lib.exceptions import DatabaseError, CliError
+from vlab_ipam_api.lib.views.paging import page_args
+from vlab_ipam_api.lib.views.streaming import splice_json, stream_json, json_object_chunks, closing
 
 logger = get_logger(__name__, loglevel=const.VLAB_IPAM_LOG_LEVEL)
 
@@ -76,6 +80,18 @@ class PortMapView(BaseView):
                       "conn_port": {
                          "type": "integer",
                          "description": "Filter results by the connection port"
+                      },
+                      "limit": {
+                         "type": "integer",
+                         "description": "Return at most this many port maps, ordered by conn_port. The response includes 'next' to supply as 'after' for the next page"
+                      },
+                      "after": {
+                         "type": "integer",
+                         "description": "Only return port maps with a conn_port greater than this value"
+                      },
+                      "fields": {
+                         "type": "string",
+                         "description": "Comma separated list of the fields to return per port map (name, target_addr, target_port, component)"
                       }
                   },
                  }
@@ -93,24 +109,35 @@ class PortMapView(BaseView):
         conn_port = request.args.get('conn_port', 0)
         target_port = request.args.get('target_port', 0)
         conn_port, target_port, error = cast_port_values(conn_port, target_port)
+        limit, after, fields, page_error = page_args(request.args, PORT_FIELDS.keys(), after_type=int)
+        error = error or page_error
         if error:
             resp_data['error'] = error
             resp = Response(ujson.dumps(resp_data))
             resp.status_code = 400
             return resp
+        filters = {'name' : name, 'addr' : addr, 'component' : component,
+                   'conn_port' : conn_port, 'target_port' : target_port,
+                   'after' : after, 'fields' : fields}
         try:
-            with Database() as db:
-                resp_data['content']['ports'] = db.lookup_port(name=name, addr=addr,
-                                                               component=component,
-                                                               conn_port=conn_port,
-                                                               target_port=target_port)
+            if limit:
+                # A bounded page; the database builds the whole document
+                with Database() as db:
+                    ports, next_after = db.lookup_port_json(limit=limit, **filters)
+                resp_data['content']['gateway_ip'] = get_ip()
+                resp_data['next'] = next_after
+                # The database already encoded the ports; don't decode it just to re-encode it
+                content = splice_json(resp_data.pop('content'), 'ports', ports)
+                body = splice_json(resp_data, 'content', content)
+            else:
+                # Could be every port map; stream it so memory use stays flat
+                body = stream_ports(resp_data, filters)
         except Exception as doh:
             logger.exception(doh)
             resp_data['error'] = '%s' % doh
             status_code = 500
-        else:
-            resp_data['content']['gateway_ip'] = get_ip()
-        resp = Response(ujson.dumps(resp_data))
+            body = ujson.dumps(resp_data)
+        resp = Response(body)
         resp.status_code = status_code
         return resp
 
@@ -126,24 +153,29 @@ class PortMapView(BaseView):
         target_component = kwargs['body']['target_component']
         status_code = 200
         try:
-            db = Database()
+            # The firewall stays locked until the record is committed, so the
+            # rules can be undone if the commit fails
+            with Database() as db, current_app.firewall:
+                mapped = False
+                try:
+                    # If the firewall update fails, the new record is rolled back
+                    with db.transaction():
+                        conn_port = db.add_port(target_addr, target_port, target_name, target_component)
+                        current_app.firewall.map_port(conn_port, target_port, target_addr)
+                        mapped = True
+                except Exception:
+                    if mapped:
+                        # The commit failed; don't leave rules without a record
+                        nat_id = current_app.firewall.find_rule(target_port, target_addr, table='nat', conn_port=conn_port)
+                        filter_id = current_app.firewall.find_rule(target_port, target_addr, table='filter', conn_port=conn_port)
+                        current_app.firewall.unmap_port(nat_id, filter_id)
+                    raise
         except Exception as doh:
-            status_code = 500
             resp_data['error'] = '%s' % doh
             logger.exception(doh)
+            status_code = 500
         else:
-            try:
-                conn_port = db.add_port(target_addr, target_port, target_name, target_component)
-                current_app.firewall.map_port(conn_port, target_port, target_addr)
-            except Exception as doh:
-                db.delete_port(conn_port)
-                resp_data['error'] = '%s' % doh
-                logger.exception(doh)
-                status_code = 500
-            else:
-                resp_data['content']['conn_port'] = conn_port
-            finally:
-                db.close()
+            resp_data['content']['conn_port'] = conn_port
 
         resp = Response(ujson.dumps(resp_data))
         resp.status_code = status_code
@@ -158,16 +190,25 @@ class PortMapView(BaseView):
         conn_port = kwargs['body']['conn_port']
         status_code = 200
         try:
-            with Database() as db:
-                target_port, target_addr = db.port_info(conn_port)
-                # The ``with`` statement locks the firewall object
-                # Only locking here because deleting requires multiple updates
-                with current_app.firewall:
-                    nat_id = current_app.firewall.find_rule(target_port, target_addr, table='nat', conn_port=conn_port)
-                    filter_id = current_app.firewall.find_rule(target_port, target_addr, table='filter')
-                    record_error, status_code = records_valid(nat_id, filter_id, target_port, target_addr)
-                    if not record_error:
-                        error, status_code = remove_port_map(nat_id, filter_id, target_port, target_addr, conn_port, db)
+            # The ``with`` statement locks the firewall object until the delete
+            # is committed, so the rules can be remade if the commit fails
+            with Database() as db, current_app.firewall:
+                removed = False
+                try:
+                    # One transaction, so the lookup and delete cost a single commit
+                    with db.transaction():
+                        target_port, target_addr = db.port_info(conn_port)
+                        nat_id = current_app.firewall.find_rule(target_port, target_addr, table='nat', conn_port=conn_port)
+                        filter_id = current_app.firewall.find_rule(target_port, target_addr, table='filter', conn_port=conn_port)
+                        record_error, status_code = records_valid(nat_id, filter_id, target_port, target_addr)
+                        if not record_error:
+                            error, status_code = remove_port_map(nat_id, filter_id, target_port, target_addr, conn_port, db)
+                            removed = error is None
+                except Exception:
+                    if removed:
+                        # The commit failed, so the record still exists; so must the rules
+                        current_app.firewall.map_port(conn_port, target_port, target_addr)
+                    raise
         except Exception as doh:
             logger.exception(doh)
             resp_data['error'] = '%s' % doh
@@ -203,6 +244,31 @@ def cast_port_values(conn_port_value, target_port_value):
     return conn_port_value, target_port_value, error
 
 
+def stream_ports(resp_data, filters):
+    """Start streaming the port maps as the response body. Any error running the
+    query is raised here, before the HTTP status code has been sent.
+
+    :Returns: closing - Iterable of Strings
+
+    :param resp_data: The response body, minus the port maps
+    :type resp_data: Dictionary
+
+    :param filters: The keyword arguments for ``Database.stream_ports_json``
+    :type filters: Dictionary
+    """
+    db = Database()
+    try:
+        batches = iter(db.stream_ports_json(**filters))
+        first = next(batches, [])
+        resp_data['content']['gateway_ip'] = get_ip()
+    except Exception:
+        db.close()
+        raise
+    ports = json_object_chunks(itertools.chain([first], batches))
+    content = stream_json(resp_data.pop('content'), 'ports', ports)
+    return closing(stream_json(resp_data, 'content', content), db)
+
+
 def records_valid(nat_id, filter_id, target_port, target_addr):
     """Ensure that the port is mapped, and the mapping records are consistent.
 
@@ -233,9 +299,9 @@ def records_valid(nat_id, filter_id, target_port, target_addr):
 def remove_port_map(nat_id, filter_id, target_port, target_addr, conn_port, db):
     """Delete a port mapping from the firewall.
 
-    Caller must obtain a lock on the firewall before calling this function. If
-    this function fails for any reason to completely delete the port mapping,
-    it will re-create any deleted rules or records.
+    Caller must obtain a lock on the firewall before calling this function.
+    Both rules are deleted together, or not at all. If the record can't be
+    deleted afterwards, the rules are re-created.
 
     :Returns: None
 
@@ -254,21 +320,20 @@ def remove_port_map(nat_id, filter_id, target_port, target_addr, conn_port, db):
     :param conn_port: The local port that maps to a remote port on a remote machine
     :type conn_port: Integer
 
-    :param db: An instantiated connection to the IPAM database
+    :param db: An instantiated connection to the IPAM database. The caller owns
+               the transaction (if any), so the record is only deleted once it
+               commits; if the commit fails, the caller must re-create the rules.
     :type db: vlab_ipam_api.lib.database.Database
     """
-    current_app.firewall.delete_rule(nat_id, table='nat')
     try:
-        # If we fail to delete the 2nd rule, undo the 1st delete
-        current_app.firewall.delete_rule(filter_id, table='filter')
+        # Both rules are deleted in one batch, so a failure leaves both in place
+        current_app.firewall.unmap_port(nat_id, filter_id)
         error = None
         status_code = 200
     except Exception as doh:
         status_code = 500
         error = '%s' % doh
         logger.exception(doh)
-        current_app.firewall.forward(target_port, target_addr)
-        current_app.firewall.save_rules()
     else:
         # iptables updated; let's update the DB
         try:
@@ -0,0 +1,125 @@
+# -*- coding: UTF-8 -*-
+"""
+Build JSON response bodies from pieces that are already JSON encoded (i.e. by
+PostgreSQL), or that arrive in batches from a server-side cursor, without
+decoding or buffering the whole document.
+"""
+import ujson
+
+
+def splice_json(document, key, raw_json):
+    """JSON encode a dictionary, plus one more key whose value is already JSON encoded.
+
+    :Returns: String
+
+    :param document: The object to JSON encode
+    :type document: Dictionary
+
+    :param key: The name of the extra key to add
+    :type key: String
+
+    :param raw_json: The JSON encoded value of the extra key
+    :type raw_json: String
+    """
+    encoded = ujson.dumps(document)
+    if encoded == '{}':
+        return '{%s:%s}' % (ujson.dumps(key), raw_json)
+    return '{%s:%s,%s' % (ujson.dumps(key), raw_json, encoded[1:])
+
+
+def stream_json(document, key, chunks):
+    """Like ``splice_json``, but the value of the extra key is produced in pieces.
+
+    :Returns: Generator of Strings
+
+    :param document: The object to JSON encode
+    :type document: Dictionary
+
+    :param key: The name of the extra key to add
+    :type key: String
+
+    :param chunks: Yields the JSON encoded value of the extra key, in pieces
+    :type chunks: Iterable
+    """
+    encoded = ujson.dumps(document)
+    yield '{%s:' % ujson.dumps(key)
+    for chunk in chunks:
+        yield chunk
+    if encoded == '{}':
+        yield '}'
+    else:
+        yield ',%s' % encoded[1:]
+
+
+def json_object_chunks(batches):
+    """Encode batches of (key, JSON encoded value) pairs as one JSON object.
+
+    :Returns: Generator of Strings - one per batch
+
+    :param batches: Yields Lists of (key, JSON String) pairs
+    :type batches: Iterable
+    """
+    yield '{'
+    separator = ''
+    for batch in batches:
+        if not batch:
+            continue
+        yield separator + ','.join('"%s":%s' % (key, value) for key, value in batch)
+        separator = ','
+    yield '}'
+
+
+def json_array_chunks(batches):
+    """Encode batches of rows as one JSON array.
+
+    :Returns: Generator of Strings - one per batch
+
+    :param batches: Yields Lists of rows
+    :type batches: Iterable
+    """
+    yield '['
+    separator = ''
+    for batch in batches:
+        if not batch:
+            continue
+        # Strip the brackets so the batches join into a single array
+        yield separator + ujson.dumps(batch)[1:-1]
+        separator = ','
+    yield ']'
+
+
+class closing(object):
+    """A response body that closes ``resource`` once ``chunks`` is exhausted, or
+    the client disconnects. The WSGI server calls ``close`` whether or not the
+    body was read (i.e. for a HEAD request), so the resource is never leaked.
+
+    :param chunks: The response body
+    :type chunks: Iterable
+
+    :param resource: The thing to close; i.e. a Database
+    :type resource: Object with a ``close`` method
+    """
+    def __init__(self, chunks, resource):
+        self._chunks = chunks
+        self._resource = resource
+        self._closed = False
+
+    def __iter__(self):
+        try:
+            for chunk in self._chunks:
+                yield chunk
+        finally:
+            self.close()
+
+    def close(self):
+        """Stop producing chunks, then close the resource they come from. Safe
+        to call more than once.
+
+        :Returns: None
+        """
+        if self._closed:
+            return
+        self._closed = True
+        if hasattr(self._chunks, 'close'):
+            self._chunks.close()
+        self._resource.close()
@@ -2,28 +2,50 @@
 """Verify that the IP addresses in the IPAM records are ping-able"""
 import sys
 import time
+import heapq
 import queue
+import asyncio
 import threading
+import functools
+import collections
+from concurrent.futures import ThreadPoolExecutor
 
 from setproctitle import setproctitle
 
-from vlab_ipam_api.lib import shell, Database, get_logger
+from vlab_ipam_api.lib import const, shell, Database, get_logger
+from vlab_ipam_api.lib.icmp import IcmpProber
 
 
-LOOP_INTERVAL = 300 # seconds
+LOOP_INTERVAL = 300 # seconds; how often the IP records are read
+SCHEDULE_TICK = 5 # seconds; the longest the producer sleeps before checking for due probes
 THREAD_POLL_TIMEOUT = 10 # seconds
 THREAD_COUNT = 10
+FLUSH_SIZE = 500 # probe results per UPDATE statement
+FLUSH_INTERVAL = 15 # seconds; max time a probe result waits to be written
 LOG_FILE = '/var/log/vlab_ipam_worker.log'
-PING_SYNTAX = '/bin/ping -W 2 -c 3 -4 -I ens192 {}'
+PROBE_IFACE = 'ens192'
+PING_SYNTAX = '/bin/ping -W 2 -c 3 -4 -I %s {}' % PROBE_IFACE
+# Only REACHABLE entries; /proc/net/arp shows STALE ones, which might be long gone, the same way
+NEIGH_SYNTAX = 'ip -4 neigh show dev {} nud reachable'
+# Every row with a probed address gets the result, whoever owns it. The arrays
+# keep the statement text the same no matter how many results are written, so
+# it's only prepared once per connection
+UPDATE_ROUTABLE = """UPDATE ipam SET routable=v.routable\
+                     FROM unnest(%s::text[], %s::boolean[]) AS v(target_addr, routable)\
+                     WHERE ipam.target_addr = v.target_addr\
+                     AND ipam.routable IS DISTINCT FROM v.routable RETURNING ipam.conn_port;"""
+# One row per address, or more if its rows disagree on routable
+SELECT_ADDRS = "SELECT target_addr, routable, count(*) FROM ipam GROUP BY target_addr, routable;"
 
 
 class Worker(threading.Thread):
     """Validates that IP records are routable"""
-    def __init__(self, tid, logger, work_queue):
+    def __init__(self, tid, logger, work_queue, writer):
         super(Worker, self).__init__()
         self.keep_running = True
         self.tid = tid
         self.work_queue = work_queue
+        self.writer = writer
         self.logger = logger
 
     def run(self):
@@ -33,17 +55,18 @@ class Worker(threading.Thread):
         while self.keep_running:
             try:
                 task = self.work_queue.get(timeout=THREAD_POLL_TIMEOUT)
-                owner, addr = task
-                self.logger.info('{}: Checking IP {} belonging to {}'.format(self.name, addr, owner))
+                addr = task
+                self.logger.info('{}: Checking IP {}'.format(self.name, addr))
                 if not pingable(addr):
-                    update_record(owner, addr, routable=False)
-                    self.logger.info('{}: IP {} owned by {} not pingable'.format(self.name, addr, owner))
+                    self.writer.add(addr, routable=False)
+                    self.logger.info('{}: IP {} not pingable'.format(self.name, addr))
                 else:
-                    update_record(owner, addr, routable=True)
+                    self.writer.add(addr, routable=True)
             except queue.Empty:
                 # timeout so we can terminate if needed
                 # without the timeout, we'll be stuck in this while loop forever
                 self.logger.debug('Nothing in queue, looping back')
+                self.writer.flush_if_stale()
             except Exception as doh:
                 self.keep_running = False
                 self.logger.error('{} crashing'.format(self.name))
@@ -51,6 +74,82 @@ class Worker(threading.Thread):
                 raise doh
 
 
+class IcmpWorker(threading.Thread):
+    """Validates that IP records are routable, like ``Worker``, but probes many
+    addresses at once from one thread, with one ICMP socket (see ``IcmpProber``)
+    instead of a ping process per address.
+
+    The results are handed to the writer on a separate thread, because a
+    flush to the database would otherwise stall every probe in flight.
+
+    :param max_in_flight: The most addresses to probe at once
+    :type max_in_flight: Integer
+    """
+    def __init__(self, tid, logger, work_queue, writer, max_in_flight=1000):
+        super(IcmpWorker, self).__init__()
+        self.keep_running = True
+        self.tid = tid
+        self.work_queue = work_queue
+        self.writer = writer
+        self.logger = logger
+        self.max_in_flight = max_in_flight
+
+    def run(self):
+        """Perform the IP address validation"""
+        self.name = 'IPAM-icmp-worker-{}'.format(self.tid)
+        self.logger.info('{} started'.format(self.name))
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        prober = IcmpProber(iface=PROBE_IFACE)
+        # One thread, so the results reach the writer in order
+        self._write_pool = ThreadPoolExecutor(max_workers=1)
+        try:
+            prober.open(loop)
+            loop.run_until_complete(self._probe_all(loop, prober))
+        except Exception as doh:
+            self.keep_running = False
+            self.logger.error('{} crashing'.format(self.name))
+            self.logger.exception(doh)
+            raise doh
+        finally:
+            prober.close()
+            self._write_pool.shutdown(wait=True)
+            loop.close()
+
+    async def _probe_all(self, loop, prober):
+        """Start a probe for every task in the work queue, until told to stop"""
+        in_flight = set()
+        while self.keep_running:
+            done = set(x for x in in_flight if x.done())
+            in_flight -= done
+            for probe in done:
+                probe.result() # raises whatever the probe did
+            if len(in_flight) >= self.max_in_flight:
+                await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                continue
+            try:
+                task = self.work_queue.get_nowait()
+            except queue.Empty:
+                try:
+                    # the probes in flight keep running while this thread waits
+                    task = await loop.run_in_executor(None, self.work_queue.get, True, THREAD_POLL_TIMEOUT)
+                except queue.Empty:
+                    self.logger.debug('Nothing in queue, looping back')
+                    await loop.run_in_executor(self._write_pool, self.writer.flush_if_stale)
+                    continue
+            in_flight.add(asyncio.ensure_future(self._probe(loop, prober, task)))
+        if in_flight:
+            await asyncio.wait(in_flight)
+
+    async def _probe(self, loop, prober, addr):
+        """Probe one address, and record the result"""
+        self.logger.info('{}: Checking IP {}'.format(self.name, addr))
+        routable = await prober.probe(addr)
+        if not routable:
+            self.logger.info('{}: IP {} not pingable'.format(self.name, addr))
+        await loop.run_in_executor(self._write_pool, functools.partial(self.writer.add, addr, routable=routable))
+
+
 def pingable(addr):
     """Issue a ping command to check if the target address is routable.
 
@@ -68,23 +167,370 @@ def pingable(addr):
     return ok
 
 
-def update_record(owner, addr, routable):
-    """Update the IPAM database to reflect the ability to route to the supplied IP
+class StatusWriter(object):
+    """Collects probe results from the worker threads, and writes them to the
+    IPAM database in batches.
 
-    :Returns: Boolean
+    Results that match the last known state of a record are dropped before they
+    reach the database, and the UPDATE skips rows that already hold the value,
+    so a sweep where nothing changed writes nothing.
 
-    :param owner: The vLab componet that owns a given IP
-    :type owner: String
+    :param logger: An object for logging events.
+    :type logger: logging.Logger
+
+    :param flush_size: Write the batch once it holds this many results
+    :type flush_size: Integer
+
+    :param flush_interval: Write the batch once its oldest result is this many seconds old
+    :type flush_interval: Integer
+
+    :param scheduler: Told of every result, so it can schedule the next probe
+    :type scheduler: ProbeScheduler
+    """
+    def __init__(self, logger, flush_size=FLUSH_SIZE, flush_interval=FLUSH_INTERVAL, scheduler=None):
+        self.logger = logger
+        self.scheduler = scheduler
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.stats = {'results' : 0, 'unchanged' : 0, 'statements' : 0, 'rows_written' : 0}
+        self._lock = threading.Lock()
+        self._known = {}
+        self._pending = {}
+        self._oldest = None
+
+    def set_known(self, known):
+        """Replace the known routable state of every address; the producer calls
+        this each sweep so rows added or changed by the API are noticed.
+
+        :Returns: None
+
+        :param known: Maps each address to the routable value in the database
+        :type known: Dictionary
+        """
+        with self._lock:
+            self._known = known
+
+    def add(self, addr, routable):
+        """Queue a probe result to be written to every record with the address
+
+        :Returns: None
+
+        :param addr: The IPv4 address that was probed
+        :type addr: String
+
+        :param routable: Set to True if the IP can be pinged
+        :type routable: Boolean
+        """
+        if self.scheduler is not None:
+            self.scheduler.record(addr, routable)
+        with self._lock:
+            self.stats['results'] += 1
+            if self._known.get(addr, None) is routable:
+                self.stats['unchanged'] += 1
+                return
+            self._pending[addr] = routable
+            if self._oldest is None:
+                self._oldest = time.time()
+            flush = len(self._pending) >= self.flush_size or self._is_stale()
+        if flush:
+            self.flush()
+
+    def _is_stale(self):
+        """Caller must hold the lock"""
+        return self._oldest is not None and time.time() - self._oldest >= self.flush_interval
+
+    def flush_if_stale(self):
+        """Write the pending results if they've waited ``flush_interval`` seconds
+
+        :Returns: None
+        """
+        with self._lock:
+            stale = self._is_stale()
+        if stale:
+            self.flush()
+
+    def flush(self):
+        """Write all pending results with a single UPDATE statement
+
+        :Returns: Integer - The number of rows changed
+        """
+        with self._lock:
+            batch = self._pending
+            self._pending = {}
+            self._oldest = None
+        if not batch:
+            return 0
+        written = update_records(batch)
+        with self._lock:
+            self._known.update(batch)
+            self.stats['statements'] += 1
+            self.stats['rows_written'] += written
+        self.logger.info('Wrote {} probe results; {} records changed'.format(len(batch), written))
+        return written
+
+
+class ProbeScheduler(object):
+    """Decides when each IP address is probed next. Every address has its own
+    interval: it starts at ``min_interval``, grows by ``backoff`` each time a
+    probe finds the same result as the last one (up to ``max_interval``), and
+    drops back to ``min_interval`` when the result changes. So stable addresses
+    are probed rarely, and new or flapping ones often.
+
+    The addresses are kept in a heap, by when their next probe is due. Thread-safe;
+    the producer pops due addresses while the workers record results.
+
+    :param min_interval: The fewest seconds between probes of an address
+    :type min_interval: Integer
+
+    :param max_interval: The most seconds between probes of an address
+    :type max_interval: Integer
+
+    :param backoff: What the interval is multiplied by after an unchanged result
+    :type backoff: Float
+    """
+    def __init__(self, min_interval=60, max_interval=1800, backoff=2.0):
+        if not 0 < min_interval <= max_interval:
+            raise ValueError('Need 0 < min_interval <= max_interval, got {} and {}'.format(min_interval, max_interval))
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.stats = {'probes' : 0, 'backed_off' : 0, 'tightened' : 0, 'saved' : 0.0, 'max_lag' : 0.0}
+        self._lock = threading.Lock()
+        self._heap = [] # (due, key); an entry is stale if it doesn't match _due
+        self._due = {} # key -> when its next probe is due, or None while it's being probed
+        self._interval = {}
+        self._last = {} # key -> the last routable value found
+
+    def __len__(self):
+        return len(self._interval)
+
+    def _schedule(self, key, due):
+        """Caller must hold the lock"""
+        self._due[key] = due
+        heapq.heappush(self._heap, (due, key))
+
+    def sync(self, known, now=None):
+        """Start tracking new addresses, and forget those no record has anymore
+
+        :Returns: None
+
+        :param known: Maps each address to the routable value in the database
+        :type known: Dictionary
+
+        :param now: The current time, in seconds since the epoch
+        :type now: Float
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            for key in list(self._interval.keys()):
+                if key not in known:
+                    del self._interval[key]
+                    del self._due[key]
+                    self._last.pop(key, None)
+            for key, routable in known.items():
+                if key not in self._interval:
+                    self._interval[key] = self.min_interval
+                    self._last[key] = routable
+                    self._schedule(key, now)
+                elif routable is None and self._due[key] is not None:
+                    # i.e. another row with the address was added
+                    self._interval[key] = self.min_interval
+                    self._schedule(key, now)
+
+    def pop_due(self, now=None, limit=None):
+        """Take the addresses whose probe is due, most overdue first; they're not
+        due again until their result is recorded
+
+        :Returns: List - The addresses to probe
+
+        :param now: The current time, in seconds since the epoch
+        :type now: Float
+
+        :param limit: The most addresses to take; the rest stay due
+        :type limit: Integer
+        """
+        now = time.time() if now is None else now
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now and (limit is None or len(due) < limit):
+                when, key = heapq.heappop(self._heap)
+                if self._due.get(key) != when:
+                    continue # rescheduled or deleted since
+                self._due[key] = None
+                due.append(key)
+                self.stats['max_lag'] = max(self.stats['max_lag'], now - when)
+            self.stats['probes'] += len(due)
+        return due
+
+    def next_due(self):
+        """When the next probe is due
+
+        :Returns: Float, or None if no probe is scheduled
+        """
+        with self._lock:
+            while self._heap and self._due.get(self._heap[0][1]) != self._heap[0][0]:
+                heapq.heappop(self._heap)
+            if self._heap:
+                return self._heap[0][0]
+            return None
+
+    def record(self, key, routable, now=None):
+        """Schedule the next probe of an address, based on the result of the last one
+
+        :Returns: None
+
+        :param key: The address
+        :type key: String
+
+        :param routable: Set to True if the IP can be pinged
+        :type routable: Boolean
+
+        :param now: The current time, in seconds since the epoch
+        :type now: Float
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            if key not in self._interval:
+                return # deleted while it was probed
+            if self._last[key] is routable:
+                interval = min(self.max_interval, self._interval[key] * self.backoff)
+                self.stats['backed_off'] += 1
+            else:
+                interval = self.min_interval
+                self.stats['tightened'] += 1
+            self._interval[key] = interval
+            self._last[key] = routable
+            # A sweep every LOOP_INTERVAL would probe it interval / LOOP_INTERVAL times before then
+            self.stats['saved'] += interval / LOOP_INTERVAL - 1
+            self._schedule(key, now + interval)
+
+
+class WorkQueue(queue.Queue):
+    """The queue the worker threads pull addresses to probe from. An address that's
+    already queued isn't queued again, and the queue holds at most ``maxsize``
+    addresses, so a producer that outpaces the workers waits (see ``wait_for_room``)
+    instead of growing a backlog.
+
+    :param maxsize: The most addresses to hold
+    :type maxsize: Integer
+    """
+    def __init__(self, maxsize=2000):
+        super(WorkQueue, self).__init__(maxsize)
+        self.stats = {'coalesced' : 0, 'max_depth' : 0, 'waited' : 0.0}
+
+    def _init(self, maxsize):
+        self.queue = collections.deque()
+        self._queued = set()
+
+    def _put(self, item):
+        self.queue.append(item)
+        self._queued.add(item)
+        self.stats['max_depth'] = max(self.stats['max_depth'], len(self.queue))
+
+    def _get(self):
+        item = self.queue.popleft()
+        self._queued.discard(item)
+        return item
+
+    def put(self, item, block=True, timeout=None):
+        """Queue an address, unless it's already queued. Like ``queue.Queue.put``,
+        waits for room if the queue is full.
+
+        :Returns: Boolean - False if the address was already queued
+
+        :Raises: queue.Full (if there's no room within the timeout, or without blocking)
+        """
+        with self.not_full:
+            start = time.time()
+            while True:
+                if item in self._queued:
+                    self.stats['coalesced'] += 1
+                    return False
+                if not self._qsize() >= self.maxsize > 0:
+                    break
+                remaining = None if timeout is None else timeout - (time.time() - start)
+                if not block or (remaining is not None and remaining <= 0):
+                    raise queue.Full
+                self.not_full.wait(remaining)
+            self.stats['waited'] += time.time() - start
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+            return True
+
+    def room(self):
+        """How many more addresses fit
+
+        :Returns: Integer, or None if the queue is unbounded
+        """
+        with self.mutex:
+            if self.maxsize <= 0:
+                return None
+            return max(0, self.maxsize - self._qsize())
+
+    def wait_for_room(self, timeout=None):
+        """Block until an address fits, i.e. a worker took one
+
+        :Returns: Boolean - False if the timeout passed first
+
+        :param timeout: The most seconds to wait
+        :type timeout: Float
+        """
+        start = time.time()
+        with self.not_full:
+            room = self.not_full.wait_for(lambda: not self._qsize() >= self.maxsize > 0, timeout)
+        self.stats['waited'] += time.time() - start
+        return room
+
+
+def reachable_neighbours(iface=PROBE_IFACE):
+    """The addresses the kernel has confirmed reachable on an interface in the last
+    half minute or so (the REACHABLE neighbour state), because they replied to ARP
+    or acknowledged traffic. They're routable, without a probe.
+
+    :Returns: Set
+
+    :Raises: CliError (if the neighbour table can't be read)
+
+    :param iface: The network interface the addresses are on
+    :type iface: String
+    """
+    result = shell.run_cmd(NEIGH_SYNTAX.format(iface))
+    return set(line.split()[0] for line in result.stdout.splitlines() if line.strip())
 
-    :param addr: The IPv4 address that is not ping-able
-    :type addr: String
 
-    :param routable: Set to True if the IP can be pinged
-    :type routable: Boolean
+def update_records(results):
+    """Update the IPAM database to reflect the ability to route to many IPs. Every
+    record with a given address is updated, but only rows whose routable value
+    actually changes are written.
+
+    :Returns: Integer - The number of rows changed
+
+    :param results: Maps each address to the routable value to record
+    :type results: Dictionary
     """
-    sql = "UPDATE ipam SET routable={} WHERE target_name LIKE (%s) and target_addr LIKE (%s);".format(routable).lower()
+    addrs = list(results.keys())
+    states = [results[addr] for addr in addrs]
     with Database() as db:
-        db.execute(sql, params=(owner, addr))
+        changed = db.execute_prepared(UPDATE_ROUTABLE, params=(addrs, states))
+    return len(changed)
+
+
+def known_states(records):
+    """Map each address to its routable value. If the rows for an address
+    disagree, the value is None so the next probe result is always written.
+
+    :Returns: Dictionary
+
+    :param records: The (target_addr, routable, row count) rows of ``SELECT_ADDRS``
+    :type records: List
+    """
+    known = {}
+    for addr, routable, _ in records:
+        if addr in known and known[addr] is not routable:
+            routable = None
+        known[addr] = routable
+    return known
 
 
 def workers_ok(worker_threads):
@@ -114,8 +560,8 @@ def drain_queue(work_queue):
         work_queue.get()
 
 
-def do_work(worker_threads, work_queue, logger):
-    """Produce tasks and add it to worker's Queue on a regular interval.
+def do_work(worker_threads, work_queue, writer, logger, scheduler=None):
+    """Produce tasks and add it to worker's Queue when they're due (see ``ProbeScheduler``).
 
     When/if this function terminates, the entire program must terminate.
 
@@ -125,20 +571,66 @@ def do_work(worker_threads, work_queue, logger):
     :type worker_threads: List
 
     :param work_queue: How the worker threads pull tasks from the producer thread.
-    :type work_queue: queue.Queue
+    :type work_queue: WorkQueue
+
+    :param writer: Batches the probe results into the IPAM database
+    :type writer: StatusWriter
 
     :param logger: An object for logging events.
     :type logger: logging.Logger
+
+    :param scheduler: Decides when each address is probed. Default is one with the
+                      VLAB_WORKER_MIN_INTERVAL, VLAB_WORKER_MAX_INTERVAL and
+                      VLAB_WORKER_BACKOFF settings, which ``writer`` is told to use
+    :type scheduler: ProbeScheduler
     """
+    if scheduler is None:
+        scheduler = ProbeScheduler(const.VLAB_WORKER_MIN_INTERVAL, const.VLAB_WORKER_MAX_INTERVAL,
+                                   const.VLAB_WORKER_BACKOFF)
+        writer.scheduler = scheduler
     keep_running = True
+    refreshed = None
+    neighbours, neighbours_read = set(), None
+    passive = {'reads' : 0, 'resolved' : 0, 'probed' : 0}
     while keep_running:
-        start_time = time.time()
-        logger.info('Looking up IP records')
-        with Database() as db:
-            records = db.execute("SELECT DISTINCT target_name, target_addr FROM ipam;")
-            logger.info('Found {} IP records to check'.format(len(records)))
-            for record in records:
-                work_queue.put(record)
+        now = time.time()
+        if refreshed is None or now - refreshed >= LOOP_INTERVAL:
+            refreshed = now
+            logger.info('Looking up IP records')
+            with Database() as db:
+                records = db.execute(SELECT_ADDRS)
+            known = known_states(records)
+            writer.set_known(known)
+            scheduler.sync(known, now)
+            logger.info('Found {} IP addresses to check, in {} records'.format(len(known), sum(x[2] for x in records)))
+            logger.info('Probes so far: {probes}, about {saved:.0f} fewer than a sweep every {0}s'.format(LOOP_INTERVAL,
+                                                                                                         **scheduler.stats))
+            next_due = scheduler.next_due()
+            lag = max(0, now - next_due) if next_due is not None else 0
+            logger.info('Work queue: {} queued (most {max_depth}), {coalesced} coalesced, {waited:.0f}s waiting for '
+                        'room; probes {:.0f}s behind schedule (most {:.0f}s)'.format(work_queue.qsize(), lag,
+                                                                                    scheduler.stats['max_lag'],
+                                                                                    **work_queue.stats))
+            logger.info('Neighbour table: read {reads} times, {resolved} addresses found reachable without a probe, '
+                        '{probed} probed'.format(**passive))
+        # Only take what fits; the rest stay due, in order, until the workers catch up
+        due = scheduler.pop_due(now, limit=work_queue.room())
+        if due and (neighbours_read is None or now - neighbours_read >= SCHEDULE_TICK):
+            # One read of the neighbour table answers for every address that's REACHABLE
+            neighbours_read = now
+            passive['reads'] += 1
+            try:
+                neighbours = reachable_neighbours()
+            except shell.CliError as doh:
+                logger.warning('Unable to read the neighbour table, probing every address: {}'.format(doh))
+                neighbours = set()
+        for addr in due:
+            if addr in neighbours:
+                passive['resolved'] += 1
+                writer.add(addr, routable=True)
+            else:
+                passive['probed'] += 1
+                work_queue.put(addr)
 
         if not workers_ok(worker_threads):
             logger.error('Worker failure detected. Draining work queue in order to terminate')
@@ -146,8 +638,16 @@ def do_work(worker_threads, work_queue, logger):
             keep_running = False
             break
 
-        interval_delta = max(0, LOOP_INTERVAL - (time.time() - start_time))
-        time.sleep(interval_delta)
+        wake = refreshed + LOOP_INTERVAL
+        next_due = scheduler.next_due()
+        if next_due is not None and next_due <= time.time():
+            # i.e. the queue is full
+            work_queue.wait_for_room(timeout=SCHEDULE_TICK)
+            continue
+        elif next_due is not None:
+            wake = min(wake, next_due)
+        # Results recorded while sleeping can schedule probes sooner, so don't sleep for long
+        time.sleep(min(SCHEDULE_TICK, max(0, wake - time.time())))
     logger.error('Terminating remaining worker threads')
     terminate_workers(worker_threads)
 
@@ -168,32 +668,56 @@ def terminate_workers(worker_threads):
         worker_thread.join(timeout=THREAD_POLL_TIMEOUT * 2)
 
 
-def make_workers(work_queue, logger):
+def make_workers(work_queue, writer, logger, prober='ping'):
     """Create all the worker threads that perform the literal address checking
 
     :Returns: List
 
+    :Raises: ValueError (if the prober is unknown)
+
     :param work_queue: How the worker threads pull tasks from the producer thread.
     :type work_queue: queue.Queue
+
+    :param writer: Batches the probe results into the IPAM database
+    :type writer: StatusWriter
+
+    :param prober: 'ping' for THREAD_COUNT threads that each run ``/bin/ping``,
+                   or 'icmp' for one thread that shares an ICMP socket between
+                   up to VLAB_WORKER_MAX_IN_FLIGHT probes
+    :type prober: String
     """
+    if prober == 'icmp':
+        t = IcmpWorker(tid=0, logger=logger, work_queue=work_queue, writer=writer,
+                       max_in_flight=const.VLAB_WORKER_MAX_IN_FLIGHT)
+        t.start()
+        return [t]
+    elif prober != 'ping':
+        raise ValueError('Unknown prober: {}'.format(prober))
     worker_threads = []
     for thread_id in range(THREAD_COUNT):
-        t = Worker(tid=thread_id, logger=logger, work_queue=work_queue)
+        t = Worker(tid=thread_id, logger=logger, work_queue=work_queue, writer=writer)
         t.start()
         worker_threads.append(t)
     return worker_threads
 
 
-def main():
-    """Entry point logic for validating IP records"""
-    work_queue = queue.Queue()
+def main(prober=None):
+    """Entry point logic for validating IP records
+
+    :param prober: How to probe the addresses; 'ping' or 'icmp'. Default is VLAB_WORKER_PROBER
+    :type prober: String
+    """
+    prober = prober or const.VLAB_WORKER_PROBER
+    work_queue = WorkQueue(const.VLAB_WORKER_QUEUE_SIZE)
     logger = get_logger(name=__name__, log_file=LOG_FILE)
     logger.info('IPAM Address Probe Starting')
-    logger.info('Starting {} worker threads'.format(THREAD_COUNT))
-    worker_threads = make_workers(work_queue, logger)
+    writer = StatusWriter(logger)
+    logger.info('Starting {} worker threads'.format(1 if prober == 'icmp' else THREAD_COUNT))
+    worker_threads = make_workers(work_queue, writer, logger, prober=prober)
     logger.info('Processing IP address records')
     # do_work blocks
-    do_work(worker_threads, work_queue, logger)
+    do_work(worker_threads, work_queue, writer, logger)
+    writer.flush()
     logger.info('IPAM Addres Probe terminating')
 
 
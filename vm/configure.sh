@@ -207,6 +207,9 @@ setup_webapp () {
   echo "Installing IPAM software"
   # This function installs the RESTful API for managaing the vLab Firewall
   pip3 --trusted-host pypi.org --trusted-host files.python.org install vlab-ipam-api
+  # The API runs its firewall commands via this helper (see VLAB_FW_HELPER in vlab-ipam.service)
+  ln -s /usr/local/lib/python3.6/dist-packages/vlab_ipam_api/vlab-firewall-helper.service /etc/systemd/system/vlab-firewall-helper.service
+  systemctl enable vlab-firewall-helper
   ln -s /usr/local/lib/python3.6/dist-packages/vlab_ipam_api/vlab-ipam.service /etc/systemd/system/vlab-ipam.service
   systemctl enable vlab-ipam
   ln -s /usr/local/lib/python3.6/dist-packages/vlab_ipam_api/vlab-worker.service /etc/systemd/system/vlab-worker.service